@@ -0,0 +1,232 @@
+"""
+Backup store - incremental, deduplicated backups
+
+A backup is a manifest (BACKUP_DIR/manifests/<UTC time>.json) that lists the
+exported files (scores, users, duels, chat shards, scores.pack), each as its
+SHA-256 and the list of its chunks. Chunks are stored once, by hash, in
+BACKUP_DIR/objects, zlib-compressed: a backup only writes the chunks that
+no earlier backup has, and a file identical to the previous backup's is not
+even chunked again.
+
+Chunk boundaries depend on the content (a line whose CRC hits CHUNK_MASK
+ends a chunk), so a change in one player's entry only changes the chunk
+around it, even when it shifts everything after it.
+
+Old backups are thinned out by a tiered policy (the newest backup of each
+of the last BACKUP_KEEP_HOURLY hours, BACKUP_KEEP_DAILY days and
+BACKUP_KEEP_WEEKLY weeks) and chunks no manifest uses any more are deleted.
+"""
+import glob
+import hashlib
+import json
+import os
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set
+from config import BACKUP_DIR, BACKUP_KEEP_HOURLY, BACKUP_KEEP_DAILY, BACKUP_KEEP_WEEKLY
+
+# ~64 KB chunks on indented JSON (a boundary every ~2048 lines), cut at
+# CHUNK_MAX when there are no lines to cut at
+CHUNK_MIN = 16 * 1024
+CHUNK_MAX = 256 * 1024
+CHUNK_MASK = 0x7FF
+
+_ID_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+
+def split_chunks(data: bytes) -> List[bytes]:
+    """Cut ``data`` into content-defined chunks (concatenating them gives ``data`` back)"""
+    chunks: List[bytes] = []
+    current: List[bytes] = []
+    size = 0
+    for line in data.splitlines(keepends=True):
+        while len(line) > CHUNK_MAX - size:
+            # no line break for too long: cut at the maximum size
+            cut = CHUNK_MAX - size
+            current.append(line[:cut])
+            chunks.append(b"".join(current))
+            current, size, line = [], 0, line[cut:]
+        current.append(line)
+        size += len(line)
+        if size >= CHUNK_MIN and zlib.crc32(line) & CHUNK_MASK == 0:
+            chunks.append(b"".join(current))
+            current, size = [], 0
+    if current:
+        chunks.append(b"".join(current))
+    return chunks
+
+
+def backup_time(backup_id: str) -> datetime:
+    """When a backup was taken, from its id"""
+    return datetime.strptime(backup_id[:19], _ID_FORMAT).replace(tzinfo=timezone.utc)
+
+
+class BackupStore:
+    """Manifests and content-addressed chunks under one directory"""
+
+    def __init__(self, root: str = BACKUP_DIR):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.manifests_dir = os.path.join(root, "manifests")
+
+    # ----- paths -----
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _manifest_path(self, backup_id: str) -> str:
+        return os.path.join(self.manifests_dir, f"{backup_id}.json")
+
+    # ----- writing -----
+
+    def _put_chunk(self, chunk: bytes) -> tuple:
+        """Store a chunk unless present; returns (digest, bytes written)"""
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        packed = zlib.compress(chunk, 6)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(packed)
+        os.replace(tmp_path, path)
+        return digest, len(packed)
+
+    def create(self, files: Dict[str, bytes], now: Optional[datetime] = None) -> str:
+        """Store a backup of ``files`` (name -> content); returns its id"""
+        now = now or datetime.now(timezone.utc)
+        previous = self.latest()
+        previous_files = self.load_manifest(previous)["files"] if previous else {}
+        entries: Dict[str, Any] = {}
+        written = 0
+        for name, data in files.items():
+            digest = hashlib.sha256(data).hexdigest()
+            known = previous_files.get(name)
+            if known and known["sha256"] == digest:
+                entries[name] = known  # unchanged since the last backup
+                continue
+            chunks = []
+            for chunk in split_chunks(data):
+                chunk_digest, size = self._put_chunk(chunk)
+                chunks.append(chunk_digest)
+                written += size
+            entries[name] = {"sha256": digest, "size": len(data), "chunks": chunks}
+
+        backup_id = now.strftime(_ID_FORMAT)
+        suffix = 0
+        while os.path.exists(self._manifest_path(backup_id)):
+            suffix += 1
+            backup_id = f"{now.strftime(_ID_FORMAT)}.{suffix}"
+        manifest = {"id": backup_id, "created": now.isoformat(), "written": written, "files": entries}
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        path = self._manifest_path(backup_id)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+        os.replace(f"{path}.tmp", path)
+        return backup_id
+
+    # ----- reading -----
+
+    def list(self) -> List[str]:
+        """Backup ids, oldest first"""
+        paths = glob.glob(os.path.join(self.manifests_dir, "*.json"))
+        return sorted(os.path.basename(p)[:-len(".json")] for p in paths)
+
+    def latest(self) -> Optional[str]:
+        backups = self.list()
+        return backups[-1] if backups else None
+
+    def at(self, when: datetime) -> Optional[str]:
+        """The newest backup taken at or before ``when``"""
+        found = None
+        for backup_id in self.list():
+            if backup_time(backup_id) > when:
+                break
+            found = backup_id
+        return found
+
+    def load_manifest(self, backup_id: str) -> Dict[str, Any]:
+        with open(self._manifest_path(backup_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def read_file(self, entry: Dict[str, Any]) -> bytes:
+        """One file of a manifest, checked against its hash"""
+        parts = []
+        for digest in entry["chunks"]:
+            with open(self._object_path(digest), "rb") as f:
+                parts.append(zlib.decompress(f.read()))
+        data = b"".join(parts)
+        if hashlib.sha256(data).hexdigest() != entry["sha256"]:
+            raise ValueError("checksum mismatch")
+        return data
+
+    def materialize(self, backup_id: str, names: Optional[Set[str]] = None) -> Dict[str, bytes]:
+        """The files of a backup (only ``names``, if given)"""
+        files = {}
+        for name, entry in self.load_manifest(backup_id)["files"].items():
+            if names is None or name in names:
+                try:
+                    files[name] = self.read_file(entry)
+                except (OSError, ValueError, zlib.error) as e:
+                    raise ValueError(f"{name} in backup {backup_id} is damaged: {e}") from e
+        return files
+
+    def usage(self) -> int:
+        """Bytes taken by the stored chunks"""
+        return sum(os.path.getsize(p) for p in glob.glob(os.path.join(self.objects_dir, "*", "*")))
+
+    # ----- retention -----
+
+    def keep(self, backup_ids: List[str]) -> Set[str]:
+        """Backups the tiered policy keeps: the newest of each of the last
+        hours, days and weeks that have one, and always the latest"""
+        kept: Set[str] = set(backup_ids[-1:])
+        tiers = (
+            (BACKUP_KEEP_HOURLY, lambda t: t.strftime("%Y-%m-%d %H")),
+            (BACKUP_KEEP_DAILY, lambda t: t.strftime("%Y-%m-%d")),
+            (BACKUP_KEEP_WEEKLY, lambda t: t.isocalendar()[:2]),
+        )
+        for limit, bucket in tiers:
+            seen = set()
+            for backup_id in reversed(backup_ids):
+                key = bucket(backup_time(backup_id))
+                if key in seen:
+                    continue
+                if len(seen) == limit:
+                    break
+                seen.add(key)
+                kept.add(backup_id)
+        return kept
+
+    def prune(self) -> tuple:
+        """Drop the backups the policy does not keep and the chunks only
+        they used; returns (backups removed, chunks removed)"""
+        backup_ids = self.list()
+        kept = self.keep(backup_ids)
+        removed = [b for b in backup_ids if b not in kept]
+        for backup_id in removed:
+            os.remove(self._manifest_path(backup_id))
+        if not removed:
+            return 0, 0
+        live: Set[str] = set()
+        for backup_id in kept:
+            for entry in self.load_manifest(backup_id)["files"].values():
+                live.update(entry["chunks"])
+        swept = 0
+        for path in glob.glob(os.path.join(self.objects_dir, "*", "*")):
+            if os.path.basename(path) not in live:
+                os.remove(path)
+                swept += 1
+        return len(removed), swept
+
+
+_store: Optional[BackupStore] = None
+
+
+def get_backup_store() -> BackupStore:
+    """Return the process-wide backup store"""
+    global _store
+    if _store is None:
+        _store = BackupStore()
+    return _store
@@ -0,0 +1,358 @@
+"""
+Benchmark - offline load generator for the dice pipeline
+
+Drives handle_dice, the /top* commands and handle_duel_turn with synthetic
+updates (no network, no Telegram) against a seeded dataset in a scratch
+directory, for a sweep of dataset sizes, and writes a JSON report:
+
+    python benchmark.py                                  # 1k, 10k, 100k users
+    python benchmark.py --sizes 1000,1000000 --rolls 20000 --backend binary
+    python benchmark.py --baseline old_report.json       # exit 1 on regressions
+
+Per size: p50/p99 latency of each handler, rolls per second, bytes written
+to disk per roll (write syscalls, /proc/self/io) and resident memory.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+
+import game_state
+import storage
+from config import STORAGE_BACKEND
+from events import get_event_log, flush_events
+from outbox import flush_replies, reset_outbox
+from scorepack import synthetic_scores
+from state_journal import get_state_journal
+from storage_backends import create_backend
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+REPORT_FILE = "benchmark_report.json"
+
+# Metrics compared against a baseline report: (section, metric)
+COMPARED_METRICS = [
+    ("dice", "p99_ms"),
+    ("dice", "bytes_written_per_roll"),
+    ("duel_turn", "p99_ms"),
+    ("top", "p99_ms"),
+    ("memory", "rss_mb"),
+]
+
+# synthetic_scores numbers its players from here
+FIRST_USER_ID = 100000000
+
+
+# ----- synthetic updates -----
+
+async def _noop(*args: Any, **kwargs: Any) -> None:
+    return None
+
+
+def make_update(user_id: int, name: str, chat_id: int, dice_value: Optional[int] = None,
+                chat_type: str = "supergroup", message_id: int = 1) -> SimpleNamespace:
+    """Update with the attributes the handlers read, replies discarded"""
+    message = SimpleNamespace(
+        chat_id=chat_id,
+        chat=SimpleNamespace(id=chat_id, type=chat_type),
+        from_user=SimpleNamespace(id=user_id, first_name=name, username=None, is_bot=False),
+        dice=SimpleNamespace(emoji="🎰", value=dice_value) if dice_value is not None else None,
+        message_id=message_id,
+        edit_date=None,
+        forward_from=None,
+        forward_from_chat=None,
+        via_bot=None,
+        reply_to_message=None,
+        reply_text=_noop,
+        reply_photo=_noop,
+    )
+    return SimpleNamespace(message=message, effective_chat=message.chat, effective_user=message.from_user)
+
+
+# the fake bot has no flood limits: measure the handlers, not Telegram's pacing
+UNTHROTTLED = {"chat_rate": 1e9, "chat_burst": 1e9, "group_rate": 1e9,
+               "group_burst": 1e9, "global_rate": 1e9}
+
+
+def make_context(args: Optional[List[str]] = None) -> SimpleNamespace:
+    bot = SimpleNamespace(send_message=_noop, delete_message=_noop, send_photo=_noop,
+                          send_dice=_noop)
+    return SimpleNamespace(bot=bot, args=list(args or []))
+
+
+# ----- measurements -----
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Latency percentiles in milliseconds"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "p50_ms": pct(0.50),
+        "p99_ms": pct(0.99),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def bytes_written() -> Optional[int]:
+    """Bytes this process passed to write() so far (Linux only)"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb() -> float:
+    """Current resident memory (peak where /proc is not available)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+# ----- phases -----
+
+async def bench_rolls(rolls: int, users: int, active_users: int, chats: int,
+                      concurrency: int, rng: random.Random) -> Dict[str, Any]:
+    """Rolls from ``active_users`` random players spread over ``chats`` chats"""
+    from handlers import handle_dice
+
+    players = rng.sample(range(users), min(active_users, users))
+    latencies: List[float] = []
+
+    async def roll(n: int) -> None:
+        player = rng.choice(players)
+        update = make_update(FIRST_USER_ID + player, f"Giocatore {player}",
+                             -1000 - rng.randrange(chats), rng.randint(1, 64), message_id=n)
+        started = time.perf_counter()
+        await handle_dice(update, make_context())
+        latencies.append(time.perf_counter() - started)
+
+    written = bytes_written()
+    started = time.perf_counter()
+    for first in range(0, rolls, concurrency):
+        await asyncio.gather(*(roll(n) for n in range(first, min(first + concurrency, rolls))))
+    elapsed = time.perf_counter() - started
+
+    # what the rolls cost on disk includes the write-behind flush they caused
+    flush_started = time.perf_counter()
+    flush_events()
+    await storage.flush_scores_async()
+    flush_s = time.perf_counter() - flush_started
+    after = bytes_written()
+
+    result: Dict[str, Any] = summarize(latencies)
+    result.update({
+        "rolls_per_s": rolls / elapsed if elapsed else None,
+        "final_flush_s": flush_s,
+        "bytes_written_per_roll": (after - written) / rolls if written is not None and after is not None else None,
+    })
+    return result
+
+
+async def bench_top(calls: int, chats: int, rng: random.Random) -> Dict[str, Any]:
+    """Every /top* command, group scope and global scope alternated"""
+    import commands_stats
+
+    commands: Dict[str, Callable[..., Awaitable[None]]] = {
+        "top": commands_stats.top_command,
+        "topstreak": commands_stats.topstreak_command,
+        "topsfiga": commands_stats.topsfiga_command,
+        "topcombo": commands_stats.topcombo_command,
+        "topwinrate": commands_stats.topwinrate_command,
+        "topspeed": commands_stats.topspeed_command,
+        "tope": commands_stats.tope_command,
+        "topduelli": commands_stats.topduelli_command,
+    }
+    all_latencies: List[float] = []
+    per_command: Dict[str, Any] = {}
+    for name, command in commands.items():
+        latencies = []
+        for i in range(calls):
+            update = make_update(FIRST_USER_ID, "Giocatore 0", -1000 - rng.randrange(chats))
+            context = make_context(["globale"] if i % 2 else [])
+            started = time.perf_counter()
+            await command(update, context)
+            latencies.append(time.perf_counter() - started)
+        per_command[name] = summarize(latencies)
+        all_latencies.extend(latencies)
+    result: Dict[str, Any] = summarize(all_latencies)
+    result["commands"] = per_command
+    return result
+
+
+def bench_duel_turns(turns: int, users: int, chats: int, rng: random.Random) -> Dict[str, Any]:
+    """handle_duel_turn on ``chats`` duels kept running (a finished one is restarted)"""
+    from commands_gameplay import handle_duel_turn
+
+    def start_duel(chat_id: int) -> None:
+        a, b = rng.sample(range(users), 2)
+        p1, p2 = str(FIRST_USER_ID + a), str(FIRST_USER_ID + b)
+        game_state.ACTIVE_DUELS[chat_id] = {
+            "p1_id": p1, "p2_id": p2,
+            "p1_name": f"Giocatore {a}", "p2_name": f"Giocatore {b}",
+            "current_turn": p1,
+            "score": {p1: 0, p2: 0},
+        }
+
+    duel_chats = [-5000 - i for i in range(chats)]
+    latencies = []
+    finished = 0
+    scores = storage.load_scores()
+    for _ in range(turns):
+        chat_id = rng.choice(duel_chats)
+        if chat_id not in game_state.ACTIVE_DUELS:
+            start_duel(chat_id)
+        duel = game_state.ACTIVE_DUELS[chat_id]
+        user_id = duel["current_turn"]
+        name = duel["p1_name"] if user_id == duel["p1_id"] else duel["p2_name"]
+        started = time.perf_counter()
+        handle_duel_turn(chat_id, user_id, name, scores, rng.random() < 0.4)
+        latencies.append(time.perf_counter() - started)
+        if chat_id not in game_state.ACTIVE_DUELS:
+            finished += 1
+    for chat_id in duel_chats:
+        game_state.ACTIVE_DUELS.pop(chat_id, None)
+
+    result: Dict[str, Any] = summarize(latencies)
+    result["duels_finished"] = finished
+    return result
+
+
+async def run_size(users: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Seed ``users`` players in a scratch directory and run every phase"""
+    rng = random.Random(args.seed)
+    home = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix="slotbot-bench-")
+    os.chdir(scratch)
+    backend = create_backend(args.backend)
+    storage.set_backend(backend)
+    reset_outbox(**UNTHROTTLED)
+    game_state.ACTIVE_DUELS.clear()
+    game_state.PENDING_DUELS.clear()
+    game_state.EXPANSION_UNTIL.clear()
+    game_state.DEBUG_MODE = False
+    game_state.SLOT_BLOCKED = False
+    try:
+        started = time.perf_counter()
+        storage.save_scores(synthetic_scores(users, seed=args.seed))
+        await storage.flush_scores_async()
+        seed_s = time.perf_counter() - started
+        rss_seeded = rss_mb()
+        print(f"  {users} utenti generati in {seed_s:.2f}s", flush=True)
+
+        dice = await bench_rolls(args.rolls, users, args.active_users, args.chats, args.concurrency, rng)
+        print(f"  slot: p50 {dice['p50_ms']:.3f}ms p99 {dice['p99_ms']:.3f}ms, "
+              f"{dice['rolls_per_s']:.0f} tiri/s", flush=True)
+        top = await bench_top(args.top_calls, args.chats, rng)
+        print(f"  /top*: p50 {top['p50_ms']:.3f}ms p99 {top['p99_ms']:.3f}ms", flush=True)
+        duel = bench_duel_turns(args.duel_turns, users, args.chats, rng)
+        print(f"  duelli: p50 {duel['p50_ms']:.3f}ms p99 {duel['p99_ms']:.3f}ms", flush=True)
+
+        await flush_replies()
+        flush_events()
+        await storage.flush_scores_async()
+        return {
+            "users": users,
+            "seed_s": seed_s,
+            "dice": dice,
+            "top": top,
+            "duel_turn": duel,
+            "memory": {"rss_mb_seeded": rss_seeded, "rss_mb": rss_mb()},
+        }
+    finally:
+        get_event_log().close()
+        get_state_journal().close()
+        storage.flush_scores()
+        if hasattr(backend, "close"):
+            backend.close()
+        os.chdir(home)
+        if not args.keep:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+def compare_reports(baseline: Dict[str, Any], report: Dict[str, Any], tolerance: float) -> List[str]:
+    """Metrics of ``report`` worse than ``baseline`` by more than ``tolerance``"""
+    previous = {run["users"]: run for run in baseline.get("runs", [])}
+    regressions = []
+    for run in report["runs"]:
+        old = previous.get(run["users"])
+        if old is None:
+            continue
+        for section, metric in COMPARED_METRICS:
+            before = old.get(section, {}).get(metric)
+            after = run.get(section, {}).get(metric)
+            if before and after is not None and after > before * (1 + tolerance):
+                regressions.append(f"{run['users']} utenti, {section}.{metric}: {before:.3f} -> {after:.3f}")
+    return regressions
+
+
+async def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark offline di handle_dice, /top* e duelli")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="utenti nel dataset, separati da virgole (es. 1000,1000000)")
+    parser.add_argument("--rolls", type=int, default=5000)
+    parser.add_argument("--active-users", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--top-calls", type=int, default=50)
+    parser.add_argument("--duel-turns", type=int, default=2000)
+    parser.add_argument("--backend", default=STORAGE_BACKEND, choices=["json", "binary", "sqlite"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default=REPORT_FILE)
+    parser.add_argument("--baseline", help="report precedente da confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--keep", action="store_true", help="non cancellare le cartelle temporanee")
+    args = parser.parse_args(argv)
+
+    report: Dict[str, Any] = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": args.backend,
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "keep")},
+        "runs": [],
+    }
+    for users in (int(s) for s in args.sizes.split(",") if s.strip()):
+        print(f"📊 {users} utenti ({args.backend})", flush=True)
+        report["runs"].append(await run_size(users, args))
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Report scritto in {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_reports(json.load(f), report, args.tolerance)
+        for line in regressions:
+            print(f"  ⚠️ {line}")
+        if regressions:
+            print(f"❌ {len(regressions)} regressioni oltre il {args.tolerance:.0%}")
+            return 1
+        print("✅ Nessuna regressione rispetto al baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
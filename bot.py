@@ -1,6 +1,7 @@
 """
 SlotBot - Main telegram bot application
 """
+import asyncio
 import os
 from telegram.ext import (
     ApplicationBuilder,
@@ -10,10 +11,25 @@ from telegram.ext import (
 )
 
 # Config and constants
-from config import TOKEN, BACKUP_INTERVAL_HOURS
+from config import (
+    TOKEN, BACKUP_INTERVAL_HOURS, BACKUP_SNAPSHOT_MINUTES, CHAT_SHARD_IDLE,
+    WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONNECTIONS, CLUSTER_WORKERS, WINDOWS_SAVE_INTERVAL,
+    ROLL_HISTORY_SAVE_INTERVAL
+)
 
 # Storage auto-recovery
-from storage import auto_import_latest_backup
+from storage import (
+    load_scores, flush_scores, save_leaderboard_snapshot, evict_idle_chats
+)
+from restore import PhaseTimer, startup_restore
+from storage_writer import get_writer
+from events import flush_events
+from state_journal import restore_game_state, get_state_journal
+from deadlines import get_deadline_scheduler
+from outbox import flush_replies
+from windows import get_windowed_stats
+from roll_history import get_roll_history
 
 # Admin commands
 from commands_admin import (
@@ -23,7 +39,8 @@ from commands_admin import (
     exportall_command, importscore_command, importduels_command,
     importusers_command, importall_command, blockslot_command,
     unblockslot_command, helpadmin_command, backupnow_command,
-    listbackups_command, scheduled_backup, test_command, addduel_command,
+    listbackups_command, scheduled_backup, scheduled_incremental_backup, ripristina_command,
+    test_command, addduel_command, ricalcolaelo_command,
     debuginfo_command, resetuser_command, modifyuser_command, 
     datacheck_command, cleanstate_command, daily_recap, highlights_command
 )
@@ -32,7 +49,8 @@ from commands_admin import (
 from commands_stats import (
     score_command, top_command, topstreak_command, topsfiga_command,
     topcombo_command, topwinrate_command, topspeed_command, 
-    topduelli_command, storicosfide_command, tope_command,
+    topduelli_command, storicosfide_command, miesfide_command, h2h_command, tope_command,
+    storico_command,
     # highlights is a generic command but stats area is fine
 )
 
@@ -40,7 +58,7 @@ from commands_stats import (
 from commands_gameplay import (
     sfida_command, espansione_command, benedici_command, 
     maledici_command, invoca_command, sbusta_command, help_command,
-    bestemmia_command
+    bestemmia_command, flush_duel_results
 )
 
 # Easter egg commands
@@ -53,35 +71,102 @@ from commands_minigames import tarocchi_command, lotteria_command, evento_comman
 from handlers import handle_dice
 
 
-def main() -> None:
-    """Start the bot"""
-    # Auto-import latest backup at startup (for Railway auto-recovery)
-    print("🔄 Avvio del bot...", flush=True)
-    auto_import_latest_backup()
-    print("✅ Dati carichi", flush=True)
-    
-    app = ApplicationBuilder().token(TOKEN).build()
+async def scheduled_snapshot(context) -> None:
+    """Record the day in the leaderboard series (written by the storage writer thread)"""
+    await asyncio.wrap_future(save_leaderboard_snapshot())
+
+
+async def scheduled_eviction(context) -> None:
+    """Drop idle chat shards from memory"""
+    evict_idle_chats()
+
+
+async def scheduled_windows_save(context) -> None:
+    """Save the rolling counters of the time-windowed boards"""
+    saved = get_windowed_stats().save()
+    if saved is not None:
+        await asyncio.wrap_future(saved)
+
 
-    # Schedule automated backup every 12 hours (but not on startup)
+async def scheduled_roll_history_save(context) -> None:
+    """Save the players' last rolls"""
+    saved = get_roll_history().save()
+    if saved is not None:
+        await asyncio.wrap_future(saved)
+
+
+async def on_stop(app) -> None:
+    """Record the duels just finished and send the roll replies still
+    waiting for their animation delay"""
+    await flush_duel_results()
+    await flush_replies()
+
+
+async def on_shutdown(app) -> None:
+    """Write any pending score changes and events before the process exits"""
+    flush_events()
+    flush_scores()
+    get_state_journal().close()
+    get_windowed_stats().save()
+    get_roll_history().save()
+    get_writer().shutdown()
+
+
+def schedule_jobs(app, global_jobs: bool = True) -> None:
+    """Backups, recaps, snapshots and shard eviction
+
+    In cluster mode every worker schedules the jobs on its own data, but only
+    one of them (``global_jobs``) sends the backup and the recap to the admin.
+    """
+    # Incremental backup every hour, full copy to the admin every 12 hours
+    # (but not on startup)
     app.job_queue.run_repeating(
-        scheduled_backup, 
-        interval=60 * 60 * BACKUP_INTERVAL_HOURS
+        scheduled_incremental_backup,
+        interval=60 * BACKUP_SNAPSHOT_MINUTES
     )
-    
-    # Schedule daily recap at 22:00 UTC
     from datetime import time
-    app.job_queue.run_daily(
-        daily_recap,
-        time=time(hour=22, minute=0)
-    )
-    
+    if global_jobs:
+        app.job_queue.run_repeating(
+            scheduled_backup,
+            interval=60 * 60 * BACKUP_INTERVAL_HOURS
+        )
+
+        # Schedule daily recap at 22:00 UTC
+        app.job_queue.run_daily(
+            daily_recap,
+            time=time(hour=22, minute=0)
+        )
+
     # Save leaderboard snapshot every day at 23:55 UTC
-    from storage import save_leaderboard_snapshot
     app.job_queue.run_daily(
-        lambda ctx: save_leaderboard_snapshot(),
+        scheduled_snapshot,
         time=time(hour=23, minute=55)
     )
 
+    # Drop idle chat shards from memory (they are flushed first)
+    app.job_queue.run_repeating(
+        scheduled_eviction,
+        interval=CHAT_SHARD_IDLE
+    )
+
+    # Rolling counters of /top oggi|settimana|mese
+    app.job_queue.run_repeating(
+        scheduled_windows_save,
+        interval=WINDOWS_SAVE_INTERVAL
+    )
+
+    # Last rolls behind /storico
+    app.job_queue.run_repeating(
+        scheduled_roll_history_save,
+        interval=ROLL_HISTORY_SAVE_INTERVAL
+    )
+
+    # End domains, lapse challenges and time out idle duels on time
+    get_deadline_scheduler().start(app.job_queue)
+
+
+def register_handlers(app) -> None:
+    """Every command and the dice handler"""
     # ============================================================
     #   STATS COMMANDS
     # ============================================================
@@ -94,6 +179,9 @@ def main() -> None:
     app.add_handler(CommandHandler("topspeed", topspeed_command))
     app.add_handler(CommandHandler("topduelli", topduelli_command))
     app.add_handler(CommandHandler("storicosfide", storicosfide_command))
+    app.add_handler(CommandHandler("storico", storico_command))
+    app.add_handler(CommandHandler("miesfide", miesfide_command))
+    app.add_handler(CommandHandler("h2h", h2h_command))
     app.add_handler(CommandHandler("tope", tope_command))
     app.add_handler(CommandHandler("highlights", highlights_command))
 
@@ -124,6 +212,7 @@ def main() -> None:
     app.add_handler(CommandHandler("debug", debug_command))
     app.add_handler(CommandHandler("test", test_command))
     app.add_handler(CommandHandler("addduel", addduel_command))
+    app.add_handler(CommandHandler("ricalcolaelo", ricalcolaelo_command))
     app.add_handler(CommandHandler("debuginfo", debuginfo_command))
     app.add_handler(CommandHandler("resetuser", resetuser_command))
     app.add_handler(CommandHandler("modifyuser", modifyuser_command))
@@ -158,6 +247,7 @@ def main() -> None:
     app.add_handler(CommandHandler("migrascores", migrascores_command))
     app.add_handler(CommandHandler("backupnow", backupnow_command))
     app.add_handler(CommandHandler("listbackups", listbackups_command))
+    app.add_handler(CommandHandler("ripristina", ripristina_command))
     app.add_handler(CommandHandler("helpadmin", helpadmin_command))
 
     # ============================================================
@@ -165,8 +255,61 @@ def main() -> None:
     # ============================================================
     app.add_handler(MessageHandler(filters.Dice.ALL, handle_dice))
 
-    print("🎰 SlotBot avviato!")
-    app.run_polling()
+
+def run_app(app) -> None:
+    """Receive updates over the webhook when WEBHOOK_URL is set, else by polling"""
+    if WEBHOOK_URL:
+        # Telegram posts each update to us: no polling round trip, and up to
+        # WEBHOOK_MAX_CONNECTIONS requests in flight at once
+        print(f"🎰 SlotBot avviato! (webhook su {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        print("🎰 SlotBot avviato!")
+        app.run_polling()
+
+
+def main() -> None:
+    """Start the bot"""
+    if CLUSTER_WORKERS > 1:
+        # one front process routing chats to worker processes (cluster.py)
+        from cluster import run_cluster
+        run_cluster(CLUSTER_WORKERS)
+        return
+
+    # Restore from the latest backup what the disk lacks (for Railway
+    # auto-recovery), without overwriting newer local data
+    print("🔄 Avvio del bot...", flush=True)
+    timer = PhaseTimer("Avvio")
+    startup_restore(timer=timer)
+    with timer.phase("caricamento dati"):
+        load_scores()
+    with timer.phase("stato di gioco"):
+        # duels, challenges and domains that were live before the restart
+        restore_game_state()
+    print("✅ Dati carichi", flush=True)
+    
+    # Updates are handled concurrently: score mutations are serialized per
+    # user by storage.ScoreStore.user transactions
+    with timer.phase("applicazione"):
+        app = (
+            ApplicationBuilder()
+            .token(TOKEN)
+            .concurrent_updates(True)
+            .post_stop(on_stop)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
+        schedule_jobs(app)
+        register_handlers(app)
+    print(timer.report(), flush=True)
+    run_app(app)
 
 
 if __name__ == "__main__":
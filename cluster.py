@@ -0,0 +1,319 @@
+"""
+Cluster mode - one front process, N worker processes, routed by chat
+
+The front receives every update (webhook or polling, as in bot.main) and
+hands it to worker ``chat_id % N``, so a chat always lands in the same
+process. A worker is a complete bot: the chat's duels, domain expansion and
+score shard live there, in its own data directory (CLUSTER_DIR/worker-<k>).
+
+A player who rolls in chats of different workers has a partial global entry
+in each of them. Workers publish theirs to CLUSTER_DIR/shared every
+CLUSTER_SYNC_INTERVAL seconds and read the others back; merge_partials
+combines them field by field into the view behind /score and the global
+boards (storage.set_global_view), so cross-chat reads lag by at most one
+interval. Admin edits and the daily cooldowns apply to the worker's part.
+
+    CLUSTER_WORKERS=4 python bot.py
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+from collections.abc import Mapping
+from concurrent.futures import Future
+from typing import Any, Dict, Iterable, List, Optional
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+import storage
+from config import (
+    TOKEN, STORAGE_BACKEND, CLUSTER_WORKERS, CLUSTER_DIR, CLUSTER_SYNC_INTERVAL,
+    CURRENT_JSON_VERSION
+)
+from models import USER_FIELDS, UserStats
+from outbox import reset_outbox
+from state_journal import restore_game_state
+from storage_backends import create_backend, write_json_atomic
+from storage_writer import get_writer
+
+# How the partial entries of one player combine into the global one. ELO is
+# the base rating plus every worker's gains and losses, achievements are the
+# union, everything else (name, current streaks, last roll) comes from the
+# part with the latest roll
+SUMMED_FIELDS = (
+    "points", "total_slots", "total_wins", "double", "triple", "quad", "quint",
+    "duel_wins", "duel_losses", "domains_used",
+)
+MAX_FIELDS = (
+    "best_streak", "best_sfiga", "best_speed", "last_slot_bot_ts", "last_duel_bot_ts",
+    "last_tarocchi_ts", "last_lotteria_ts", "last_evento_ts", "last_bestemmia_sfiga",
+)
+ELO_BASE = dict(USER_FIELDS)["elo"]
+
+# Update kinds that carry their chat directly
+_CHAT_UPDATES = (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "my_chat_member", "chat_member", "chat_join_request",
+)
+
+
+def route(chat_id: int, workers: int) -> int:
+    """Index of the worker that owns a chat"""
+    return chat_id % workers
+
+
+def update_chat_id(data: Mapping) -> int:
+    """Chat of an update as Telegram sends it (0 if it has none)"""
+    for kind in _CHAT_UPDATES:
+        if kind in data:
+            return data[kind]["chat"]["id"]
+    query = data.get("callback_query")
+    if query and query.get("message"):
+        return query["message"]["chat"]["id"]
+    # inline queries, poll answers...: keep each user on one worker
+    for value in data.values():
+        if isinstance(value, Mapping) and "from" in value:
+            return value["from"]["id"]
+    return 0
+
+
+def merge_entries(entries: List[Mapping[str, Any]]) -> UserStats:
+    """One player's global entry out of their partial ones"""
+    latest = max(entries, key=lambda e: e.get("last_slot_ts") or 0.0)
+    user = UserStats.from_dict(latest)
+    for field in SUMMED_FIELDS:
+        user[field] = sum(e.get(field) or 0 for e in entries)
+    for field in MAX_FIELDS:
+        user[field] = max(e.get(field) or 0 for e in entries)
+    user.elo = ELO_BASE + sum(e.get("elo", ELO_BASE) - ELO_BASE for e in entries)
+    achievements: List[str] = []
+    for entry in entries:
+        for achievement in entry.get("achievements") or []:
+            if achievement not in achievements:
+                achievements.append(achievement)
+    user.achievements = achievements
+    return user
+
+
+def merge_partials(parts: Iterable[Mapping[str, Any]]) -> Dict[str, Any]:
+    """Global scores dict out of the workers' partial ones"""
+    grouped: Dict[str, List[Mapping[str, Any]]] = {}
+    for part in parts:
+        for user_id, entry in part.items():
+            if not user_id.startswith("_") and isinstance(entry, Mapping):
+                grouped.setdefault(user_id, []).append(entry)
+    merged: Dict[str, Any] = {"_version": CURRENT_JSON_VERSION}
+    for user_id, entries in grouped.items():
+        merged[user_id] = merge_entries(entries)
+    return merged
+
+
+class ClusterNode:
+    """A worker's side of the shared store: publishes the worker's partial
+    scores and users, and serves the merged view of every worker's.
+
+    ``load``/``subscribe``/``version`` make it usable as storage's global view.
+    """
+
+    def __init__(self, index: int, root: str = CLUSTER_DIR):
+        self.index = index
+        self.shared_dir = os.path.join(root, "shared")
+        os.makedirs(self.shared_dir, exist_ok=True)
+        self._parts: Dict[str, tuple] = {}  # path -> (mtime, published data)
+        self._merged: Optional[Dict[str, Any]] = None
+        self._listeners: List[Any] = []
+        self.version = storage.new_version()
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self.shared_dir, f"worker-{index}.json")
+
+    def load(self) -> Dict[str, Any]:
+        if self._merged is None:
+            self.refresh(self._read_others())
+        return self._merged
+
+    def subscribe(self, listener: Any) -> None:
+        self._listeners.append(listener)
+
+    def publish(self) -> Future:
+        """Write this worker's partial scores and users to the shared store"""
+        data = {
+            "scores": storage.snapshot_scores(storage.load_scores()),
+            "users": dict(storage.load_users()),
+        }
+        return get_writer().submit(write_json_atomic, self._path(self.index), data)
+
+    def _read_others(self) -> List[Dict[str, Any]]:
+        own = self._path(self.index)
+        parts = []
+        for name in sorted(os.listdir(self.shared_dir)):
+            path = os.path.join(self.shared_dir, name)
+            if not name.endswith(".json") or path == own:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+                cached = self._parts.get(path)
+                if cached is None or cached[0] != mtime:
+                    with open(path, "r", encoding="utf-8") as f:
+                        cached = self._parts[path] = (mtime, json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Parte del cluster illeggibile ({name}): {e}", flush=True)
+                continue
+            parts.append(cached[1])
+        return parts
+
+    def refresh(self, others: List[Dict[str, Any]]) -> None:
+        """Merge the other workers' published parts with this worker's live scores"""
+        users = storage.load_users()
+        for part in others:
+            for user_id, name in part.get("users", {}).items():
+                users.setdefault(user_id, name)
+        self._merged = merge_partials([storage.load_scores()] + [part.get("scores", {}) for part in others])
+        self.version = storage.new_version()
+        for listener in self._listeners:
+            listener(self._merged, None)
+
+    async def sync(self, context: Any = None) -> None:
+        """Job: publish this worker's part, then rebuild the merged view"""
+        await asyncio.wrap_future(self.publish())
+        self.refresh(await asyncio.to_thread(self._read_others))
+
+
+async def _serve(index: int, root: str, inbox: Any, results: Any, backend: str,
+                 fake_api: bool, sync_interval: float) -> None:
+    storage.set_backend(create_backend(backend))
+    restore_game_state()
+    node = ClusterNode(index, root)
+    storage.set_global_view(node)
+    from bot import on_stop, on_shutdown, register_handlers, schedule_jobs
+    if fake_api:
+        # local runs and tests: no Telegram, no flood limits
+        from benchmark import UNTHROTTLED
+        from loadtest import FakeBotAPI, build_app
+        reset_outbox(**UNTHROTTLED)
+        api = FakeBotAPI()
+        app = build_app(api)
+    else:
+        api = None
+        app = ApplicationBuilder().token(TOKEN).concurrent_updates(True).build()
+        register_handlers(app)
+    # backups to the admin and the daily recap: once per cluster
+    schedule_jobs(app, global_jobs=index == 0)
+    app.job_queue.run_repeating(node.sync, interval=sync_interval)
+
+    loop = asyncio.get_running_loop()
+    handled = 0
+    async with app:
+        await app.start()
+        print(f"🧩 Worker {index} pronto", flush=True)
+        while True:
+            data = await loop.run_in_executor(None, inbox.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+            handled += 1
+        jobs = sorted(job.name for job in app.job_queue.jobs())
+        await app.stop()  # handles everything already queued first
+        # the application runs without run_polling/run_webhook, which would
+        # call the post_stop/post_shutdown hooks
+        await on_stop(app)
+    await storage.flush_scores_async()
+    await asyncio.wrap_future(node.publish())
+    await on_shutdown(app)
+    results.put({"worker": index, "updates": handled, "jobs": jobs,
+                 "api_calls": dict(api.calls) if api else {}})
+
+
+def _worker_main(index: int, root: str, inbox: Any, results: Any, backend: str,
+                 fake_api: bool, sync_interval: float) -> None:
+    """Entry point of a worker process: serve in its own data directory"""
+    workdir = os.path.join(root, f"worker-{index}")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    asyncio.run(_serve(index, root, inbox, results, backend, fake_api, sync_interval))
+
+
+class ClusterFront:
+    """Starts the worker processes and hands them updates by chat"""
+
+    def __init__(self, workers: int = CLUSTER_WORKERS, root: str = CLUSTER_DIR,
+                 backend: str = STORAGE_BACKEND, fake_api: bool = False,
+                 sync_interval: float = CLUSTER_SYNC_INTERVAL):
+        self.workers = workers
+        self.root = os.path.abspath(root)
+        self.backend = backend
+        self.fake_api = fake_api
+        self.sync_interval = sync_interval
+        # updates handed to each worker
+        self.routed = [0] * workers
+        # spawn, not fork: the front's threads and event loop must not be copied
+        self._context = multiprocessing.get_context("spawn")
+        self._inboxes: List[Any] = []
+        self._processes: List[Any] = []
+        self._results: Any = None
+
+    def start(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        self._results = self._context.Queue()
+        for index in range(self.workers):
+            inbox = self._context.Queue()
+            process = self._context.Process(
+                target=_worker_main, name=f"slotbot-worker-{index}", daemon=True,
+                args=(index, self.root, inbox, self._results, self.backend,
+                      self.fake_api, self.sync_interval),
+            )
+            process.start()
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+
+    def dispatch(self, data: Mapping) -> int:
+        """Queue one update (Telegram's JSON) on the worker of its chat"""
+        index = route(update_chat_id(data), self.workers)
+        self._inboxes[index].put(data)
+        self.routed[index] += 1
+        return index
+
+    def stop(self, timeout: float = 60.0) -> List[Dict[str, Any]]:
+        """Let every worker finish the updates it was given and exit;
+        returns their stats (updates handled, Bot API calls)"""
+        for inbox in self._inboxes:
+            inbox.put(None)
+        stats = []
+        for _ in self._processes:
+            try:
+                stats.append(self._results.get(timeout=timeout))
+            except queue.Empty:
+                print("⚠️ Un worker del cluster non ha risposto in tempo", flush=True)
+                break
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._inboxes.clear()
+        self._processes.clear()
+        return sorted(stats, key=lambda s: s["worker"])
+
+
+def run_cluster(workers: int = CLUSTER_WORKERS) -> None:
+    """Front process: receive updates like bot.main and route them to the workers"""
+    from bot import run_app
+
+    front = ClusterFront(workers)
+    front.start()
+
+    async def forward(update: Update, context: Any) -> None:
+        front.dispatch(update.to_dict())
+
+    async def stop_workers(app: Any) -> None:
+        await asyncio.to_thread(front.stop)
+
+    app = ApplicationBuilder().token(TOKEN).concurrent_updates(True).post_stop(stop_workers).build()
+    app.add_handler(TypeHandler(Update, forward))
+    print(f"🧩 Cluster: {workers} worker in {front.root}", flush=True)
+    run_app(app)
+
+
+if __name__ == "__main__":
+    run_cluster()
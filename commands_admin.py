@@ -5,16 +5,28 @@ import json
 import os
 import zipfile
 import io
+from collections.abc import Mapping, MutableMapping
 from datetime import datetime, timezone
+from typing import Callable, List, Optional, Tuple
 from telegram import Update
 from telegram.ext import ContextTypes
-from config import ADMIN_ID, SCORES_FILE, USERS_FILE, DUELS_FILE
+from config import ADMIN_ID, SCORES_FILE, USERS_FILE, DUELS_FILE, ELO_K_FACTOR, CHAT_SCORES_DIR
 from storage import (
     load_scores, save_scores, load_duels, save_duels, 
-    load_users, save_users, migrate_scores, migrate_duels, 
-    migrate_users, create_backup_zip, get_backup_list, 
-    create_export_zip
+    load_users, save_users, migrate_duels, 
+    migrate_users, get_backup_list, append_duel, link_duel_ids,
+    create_backup_async, backup_zip_async, get_legacy_backups, import_json_files_async,
+    create_export_zip_async, export_json_async,
+    flush_scores_async, get_score_store, list_chats, ScoreStore
 )
+from events import log_event
+from outbox import reply, send_text, call
+from state_journal import journal_clear
+from storage_writer import get_writer
+from backup_store import get_backup_store
+from models import migrate_scores, UserStats
+from highlights import get_highlights_engine
+from commands_stats import GLOBAL_SCOPE_ARGS
 
 
 def is_admin(user_id: int) -> bool:
@@ -22,13 +34,39 @@ def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_ID
 
 
+def _score_stores() -> List[ScoreStore]:
+    """The global scores and every chat shard"""
+    return [get_score_store()] + [get_score_store(chat_id) for chat_id in list_chats()]
+
+
+async def edit_user(user_id: str, edit: Callable[[UserStats], None]) -> Tuple[Optional[UserStats], List[int]]:
+    """Apply ``edit`` to a user's global entry, then to their entry in every
+    chat shard, each inside that user's transaction (a roll waiting on the
+    lock can't undo the edit). Returns a copy of the edited global entry
+    (None if the user is unknown) and the chats whose entry was edited."""
+    store = get_score_store()
+    if user_id not in store.load():
+        return None, []
+    async with store.user(user_id) as tx:
+        edit(tx.user)
+        edited = tx.user.copy()
+    chats = []
+    for chat_id in list_chats():
+        shard = get_score_store(chat_id)
+        if user_id in shard.load():
+            async with shard.user(user_id) as tx:
+                edit(tx.user)
+            chats.append(chat_id)
+    return edited, chats
+
+
 async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Toggle debug mode (admin only)"""
     import game_state
     
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     game_state.DEBUG_MODE = not game_state.DEBUG_MODE
 
@@ -37,9 +75,10 @@ async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # when debug activates automatically send current scores
             await exportscore_command(update, context)
         except:
-            await update.message.reply_text("⚠️ Export fallito, ma debug attivo.")
+            await reply(update.message, "⚠️ Export fallito, ma debug attivo.")
 
-        await update.message.reply_text(
+        await reply(
+            update.message,
             "🛠️ *DEBUG MODE ATTIVO*\n"
             "• Solo tu puoi tirare slot (gli altri vengono ignorati)\n"
             "• I failsafe sono disattivati\n"
@@ -48,7 +87,8 @@ async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown"
         )
     else:
-        await update.message.reply_text(
+        await reply(
+            update.message,
             "🛠️ *DEBUG MODE DISATTIVATO*\n"
             "Il bot è tornato alla normalità: tutte le slot vengono di nuovo tracciate e i failsafe ripristinati.",
             parse_mode="Markdown"
@@ -59,64 +99,73 @@ async def migrascores_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Manually migrate scores (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
-
-    scores = load_scores()
-    migrated = migrate_scores(scores)
-    save_scores(migrated)
+        return await reply(update.message, "Non hai il permesso.")
+
+    for store in _score_stores():
+        scores = store.load()
+        for user_id in [k for k, v in scores.items() if not k.startswith("_") and not isinstance(v, UserStats)]:
+            async with store.user(user_id) as tx:
+                migrated = migrate_scores({"_version": scores.get("_version", 1), user_id: tx.user})
+                if user_id in migrated:
+                    tx.scores[user_id] = migrated[user_id]
+                else:
+                    del tx.scores[user_id]  # corrupted entry
 
-    await update.message.reply_text("🔧 Scores migrati alla nuova struttura.")
+    await reply(update.message, "🔧 Scores migrati alla nuova struttura.")
 
 
 async def setpoints_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set user points (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if len(context.args) != 2:
-        return await update.message.reply_text("Uso: /setpoints <user_id> <punti>")
+        return await reply(update.message, "Uso: /setpoints <user_id> <punti>")
 
     target_id = context.args[0]
     try:
         new_points = int(context.args[1])
     except:
-        return await update.message.reply_text("I punti devono essere un numero.")
+        return await reply(update.message, "I punti devono essere un numero.")
 
-    scores = load_scores()
-    if target_id not in scores:
-        return await update.message.reply_text("Utente non trovato.")
+    def set_points(d):
+        d["points"] = new_points
 
-    scores[target_id]["points"] = new_points
-    save_scores(scores)
+    edited, chats = await edit_user(target_id, set_points)
+    if edited is None:
+        return await reply(update.message, "Utente non trovato.")
+    log_event("admin_set", user=target_id, field="points", value=new_points, admin=user.id, chats=chats)
 
-    await update.message.reply_text(f"Punti aggiornati per {scores[target_id]['name']}: {new_points}")
+    await reply(update.message, f"Punti aggiornati per {edited['name']}: {new_points}")
 
 
 async def addpoints_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Add points to user (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if len(context.args) != 2:
-        return await update.message.reply_text("Uso: /addpoints <user_id> <punti>")
+        return await reply(update.message, "Uso: /addpoints <user_id> <punti>")
 
     target_id = context.args[0]
     try:
         add = int(context.args[1])
     except:
-        return await update.message.reply_text("I punti devono essere un numero.")
+        return await reply(update.message, "I punti devono essere un numero.")
 
-    scores = load_scores()
-    if target_id not in scores:
-        return await update.message.reply_text("Utente non trovato.")
+    def add_points(d):
+        d["points"] += add
 
-    scores[target_id]["points"] += add
-    save_scores(scores)
+    edited, chats = await edit_user(target_id, add_points)
+    if edited is None:
+        return await reply(update.message, "Utente non trovato.")
+    log_event("admin_add", user=target_id, field="points", value=add, admin=user.id, chats=chats)
 
-    await update.message.reply_text(
-        f"Aggiunti {add} punti a {scores[target_id]['name']}. Totale: {scores[target_id]['points']}"
+    await reply(
+        update.message,
+        f"Aggiunti {add} punti a {edited['name']}. Totale: {edited['points']}"
     )
 
 
@@ -124,56 +173,58 @@ async def setstreak_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set user streak (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if len(context.args) != 2:
-        return await update.message.reply_text("Uso: /setstreak <user_id> <streak>")
+        return await reply(update.message, "Uso: /setstreak <user_id> <streak>")
 
     target_id = context.args[0]
     try:
         new_streak = int(context.args[1])
     except:
-        return await update.message.reply_text("La streak deve essere un numero.")
-
-    scores = load_scores()
-    if target_id not in scores:
-        return await update.message.reply_text("Utente non trovato.")
+        return await reply(update.message, "La streak deve essere un numero.")
 
-    scores[target_id]["streak"] = new_streak
-    if new_streak > scores[target_id]["best_streak"]:
-        scores[target_id]["best_streak"] = new_streak
+    def set_streak(d):
+        d["streak"] = new_streak
+        if new_streak > d["best_streak"]:
+            d["best_streak"] = new_streak
 
-    save_scores(scores)
+    edited, chats = await edit_user(target_id, set_streak)
+    if edited is None:
+        return await reply(update.message, "Utente non trovato.")
+    log_event("admin_set", user=target_id, field="streak", value=new_streak, raise_best=True,
+              admin=user.id, chats=chats)
 
-    await update.message.reply_text(f"Streak aggiornata per {scores[target_id]['name']}: {new_streak}")
+    await reply(update.message, f"Streak aggiornata per {edited['name']}: {new_streak}")
 
 
 async def setsfiga_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set user sfiga (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if len(context.args) != 2:
-        return await update.message.reply_text("Uso: /setsfiga <user_id> <sfiga>")
+        return await reply(update.message, "Uso: /setsfiga <user_id> <sfiga>")
 
     target_id = context.args[0]
     try:
         new_sfiga = int(context.args[1])
     except:
-        return await update.message.reply_text("La sfiga deve essere un numero.")
-
-    scores = load_scores()
-    if target_id not in scores:
-        return await update.message.reply_text("Utente non trovato.")
+        return await reply(update.message, "La sfiga deve essere un numero.")
 
-    scores[target_id]["sfiga"] = new_sfiga
-    if new_sfiga > scores[target_id]["best_sfiga"]:
-        scores[target_id]["best_sfiga"] = new_sfiga
+    def set_sfiga(d):
+        d["sfiga"] = new_sfiga
+        if new_sfiga > d["best_sfiga"]:
+            d["best_sfiga"] = new_sfiga
 
-    save_scores(scores)
+    edited, chats = await edit_user(target_id, set_sfiga)
+    if edited is None:
+        return await reply(update.message, "Utente non trovato.")
+    log_event("admin_set", user=target_id, field="sfiga", value=new_sfiga, raise_best=True,
+              admin=user.id, chats=chats)
 
-    await update.message.reply_text(f"Sfiga aggiornata per {scores[target_id]['name']}: {new_sfiga}")
+    await reply(update.message, f"Sfiga aggiornata per {edited['name']}: {new_sfiga}")
 
 
 async def exportscore_command(update, context):
@@ -182,15 +233,15 @@ async def exportscore_command(update, context):
         return
 
     try:
-        with open(SCORES_FILE, "rb") as f:
-            await update.message.reply_document(
-                document=f,
-                filename=SCORES_FILE,
-                caption="📤 Ecco *scores.json*",
-                parse_mode="Markdown"
-            )
+        await call(
+            update.message.chat_id, update.message.reply_document,
+            document=io.BytesIO(await export_json_async(SCORES_FILE)),
+            filename=SCORES_FILE,
+            caption="📤 Ecco *scores.json*",
+            parse_mode="Markdown"
+        )
     except:
-        await update.message.reply_text("⚠️ scores.json non trovato.")
+        await reply(update.message, "⚠️ scores.json non trovato.")
 
 
 async def exportduels_command(update, context):
@@ -199,15 +250,15 @@ async def exportduels_command(update, context):
         return
 
     try:
-        with open(DUELS_FILE, "rb") as f:
-            await update.message.reply_document(
-                document=f,
-                filename=DUELS_FILE,
-                caption="📤 Ecco *duels.json*",
-                parse_mode="Markdown"
-            )
+        await call(
+            update.message.chat_id, update.message.reply_document,
+            document=io.BytesIO(await export_json_async(DUELS_FILE)),
+            filename=DUELS_FILE,
+            caption="📤 Ecco *duels.json*",
+            parse_mode="Markdown"
+        )
     except:
-        await update.message.reply_text("⚠️ duels.json non trovato.")
+        await reply(update.message, "⚠️ duels.json non trovato.")
 
 
 async def exportusers_command(update, context):
@@ -216,15 +267,15 @@ async def exportusers_command(update, context):
         return
 
     try:
-        with open(USERS_FILE, "rb") as f:
-            await update.message.reply_document(
-                document=f,
-                filename=USERS_FILE,
-                caption="📤 Ecco *users.json*",
-                parse_mode="Markdown"
-            )
+        await call(
+            update.message.chat_id, update.message.reply_document,
+            document=io.BytesIO(await export_json_async(USERS_FILE)),
+            filename=USERS_FILE,
+            caption="📤 Ecco *users.json*",
+            parse_mode="Markdown"
+        )
     except:
-        await update.message.reply_text("⚠️ users.json non trovato.")
+        await reply(update.message, "⚠️ users.json non trovato.")
 
 
 async def exportall_command(update, context):
@@ -232,9 +283,12 @@ async def exportall_command(update, context):
     if not is_admin(update.message.from_user.id):
         return
 
-    buffer = create_export_zip()
+    # the archive is built from memory; also wait for the disk to match it
+    await flush_scores_async()
+    buffer = await create_export_zip_async()
 
-    await update.message.reply_document(
+    await call(
+        update.message.chat_id, update.message.reply_document,
         document=buffer,
         filename="slotbot_backup.zip",
         caption="📦 Backup completo del bot",
@@ -246,10 +300,11 @@ async def importscore_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Import scores.json (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if not update.message.reply_to_message or not update.message.reply_to_message.document:
-        return await update.message.reply_text(
+        return await reply(
+            update.message,
             "Usa /importscore *rispondendo* a un messaggio che contiene `scores.json`.",
             parse_mode="Markdown"
         )
@@ -262,19 +317,20 @@ async def importscore_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         scores = json.loads(content.decode("utf-8"))
         scores = migrate_scores(scores)
         save_scores(scores)
-        await update.message.reply_text("📥 scores.json importato e migrato.")
+        await reply(update.message, "📥 scores.json importato e migrato.")
     except Exception as e:
-        await update.message.reply_text(f"⚠️ Errore nell'import di scores.json:\n{e}")
+        await reply(update.message, f"⚠️ Errore nell'import di scores.json:\n{e}")
 
 
 async def importduels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Import duels.json (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if not update.message.reply_to_message or not update.message.reply_to_message.document:
-        return await update.message.reply_text(
+        return await reply(
+            update.message,
             "Usa /importduels *rispondendo* a un messaggio che contiene `duels.json`.",
             parse_mode="Markdown"
         )
@@ -287,19 +343,20 @@ async def importduels_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         duels = json.loads(content.decode("utf-8"))
         duels = migrate_duels(duels)
         save_duels(duels)
-        await update.message.reply_text("📥 duels.json importato e migrato.")
+        await reply(update.message, "📥 duels.json importato e migrato.")
     except Exception as e:
-        await update.message.reply_text(f"⚠️ Errore nell'import di duels.json:\n{e}")
+        await reply(update.message, f"⚠️ Errore nell'import di duels.json:\n{e}")
 
 
 async def importusers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Import users.json (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if not update.message.reply_to_message or not update.message.reply_to_message.document:
-        return await update.message.reply_text(
+        return await reply(
+            update.message,
             "Usa /importusers *rispondendo* a un messaggio che contiene `users.json`.",
             parse_mode="Markdown"
         )
@@ -312,19 +369,20 @@ async def importusers_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         users = json.loads(content.decode("utf-8"))
         users = migrate_users(users)
         save_users(users)
-        await update.message.reply_text("📥 users.json importato e migrato.")
+        await reply(update.message, "📥 users.json importato e migrato.")
     except Exception as e:
-        await update.message.reply_text(f"⚠️ Errore nell'import di users.json:\n{e}")
+        await reply(update.message, f"⚠️ Errore nell'import di users.json:\n{e}")
 
 
 async def importall_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Import all JSON from ZIP (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if not update.message.reply_to_message or not update.message.reply_to_message.document:
-        return await update.message.reply_text(
+        return await reply(
+            update.message,
             "Usa /importall *rispondendo* a un file ZIP contenente scores.json, duels.json e users.json.",
             parse_mode="Markdown"
         )
@@ -336,33 +394,22 @@ async def importall_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         z = zipfile.ZipFile(io.BytesIO(content))
     except:
-        return await update.message.reply_text("⚠️ Il file non è uno ZIP valido.")
-
-    # SCORES
+        return await reply(update.message, "⚠️ Il file non è uno ZIP valido.")
+
+    # same path as a backup restore: users before duels, so that legacy
+    # duels can be linked to ids by name, then the per-chat shards
+    files = {
+        name: z.read(name) for name in z.namelist()
+        if name in (SCORES_FILE, DUELS_FILE, USERS_FILE) or name.startswith(f"{CHAT_SCORES_DIR}/")
+    }
+    if not files:
+        return await reply(update.message, "⚠️ Lo ZIP non contiene scores.json, duels.json o users.json.")
     try:
-        scores = json.loads(z.read(SCORES_FILE).decode("utf-8"))
-        scores = migrate_scores(scores)
-        save_scores(scores)
+        await import_json_files_async(files)
     except Exception as e:
-        await update.message.reply_text(f"⚠️ Errore in scores.json:\n{e}")
+        return await reply(update.message, f"⚠️ Errore durante l'import:\n{e}")
 
-    # DUELS
-    try:
-        duels = json.loads(z.read(DUELS_FILE).decode("utf-8"))
-        duels = migrate_duels(duels)
-        save_duels(duels)
-    except Exception as e:
-        await update.message.reply_text(f"⚠️ Errore in duels.json:\n{e}")
-
-    # USERS
-    try:
-        users = json.loads(z.read(USERS_FILE).decode("utf-8"))
-        users = migrate_users(users)
-        save_users(users)
-    except Exception as e:
-        await update.message.reply_text(f"⚠️ Errore in users.json:\n{e}")
-
-    await update.message.reply_text("📥 Import completo eseguito.")
+    await reply(update.message, "📥 Import completo eseguito.")
 
 
 async def blockslot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -371,11 +418,12 @@ async def blockslot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     game_state.SLOT_BLOCKED = True
 
-    await update.message.reply_text(
+    await reply(
+        update.message,
         "⛔ *SLOT TRACKING BLOCCATO*\n"
         "Da questo momento il bot ignorerà *tutte* le slot tirate.\n\n"
         "*DISCLAIMER*: questa funzione è pensata solo per manutenzione o test.\n"
@@ -395,11 +443,12 @@ async def unblockslot_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     game_state.SLOT_BLOCKED = False
 
-    await update.message.reply_text(
+    await reply(
+        update.message,
         "✅ *SLOT TRACKING RIATTIVATO*\n"
         "Il bot ora registra di nuovo tutte le slot.",
         parse_mode="Markdown"
@@ -432,19 +481,21 @@ async def helpadmin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• /importall — Importa ZIP con scores.json, duels.json, users.json\n\n"
 
         "🧬 *Migrazione*\n"
-        "• /migrascores — Migra manualmente scores.json alla versione corrente\n\n"
+        "• /migrascores — Migra manualmente scores.json alla versione corrente\n"
+        "• /ricalcolaelo [K] — Ricalcola gli ELO rigiocando lo storico dei duelli\n\n"
 
         "📦 *Backup*\n"
         "• /backupnow — Crea un backup ZIP immediato e te lo invia\n"
-        "• /listbackups — Mostra i backup salvati in /backup/\n\n"
+        "• /listbackups — Mostra i backup salvati in /backup/\n"
+        "• /ripristina <data> [ora] — Ripristina i dati com'erano a quel momento\n\n"
 
         "⏱️ *Backup automatico*\n"
-        "• Ogni 12h viene creato un backup ZIP\n"
-        "• Viene inviato a te\n"
-        "• Mantiene solo gli ultimi 10\n"
+        "• Ogni ora un backup incrementale (solo quello che è cambiato)\n"
+        "• Ogni 12h una copia ZIP completa inviata a te\n"
+        "• Tiene un backup per ora (24h), per giorno (7 giorni) e per settimana (8 settimane)\n"
     )
 
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    await reply(update.message, msg, parse_mode="Markdown")
 
 
 async def backupnow_command(update, context):
@@ -452,11 +503,12 @@ async def backupnow_command(update, context):
     if not is_admin(update.message.from_user.id):
         return
 
-    zip_path = create_backup_zip()
+    backup_id = await create_backup_async()
 
-    await update.message.reply_document(
-        document=open(zip_path, "rb"),
-        filename=os.path.basename(zip_path),
+    await call(
+        update.message.chat_id, update.message.reply_document,
+        document=await backup_zip_async(backup_id),
+        filename=f"backup_{backup_id}.zip",
         caption="📦 Backup manuale eseguito."
     )
 
@@ -466,27 +518,77 @@ async def listbackups_command(update, context):
     if not is_admin(update.message.from_user.id):
         return
 
+    store = get_backup_store()
     backups = get_backup_list()
+    legacy = get_legacy_backups()
 
-    if not backups:
-        return await update.message.reply_text("Nessun backup trovato.")
+    if not backups and not legacy:
+        return await reply(update.message, "Nessun backup trovato.")
 
     msg = "📦 *Backup disponibili:*\n\n"
-    for b in backups:
-        msg += f"• `{os.path.basename(b)}`\n"
+    for b in backups[-15:]:
+        written = store.load_manifest(b).get("written", 0)
+        msg += f"• `{b}` (+{written / 1024:.1f} KB)\n"
+    if len(backups) > 15:
+        msg += f"…e altri {len(backups) - 15} più vecchi\n"
+    msg += f"\n💾 Spazio usato: {store.usage() / 1024:.1f} KB\n"
+    for b in legacy:
+        msg += f"• `{os.path.basename(b)}` (vecchio formato)\n"
+
+    await reply(update.message, msg, parse_mode="Markdown")
+
+
+async def ripristina_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Restore the data as it was at a given time (admin only)"""
+    if not is_admin(update.message.from_user.id):
+        return await reply(update.message, "Non hai il permesso.")
+
+    if not context.args:
+        return await reply(
+            update.message,
+            "Uso: /ripristina <AAAA-MM-GG> [HH:MM] (UTC)\n"
+            "Ripristina l'ultimo backup fatto entro quel momento."
+        )
+    try:
+        when = datetime.fromisoformat(" ".join(context.args[:2]))
+    except ValueError:
+        return await reply(update.message, "Data non valida. Esempio: /ripristina 2026-10-01 18:30")
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    if len(context.args) == 1 and len(context.args[0]) == 10:
+        when = when.replace(hour=23, minute=59, second=59)  # a date means that whole day
+
+    backup_id = get_backup_store().at(when)
+    if backup_id is None:
+        return await reply(update.message, "Nessun backup così vecchio.")
+    try:
+        files = await get_writer().run(get_backup_store().materialize, backup_id)
+        await import_json_files_async(files)
+    except Exception as e:
+        return await reply(update.message, f"⚠️ Ripristino fallito:\n{e}")
+
+    await reply(update.message, f"♻️ Dati ripristinati dal backup {backup_id}.")
+
 
-    await update.message.reply_text(msg, parse_mode="Markdown")
+async def scheduled_incremental_backup(context):
+    """Scheduled incremental backup, kept on disk only"""
+    try:
+        await create_backup_async()
+    except Exception as e:
+        print(f"⚠️ Backup incrementale fallito: {e}", flush=True)
 
 
 async def scheduled_backup(context):
     """Scheduled backup task"""
     from config import ADMIN_ID
-    zip_path = create_backup_zip()
+    backup_id = await create_backup_async()
 
     try:
-        await context.bot.send_document(
+        await call(
+            ADMIN_ID, context.bot.send_document,
             chat_id=ADMIN_ID,
-            document=open(zip_path, "rb"),
+            document=await backup_zip_async(backup_id),
+            filename=f"backup_{backup_id}.zip",
             caption="📦 Backup automatico eseguito."
         )
     except:
@@ -497,10 +599,11 @@ async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Run comprehensive bot tests (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     try:
-        await update.message.reply_text(
+        await reply(
+            update.message,
             "🧪 Test in corso...\n"
             "Esecuzione della suite di test...",
             parse_mode="Markdown"
@@ -528,7 +631,7 @@ async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Test 2: Load scores
         try:
             scores = load_scores()
-            assert isinstance(scores, dict)
+            assert isinstance(scores, MutableMapping)
             results["passed"] += 1
         except Exception as e:
             results["failed"] += 1
@@ -570,11 +673,11 @@ async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Test 6: Test ELO calculation
         try:
             test_scores = {
-                "user1": {"elo": 1600},
-                "user2": {"elo": 1400}
+                "user1": models.UserStats("User1", elo=1600),
+                "user2": models.UserStats("User2", elo=1400)
             }
             models.update_elo("user1", "user2", test_scores)
-            assert test_scores["user1"]["elo"] != 1600
+            assert test_scores["user1"].elo != 1600
             results["passed"] += 1
         except Exception as e:
             results["failed"] += 1
@@ -634,21 +737,22 @@ async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             message += "\nTutti i test passati!"
 
-        await update.message.reply_text(message)
+        await reply(update.message, message)
 
     except Exception as e:
         # Fallback error message
-        await update.message.reply_text(f"Errore nei test: {str(e)}")
+        await reply(update.message, f"Errore nei test: {str(e)}")
 
 
 async def addduel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Add a duel record manually (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if not context.args or len(context.args) < 5:
-        return await update.message.reply_text(
+        return await reply(
+            update.message,
             "Uso: /addduel <player1> <player2> <score1> <score2> <winner_name>\n\n"
             "Esempio: /addduel Mario Luigi 3 1 Mario\n"
             "(aggiunge un duello vinto da Mario 3-1 contro Luigi)"
@@ -661,36 +765,75 @@ async def addduel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         score2 = int(context.args[3])
         winner_name = " ".join(context.args[4:])  # Supporta nomi con spazi
 
-        # Load and add duel
-        duels = load_duels()
-        duels.append({
+        # Add duel, linked to the players' ids when their names are known
+        duel = {
             "p1": p1_name,
             "p2": p2_name,
             "score1": score1,
             "score2": score2,
             "winner": winner_name,
             "timestamp": datetime.now(timezone.utc).isoformat(),
-        })
-        save_duels(duels)
+        }
+        link_duel_ids([duel], load_users())
+        append_duel(duel)
 
-        await update.message.reply_text(
+        await reply(
+            update.message,
             f"✅ Duello aggiunto:\n"
             f"{p1_name} vs {p2_name}: {score1} - {score2}\n"
             f"Vincitore: {winner_name}"
         )
 
     except (ValueError, IndexError):
-        await update.message.reply_text(
+        await reply(
+            update.message,
             "❌ Errore! Controlla i parametri:\n"
             "/addduel <player1> <player2> <score1> <score2> <winner>"
         )
 
 
+async def ricalcolaelo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Recompute every ELO from the duel history (admin only)"""
+    from ratings import RatingEngine
+
+    user = update.message.from_user
+    if not is_admin(user.id):
+        return await reply(update.message, "Non hai il permesso.")
+
+    try:
+        k = float(context.args[0]) if context.args else ELO_K_FACTOR
+    except ValueError:
+        return await reply(update.message, "Uso: /ricalcolaelo [K]")
+    if k <= 0:
+        return await reply(update.message, "K deve essere positivo.")
+
+    engine = RatingEngine(k=k)
+    ratings = engine.elo_ratings()
+    store = get_score_store()
+    changed = []
+    for user_id, rating in ratings.items():
+        if user_id not in store.load():
+            continue
+        async with store.user(user_id) as tx:
+            if tx.user["elo"] == round(rating):
+                tx.rollback()  # nothing to write
+                continue
+            tx.user["elo"] = round(rating)
+        changed.append(user_id)
+        log_event("admin_set", user=user_id, field="elo", value=round(rating), admin=user.id)
+
+    await reply(
+        update.message,
+        f"📈 ELO ricalcolati da {engine.replayed} duelli (K={k:g}): "
+        f"{len(changed)} giocatori aggiornati su {len(ratings)}."
+    )
+
+
 async def debuginfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show complete debug info about all data (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     try:
         scores = load_scores()
@@ -723,43 +866,36 @@ async def debuginfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Backup info
         backups = get_backup_list()
-        msg += f"\n💾 **Backup:** {len(backups)} file salvati\n"
+        msg += f"\n💾 **Backup:** {len(backups)} salvati\n"
         if backups:
-            latest = backups[-1].split("/")[-1]
-            msg += f"Ultimo: {latest}"
+            msg += f"Ultimo: {backups[-1]}"
         
-        await update.message.reply_text(msg)
+        await reply(update.message, msg)
     except Exception as e:
-        await update.message.reply_text(f"❌ Errore: {str(e)}")
+        await reply(update.message, f"❌ Errore: {str(e)}")
 
 
 async def resetuser_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reset a user's data to default (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if not context.args or len(context.args) < 1:
-        return await update.message.reply_text("Uso: /resetuser <user_id>")
+        return await reply(update.message, "Uso: /resetuser <user_id>")
 
     try:
         user_id = str(context.args[0])
-        scores = load_scores()
-        
-        if user_id not in scores:
-            return await update.message.reply_text(f"❌ Utente {user_id} non trovato.")
-        
-        nome = scores[user_id].get("name", "Unnamed")
-        
-        # Reset to default structure
-        from models import ensure_user_struct
-        scores[user_id] = {}
-        ensure_user_struct(scores, user_id, nome)
-        save_scores(scores)
+
+        # Reset to default structure, name kept
+        edited, chats = await edit_user(user_id, UserStats.clear)
+        if edited is None:
+            return await reply(update.message, f"❌ Utente {user_id} non trovato.")
+        log_event("admin_reset", user=user_id, admin=user.id, chats=chats)
         
-        await update.message.reply_text(f"✅ {nome} resettato ai valori di default.")
+        await reply(update.message, f"✅ {edited.name} resettato ai valori di default.")
     except Exception as e:
-        await update.message.reply_text(f"❌ Errore: {str(e)}")
+        await reply(update.message, f"❌ Errore: {str(e)}")
 
 
 async def modifyuser_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -770,10 +906,11 @@ async def modifyuser_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     if not context.args or len(context.args) < 3:
-        return await update.message.reply_text(
+        return await reply(
+            update.message,
             "Uso: /modifyuser <user_id> <campo> <valore>\n\n"
             "Campi: points, streak, best_streak, sfiga, best_sfiga, elo, "
             "duel_wins, duel_losses, total_wins, total_slots, name"
@@ -784,10 +921,6 @@ async def modifyuser_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         field = context.args[1]
         value = context.args[2]
         
-        scores = load_scores()
-        if user_id not in scores:
-            return await update.message.reply_text(f"❌ Utente {user_id} non trovato.")
-        
         # Parse value type
         if value.isdigit():
             value = int(value)
@@ -798,47 +931,57 @@ async def modifyuser_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         elif value.lower() == "false":
             value = False
         
-        old_value = scores[user_id].get(field, "N/A")
-        scores[user_id][field] = value
-        save_scores(scores)
+        old_values = []
+
+        def set_field(d):
+            old_values.append(d.get(field, "N/A"))
+            d[field] = value
+
+        edited, chats = await edit_user(user_id, set_field)
+        if edited is None:
+            return await reply(update.message, f"❌ Utente {user_id} non trovato.")
+        log_event("admin_set", user=user_id, field=field, value=value, admin=user.id, chats=chats)
         
-        await update.message.reply_text(
-            f"✅ {scores[user_id]['name']}.{field}\n"
-            f"{old_value} → {value}"
+        await reply(
+            update.message,
+            f"✅ {edited['name']}.{field}\n"
+            f"{old_values[0]} → {value}"
         )
     except Exception as e:
-        await update.message.reply_text(f"❌ Errore: {str(e)}")
+        await reply(update.message, f"❌ Errore: {str(e)}")
 
 
 async def datacheck_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check data integrity (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     try:
         scores = load_scores()
-        from models import ensure_user_struct
         
         issues = []
         fixed = 0
         
-        for user_id, data in scores.items():
-            if not isinstance(data, dict):
-                issues.append(f"❌ {user_id}: dati non sono dict")
-                continue
-            
-            # Verifica campi obbligatori
-            required = ["name", "points", "streak", "best_streak", "sfiga", 
-                       "best_sfiga", "total_slots", "total_wins", "elo"]
-            
-            for field in required:
-                if field not in data:
-                    ensure_user_struct(scores, user_id, data.get("name", "?"))
-                    fixed += 1
+        # Verifica campi obbligatori
+        required = ["name", "points", "streak", "best_streak", "sfiga", 
+                   "best_sfiga", "total_slots", "total_wins", "elo"]
         
-        if fixed > 0:
-            save_scores(scores)
+        for store in _score_stores():
+            entries = store.load()
+            for user_id, data in list(entries.items()):
+                if user_id.startswith("_"):
+                    continue
+                if not isinstance(data, Mapping):
+                    if store.chat_id is None:
+                        issues.append(f"❌ {user_id}: dati non sono dict")
+                    continue
+                missing = sum(1 for field in required if field not in data)
+                if missing:
+                    # the transaction normalizes the entry (ensure_user_struct)
+                    async with store.user(user_id, data.get("name", "?")):
+                        pass
+                    fixed += missing
         
         msg = "🔍 **Data Integrity Check**\n\n"
         msg += f"✅ {len(scores)} utenti verificati\n"
@@ -851,16 +994,16 @@ async def datacheck_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             msg += "\n✅ Nessun problema!"
         
-        await update.message.reply_text(msg)
+        await reply(update.message, msg)
     except Exception as e:
-        await update.message.reply_text(f"❌ Errore: {str(e)}")
+        await reply(update.message, f"❌ Errore: {str(e)}")
 
 
 async def cleanstate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Clean temporary game state (admin only)"""
     user = update.message.from_user
     if not is_admin(user.id):
-        return await update.message.reply_text("Non hai il permesso.")
+        return await reply(update.message, "Non hai il permesso.")
 
     try:
         import game_state
@@ -872,6 +1015,7 @@ async def cleanstate_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         game_state.ACTIVE_DUELS.clear()
         game_state.EXPANSION_UNTIL.clear()
         game_state.PENDING_DUELS.clear()
+        journal_clear()
         game_state.SLOT_BLOCKED = False
         
         msg = f"🧹 **Pulizia Game State**\n\n"
@@ -881,124 +1025,36 @@ async def cleanstate_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         msg += f"✅ Slot sbloccati\n\n"
         msg += "State pulito! I dati persistenti (.json) sono intatti."
         
-        await update.message.reply_text(msg)
+        await reply(update.message, msg)
     except Exception as e:
-        await update.message.reply_text(f"❌ Errore: {str(e)}")
+        await reply(update.message, f"❌ Errore: {str(e)}")
 
 async def daily_recap(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send daily recap of leaderboard changes to admin"""
-    from storage import get_leaderboard_snapshots, load_scores
-    
-    # Get yesterday's snapshot
-    yesterday = get_leaderboard_snapshots(days_back=1)
-    if not yesterday:
+    engine = get_highlights_engine()
+    highlights = engine.compute()
+    if highlights is None:
         return  # No snapshot from yesterday
     
-    # Get today's top 10 (ignore metadata/non-dict entries)
-    scores = load_scores()
-    clean_scores = {k: v for k, v in scores.items() if isinstance(v, dict)}
-    today_top_10 = sorted(clean_scores.items(), key=lambda x: x[1].get("points", 0), reverse=True)[:10]
-    
-    msg = "📊 *DAILY RECAP* 📊\n\n"
-    
-    # Analyze changes
-    yesterday_dict = {item["user_id"]: item for item in yesterday["top_10"]}
-    
-    movers = []
-    for idx, (uid, data) in enumerate(today_top_10):
-        old_position = None
-        old_points = None
-        
-        # Find old position
-        for old_idx, old_item in enumerate(yesterday["top_10"]):
-            if old_item["user_id"] == uid:
-                old_position = old_idx
-                old_points = old_item["points"]
-                break
-        
-        if old_position is not None:
-            position_change = old_position - idx
-            points_change = data.get("points", 0) - old_points
-            
-            if position_change != 0 or points_change > 50:
-                if position_change > 0:
-                    movers.append(f"📈 {data.get('name', 'Unknown')} sale a #{idx+1} (+{points_change} pts)")
-                elif position_change < 0:
-                    movers.append(f"📉 {data.get('name', 'Unknown')} scende a #{idx+1}")
-                else:
-                    if points_change > 0:
-                        movers.append(f"💎 {data.get('name', 'Unknown')} guadagna {points_change} pts (rimane #{idx+1})")
-        else:
-            # New entry to top 10
-            movers.append(f"⭐ {data.get('name', 'Unknown')} entra in top 10 a #{idx+1}!")
-    
-    if movers:
-        msg += "*HIGHLIGHTS:*\n"
-        for mover in movers:
-            msg += f"{mover}\n"
-    else:
-        msg += "Nessun cambiamento significativo nel leaderboard.\n"
-    
-    msg += "\n*TOP 10 OGGI:*\n"
-    for idx, (uid, data) in enumerate(today_top_10):
-        msg += f"#{idx+1} - {data.get('name', 'Unknown')}: {data.get('points', 0)} pts\n"
-    
     # Send to admin
     try:
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=msg,
-            parse_mode="Markdown"
-        )
+        msg = engine.format(highlights, "📊 *DAILY RECAP* 📊")
+        await send_text(context.bot, ADMIN_ID, msg, parse_mode="Markdown")
     except Exception as e:
         print(f"❌ Failed to send daily recap: {str(e)}")
 
 
 async def highlights_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show today's highlights in the current chat (no snapshot created)"""
-    from storage import get_leaderboard_snapshots, load_scores
-
-    yesterday = get_leaderboard_snapshots(days_back=1)
-    if not yesterday:
-        return await update.message.reply_text("Nessun highlight disponibile ancora.")
-
-    scores = load_scores()
-    clean_scores = {k: v for k, v in scores.items() if isinstance(v, dict)}
-    today_top_10 = sorted(clean_scores.items(), key=lambda x: x[1].get("points", 0), reverse=True)[:10]
-
-    msg = "📊 *HIGHLIGHTS DEL GIORNO* 📊\n\n"
-
-    movers = []
-    for idx, (uid, data) in enumerate(today_top_10):
-        old_position = None
-        old_points = None
-        for old_idx, old_item in enumerate(yesterday["top_10"]):
-            if old_item["user_id"] == uid:
-                old_position = old_idx
-                old_points = old_item["points"]
-                break
-        if old_position is not None:
-            position_change = old_position - idx
-            points_change = data.get("points", 0) - old_points
-            if position_change != 0 or points_change > 50:
-                if position_change > 0:
-                    movers.append(f"📈 {data.get('name','Unknown')} sale a #{idx+1} (+{points_change} pts)")
-                elif position_change < 0:
-                    movers.append(f"📉 {data.get('name','Unknown')} scende a #{idx+1}")
-                else:
-                    if points_change > 0:
-                        movers.append(f"💎 {data.get('name','Unknown')} guadagna {points_change} pts (rimane #{idx+1})")
-        else:
-            movers.append(f"⭐ {data.get('name','Unknown')} entra in top 10 a #{idx+1}!")
-    if movers:
-        msg += "*HIGHLIGHTS:*\n"
-        for m in movers:
-            msg += f"{m}\n"
-    else:
-        msg += "Nessun cambiamento significativo nel leaderboard.\n"
-
-    msg += "\n*TOP 10 OGGI:*\n"
-    for idx, (uid, data) in enumerate(today_top_10):
-        msg += f"#{idx+1} - {data.get('name','Unknown')}: {data.get('points',0)} pts\n"
-
-    await update.message.reply_text(msg, parse_mode="Markdown")
\ No newline at end of file
+    """Show today's highlights in the current chat (of the group's players
+    in groups, of everyone in private or with 'globale')"""
+    message = update.message
+    everyone = any(str(arg).lower() in GLOBAL_SCOPE_ARGS for arg in context.args or ())
+    scope = message.chat_id if message.chat.type in ("group", "supergroup") and not everyone else None
+
+    engine = get_highlights_engine()
+    highlights = engine.compute(scope)
+    if highlights is None:
+        return await reply(message, "Nessun highlight disponibile ancora.")
+
+    title = "📊 *HIGHLIGHTS DEL GIORNO* 📊" + (" — questo gruppo" if scope is not None else "")
+    await reply(message, engine.format(highlights, title), parse_mode="Markdown")
\ No newline at end of file
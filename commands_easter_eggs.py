@@ -6,8 +6,9 @@ import random
 from datetime import datetime, timezone
 from telegram import Update
 from telegram.ext import ContextTypes
-from storage import load_scores, save_scores
-from models import ensure_user_struct
+from storage import get_score_store
+from events import log_event
+from outbox import reply, call, PRIORITY_LOW
 
 
 async def slot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -17,24 +18,25 @@ async def slot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_name = message.from_user.first_name
     chat_id = message.chat_id
 
-    scores = load_scores()
-    ensure_user_struct(scores, user_id, user_name)
-    
-    # Check one-per-day cooldown
-    now_ts = datetime.now(timezone.utc).timestamp()
-    last_slot_bot = scores[user_id].get("last_slot_bot_ts", 0)
-    
-    if last_slot_bot > 0 and now_ts - last_slot_bot < 86400:  # 86400 = 1 giorno
-        hours_remaining = int((86400 - (now_ts - last_slot_bot)) / 3600)
-        return await message.reply_text(
-            f"⏳ Il bot è stanco!\n"
-            f"Tornerà tra circa {hours_remaining} ore.",
-            parse_mode="Markdown"
-        )
-    
-    # Update last slot bot timestamp
-    scores[user_id]["last_slot_bot_ts"] = now_ts
-    save_scores(scores)
+    cooldown = None
+    async with get_score_store().user(user_id, user_name) as tx:
+        # Check one-per-day cooldown
+        now_ts = datetime.now(timezone.utc).timestamp()
+        last_slot_bot = tx.user.last_slot_bot_ts
+
+        if last_slot_bot > 0 and now_ts - last_slot_bot < 86400:  # 86400 = 1 giorno
+            hours_remaining = int((86400 - (now_ts - last_slot_bot)) / 3600)
+            cooldown = (
+                f"⏳ Il bot è stanco!\n"
+                f"Tornerà tra circa {hours_remaining} ore."
+            )
+        else:
+            # Update last slot bot timestamp
+            tx.user.last_slot_bot_ts = now_ts
+
+    # replies go out once the transaction is over: a slow send never holds the user's lock
+    if cooldown:
+        return await reply(message, cooldown, parse_mode="Markdown")
     
     # Bot rolls 1-10 times
     num_rolls = random.randint(1, 10)
@@ -47,25 +49,25 @@ async def slot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "⚡ *Energia quantica attivata!*",
     ]
     
-    await message.reply_text(random.choice(bot_messages), parse_mode="Markdown")
+    await reply(message, random.choice(bot_messages), parse_mode="Markdown")
     
-    # Actually send dice so users see the bot rolling
-    wins = 0
+    # Actually send dice so users see the bot rolling. One at a time and at
+    # low priority: queued together they would use up the chat's send burst
+    # and hold back the other commands' replies
     # import WIN_VALUES here to match the main handler
     from config import WIN_VALUES
-    for i in range(num_rolls):
+    rolls = []
+    for _ in range(num_rolls):
         try:
-            resp = await context.bot.send_dice(chat_id=chat_id, emoji="🎰")
+            rolls.append(await call(chat_id, context.bot.send_dice, chat_id=chat_id, emoji="🎰",
+                                    priority=PRIORITY_LOW))
         except Exception:
-            resp = None
-
-        # if the dice value is available check for win
-        if resp and getattr(resp, "dice", None) is not None:
-            val = resp.dice.value
-            if val in WIN_VALUES:
-                wins += 1
-        # add a small delay so animations don't collide
-        await asyncio.sleep(1)
+            pass
+    # if the dice value is available check for win
+    wins = sum(
+        1 for resp in rolls
+        if getattr(resp, "dice", None) is not None and resp.dice.value in WIN_VALUES
+    )
     
     result_messages = [
         f"🤖 Ho tirato {num_rolls} volte e ho vinto {wins} volte! *Non male, eh?* 🎉",
@@ -74,7 +76,7 @@ async def slot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🌟 Eccellente! Ho ottenuto {wins} vittorie in {num_rolls} slot. *Il dominio è mio*! 👑",
     ]
     
-    await message.reply_text(random.choice(result_messages), parse_mode="Markdown")
+    await reply(message, random.choice(result_messages), parse_mode="Markdown")
 
 
 async def sfidabot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -84,37 +86,40 @@ async def sfidabot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_name = message.from_user.first_name
     chat_id = message.chat_id
     
-    scores = load_scores()
-    ensure_user_struct(scores, user_id, user_name)
-    
-    # Check one-per-day cooldown
-    now_ts = datetime.now(timezone.utc).timestamp()
-    last_duel_bot = scores[user_id].get("last_duel_bot_ts", 0)
-    
-    if last_duel_bot > 0 and now_ts - last_duel_bot < 86400:
-        hours_remaining = int((86400 - (now_ts - last_duel_bot)) / 3600)
-        return await message.reply_text(
-            f"⏳ Il bot ha bisogno di ricaricarsi!\n"
-            f"Sarà disponibile tra circa {hours_remaining} ore.",
-            parse_mode="Markdown"
-        )
-    
-    # Update last duel bot timestamp
-    scores[user_id]["last_duel_bot_ts"] = now_ts
-    save_scores(scores)
+    cooldown = None
+    async with get_score_store().user(user_id, user_name) as tx:
+        # Check one-per-day cooldown
+        now_ts = datetime.now(timezone.utc).timestamp()
+        last_duel_bot = tx.user.last_duel_bot_ts
+
+        if last_duel_bot > 0 and now_ts - last_duel_bot < 86400:
+            hours_remaining = int((86400 - (now_ts - last_duel_bot)) / 3600)
+            cooldown = (
+                f"⏳ Il bot ha bisogno di ricaricarsi!\n"
+                f"Sarà disponibile tra circa {hours_remaining} ore."
+            )
+        else:
+            # Update last duel bot timestamp
+            tx.user.last_duel_bot_ts = now_ts
+
+    if cooldown:
+        return await reply(message, cooldown, parse_mode="Markdown")
     
     # Simulate bot duel
     player_wins = 0
     bot_wins = 0
     
-    await message.reply_text(
+    await reply(
+        message,
         f"⚔️ *SFIDA EPICA*\n"
         f"🤖 *Il bot accetta la sfida!*\n"
         f"Primo a 3 vittorie vince...",
         parse_mode="Markdown"
     )
     
-    # Simulate rounds
+    # Simulate rounds; they are queued together so the chat's send queue can
+    # merge them instead of spending a message (and a rate-limit slot) each
+    rounds = []
     while player_wins < 3 and bot_wins < 3:
         player_roll = random.randint(1, 64)
         bot_roll = random.randint(1, 64)
@@ -132,26 +137,27 @@ async def sfidabot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             round_msg = f"🎲 *Round {player_wins + bot_wins}*\nPareggio! Rivincita..."
             continue
         
-        await message.reply_text(round_msg, parse_mode="Markdown")
-        
-        # Small delay between rounds for suspense
-        await asyncio.sleep(0.5)
-    
-    # Determine overall winner
-    if player_wins == 3:
-        win_messages = [
-            f"🏆 *HAI VINTO!* 🏆\nCongratulazioni {user_name}! Hai battuto l'IA!\nIl bot ti inchina rispettosamente.",
-            f"⚡ *INCREDIBILE!* ⚡\n{user_name} ha superato i limiti della logica quantica!\nIl bot è... impressionato.",
-            f"🌟 *LEGGENDARIO!* 🌟\nAncora una volta, l'istinto umano batte la freddezza della macchina!\nVai {user_name}, vai!",
-        ]
-        scores[user_id]["duel_wins"] += 1
-    else:
-        win_messages = [
-            f"🤖 *IL BOT VINCE!* 🤖\nNon sei abbastanza veloce, {user_name}.\nMeglio fortuna la prossima volta.",
-            f"⚙️ *ELIMINATO* ⚙️\nIl bot ha dimostrato la superiorità della macchina.\nRitorna quando sei più forte, {user_name}.",
-            f"💻 *PROCESSO COMPLETATO* 💻\nIl bot celebra la vittoria sulla biologia umana.\nRiprova domani, se ne hai il coraggio!",
-        ]
-        scores[user_id]["duel_losses"] += 1
-    
-    save_scores(scores)
-    await message.reply_text(random.choice(win_messages), parse_mode="Markdown")
+        rounds.append(round_msg)
+
+    await asyncio.gather(*(reply(message, round_msg, parse_mode="Markdown") for round_msg in rounds))
+    
+    # Determine overall winner (the rounds took a while: record it in a fresh transaction)
+    async with get_score_store().user(user_id, user_name) as tx:
+        if player_wins == 3:
+            win_messages = [
+                f"🏆 *HAI VINTO!* 🏆\nCongratulazioni {user_name}! Hai battuto l'IA!\nIl bot ti inchina rispettosamente.",
+                f"⚡ *INCREDIBILE!* ⚡\n{user_name} ha superato i limiti della logica quantica!\nIl bot è... impressionato.",
+                f"🌟 *LEGGENDARIO!* 🌟\nAncora una volta, l'istinto umano batte la freddezza della macchina!\nVai {user_name}, vai!",
+            ]
+            tx.user.duel_wins += 1
+        else:
+            win_messages = [
+                f"🤖 *IL BOT VINCE!* 🤖\nNon sei abbastanza veloce, {user_name}.\nMeglio fortuna la prossima volta.",
+                f"⚙️ *ELIMINATO* ⚙️\nIl bot ha dimostrato la superiorità della macchina.\nRitorna quando sei più forte, {user_name}.",
+                f"💻 *PROCESSO COMPLETATO* 💻\nIl bot celebra la vittoria sulla biologia umana.\nRiprova domani, se ne hai il coraggio!",
+            ]
+            tx.user.duel_losses += 1
+        log_event("set", user=user_id, name=user_name, fields={
+            "duel_wins": tx.user.duel_wins, "duel_losses": tx.user.duel_losses})
+
+    await reply(message, random.choice(win_messages), parse_mode="Markdown")
@@ -1,13 +1,19 @@
 """
 Gameplay commands - duels, buffs, domain expansion, etc.
 """
+import asyncio
 import random
 from datetime import datetime, timezone
+from typing import Optional, Set
 from telegram import Update
 from telegram.ext import ContextTypes
-from storage import load_scores, save_scores, load_duels, save_duels, load_users, save_users
-from models import ensure_user_struct, update_elo, unlock_achievement
+from storage import get_score_store, save_scores, append_duel, load_users
+from models import ensure_user_struct, update_elo, unlock_achievement, UserStats
 from utils import is_expansion_active
+from events import log_event
+from windows import get_windowed_stats
+from outbox import reply, call
+from state_journal import journal_duel, journal_pending, journal_expansion
 import game_state
 
 
@@ -23,14 +29,14 @@ async def sfida_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Check if there's already an active duel
     if chat_id in game_state.ACTIVE_DUELS:
-        return await message.reply_text("C'è già una sfida attiva in questo gruppo. Finite quella prima.")
+        return await reply(message, "C'è già una sfida attiva in questo gruppo. Finite quella prima.")
 
     if not message.reply_to_message:
-        return await message.reply_text("Usa /sfida rispondendo al messaggio di chi vuoi sfidare.")
+        return await reply(message, "Usa /sfida rispondendo al messaggio di chi vuoi sfidare.")
 
     target = message.reply_to_message.from_user
     if target.id == challenger.id:
-        return await message.reply_text("Non puoi sfidare te stesso, anche se sei messo male.")
+        return await reply(message, "Non puoi sfidare te stesso, anche se sei messo male.")
 
     challenger_id = str(challenger.id)
     target_id = str(target.id)
@@ -53,8 +59,11 @@ async def sfida_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 challenger_id: 0,
             },
         }
+        journal_pending(chat_id, target_id)
+        journal_duel(chat_id)
 
-        await message.reply_text(
+        await reply(
+            message,
             f"⚔️ SFIDA ACCETTATA!\n"
             f"{target.first_name} vs {challenger.first_name}\n\n"
             f"🎲 Turno: {target.first_name} (manda uno slot a testa, a turni!)\n"
@@ -65,8 +74,10 @@ async def sfida_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # SFIDA NUOVA: challenge non ancora accettato
     pending_key = (chat_id, challenger_id)
     game_state.PENDING_DUELS[pending_key] = target.id
+    journal_pending(chat_id, challenger_id)
 
-    await message.reply_text(
+    await reply(
+        message,
         f"⚔️ SFIDA LANCIATA!\n"
         f"{challenger.first_name} ha sfidato {target.first_name}.\n\n"
         f"@{target.username or target.first_name}, rispondi con /sfida a questo messaggio per accettare!"
@@ -106,57 +117,121 @@ def handle_duel_turn(chat_id: int, user_id: str, nome: str, scores, won: bool =
         # lost round, no score increment
         msg = f"\n💥 {nome} perde il round! ({duel['score'][user_id]}-{duel['score'][opponent_id]})\n"
 
+    log_event("duel_round", chat=chat_id, user=user_id, won=won,
+              score={uid: n for uid, n in duel["score"].items()})
+
     # Always pass turn to opponent
     duel["current_turn"] = opponent_id
     msg += f"📍 Prossimo turno: {opponent_name}"
 
     # If it was a winning round, check if duel ended
     if won and duel["score"][user_id] >= 3:
-        p1_id = duel["p1_id"]
-        p2_id = duel["p2_id"]
-        p1_name = duel["p1_name"]
-        p2_name = duel["p2_name"]
-        s1 = duel["score"][p1_id]
-        s2 = duel["score"][p2_id]
-
-        ensure_user_struct(scores, p1_id, p1_name)
-        ensure_user_struct(scores, p2_id, p2_name)
-
-        if s1 > s2:
-            winner_id, loser_id = p1_id, p2_id
+        return finish_duel(chat_id, user_id, scores)
+
+    journal_duel(chat_id)
+    return msg
+
+
+def _rating(scores, user_id: str) -> int:
+    return (scores.get(user_id) or UserStats()).elo
+
+
+async def record_duel_side(chat_id: Optional[int], user_id: str, name: str, won: bool, elo_change: int) -> None:
+    """One player's side of a finished duel, in that player's own
+    transaction of the global scores (``chat_id`` None) or a chat shard"""
+    async with get_score_store(chat_id).user(user_id, name) as tx:
+        if won:
+            tx.user.duel_wins += 1
         else:
-            winner_id, loser_id = p2_id, p1_id
-
-        scores[winner_id]["duel_wins"] += 1
-        scores[loser_id]["duel_losses"] += 1
-
-        elo_gain, elo_loss = update_elo(winner_id, loser_id, scores)
-
-        duels = load_duels()
-        duels.append(
-            {
-                "p1": p1_name,
-                "p2": p2_name,
-                "score1": s1,
-                "score2": s2,
-                "winner": scores[winner_id]["name"],
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-            }
-        )
-        save_duels(duels)
+            tx.user.duel_losses += 1
+        tx.user.elo += elo_change
 
-        msg = (
-            f"\n🏁 DUELLO FINITO!\n"
-            f"{p1_name} vs {p2_name}: {s1} - {s2}\n"
-            f"Vince {scores[winner_id]['name']}!\n\n"
-            f"📈 ELO aggiornati:\n"
-            f"• {scores[winner_id]['name']}: {scores[winner_id]['elo']} ( +{elo_gain} )\n"
-            f"• {scores[loser_id]['name']}: {scores[loser_id]['elo']} ( {elo_loss} )"
-        )
 
-        del game_state.ACTIVE_DUELS[chat_id]
+# duel results still being recorded (kept referenced until they are done)
+_duel_updates: Set[asyncio.Task] = set()
 
-    return msg
+
+def _spawn(coro) -> None:
+    task = asyncio.get_running_loop().create_task(coro)
+    _duel_updates.add(task)
+    task.add_done_callback(_duel_updates.discard)
+
+
+async def flush_duel_results() -> None:
+    """Wait for the duel results still being recorded"""
+    while _duel_updates:
+        await asyncio.gather(*_duel_updates, return_exceptions=True)
+
+
+def finish_duel(chat_id: int, winner_id: str, scores, forfeit: bool = False) -> str:
+    """End the chat's duel with ``winner_id`` as the winner: record it in the
+    global scores (``scores``), the chat shard, the event log and the duel
+    history. Returns the result message.
+
+    The caller holds the winner's transaction, so only the winner's global
+    entry is changed here; the loser and both chat shard entries are
+    updated in their own transactions as soon as their locks are free.
+
+    ``forfeit``: the loser timed out (see deadlines.py) instead of losing
+    the last round.
+    """
+    duel = game_state.ACTIVE_DUELS[chat_id]
+    p1_id = duel["p1_id"]
+    p2_id = duel["p2_id"]
+    p1_name = duel["p1_name"]
+    p2_name = duel["p2_name"]
+    s1 = duel["score"][p1_id]
+    s2 = duel["score"][p2_id]
+    loser_id = p2_id if winner_id == p1_id else p1_id
+    winner_name, loser_name = (p1_name, p2_name) if winner_id == p1_id else (p2_name, p1_name)
+
+    winner = ensure_user_struct(scores, winner_id, winner_name)
+    ratings = {winner_id: {"elo": winner.elo}, loser_id: {"elo": _rating(scores, loser_id)}}
+    elo_gain, elo_loss = update_elo(winner_id, loser_id, ratings)
+    winner.duel_wins += 1
+    winner.elo += elo_gain
+    save_scores(scores, winner_id)
+    _spawn(record_duel_side(None, loser_id, loser_name, False, elo_loss))
+    # the chat shard keeps its own duel record and ELO
+    chat_scores = get_score_store(chat_id).load()
+    chat_ratings = {winner_id: {"elo": _rating(chat_scores, winner_id)},
+                    loser_id: {"elo": _rating(chat_scores, loser_id)}}
+    chat_gain, chat_loss = update_elo(winner_id, loser_id, chat_ratings)
+    _spawn(record_duel_side(chat_id, winner_id, winner_name, True, chat_gain))
+    _spawn(record_duel_side(chat_id, loser_id, loser_name, False, chat_loss))
+    get_windowed_stats().record_duel(winner_id, loser_id, chat_id, datetime.now(timezone.utc).timestamp())
+    end_fields = {"forfeit": True} if forfeit else {}
+    log_event("duel_end", chat=chat_id, winner=winner_id, loser=loser_id,
+              winner_name=winner_name, loser_name=loser_name,
+              score1=s1, score2=s2, **end_fields)
+
+    append_duel(
+        {
+            "p1": p1_name,
+            "p2": p2_name,
+            "p1_id": p1_id,
+            "p2_id": p2_id,
+            "score1": s1,
+            "score2": s2,
+            "winner": winner_name,
+            "winner_id": winner_id,
+            "chat": chat_id,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            **end_fields,
+        }
+    )
+
+    del game_state.ACTIVE_DUELS[chat_id]
+    journal_duel(chat_id)
+
+    return (
+        f"\n🏁 DUELLO FINITO!\n"
+        f"{p1_name} vs {p2_name}: {s1} - {s2}\n"
+        f"Vince {winner_name}!\n\n"
+        f"📈 ELO aggiornati:\n"
+        f"• {winner_name}: {winner.elo} ( +{elo_gain} )\n"
+        f"• {loser_name}: {ratings[loser_id]['elo']} ( {elo_loss} )"
+    )
 
 
 async def espansione_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -168,38 +243,38 @@ async def espansione_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user = update.message.from_user
     user_id = str(user.id)
 
-    scores = load_scores()
-    ensure_user_struct(scores, user_id, user.first_name)
-
-    last_triple = scores[user_id].get("last_triple_msg_id", None)
-    if last_triple is None:
-        return await update.message.reply_text(
-            "❌ Non puoi espandere il dominio senza una *TRIPLA*."
-        )
-
-    if update.message.message_id - last_triple > DOMAIN_EXPANSION_MESSAGE_WINDOW:
-        return await update.message.reply_text(
-            "⏳ La finestra di attivazione è scaduta.\n"
-            "La TRIPLA non risuona più con il dominio."
-        )
-        scores[user_id]["last_triple_msg_id"] = None
-        save_scores(scores)
-
+    async with get_score_store().user(user_id, user.first_name) as tx:
+        u = tx.user
 
-    if is_expansion_active(chat_id):
-        return await update.message.reply_text("Il dominio è già attivo.")
+        last_triple = u.last_triple_msg_id
+        if last_triple is None:
+            refusal = "❌ Non puoi espandere il dominio senza una *TRIPLA*."
+        elif update.message.message_id - last_triple > DOMAIN_EXPANSION_MESSAGE_WINDOW:
+            refusal = (
+                "⏳ La finestra di attivazione è scaduta.\n"
+                "La TRIPLA non risuona più con il dominio."
+            )
+        elif is_expansion_active(chat_id):
+            refusal = "Il dominio è già attivo."
+        else:
+            refusal = None
+            now_ts = datetime.now(timezone.utc).timestamp()
+            game_state.EXPANSION_UNTIL[chat_id] = now_ts + DOMAIN_EXPANSION_DURATION
+            journal_expansion(chat_id)
 
-    now_ts = datetime.now(timezone.utc).timestamp()
-    game_state.EXPANSION_UNTIL[chat_id] = now_ts + DOMAIN_EXPANSION_DURATION
+            # contatore domini
+            u.domains_used += 1
+            log_event("set", user=user_id, chat=chat_id, fields={"domains_used": u.domains_used})
 
-    # contatore domini
-    scores[user_id]["domains_used"] += 1
-    save_scores(scores)
+    # replies go out once the transaction is over: a slow send never holds the user's lock
+    if refusal:
+        return await reply(update.message, refusal)
 
     # Invio immagine dominio
     try:
         with open("immagini/dominio.jpg", "rb") as img:
-            await update.message.reply_photo(
+            await call(
+                update.message.chat_id, update.message.reply_photo,
                 photo=img,
                 caption=(
                     "🌌 *IDLE DEATH GAMBLE — DOMAIN EXPANSION*"
@@ -207,7 +282,8 @@ async def espansione_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 parse_mode="Markdown"
             )
             # frase epica stile Hakari, subito dopo l'immagine
-            await update.message.reply_text(
+            await reply(
+                update.message,
                 f"{user.first_name} non ha mai acquisito la tecnica inversa, ma…\n"
                 f"l'energia infinita che trabocca da {user.first_name} "
                 "forza la realtà istintivamente a riscriversi da sola pur di proteggerlo.\n\n"
@@ -216,7 +292,8 @@ async def espansione_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
 
     except Exception as e:
-        await update.message.reply_text(
+        await reply(
+            update.message,
             "⚠️ Errore nel caricare l'immagine del dominio.",
             parse_mode="Markdown"
         )
@@ -226,7 +303,7 @@ async def benedici_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Bless a random user"""
     users = load_users()
     if not users:
-        await update.message.reply_text("Non posso benedire nessuno, nessun utente.")
+        await reply(update.message, "Non posso benedire nessuno, nessun utente.")
         return
 
     user_id, name = random.choice(list(users.items()))
@@ -234,14 +311,14 @@ async def benedici_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"✨ *BENEDIZIONE DELLA SLOT*\n"
         f"Oggi il seed si è rivelato a {name}..."
     )
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    await reply(update.message, msg, parse_mode="Markdown")
 
 
 async def maledici_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Curse a random user"""
     users = load_users()
     if not users:
-        await update.message.reply_text("Non posso maledire nessuno, nessun utente.")
+        await reply(update.message, "Non posso maledire nessuno, nessun utente.")
         return
 
     user_id, name = random.choice(list(users.items()))
@@ -250,7 +327,7 @@ async def maledici_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"{name} è stato scelto.\n"
         f"Per le prossime 5 slot, la matematica riderà di lui."
     )
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    await reply(update.message, msg, parse_mode="Markdown")
 
 
 async def invoca_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -283,20 +360,20 @@ async def invoca_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Oggi {nome} è stato scelto."
         )
 
-        await update.message.reply_text(msg, parse_mode="Markdown")
+        await reply(update.message, msg, parse_mode="Markdown")
 
 
 async def sbusta_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Tag all users"""
     users = load_users()
     if not users:
-        await update.message.reply_text("Non c'è nessuno da taggare… gruppo fantasma 👻")
+        await reply(update.message, "Non c'è nessuno da taggare… gruppo fantasma 👻")
         return
 
     mentions = " ".join([f"@{name}" for name in users.values() if name])
     msg = f"📦 **È ORA DI SBUSTARE!**\n{mentions}\n\nAndiamo a sbustare?"
 
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    await reply(update.message, msg, parse_mode="Markdown")
 
 
 async def bestemmia_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -304,29 +381,29 @@ async def bestemmia_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     user_id = str(user.id)
 
-    scores = load_scores()
-    ensure_user_struct(scores, user_id, user.first_name)
+    async with get_score_store().user(user_id, user.first_name) as tx:
+        u = tx.user
 
-    sfiga = scores[user_id].get("sfiga", 0)
-    last_baseline = scores[user_id].get("last_bestemmia_sfiga", 0)
+        sfiga = u.sfiga
+        last_baseline = u.last_bestemmia_sfiga
 
-    if sfiga < 50:
-        return await update.message.reply_text(
-            "❌ Hai bisogno di almeno 50 skill issues consecutive per poter bestemmiare!"
-        )
-
-    if sfiga - last_baseline < 50:
-        needed = last_baseline + 50 - sfiga
-        return await update.message.reply_text(
-            f"🛑 Hai già bestemmiato di recente. Ti servono ancora {needed} skill issues prima di poterlo fare di nuovo."
-        )
+        if sfiga < 50:
+            refusal = "❌ Hai bisogno di almeno 50 skill issues consecutive per poter bestemmiare!"
+        elif sfiga - last_baseline < 50:
+            needed = last_baseline + 50 - sfiga
+            refusal = f"🛑 Hai già bestemmiato di recente. Ti servono ancora {needed} skill issues prima di poterlo fare di nuovo."
+        else:
+            refusal = None
+            # Allow the vent and record baseline
+            u.last_bestemmia_sfiga = sfiga
+            log_event("set", user=user_id, fields={"last_bestemmia_sfiga": sfiga})
+            unlock_achievement(tx.scores, user_id, "bestemmia")
 
-    # Allow the vent and record baseline
-    scores[user_id]["last_bestemmia_sfiga"] = sfiga
-    unlock_achievement(scores, user_id, "bestemmia")
-    save_scores(scores)
+    if refusal:
+        return await reply(update.message, refusal)
 
-    await update.message.reply_text(
+    await reply(
+        update.message,
         "🔥 *PORCO DIO* 🔥",
         parse_mode="Markdown"
     )
@@ -348,9 +425,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "• /sfida (in risposta) — Duello al meglio delle 3 vittorie\n"
         "• /topduelli — Classifica duelli\n"
         "• /storicosfide — Ultime 10 sfide\n"
+        "• /miesfide — I tuoi duelli e la tua serie\n"
+        "• /h2h (in risposta o con un nome) — Scontri diretti\n"
         "• Sistema ELO integrato con /tope\n\n"
         "📊 *Comandi:*\n"
         "• /score — Le tue statistiche personali\n"
+        "• /storico [n] — I tuoi ultimi tiri, simboli e fortuna\n"
         "• /top — Classifica punti\n"
         "• /topstreak — Classifica streak\n"
         "• /topsfiga — Classifica skill issue\n"
@@ -358,6 +438,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "• /topwinrate — Classifica winrate\n"
         "• /topspeed — Classifica velocità\n"
         "• /tope — Classifica ELO\n"
+        "• Nei gruppi le classifiche sono del gruppo: aggiungi `globale` (es. /top globale) per quella di tutti\n"
+        "• /top, /topcombo e /topwinrate anche per periodo: `oggi`, `settimana`, `mese`, `anno` (es. /top oggi)\n"
         "• /espansione — Attiva l'espansione del dominio\n"
         "• /bestemmia — Sfoga la tua frustrazione (richiede 50 sfighe)\n"
         "• /help — Questo magnifico manuale\n\n"
@@ -366,4 +448,4 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "Buona fortuna… ne avrai bisogno. 😈"
     )
 
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    await reply(update.message, msg, parse_mode="Markdown")
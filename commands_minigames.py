@@ -5,8 +5,10 @@ import random
 from datetime import datetime, timezone, timedelta
 from telegram import Update
 from telegram.ext import ContextTypes
-from storage import load_scores, save_scores
-from models import ensure_user_struct, unlock_achievement
+from storage import get_score_store
+from models import unlock_achievement
+from events import log_event
+from outbox import reply
 
 
 # Tarocchi data
@@ -77,39 +79,43 @@ async def tarocchi_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(message.from_user.id)
     user_name = message.from_user.first_name
     
-    scores = load_scores()
-    ensure_user_struct(scores, user_id, user_name)
-    
+    async with get_score_store().user(user_id, user_name) as tx:
+        msg = _draw_tarocchi(tx, user_id, user_name)
+    # sent once the transaction is over: a slow send never holds the user's lock
+    await reply(message, msg, parse_mode="Markdown")
+
+
+def _draw_tarocchi(tx, user_id: str, user_name: str) -> str:
+    """Draw the user's card of the day; returns the reply"""
+    u = tx.user
+
     # Check one-per-day cooldown
     now_ts = datetime.now(timezone.utc).timestamp()
-    last_tarocchi = scores[user_id].get("last_tarocchi_ts", 0)
-    
+    last_tarocchi = u.last_tarocchi_ts
+
     if last_tarocchi > 0 and now_ts - last_tarocchi < 86400:
         hours_remaining = int((86400 - (now_ts - last_tarocchi)) / 3600)
-        return await message.reply_text(
+        return (
             f"🔮 Le carte sono già state rivelate!\n"
-            f"Torneranno disponibili tra circa {hours_remaining} ore.",
-            parse_mode="Markdown"
+            f"Torneranno disponibili tra circa {hours_remaining} ore."
         )
-    
+
     # Update last tarocchi timestamp
-    scores[user_id]["last_tarocchi_ts"] = now_ts
-    save_scores(scores)
-    
+    u.last_tarocchi_ts = now_ts
+
     # Draw card
     card = random.choice(TAROCCHI)
-    
+
     msg = (
         f"🔮 *LETTURA DEI TAROCCHI* 🔮\n\n"
         f"*{card[0]}*\n\n"
         f"_{card[1]}_\n\n"
         f"✨ La carta ha parlato, {user_name}. Il destino è nelle tue mani."
     )
-    
-    unlock_achievement(scores, user_id, "tarot_reader")
-    save_scores(scores)
-    
-    await message.reply_text(msg, parse_mode="Markdown")
+
+    unlock_achievement(tx.scores, user_id, "tarot_reader")
+
+    return msg
 
 
 async def lotteria_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -118,39 +124,48 @@ async def lotteria_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(message.from_user.id)
     user_name = message.from_user.first_name
     
-    scores = load_scores()
-    ensure_user_struct(scores, user_id, user_name)
-    
+    async with get_score_store().user(user_id, user_name) as tx:
+        msg = _draw_lotteria(tx, user_id, user_name)
+    # sent once the transaction is over: a slow send never holds the user's lock
+    await reply(message, msg, parse_mode="Markdown")
+
+
+def _draw_lotteria(tx, user_id: str, user_name: str) -> str:
+    """Play the user's weekly lottery ticket; returns the reply"""
+    u = tx.user
+
     # Check one-per-week cooldown (7 giorni)
     now_ts = datetime.now(timezone.utc).timestamp()
-    last_lotteria = scores[user_id].get("last_lotteria_ts", 0)
-    
+    last_lotteria = u.last_lotteria_ts
+
     if last_lotteria > 0 and now_ts - last_lotteria < 604800:
         days_remaining = int((604800 - (now_ts - last_lotteria)) / 86400)
-        return await message.reply_text(
+        return (
             f"🎰 Hai già partecipato a questa settimana!\n"
-            f"La prossima estrazione sarà tra circa {days_remaining} giorni.",
-            parse_mode="Markdown"
+            f"La prossima estrazione sarà tra circa {days_remaining} giorni."
         )
-    
+
     # Update last lotteria timestamp
-    scores[user_id]["last_lotteria_ts"] = now_ts
+    u.last_lotteria_ts = now_ts
+
+    # Read current jackpot (stored in scores under key _jackpot); touched
+    # first, so a rollback restores it along with the user
+    tx.touch("_jackpot")
+    jackpot = tx.scores.get("_jackpot", 0)
 
-    # Read current jackpot (stored in scores under key _jackpot)
-    jackpot = scores.get("_jackpot", 0)
-    
     # Draw lucky number
     lucky_num = random.randint(1, 100)
     user_num = random.randint(1, 100)
-    
+
     # 20% chance to win
     won = user_num == lucky_num or random.random() < 0.20
-    
+
+    prize = 0
     if won:
         prize = jackpot + random.randint(100, 500)
-        scores[user_id]["points"] += prize
+        u.points += prize
         jackpot = 50  # Reset jackpot
-        
+    
         msg = (
             f"🎰 *LOTTERIA SETTIMANALE* 🎰\n\n"
             f"🍀 *VINCITA!*\n"
@@ -159,10 +174,10 @@ async def lotteria_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🏆 Hai vinto: *{prize} punti*!\n"
             f"Congratulazioni {user_name}! La fortuna è dalla tua parte!"
         )
-        unlock_achievement(scores, user_id, "lottery_winner")
+        unlock_achievement(tx.scores, user_id, "lottery_winner")
     else:
         jackpot += 50  # Add to jackpot for next winner
-        
+    
         msg = (
             f"🎰 *LOTTERIA SETTIMANALE* 🎰\n\n"
             f"❌ *SFORTUNATO*\n"
@@ -173,10 +188,10 @@ async def lotteria_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     # Save both scores and updated jackpot
-    scores["_jackpot"] = jackpot
-    save_scores(scores)
-    
-    await message.reply_text(msg, parse_mode="Markdown")
+    tx.scores["_jackpot"] = jackpot
+    log_event("lottery", user=user_id, name=user_name, ts=now_ts, won=won, prize=prize, jackpot=jackpot)
+
+    return msg
 
 
 async def evento_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -185,9 +200,16 @@ async def evento_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(message.from_user.id)
     user_name = message.from_user.first_name
     
-    scores = load_scores()
-    ensure_user_struct(scores, user_id, user_name)
-    
+    async with get_score_store().user(user_id, user_name) as tx:
+        msg = _play_evento(tx, user_id, user_name)
+    # sent once the transaction is over: a slow send never holds the user's lock
+    await reply(message, msg, parse_mode="Markdown")
+
+
+def _play_evento(tx, user_id: str, user_name: str) -> str:
+    """Play the Sunday event; returns the reply"""
+    u = tx.user
+
     # Check if it's Sunday (weekday 6)
     from datetime import datetime, timezone, timedelta
     now = datetime.now(timezone.utc)
@@ -195,36 +217,35 @@ async def evento_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         days_until_sunday = (6 - now.weekday()) % 7
         if days_until_sunday == 0:
             days_until_sunday = 7
-        return await message.reply_text(
+        return (
             f"⚡ L'evento è solo di domenica!\n"
-            f"Torna tra {days_until_sunday} giorni per partecipare.",
-            parse_mode="Markdown"
+            f"Torna tra {days_until_sunday} giorni per partecipare."
         )
-    
+
     # Check one-per-week cooldown
     now_ts = datetime.now(timezone.utc).timestamp()
-    last_evento = scores[user_id].get("last_evento_ts", 0)
-    
+    last_evento = u.last_evento_ts
+
     if last_evento > 0 and now_ts - last_evento < 604800:  # 604800 = 7 giorni
         days_remaining = int((604800 - (now_ts - last_evento)) / 86400)
-        return await message.reply_text(
+        return (
             f"⚡ Hai già partecipato all'evento questa settimana!\n"
-            f"Il prossimo sarà disponibile tra circa {days_remaining} giorni.",
-            parse_mode="Markdown"
+            f"Il prossimo sarà disponibile tra circa {days_remaining} giorni."
         )
-    
+
     # Update last evento timestamp
-    scores[user_id]["last_evento_ts"] = now_ts
-    
+    u.last_evento_ts = now_ts
+
     # Pick random evento
     event = random.choice(EVENTOS)
-    
+    points_before = u.points
+
     # Simulate event outcome (simplified version)
     if event["name"] == "Duello Rapido":
         rolls = [random.randint(1, 64) for _ in range(3)]
         wins = sum(1 for r in rolls if r >= 43)
         reward = event["rewards"][wins]
-        scores[user_id]["points"] += reward
+        u.points += reward
         msg = (
             f"{event['emoji']} *{event['name'].upper()}* {event['emoji']}\n\n"
             f"{event['desc']}\n\n"
@@ -240,7 +261,7 @@ async def evento_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 hits += 1
         if hits > 0:
             reward = event["rewards"]
-            scores[user_id]["points"] += reward
+            u.points += reward
             msg = (
                 f"{event['emoji']} *{event['name'].upper()}* {event['emoji']}\n\n"
                 f"{event['desc']}\n\n"
@@ -258,7 +279,7 @@ async def evento_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif event["name"] == "Sfida della Velocità":
         # simulate how many slots the user would manage in 10 seconds
         rolls = random.randint(0, 20)  # arbitrary range
-        scores[user_id]["points"] += rolls
+        u.points += rolls
         msg = (
             f"{event['emoji']} *{event['name'].upper()}* {event['emoji']}\n\n"
             f"{event['desc']}\n\n"
@@ -269,16 +290,16 @@ async def evento_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         roll = random.randint(1, 64)
         if roll >= 43:
             multiplier = 3
-            old_points = scores[user_id]["points"]
-            scores[user_id]["points"] *= multiplier
+            old_points = u.points
+            u.points *= multiplier
             msg = (
                 f"{event['emoji']} *{event['name'].upper()}* {event['emoji']}\n\n"
                 f"{event['desc']}\n\n"
                 f"🎲 Hai tirato un numero vincente!\n"
-                f"💰 I tuoi punti sono passati da {old_points} a {scores[user_id]['points']}!"
+                f"💰 I tuoi punti sono passati da {old_points} a {u['points']}!"
             )
         else:
-            scores[user_id]["points"] -= 10
+            u.points -= 10
             msg = (
                 f"{event['emoji']} *{event['name'].upper()}* {event['emoji']}\n\n"
                 f"{event['desc']}\n\n"
@@ -288,14 +309,15 @@ async def evento_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         # Generic event
         reward = random.randint(20, 50)
-        scores[user_id]["points"] += reward
+        u.points += reward
         msg = (
             f"{event['emoji']} *{event['name'].upper()}* {event['emoji']}\n\n"
             f"{event['desc']}\n\n"
             f"🏆 Hai vinto *{reward} punti*!"
         )
-    
-    unlock_achievement(scores, user_id, "event_master")
-    save_scores(scores)
-    
-    await message.reply_text(msg, parse_mode="Markdown")
+
+    unlock_achievement(tx.scores, user_id, "event_master")
+    log_event("evento", user=user_id, name=user_name, ts=now_ts, evento=event["name"],
+              delta=u.points - points_before)
+
+    return msg
@@ -1,11 +1,111 @@
 """
 Stats and leaderboard commands
 """
+from datetime import datetime, timezone
+from typing import Callable, Optional, Tuple
 from telegram import Update
 from telegram.ext import ContextTypes
-from storage import load_scores, load_duels, load_users
+from storage import load_global_scores, load_users
+from duel_history import get_duel_history
+from ratings import get_rating_engine
+from windows import WINDOWS, WINDOW_WINRATE_MIN_SLOTS, day_number, get_windowed_stats
+from render_cache import get_render_cache
+from roll_history import get_roll_history, reels, luck, timing, SYMBOL_EMOJI, WIN_ODDS
 from utils import format_winrate
 from models import get_achievements_display
+from leaderboard import LeaderboardIndex, get_leaderboard_index
+from outbox import reply
+
+
+# /top global, /top globale: the whole bot instead of the current group
+GLOBAL_SCOPE_ARGS = {"global", "globale", "tutti"}
+
+
+def leaderboard_scope(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Tuple[LeaderboardIndex, str]:
+    """Index to read and heading suffix: the current group's shard by
+    default, the global scores in private chats or with a 'global' arg"""
+    message = update.message
+    if any(str(arg).lower() in GLOBAL_SCOPE_ARGS for arg in context.args or ()):
+        return get_leaderboard_index(), " — globale"
+    if message.chat.type in ("group", "supergroup"):
+        return get_leaderboard_index(message.chat_id), " — questo gruppo"
+    return get_leaderboard_index(), ""
+
+
+# /top oggi, /topwinrate settimana...: heading of each window
+WINDOW_LABELS = {
+    "oggi": "oggi",
+    "settimana": "ultimi 7 giorni",
+    "mese": "ultimi 30 giorni",
+    "anno": "ultimo anno",
+}
+
+
+def window_arg(context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+    """The time window asked for (oggi, settimana, mese, anno), if any"""
+    for arg in context.args or ():
+        if str(arg).lower() in WINDOWS:
+            return str(arg).lower()
+    return None
+
+
+# (text, parse_mode) of a board reply
+Rendered = Tuple[str, Optional[str]]
+
+
+async def board_reply(update: Update, key: tuple, token: tuple, render: Callable[[], Rendered]) -> None:
+    """Send a board, rendered only when its token changed since the last
+    time (see render_cache.py)"""
+    text, parse_mode = get_render_cache().get_or_render(key, token, render)
+    if parse_mode:
+        await reply(update.message, text, parse_mode=parse_mode)
+    else:
+        await reply(update.message, text)
+
+
+async def index_board(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str,
+                      render: Callable[[LeaderboardIndex, str], Rendered]) -> None:
+    """A board of the leaderboard index, cached until its scores change"""
+    index, scope = leaderboard_scope(update, context)
+    key = (command, getattr(index.store, "chat_id", None), scope, None)
+    await board_reply(update, key, (index.store.version,), lambda: render(index, scope))
+
+
+async def window_board(update: Update, context: ContextTypes.DEFAULT_TYPE, window: str,
+                       metric: str, title: str, empty: str, fmt) -> None:
+    """A board over a time window, from the rolling counters in windows.py;
+    ``fmt(value, totals)`` renders one row"""
+    index, scope = leaderboard_scope(update, context)
+    chat_id = getattr(index.store, "chat_id", None)
+    stats = get_windowed_stats()
+
+    def render() -> Rendered:
+        rows = stats.top(metric, window, chat_id)
+        if not rows:
+            return empty, None
+        users = load_users()
+        lines = [f"{title} — {WINDOW_LABELS[window]}{scope}"]
+        for i, (uid, value, totals) in enumerate(rows, start=1):
+            lines.append(f"{i}. {users.get(uid, uid)} — {fmt(value, totals)}")
+        return "\n".join(lines), "Markdown"
+
+    # the day is part of the token: yesterday's rolls leave /top oggi at midnight
+    today = day_number(datetime.now(timezone.utc).timestamp())
+    token = (index.store.version, stats.version, today)
+    await board_reply(update, (metric, chat_id, scope, window), token, render)
+
+
+# Boards listed in /score, in display order
+RANK_LABELS = [
+    ("points", "Punti"),
+    ("best_streak", "Streak"),
+    ("best_sfiga", "Skill issue"),
+    ("combo", "Combo"),
+    ("winrate", "Winrate"),
+    ("best_speed", "Velocità"),
+    ("elo", "ELO"),
+    ("duel_wins", "Duelli"),
+]
 
 
 async def score_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -14,10 +114,10 @@ async def score_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     user_id = str(user.id)
     nome = user.first_name
 
-    scores = load_scores()
+    scores = load_global_scores()
 
     if user_id not in scores:
-        await update.message.reply_text(f"{nome}, non hai ancora nessuna statistica. 🎰")
+        await reply(update.message, f"{nome}, non hai ancora nessuna statistica. 🎰")
         return
 
     d = scores[user_id]
@@ -39,221 +139,338 @@ async def score_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         f"• Doppie: {d.get('double', 0)} — Triple: {d.get('triple', 0)} — Poker: {d.get('quad', 0)} — Cinquine: {d.get('quint', 0)}\n"
         f"• Record velocità: {best_speed:.3f} slot/s\n"
         f"• Duelli: {d.get('duel_wins', 0)} vittorie / {d.get('duel_losses', 0)} sconfitte\n"
+    )
+    glicko = get_rating_engine().glicko_of(user_id)
+    if glicko is not None:
+        msg += f"• Glicko-2: {glicko[0]:.0f} ± {2 * glicko[1]:.0f}\n"
+    msg += (
         f"• Domini espansi: {d.get('domains_used', 0)}\n"
     )
     
+    # Position in every board the player appears in
+    index = get_leaderboard_index()
+    ranks = []
+    for metric, label in RANK_LABELS:
+        rank = index.rank(metric, user_id)
+        if rank is not None:
+            ranks.append(f"  {label}: #{rank[0]}/{rank[1]}")
+    if ranks:
+        msg += "\n🏅 Posizioni in classifica:\n" + "\n".join(ranks) + "\n"
+
     # Add achievements
     achievements = get_achievements_display(scores, user_id)
     if achievements:
         msg += achievements
 
-    await update.message.reply_text(msg)
+    await reply(update.message, msg)
 
 
 async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show points leaderboard"""
-    scores = load_scores()
-    if not scores:
-        await update.message.reply_text("Nessun punteggio ancora. Qualcuno tiri una slot! 🎰")
-        return
-
-    # Filter out corrupted entries (ensure all values are dicts)
-    clean_scores = {k: v for k, v in scores.items() if isinstance(v, dict) and "points" in v}
-    if not clean_scores:
-        await update.message.reply_text("Nessun punteggio valido. Qualcuno tiri una slot! 🎰")
-        return
+    """Show points leaderboard (over a time window with oggi/settimana/mese/anno)"""
+    window = window_arg(context)
+    if window:
+        return await window_board(
+            update, context, window, "points", "🏆 *CLASSIFICA PUNTI*",
+            "Nessun punto guadagnato in questo periodo. 🎰", lambda v, t: f"{v} punti"
+        )
+    await index_board(update, context, "top", render_top)
 
-    sorted_players = sorted(clean_scores.items(), key=lambda x: x[1]["points"], reverse=True)
 
-    lines = ["🏆 *CLASSIFICA PUNTI*"]
-    for i, (_, d) in enumerate(sorted_players[:10], start=1):
-        lines.append(f"{i}. {d['name']} — {d['points']} punti")
+def render_top(index: LeaderboardIndex, scope: str) -> Rendered:
+    if not index.size("points"):
+        return "Nessun punteggio ancora. Qualcuno tiri una slot! 🎰", None
 
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+    scores = index.store.load()
+    lines = [f"🏆 *CLASSIFICA PUNTI*{scope}"]
+    for i, (uid, points) in enumerate(index.top("points", 10), start=1):
+        lines.append(f"{i}. {scores[uid]['name']} — {points} punti")
+    return "\n".join(lines), "Markdown"
 
 
 async def topstreak_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show streak leaderboard"""
-    scores = load_scores()
-    if not scores:
-        await update.message.reply_text("Nessuna streak registrata.")
-        return
-
-    # Filter out corrupted entries
-    clean_scores = {k: v for k, v in scores.items() if isinstance(v, dict) and "best_streak" in v}
-    if not clean_scores:
-        await update.message.reply_text("Nessuna streak registrata.")
-        return
+    await index_board(update, context, "topstreak", render_topstreak)
 
-    sorted_players = sorted(clean_scores.items(), key=lambda x: x[1]["best_streak"], reverse=True)
 
-    lines = ["🔥 *CLASSIFICA STREAK*"]
-    for i, (_, d) in enumerate(sorted_players[:10], start=1):
-        lines.append(f"{i}. {d['name']} — {d['best_streak']} di fila")
+def render_topstreak(index: LeaderboardIndex, scope: str) -> Rendered:
+    if not index.size("best_streak"):
+        return "Nessuna streak registrata.", None
 
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+    scores = index.store.load()
+    lines = [f"🔥 *CLASSIFICA STREAK*{scope}"]
+    for i, (uid, best_streak) in enumerate(index.top("best_streak", 10), start=1):
+        lines.append(f"{i}. {scores[uid]['name']} — {best_streak} di fila")
+    return "\n".join(lines), "Markdown"
 
 
 async def topsfiga_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show skill issue leaderboard"""
-    scores = load_scores()
-    if not scores:
-        await update.message.reply_text("Nessuna skill issue registrata.")
-        return
+    await index_board(update, context, "topsfiga", render_topsfiga)
 
-    # Filter out corrupted entries
-    clean_scores = {k: v for k, v in scores.items() if isinstance(v, dict) and "best_sfiga" in v}
-    if not clean_scores:
-        await update.message.reply_text("Nessun sfiga registrata.")
-        return
 
-    sorted_players = sorted(clean_scores.items(), key=lambda x: x[1]["best_sfiga"], reverse=True)
+def render_topsfiga(index: LeaderboardIndex, scope: str) -> Rendered:
+    if not index.size("best_sfiga"):
+        return "Nessuna skill issue registrata.", None
 
-    lines = ["💀 *CLASSIFICA DELLA SKILL ISSUE*"]
-    for i, (_, d) in enumerate(sorted_players[:10], start=1):
-        lines.append(f"{i}. {d['name']} — {d['best_sfiga']} fallimenti consecutivi")
-
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+    scores = index.store.load()
+    lines = [f"💀 *CLASSIFICA DELLA SKILL ISSUE*{scope}"]
+    for i, (uid, best_sfiga) in enumerate(index.top("best_sfiga", 10), start=1):
+        lines.append(f"{i}. {scores[uid]['name']} — {best_sfiga} fallimenti consecutivi")
+    return "\n".join(lines), "Markdown"
 
 
 async def topcombo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show combo leaderboard"""
-    scores = load_scores()
-    if not scores:
-        return await update.message.reply_text("Nessuna combo registrata.")
-
-    players = []
-    for _, d in scores.items():
-        total_combo = d.get("double", 0) + d.get("triple", 0) + d.get("quad", 0) + d.get("quint", 0)
-        if total_combo > 0:
-            players.append(
-                (
-                    d["name"],
-                    d.get("double", 0),
-                    d.get("triple", 0),
-                    d.get("quad", 0),
-                    d.get("quint", 0),
-                    total_combo,
-                )
-            )
-
-    if not players:
-        return await update.message.reply_text("Nessuna combo registrata.")
-
-    players.sort(key=lambda x: x[5], reverse=True)
-
-    lines = ["🎯 *CLASSIFICA COMBO* (doppie/triple/poker/cinquine)"]
-    for i, (name, d2, t3, q4, q5, tot) in enumerate(players[:10], start=1):
-        lines.append(f"{i}. {name} — {tot} combo (2x:{d2}, 3x:{t3}, 4x:{q4}, 5x:{q5})")
-
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+    """Show combo leaderboard (over a time window with oggi/settimana/mese/anno)"""
+    window = window_arg(context)
+    if window:
+        return await window_board(
+            update, context, window, "combo", "🎯 *CLASSIFICA COMBO*",
+            "Nessuna combo in questo periodo.", lambda v, t: f"{v} combo su {t['slots']} slot"
+        )
+    await index_board(update, context, "topcombo", render_topcombo)
 
 
-async def topwinrate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show winrate leaderboard (min 10 slots)"""
-    scores = load_scores()
-    if not scores:
-        return await update.message.reply_text("Nessuna statistica ancora.")
+def render_topcombo(index: LeaderboardIndex, scope: str) -> Rendered:
+    if not index.size("combo"):
+        return "Nessuna combo registrata.", None
+
+    scores = index.store.load()
+    lines = [f"🎯 *CLASSIFICA COMBO* (doppie/triple/poker/cinquine){scope}"]
+    for i, (uid, tot) in enumerate(index.top("combo", 10), start=1):
+        d = scores[uid]
+        lines.append(
+            f"{i}. {d['name']} — {tot} combo (2x:{d.get('double', 0)}, 3x:{d.get('triple', 0)}, "
+            f"4x:{d.get('quad', 0)}, 5x:{d.get('quint', 0)})"
+        )
+    return "\n".join(lines), "Markdown"
 
-    players = []
-    for _, d in scores.items():
-        total_slots = d.get("total_slots", 0)
-        total_wins = d.get("total_wins", 0)
-        if total_slots >= 10:
-            wr = total_wins / total_slots if total_slots > 0 else 0
-            players.append((d["name"], wr, total_slots))
 
-    if not players:
-        return await update.message.reply_text("Nessuno ha ancora abbastanza slot per una classifica seria (minimo 10).")
+async def topwinrate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show winrate leaderboard (min 10 slots; over a time window with
+    oggi/settimana/mese/anno)"""
+    window = window_arg(context)
+    if window:
+        return await window_board(
+            update, context, window, "winrate", f"📈 *CLASSIFICA WINRATE* (min {WINDOW_WINRATE_MIN_SLOTS} slot)",
+            "Nessuno ha abbastanza slot in questo periodo per una classifica seria.",
+            lambda v, t: f"{v*100:.2f}% su {t['slots']} slot"
+        )
+    await index_board(update, context, "topwinrate", render_topwinrate)
 
-    players.sort(key=lambda x: x[1], reverse=True)
 
-    lines = ["📈 *CLASSIFICA WINRATE* (min 10 slot)"]
-    for i, (name, wr, ts) in enumerate(players[:10], start=1):
-        lines.append(f"{i}. {name} — {wr*100:.2f}% su {ts} slot")
+def render_topwinrate(index: LeaderboardIndex, scope: str) -> Rendered:
+    if not index.size("elo"):
+        return "Nessuna statistica ancora.", None
 
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+    if not index.size("winrate"):
+        return "Nessuno ha ancora abbastanza slot per una classifica seria (minimo 10).", None
+
+    scores = index.store.load()
+    lines = [f"📈 *CLASSIFICA WINRATE* (min 10 slot){scope}"]
+    for i, (uid, wr) in enumerate(index.top("winrate", 10), start=1):
+        d = scores[uid]
+        lines.append(f"{i}. {d['name']} — {wr*100:.2f}% su {d.get('total_slots', 0)} slot")
+    return "\n".join(lines), "Markdown"
 
 
 async def topspeed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show speed leaderboard"""
-    scores = load_scores()
-    if not scores:
-        return await update.message.reply_text("Nessuna slot ancora, nessuna velocità da misurare.")
+    await index_board(update, context, "topspeed", render_topspeed)
+
 
-    players = []
-    for _, d in scores.items():
-        bs = d.get("best_speed", 0.0)
-        if bs > 0:
-            players.append((d["name"], bs))
+def render_topspeed(index: LeaderboardIndex, scope: str) -> Rendered:
+    if not index.size("elo"):
+        return "Nessuna slot ancora, nessuna velocità da misurare.", None
 
-    if not players:
-        return await update.message.reply_text("Nessun record di velocità registrato.")
+    if not index.size("best_speed"):
+        return "Nessun record di velocità registrato.", None
 
-    players.sort(key=lambda x: x[1], reverse=True)
+    scores = index.store.load()
+    lines = [f"⚡ *CLASSIFICA VELOCITÀ SLOT* (slot/s){scope}"]
+    for i, (uid, bs) in enumerate(index.top("best_speed", 10), start=1):
+        lines.append(f"{i}. {scores[uid]['name']} — {bs:.3f} slot/s")
+    return "\n".join(lines), "Markdown"
 
-    lines = ["⚡ *CLASSIFICA VELOCITÀ SLOT* (slot/s)"]
-    for i, (name, bs) in enumerate(players[:10], start=1):
-        lines.append(f"{i}. {name} — {bs:.3f} slot/s")
 
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+# /tope glicko: the Glicko-2 board replayed from the duel history
+GLICKO_ARGS = {"glicko", "glicko2"}
 
 
 async def tope_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show ELO leaderboard"""
-    scores = load_scores()
-    if not scores:
-        return await update.message.reply_text("Nessun ELO registrato.")
+    """Show ELO leaderboard (or the Glicko-2 one with a 'glicko' arg)"""
+    if context.args and str(context.args[0]).lower() in GLICKO_ARGS:
+        top = get_rating_engine().glicko_top(10)
+        if not top:
+            return await reply(update.message, "Nessun duello registrato.")
+        users = load_users()
+        lines = ["🏅 *CLASSIFICA GLICKO-2* (dai duelli)"]
+        for i, (uid, rating, rd) in enumerate(top, start=1):
+            lines.append(f"{i}. {users.get(uid, uid)} — {rating:.0f} ± {2 * rd:.0f}")
+        return await reply(update.message, "\n".join(lines), parse_mode="Markdown")
 
-    players = []
-    for _, d in scores.items():
-        players.append((d["name"], d.get("elo", 1000)))
+    await index_board(update, context, "tope", render_tope)
 
-    players.sort(key=lambda x: x[1], reverse=True)
 
-    lines = ["🏅 *CLASSIFICA ELO*"]
-    for i, (name, elo) in enumerate(players[:10], start=1):
-        lines.append(f"{i}. {name} — {elo}")
+def render_tope(index: LeaderboardIndex, scope: str) -> Rendered:
+    if not index.size("elo"):
+        return "Nessun ELO registrato.", None
 
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+    scores = index.store.load()
+    lines = [f"🏅 *CLASSIFICA ELO*{scope}"]
+    for i, (uid, elo) in enumerate(index.top("elo", 10), start=1):
+        lines.append(f"{i}. {scores[uid]['name']} — {elo}")
+    return "\n".join(lines), "Markdown"
 
 
 async def topduelli_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show duel leaderboard"""
-    scores = load_scores()
-    if not scores:
-        return await update.message.reply_text("Nessun duello registrato.")
+    await index_board(update, context, "topduelli", render_topduelli)
 
-    players = []
-    for _, d in scores.items():
-        wins = d.get("duel_wins", 0)
-        losses = d.get("duel_losses", 0)
-        if wins + losses > 0:
-            players.append((d["name"], wins, losses))
 
-    if not players:
-        return await update.message.reply_text("Nessun duello registrato.")
+def render_topduelli(index: LeaderboardIndex, scope: str) -> Rendered:
+    if not index.size("duel_wins"):
+        return "Nessun duello registrato.", None
 
-    players.sort(key=lambda x: x[1], reverse=True)
-
-    lines = ["⚔️ *CLASSIFICA DUELLI*"]
-    for i, (name, w, l) in enumerate(players[:10], start=1):
-        lines.append(f"{i}. {name} — {w} vittorie / {l} sconfitte")
-
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+    scores = index.store.load()
+    lines = [f"⚔️ *CLASSIFICA DUELLI*{scope}"]
+    for i, (uid, w) in enumerate(index.top("duel_wins", 10), start=1):
+        d = scores[uid]
+        lines.append(f"{i}. {d['name']} — {w} vittorie / {d.get('duel_losses', 0)} sconfitte")
+    return "\n".join(lines), "Markdown"
 
 
 async def storicosfide_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show last 10 duels"""
-    duels = load_duels()
+    duels = get_duel_history().recent(10)
     if not duels:
-        return await update.message.reply_text("Nessuna sfida in archivio.")
+        return await reply(update.message, "Nessuna sfida in archivio.")
 
-    last = duels[-10:]
     lines = ["📜 *STORICO SFIDE* (ultime 10)"]
-    for d in reversed(last):
-        lines.append(
-            f"{d['p1']} vs {d['p2']}: {d['score1']} - {d['score2']} (vincitore: {d['winner']})"
-        )
+    for d in duels:
+        lines.append(format_duel(d))
+
+    await reply(update.message, "\n".join(lines), parse_mode="Markdown")
+
 
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+def format_duel(d) -> str:
+    """One line of a duel list"""
+    return f"{d['p1']} vs {d['p2']}: {d['score1']} - {d['score2']} (vincitore: {d['winner']})"
+
+
+def format_streak(streak: int) -> str:
+    if streak > 0:
+        return f"{streak} vittori{'a' if streak == 1 else 'e'} di fila"
+    if streak < 0:
+        return f"{-streak} sconfitt{'a' if streak == -1 else 'e'} di fila"
+    return "nessuna"
+
+
+async def miesfide_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the user's duel record and last 10 duels"""
+    user = update.message.from_user
+    user_id = str(user.id)
+    history = get_duel_history()
+    duels = history.for_player(user_id, limit=10)
+    if not duels:
+        return await reply(update.message, f"{user.first_name}, non hai ancora duelli in archivio. ⚔️")
+
+    record = history.record(user_id)
+    lines = [
+        f"⚔️ Duelli di {user.first_name}:",
+        f"• Vittorie: {record['wins']} — Sconfitte: {record['losses']}",
+        f"• Serie attuale: {format_streak(record['streak'])}",
+        f"• Miglior serie: {record['best_streak']}",
+        "",
+        "📜 Ultimi duelli:",
+    ]
+    lines += [format_duel(d) for d in duels]
+    await reply(update.message, "\n".join(lines))
+
+
+def find_user_id(name: str) -> Optional[str]:
+    """Id of the user with this display name (case-insensitive), if unique"""
+    wanted = name.strip().lstrip("@").casefold()
+    matches = [user_id for user_id, known in load_users().items()
+               if not user_id.startswith("_") and isinstance(known, str) and known.casefold() == wanted]
+    return matches[0] if len(matches) == 1 else None
+
+
+async def h2h_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the head-to-head record against another player
+    (reply to their message, or /h2h <nome>)"""
+    message = update.message
+    user = message.from_user
+    user_id = str(user.id)
+    if message.reply_to_message:
+        opponent_id = str(message.reply_to_message.from_user.id)
+    elif context.args:
+        opponent_id = find_user_id(" ".join(context.args))
+        if opponent_id is None:
+            return await reply(message, "Non conosco nessun giocatore con quel nome (o ce n'è più di uno).")
+    else:
+        return await reply(message, "Usa /h2h rispondendo a un messaggio dell'avversario, oppure /h2h <nome>.")
+    if opponent_id == user_id:
+        return await reply(message, "Contro te stesso sei sempre in parità. 🪞")
+
+    users = load_users()
+    opponent_name = users.get(opponent_id, "l'avversario")
+    history = get_duel_history()
+    duels = history.head_to_head(user_id, opponent_id, limit=5)
+    if not duels:
+        return await reply(message, f"Nessun duello tra {user.first_name} e {opponent_name}.")
+
+    record = history.record(user_id, opponent_id)
+    lines = [
+        f"🤺 {user.first_name} vs {opponent_name}",
+        f"• Bilancio: {record['wins']} - {record['losses']}",
+        f"• Serie attuale di {user.first_name}: {format_streak(record['streak'])}",
+        "",
+        "📜 Ultimi scontri:",
+    ]
+    lines += [format_duel(d) for d in duels]
+    await reply(message, "\n".join(lines))
+
+
+# /storico [n]: how many rolls to list by default, and at most
+STORICO_DEFAULT = 20
+STORICO_MAX = 50
+
+
+async def storico_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the user's last rolls, symbol rates and luck against the odds"""
+    user = update.message.from_user
+    ring = get_roll_history().get(str(user.id))
+    if not ring:
+        return await reply(update.message, f"{user.first_name}, nessun tiro registrato ancora. 🎰")
+
+    shown = STORICO_DEFAULT
+    if context.args:
+        try:
+            shown = max(1, min(int(context.args[0]), STORICO_MAX))
+        except ValueError:
+            pass
+    rolls = [value for value, _ in ring.recent()]
+    last = rolls[-shown:]
+    stats = luck(rolls)
+
+    lines = [f"🎰 Ultimi {len(last)} tiri di {user.first_name} (dal più vecchio):"]
+    for start in range(0, len(last), 5):
+        lines.append("  ".join("".join(SYMBOL_EMOJI[s] for s in reels(v)) for v in last[start:start + 5]))
+    lines += [
+        "",
+        f"📊 Sugli ultimi {stats['rolls']} tiri:",
+        f"• Vincite: {stats['wins']} ({stats['wins'] / stats['rolls'] * 100:.1f}%, "
+        f"attese {WIN_ODDS * 100:.2f}% → {stats['expected']:.1f})",
+        f"• Jackpot 777: {stats['jackpots']}",
+        "• Simboli sui rulli: " + ", ".join(
+            f"{SYMBOL_EMOJI[s]} {rate * 100:.0f}%" for s, rate in stats["symbols"].items()
+        ),
+    ]
+    if stats["z"] >= 2:
+        lines.append("🍀 Fortuna sfacciata: ben sopra le probabilità.")
+    elif stats["z"] <= -2:
+        lines.append("💀 Sfortuna certificata: ben sotto le probabilità.")
+    rhythm = timing(ring.gaps())
+    if rhythm is not None:
+        lines.append(f"• Ritmo: un tiro ogni {rhythm['mean']:.1f}s quando giochi di fila")
+    await reply(update.message, "\n".join(lines))
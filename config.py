@@ -8,10 +8,113 @@ from typing import Set
 TOKEN = os.getenv("TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 
+# Webhook mode: with WEBHOOK_URL set (the public https address Telegram posts
+# to) the bot serves updates over HTTP instead of long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
 # File paths
 SCORES_FILE = "scores.json"
 USERS_FILE = "users.json"
 DUELS_FILE = "duels.json"
+SCORES_PACK_FILE = "scores.pack"
+SNAPSHOT_DIR = "leaderboard_snapshots"
+CHAT_SCORES_DIR = "chat_scores"
+
+# Storage backend: "json" (the files above), "binary" (scores in the compact
+# scores.pack, see scorepack.py, the rest as JSON) or "sqlite"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_FILE = os.getenv("SQLITE_FILE", "slotbot.db")
+
+# Write-behind for scores.json: flush after this many seconds or mutations
+SCORES_FLUSH_DELAY = 5
+SCORES_FLUSH_EVERY = 100
+
+# Per-chat score shards are dropped from memory after this many idle seconds
+CHAT_SHARD_IDLE = 30 * 60
+
+# Rendered /top* replies kept in memory (see render_cache.py)
+RENDER_CACHE_SIZE = 512
+
+# Rolling per-day counters behind /top oggi|settimana|mese (see windows.py):
+# days older than WINDOW_KEEP_DAYS fold into weeks, weeks older than
+# WINDOW_KEEP_WEEKS into months, months older than WINDOW_KEEP_MONTHS into
+# one remainder. Saved every WINDOWS_SAVE_INTERVAL seconds
+WINDOWS_FILE = "windows.json"
+WINDOW_KEEP_DAYS = 35
+WINDOW_KEEP_WEEKS = 10
+WINDOW_KEEP_MONTHS = 13
+WINDOWS_SAVE_INTERVAL = 5 * 60
+
+# Daily columns of every player's points, elo, slots, wins and best streak
+# (see leaderboard_series.py), with a full key frame every
+# SERIES_KEYFRAME_DAYS and only the changes in between
+SERIES_FILE = "leaderboard_series.bin"
+SERIES_KEYFRAME_DAYS = 7
+
+# Daily recap and /highlights: how many players the top shows, the points a
+# player must gain to be mentioned without moving, and the size of the
+# biggest gainers/losers sections
+HIGHLIGHTS_TOP = 10
+HIGHLIGHTS_POINTS_THRESHOLD = 50
+HIGHLIGHTS_MOVERS = 3
+
+# Last rolls of each player (see roll_history.py): ROLL_HISTORY_SIZE rolls
+# at 5 bytes each, saved every ROLL_HISTORY_SAVE_INTERVAL seconds. The
+# anti-cheat flags ROLL_BOT_MIN_ROLLS rolls in a row (no pause longer than
+# ROLL_BOT_MAX_PAUSE seconds) whose intervals vary by less than
+# ROLL_BOT_MAX_CV of their mean, at most once per ROLL_ALERT_COOLDOWN
+ROLL_HISTORY_FILE = "roll_history.bin"
+ROLL_HISTORY_SIZE = 256
+ROLL_HISTORY_SAVE_INTERVAL = 5 * 60
+ROLL_BOT_MIN_ROLLS = 30
+ROLL_BOT_MAX_CV = 0.05
+ROLL_BOT_MAX_PAUSE = 120
+ROLL_ALERT_COOLDOWN = 60 * 60
+
+# Append-only event log (rolls, duels, minigames, admin edits), fsync'ed in batches
+EVENT_LOG_FILE = os.getenv("EVENT_LOG_FILE", "events.log")
+EVENT_LOG_FSYNC_EVERY = 50
+EVENT_LOG_FSYNC_DELAY = 1.0
+
+# Live game state (duels, /sfida challenges, domain expansions) is journaled
+# here and restored at startup; what went stale while the bot was down for
+# more than GAME_STATE_STALE_AFTER is dropped on restore
+STATE_JOURNAL_FILE = os.getenv("STATE_JOURNAL_FILE", "game_state.log")
+STATE_JOURNAL_COMPACT_EVERY = 500
+GAME_STATE_STALE_AFTER = 24 * 60 * 60
+
+# Unanswered /sfida challenges lapse after PENDING_DUEL_TTL. A duel with no
+# roll for DUEL_IDLE_TIMEOUT is lost by the player on turn (or just
+# cancelled with DUEL_TIMEOUT_FORFEIT = False)
+PENDING_DUEL_TTL = 60 * 60
+DUEL_IDLE_TIMEOUT = 15 * 60
+DUEL_TIMEOUT_FORFEIT = True
+
+# Replies to a roll wait for the slot animation; replies due within the merge
+# window of each other in the same chat are sent as one message
+REPLY_DELAY = 1.0
+REPLY_MERGE_WINDOW = 0.5
+
+# Outgoing messages are kept under Telegram's flood limits: about one message
+# per second in a chat, 20 per minute in a group, 30 per second overall
+SEND_RATE_PER_CHAT = 1.0
+SEND_BURST_PER_CHAT = 3
+SEND_RATE_PER_GROUP = 20 / 60
+SEND_BURST_PER_GROUP = 20
+SEND_RATE_GLOBAL = 30.0
+SEND_MAX_RETRIES = 3
+
+# Cluster mode: with CLUSTER_WORKERS > 1 a front process receives the updates
+# and hands each chat to one of the worker processes (see cluster.py). Keep
+# the count fixed: chats are assigned by chat_id modulo the worker count
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "1"))
+CLUSTER_DIR = os.getenv("CLUSTER_DIR", "cluster")
+CLUSTER_SYNC_INTERVAL = 5
 
 # Game constants
 WIN_VALUES: Set[int] = {1, 22, 43, 64}
@@ -28,6 +131,18 @@ DOMAIN_EXPANSION_MESSAGE_WINDOW = 10  # Messages to activate after triple
 # ELO calculation constant
 ELO_K_FACTOR = 32
 
-# Backup settings
-MAX_BACKUPS = 10
+# Glicko-2 ratings replayed from the duel history (see ratings.py): system
+# constant tau and length of a rating period in seconds
+GLICKO2_TAU = 0.5
+GLICKO2_PERIOD = 24 * 60 * 60
+
+# Backup settings: an incremental backup (see backup_store.py) every
+# BACKUP_SNAPSHOT_MINUTES, a full copy sent to the admin every
+# BACKUP_INTERVAL_HOURS. Kept: the newest backup of each of the last
+# BACKUP_KEEP_HOURLY hours, BACKUP_KEEP_DAILY days and BACKUP_KEEP_WEEKLY weeks
+BACKUP_DIR = "backup"
+BACKUP_SNAPSHOT_MINUTES = 60
 BACKUP_INTERVAL_HOURS = 12
+BACKUP_KEEP_HOURLY = 24
+BACKUP_KEEP_DAILY = 7
+BACKUP_KEEP_WEEKLY = 8
@@ -0,0 +1,202 @@
+"""
+Deadlines - timer-driven expiry of the live game state
+
+A min-heap of (deadline, kind, key) knows when each domain expansion ends,
+when each pending /sfida challenge lapses and when each duel times out for
+inactivity. One job_queue job is kept scheduled for the earliest deadline;
+when it fires, the due entries are handled: the domain dissolves with its
+message, the challenge is dropped, the idle duel is lost by the player on
+turn (or cancelled, see DUEL_TIMEOUT_FORFEIT).
+
+The scheduler follows the state journal: every journaled change re-arms or
+disarms the deadline of that key. Re-arming pushes a new heap entry and the
+old one is skipped when it surfaces, so each change costs O(log n).
+"""
+import heapq
+import itertools
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from config import PENDING_DUEL_TTL, DUEL_IDLE_TIMEOUT, DUEL_TIMEOUT_FORFEIT
+from outbox import send_text
+from state_journal import get_state_journal, journal_duel, journal_pending, journal_expansion
+from storage import get_score_store
+from utils import msg_dominio_dissolto
+import game_state
+
+
+def _now() -> float:
+    return datetime.now(timezone.utc).timestamp()
+
+
+class DeadlineScheduler:
+    """Heap of game state deadlines, drained by a single job_queue job"""
+
+    def __init__(self, duel_timeout: float = DUEL_IDLE_TIMEOUT,
+                 pending_ttl: float = PENDING_DUEL_TTL, forfeit: bool = DUEL_TIMEOUT_FORFEIT):
+        self.duel_timeout = duel_timeout
+        self.pending_ttl = pending_ttl
+        self.forfeit = forfeit
+        self._heap: List[Tuple[float, int, str, Any]] = []
+        # the live deadline of each key; heap entries that disagree are stale
+        self._deadlines: Dict[Tuple[str, Any], float] = {}
+        self._seq = itertools.count()
+        self._job_queue = None
+        self._job = None
+        self._job_at: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    # ----- heap -----
+
+    def set(self, kind: str, key: Any, deadline: float) -> None:
+        """Arm (or move) the deadline of one entry"""
+        self._deadlines[(kind, key)] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), kind, key))
+        if len(self._heap) > 64 and len(self._heap) > 4 * len(self._deadlines):
+            # mostly stale entries (busy duels re-arm every turn): rebuild
+            self._heap = [(d, next(self._seq), kind, key) for (kind, key), d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+        self._arm()
+
+    def cancel(self, kind: str, key: Any) -> None:
+        """Disarm one entry; its heap entry is skipped when it surfaces"""
+        self._deadlines.pop((kind, key), None)
+
+    def deadline(self, kind: str, key: Any) -> Optional[float]:
+        return self._deadlines.get((kind, key))
+
+    def next_deadline(self) -> Optional[float]:
+        while self._heap:
+            deadline, _, kind, key = self._heap[0]
+            if self._deadlines.get((kind, key)) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: float) -> List[Tuple[str, Any]]:
+        """Remove and return the entries whose deadline has passed"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, kind, key = heapq.heappop(self._heap)
+            if self._deadlines.get((kind, key)) == deadline:
+                del self._deadlines[(kind, key)]
+                due.append((kind, key))
+        return due
+
+    # ----- following game_state -----
+
+    def on_state_changed(self, kind: str, key: Any) -> None:
+        """State journal listener: re-arm the changed entry from game_state"""
+        if kind == "clear":
+            self._deadlines.clear()
+            self._heap.clear()
+            return
+        if kind == "duel":
+            present = key in game_state.ACTIVE_DUELS
+            deadline = _now() + self.duel_timeout
+        elif kind == "pending":
+            present = key in game_state.PENDING_DUELS
+            deadline = _now() + self.pending_ttl
+        elif kind == "expansion":
+            deadline = game_state.EXPANSION_UNTIL.get(key) or 0
+            present = deadline > 0
+        else:
+            return
+        if present:
+            self.set(kind, key, deadline)
+        else:
+            self.cancel(kind, key)
+
+    def track_all(self) -> None:
+        """Arm every entry in game_state (after a restore)"""
+        for chat_id in list(game_state.ACTIVE_DUELS):
+            self.on_state_changed("duel", chat_id)
+        for key in list(game_state.PENDING_DUELS):
+            self.on_state_changed("pending", key)
+        for chat_id in list(game_state.EXPANSION_UNTIL):
+            self.on_state_changed("expansion", chat_id)
+
+    # ----- firing -----
+
+    def start(self, job_queue: Any) -> None:
+        """Arm everything already live and fire on ``job_queue`` from now on"""
+        self._job_queue = job_queue
+        self.track_all()
+        self._arm()
+
+    def _arm(self) -> None:
+        if self._job_queue is None:
+            return
+        deadline = self.next_deadline()
+        if deadline is None or (self._job_at is not None and self._job_at <= deadline):
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+        self._job_at = deadline
+        self._job = self._job_queue.run_once(self._fire, when=max(0.0, deadline - _now()),
+                                             name="game-state-deadlines")
+
+    async def _fire(self, context: Any) -> None:
+        self._job = None
+        self._job_at = None
+        await self.run_due(context.bot)
+        self._arm()
+
+    async def run_due(self, bot: Any, now: Optional[float] = None) -> int:
+        """Handle every entry due by ``now``; returns how many"""
+        due = self.pop_due(_now() if now is None else now)
+        for kind, key in due:
+            try:
+                if kind == "expansion":
+                    await self._dissolve(bot, key)
+                elif kind == "pending":
+                    if game_state.PENDING_DUELS.pop(key, None) is not None:
+                        journal_pending(*key)
+                elif kind == "duel":
+                    await self._time_out_duel(bot, key)
+            except Exception as e:
+                print(f"⚠️ Scadenza non gestita ({kind} {key}): {e}", flush=True)
+        return len(due)
+
+    async def _dissolve(self, bot: Any, chat_id: int) -> None:
+        if game_state.EXPANSION_UNTIL.pop(chat_id, 0) <= 0:
+            return
+        journal_expansion(chat_id)
+        await send_text(bot, chat_id, msg_dominio_dissolto(), parse_mode="Markdown")
+
+    async def _time_out_duel(self, bot: Any, chat_id: int) -> None:
+        from commands_gameplay import finish_duel
+
+        duel = game_state.ACTIVE_DUELS.get(chat_id)
+        if duel is None:
+            return
+        minutes = max(1, round(self.duel_timeout / 60))
+        if not self.forfeit:
+            del game_state.ACTIVE_DUELS[chat_id]
+            journal_duel(chat_id)
+            await send_text(bot, chat_id, f"⌛ Il duello tra {duel['p1_name']} e {duel['p2_name']} "
+                                          f"è annullato: nessun tiro da {minutes} minuti.")
+            return
+
+        loser_id = duel["current_turn"]
+        if loser_id == duel["p1_id"]:
+            winner_id, winner_name, loser_name = duel["p2_id"], duel["p2_name"], duel["p1_name"]
+        else:
+            winner_id, winner_name, loser_name = duel["p1_id"], duel["p1_name"], duel["p2_name"]
+        async with get_score_store().user(winner_id, winner_name) as tx:
+            # a roll may have landed while we waited for the lock
+            if game_state.ACTIVE_DUELS.get(chat_id) is not duel or self.deadline("duel", chat_id):
+                return
+            result = finish_duel(chat_id, winner_id, tx.scores, forfeit=True)
+        await send_text(bot, chat_id, f"⌛ {loser_name} non tira da {minutes} minuti "
+                                      f"e perde il duello a tavolino!\n{result}")
+
+
+_scheduler = DeadlineScheduler()
+get_state_journal().subscribe(_scheduler.on_state_changed)
+
+
+def get_deadline_scheduler() -> DeadlineScheduler:
+    """Return the process-wide scheduler"""
+    return _scheduler
@@ -0,0 +1,108 @@
+"""
+Duel history - finished duels indexed by player and by pair
+
+The records themselves are storage's duel list (duels.json or the duels
+table), appended to with storage.append_duel. DuelHistory indexes them by
+player id and by pair of ids: new records are indexed the next time the
+history is read, so an append costs O(1) and the per-player and
+head-to-head queries only look at the duels of those players. Records
+without ids (older than the id fields, or not linkable by name, see
+storage.link_duel_ids) appear in the overall history only.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+from storage import load_duels
+
+
+def pair_key(a: str, b: str) -> Tuple[str, str]:
+    """Order-independent key of two players"""
+    return (a, b) if a <= b else (b, a)
+
+
+def winner_of(duel: Dict[str, Any]) -> Optional[str]:
+    """Id of the duel's winner, if known"""
+    if duel.get("winner_id"):
+        return duel["winner_id"]
+    for side in ("p1", "p2"):
+        if duel.get(f"{side}_id") and duel.get("winner") == duel.get(side):
+            return duel[f"{side}_id"]
+    return None
+
+
+class DuelHistory:
+    """Per-player and per-pair indexes over the stored duel list"""
+
+    def __init__(self):
+        self._duels: Optional[List[Dict[str, Any]]] = None
+        self._indexed = 0
+        self._by_player: Dict[str, List[int]] = {}
+        self._by_pair: Dict[Tuple[str, str], List[int]] = {}
+
+    def _sync(self) -> List[Dict[str, Any]]:
+        duels = load_duels()
+        if duels is not self._duels or self._indexed > len(duels):
+            # replaced by an import: start over
+            self._duels = duels
+            self._indexed = 0
+            self._by_player.clear()
+            self._by_pair.clear()
+        for position in range(self._indexed, len(duels)):
+            duel = duels[position]
+            p1, p2 = duel.get("p1_id"), duel.get("p2_id")
+            for user_id in {p1, p2} - {None}:
+                self._by_player.setdefault(user_id, []).append(position)
+            if p1 and p2:
+                self._by_pair.setdefault(pair_key(p1, p2), []).append(position)
+        self._indexed = len(duels)
+        return duels
+
+    def recent(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """The last ``limit`` duels, newest first"""
+        return list(reversed(self._sync()[-limit:]))
+
+    def for_player(self, user_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """The player's duels, newest first"""
+        duels = self._sync()
+        positions = self._by_player.get(user_id, [])
+        if limit is not None:
+            positions = positions[-limit:]
+        return [duels[p] for p in reversed(positions)]
+
+    def head_to_head(self, a: str, b: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """The duels between two players, newest first"""
+        duels = self._sync()
+        positions = self._by_pair.get(pair_key(a, b), [])
+        if limit is not None:
+            positions = positions[-limit:]
+        return [duels[p] for p in reversed(positions)]
+
+    def record(self, user_id: str, opponent_id: Optional[str] = None) -> Dict[str, int]:
+        """Wins, losses and streaks of a player (against one opponent, if
+        given). ``streak`` is the current run, positive for wins and
+        negative for losses; ``best_streak`` the longest run of wins"""
+        if opponent_id is None:
+            duels = self.for_player(user_id)
+        else:
+            duels = self.head_to_head(user_id, opponent_id)
+        wins = losses = streak = best = run = 0
+        for duel in reversed(duels):  # oldest first
+            winner = winner_of(duel)
+            if winner is None:
+                continue
+            if winner == user_id:
+                wins += 1
+                run += 1
+                best = max(best, run)
+                streak = streak + 1 if streak > 0 else 1
+            else:
+                losses += 1
+                run = 0
+                streak = streak - 1 if streak < 0 else -1
+        return {"wins": wins, "losses": losses, "streak": streak, "best_streak": best}
+
+
+_history = DuelHistory()
+
+
+def get_duel_history() -> DuelHistory:
+    """Return the process-wide duel history"""
+    return _history
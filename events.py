@@ -0,0 +1,259 @@
+"""
+Event log - append-only, line-delimited JSON record of every roll and game
+action, plus a replay engine that rebuilds the scores from it
+
+Each line is one event: {"type": ..., "ts": ..., ...}. Writes are buffered
+and fsync'ed in batches; the replay reuses models.apply_roll/update_elo so
+it scores exactly like the live bot.
+
+    python events.py verify            # compare a replay with the live scores
+    python events.py repair            # overwrite the live scores with the replay
+"""
+import asyncio
+import copy
+import json
+import os
+import sys
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from concurrent.futures import Future
+from typing import Dict, Any, List, Optional, Iterator, Iterable
+from config import EVENT_LOG_FILE, EVENT_LOG_FSYNC_EVERY, EVENT_LOG_FSYNC_DELAY
+from models import ensure_user_struct, apply_roll, update_elo, unlock_achievement, migrate_scores, UserStats
+from storage_writer import get_writer
+
+
+# Fields a replay can rebuild from the log (used by verify)
+REPLAYED_FIELDS = [
+    "points", "streak", "best_streak", "sfiga", "best_sfiga", "total_slots",
+    "total_wins", "double", "triple", "quad", "quint", "duel_wins",
+    "duel_losses", "elo", "best_speed",
+]
+
+# Events that also feed the per-chat shards
+CHAT_EVENTS = {"roll", "duel_end"}
+# Admin edits, applied to the shards listed in their "chats"
+ADMIN_EVENTS = {"admin_set", "admin_add", "admin_reset"}
+
+
+class EventLog:
+    """Buffered appender: events are written and fsync'ed every
+    ``fsync_every`` events or ``fsync_delay`` seconds, whichever comes first.
+    The write and fsync run on the storage writer thread."""
+
+    def __init__(self, path: str = EVENT_LOG_FILE,
+                 fsync_every: int = EVENT_LOG_FSYNC_EVERY,
+                 fsync_delay: float = EVENT_LOG_FSYNC_DELAY):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_delay = fsync_delay
+        self._buffer: List[str] = []
+        self._file = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def append(self, event_type: str, **fields: Any) -> None:
+        event = {"type": event_type, "ts": fields.pop("ts", None) or datetime.now(timezone.utc).timestamp()}
+        event.update(fields)
+        self._buffer.append(json.dumps(event, ensure_ascii=False, separators=(",", ":")))
+
+        if len(self._buffer) >= self.fsync_every:
+            self.flush()
+            return
+        if self._timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self._timer = loop.call_later(self.fsync_delay, self.flush)
+
+    def flush(self) -> Optional[Future]:
+        """Queue the buffered events for writing + fsync; returns the write's future"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return None
+        chunk = "\n".join(self._buffer) + "\n"
+        self._buffer.clear()
+        return get_writer().submit(self._write, chunk)
+
+    def _write(self, chunk: str) -> None:
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(chunk)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self) -> None:
+        self.flush()
+        get_writer().submit(self._close_file).result()
+
+
+_event_log = EventLog()
+
+
+def get_event_log() -> EventLog:
+    """Return the process-wide event log"""
+    return _event_log
+
+
+def log_event(event_type: str, **fields: Any) -> None:
+    """Append one event to the process-wide log"""
+    _event_log.append(event_type, **fields)
+
+
+def flush_events() -> None:
+    """Force buffered events to disk and wait for the fsync"""
+    _event_log.flush()
+    get_writer().wait()
+
+
+def read_events(path: str = EVENT_LOG_FILE) -> Iterator[Dict[str, Any]]:
+    """Iterate the events of a log file, skipping a torn last line"""
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def apply_event(scores: Dict[str, Any], event: Dict[str, Any]) -> None:
+    """Apply one logged event to a scores dict"""
+    kind = event.get("type")
+    user_id = event.get("user")
+
+    if kind == "roll":
+        d = ensure_user_struct(scores, user_id, event.get("name", "?"))
+        result = apply_roll(d, event["value"], event["ts"], event.get("expansion", False))
+        if result["won"] and result["streak"] == 3:
+            d.last_triple_msg_id = event.get("msg")
+
+    elif kind == "duel_end":
+        winner, loser = event["winner"], event["loser"]
+        ensure_user_struct(scores, winner, event.get("winner_name", "?")).duel_wins += 1
+        ensure_user_struct(scores, loser, event.get("loser_name", "?")).duel_losses += 1
+        update_elo(winner, loser, scores)
+
+    elif kind == "lottery":
+        d = ensure_user_struct(scores, user_id, event.get("name", "?"))
+        d.last_lotteria_ts = event["ts"]
+        d.points += event.get("prize", 0)
+        scores["_jackpot"] = event["jackpot"]
+        if event.get("won"):
+            unlock_achievement(scores, user_id, "lottery_winner")
+
+    elif kind == "evento":
+        d = ensure_user_struct(scores, user_id, event.get("name", "?"))
+        d.last_evento_ts = event["ts"]
+        d.points += event.get("delta", 0)
+        unlock_achievement(scores, user_id, "event_master")
+
+    elif kind == "admin_set":
+        if user_id in scores:
+            scores[user_id][event["field"]] = event["value"]
+            for field, best in (("streak", "best_streak"), ("sfiga", "best_sfiga")):
+                if event["field"] == field and event.get("raise_best") and event["value"] > scores[user_id][best]:
+                    scores[user_id][best] = event["value"]
+
+    elif kind == "admin_add":
+        if user_id in scores:
+            scores[user_id][event["field"]] += event["value"]
+
+    elif kind == "admin_reset":
+        if user_id in scores:
+            scores[user_id] = UserStats(scores[user_id].get("name", "Unnamed"))
+
+    elif kind == "set":
+        # plain field updates from commands without scoring rules (cooldowns, ...)
+        ensure_user_struct(scores, user_id, event.get("name", "?")).update(event.get("fields", {}))
+
+    # "duel_round" and unknown types are informational only
+
+
+def _feeds_chat(event: Dict[str, Any], chat_id: int) -> bool:
+    if event.get("type") in CHAT_EVENTS:
+        return event.get("chat") == chat_id
+    return event.get("type") in ADMIN_EVENTS and chat_id in event.get("chats", ())
+
+
+def replay(events: Iterable[Dict[str, Any]], base: Optional[Dict[str, Any]] = None,
+           since: float = 0.0, chat_id: Optional[int] = None) -> Dict[str, Any]:
+    """Rebuild a scores dict by applying ``events`` (newer than ``since``) on ``base``.
+
+    With ``chat_id`` only the rolls and duels of that chat (and the admin
+    edits that reached it) are applied, which rebuilds its shard.
+    """
+    scores: Dict[str, Any] = migrate_scores(copy.deepcopy(dict(base.items()))) if base else {}
+    for event in events:
+        if event.get("ts", 0) <= since:
+            continue
+        if chat_id is not None and not _feeds_chat(event, chat_id):
+            continue
+        apply_event(scores, event)
+    return scores
+
+
+def diff_scores(expected: Dict[str, Any], actual: Dict[str, Any]) -> List[str]:
+    """Human readable differences between a replay and the live scores"""
+    problems = []
+    for user_id, d in expected.items():
+        if user_id.startswith("_"):
+            continue
+        live = actual.get(user_id)
+        if not isinstance(live, Mapping):
+            problems.append(f"{user_id}: missing from live scores")
+            continue
+        for field in REPLAYED_FIELDS:
+            a, b = d.get(field), live.get(field)
+            if isinstance(a, float) or isinstance(b, float):
+                if abs((a or 0) - (b or 0)) > 1e-9:
+                    problems.append(f"{user_id}.{field}: log={a} live={b}")
+            elif a != b:
+                problems.append(f"{user_id}.{field}: log={a} live={b}")
+    return problems
+
+
+if __name__ == "__main__":
+    import time
+    from storage import load_scores, save_scores, flush_scores
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command not in ("verify", "repair"):
+        print("Uso: python events.py verify|repair [events.log]")
+        sys.exit(1)
+
+    log_path = sys.argv[2] if len(sys.argv) > 2 else EVENT_LOG_FILE
+    started = time.perf_counter()
+    events = list(read_events(log_path))
+    rebuilt = replay(events)
+    elapsed = time.perf_counter() - started
+    print(f"Replayed {len(events)} events in {elapsed:.3f}s")
+
+    live = load_scores()
+    problems = diff_scores(rebuilt, live)
+    for problem in problems[:50]:
+        print(f"  {problem}")
+    print(f"{len(problems)} differences")
+
+    if command == "repair" and problems:
+        for user_id, d in rebuilt.items():
+            if user_id.startswith("_") or not isinstance(live.get(user_id), Mapping):
+                live[user_id] = d
+            else:
+                for field in REPLAYED_FIELDS:
+                    live[user_id][field] = d.get(field)
+        save_scores(live)
+        flush_scores()
+        print("✅ Scores repaired from the event log")
@@ -1,19 +1,46 @@
-import asyncio
 import random
 from datetime import datetime, timezone
+from typing import Dict
 from telegram import Update
 from telegram.ext import ContextTypes
-from config import WIN_VALUES, ADMIN_ID, DOMAIN_EXPANSION_DURATION
-from storage import load_scores, save_scores, load_users, save_users, load_duels, save_duels
-from models import ensure_user_struct
+from config import WIN_VALUES, ADMIN_ID, DOMAIN_EXPANSION_DURATION, ROLL_ALERT_COOLDOWN
+from storage import get_score_store, save_user_name
+from models import apply_roll
+from events import log_event
+from windows import get_windowed_stats
+from roll_history import get_roll_history
+from outbox import reply, defer_reply, PRIORITY_HIGH, PRIORITY_LOW
 from utils import (
-    msg_vittoria, msg_streak, msg_sfiga, 
+    msg_vittoria, msg_streak, msg_sfiga, msg_dominio_dissolto,
     is_expansion_active
 )
 from commands_gameplay import handle_duel_turn
+from state_journal import journal_expansion
 import game_state
 
 
+# user id -> when the admin was last told about their roll timing
+_timing_alerts: Dict[str, float] = {}
+
+
+def report_automated_timing(bot, user_id: str, nome: str, chat_id: int, now_ts: float) -> None:
+    """Tell the admin (at most once per ROLL_ALERT_COOLDOWN) about a player
+    whose last rolls came at machine-regular intervals"""
+    stats = get_roll_history().looks_automated(user_id)
+    if stats is None or now_ts - _timing_alerts.get(user_id, 0.0) < ROLL_ALERT_COOLDOWN:
+        return
+    _timing_alerts[user_id] = now_ts
+    log_event("anticheat", user=user_id, chat=chat_id, reason="timing",
+              rolls=stats["count"], mean=round(stats["mean"], 3), cv=round(stats["cv"], 4))
+    if ADMIN_ID:
+        defer_reply(
+            bot, ADMIN_ID,
+            f"🤖 Tiri sospetti: {nome} ({user_id}) nella chat {chat_id} ha fatto {stats['count']} tiri "
+            f"a {stats['mean']:.2f}s l'uno dall'altro (variazione {stats['cv'] * 100:.1f}%).",
+            parse_mode=None, priority=PRIORITY_LOW
+        )
+
+
 async def handle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Main handler for slot dice rolls"""
     if update.message is None or update.message.dice is None:
@@ -33,7 +60,8 @@ async def handle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
     # Check if slot tracking is blocked
     if game_state.SLOT_BLOCKED:
-        await update.message.reply_text(
+        await reply(
+            update.message,
             "⛔ Il tracking delle slot è temporaneamente disattivato dall'amministratore.",
             parse_mode="Markdown"
         )
@@ -52,7 +80,8 @@ async def handle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         fwd_chat = getattr(update.message, "forward_from_chat", None)
 
         if fwd_user or fwd_chat:
-            await update.message.reply_text(
+            await reply(
+                update.message,
                 "❌ Non puoi inoltrare una slot. Nice try.",
                 parse_mode="Markdown"
             )
@@ -60,7 +89,8 @@ async def handle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
         # 2) BLOCK EDITED MESSAGES
         if getattr(update.message, "edit_date", None):
-            await update.message.reply_text(
+            await reply(
+                update.message,
                 "❌ Slot modificata? Non funziona così.",
                 parse_mode="Markdown"
             )
@@ -68,7 +98,8 @@ async def handle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
         # 3) BLOCK MESSAGES VIA BOT
         if getattr(update.message, "via_bot", None):
-            await update.message.reply_text(
+            await reply(
+                update.message,
                 "❌ Non puoi usare bot esterni per tirare slot.",
                 parse_mode="Markdown"
             )
@@ -77,7 +108,8 @@ async def handle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         # 4) VERIFY AUTHENTIC DICE
         dice_obj = getattr(update.message, "dice", None)
         if dice_obj is None:
-            await update.message.reply_text(
+            await reply(
+                update.message,
                 "❌ Questo non è un vero tiro di slot.",
                 parse_mode="Markdown"
             )
@@ -90,182 +122,129 @@ async def handle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     # Check if domain expansion ended
     if chat_id in game_state.EXPANSION_UNTIL:
         if game_state.EXPANSION_UNTIL[chat_id] > 0 and game_state.EXPANSION_UNTIL[chat_id] < datetime.now(timezone.utc).timestamp():
-            await update.message.reply_text(
-                "🌌 *Il dominio si dissolve.*\n"
-                "La realtà torna stabile.",
-                parse_mode="Markdown"
-            )
+            await reply(update.message, msg_dominio_dissolto(), parse_mode="Markdown")
             game_state.EXPANSION_UNTIL[chat_id] = 0
+            journal_expansion(chat_id)
 
-    # Measure speed BEFORE sleep
+    # Measure speed on arrival
     now_ts = datetime.now(timezone.utc).timestamp()
-    
-    # Load scores to get last timestamp
-    scores = load_scores()
-    user_id = str(user_id_int)
-    ensure_user_struct(scores, user_id, update.message.from_user.first_name)
-    
-    last_ts = scores[user_id]["last_slot_ts"]
-    scores[user_id]["last_slot_ts"] = now_ts
-
-    # Sleep to not spoil animation
-    await asyncio.sleep(1)
 
-    # Now process the roll
     message = update.message
     user = message.from_user
     nome = user.first_name
-    chat_id = message.chat_id
-
-    # Update users list
-    users = load_users()
-    users[user_id] = nome
-    save_users(users)
-
-    # Reload scores (in case they were updated during sleep)
-    scores = load_scores()
-    ensure_user_struct(scores, user_id, nome)
-
-    # we must make sure the timestamp we calculated before the sleep is
-    # preserved, otherwise the field would revert to its previous value and
-    # the speed check would never see a delta. reapply it here.
-    scores[user_id]["last_slot_ts"] = now_ts
-
-    jackpot = (dice.value == 64)
-
-    # -------------------------------------------------------
-    #   DOMAIN EXPANSION REROLL
-    # -------------------------------------------------------
-    if is_expansion_active(chat_id):
-        if scores[user_id]["last_was_win"] and dice.value not in WIN_VALUES:
-            if random.random() < 0.33:  # Hakari probability
-                try:
-                    await context.bot.delete_message(
-                        chat_id=chat_id,
-                        message_id=message.message_id
-                    )
-                except:
-                    pass
+    user_id = str(user_id_int)
+
+    # Everything below is one transaction on this user's entry: a second roll
+    # (or /tarocchi) by the same user waits here instead of racing this one.
+    # Nothing in it waits for the slot animation: the replies are deferred
+    # (outbox.py) and the roll is committed right away.
+    async with get_score_store().user(user_id, nome) as tx:
+        u = tx.user
 
-                await update.message.reply_text(
-                    "🌌 *IDLE DEATH GAMBLE*\n"
-                    "La tua sconfitta è stata *cancellata*.",
-                    parse_mode="Markdown"
+        # Update users list (only written when the name is new or changed)
+        save_user_name(user_id, nome)
+
+        # -------------------------------------------------------
+        #   DOMAIN EXPANSION REROLL
+        # -------------------------------------------------------
+        if is_expansion_active(chat_id):
+            if u.last_was_win and dice.value not in WIN_VALUES:
+                if random.random() < 0.33:  # Hakari probability
+                    # the roll disappears once its animation is over
+                    defer_reply(
+                        context.bot, chat_id,
+                        "🌌 *IDLE DEATH GAMBLE*\n"
+                        "La tua sconfitta è stata *cancellata*.",
+                        delete=message.message_id
+                    )
+                    # the cancelled roll leaves no trace, not even its timestamp
+                    tx.rollback()
+                    return
+
+        # -------------------------------------------------------
+        #   SCORING (streaks, combos, points, speed)
+        # -------------------------------------------------------
+        expansion = is_expansion_active(chat_id)
+        result = apply_roll(u, dice.value, now_ts, expansion)
+
+        msg = ""
+        in_duel = chat_id in game_state.ACTIVE_DUELS
+
+        # -------------------------------------------------------
+        #   WIN
+        # -------------------------------------------------------
+        if result["won"]:
+            streak = result["streak"]
+
+            if streak == 3:
+                # Triple notification - can activate domain
+                defer_reply(
+                    context.bot, chat_id,
+                    f"🎲 *JACKPOT PROBABILITY RISING*\n"
+                    f"{nome} ha ottenuto una *TRIPLA*.\n"
+                    f"L'energia del dominio vibra attorno a lui…\n"
+                    f"Può attivare l'ESPANSIONE entro i prossimi *10 messaggi*.",
+                    reply_to=message.message_id
                 )
-                return
-
-    # -------------------------------------------------------
-    #   GENERAL TRACKING
-    # -------------------------------------------------------
-    scores[user_id]["total_slots"] += 1
-
-    speed_msg = ""
-    if last_ts > 0:  # Only track speed if not first roll
-        delta = now_ts - last_ts
-        if delta > 0:  # we only care about positive intervals
-            speed = 1.0 / delta
-            best_speed = scores[user_id].get("best_speed", 0.0)
-            if best_speed == 0.0 or speed > best_speed:  # First time or new record
-                scores[user_id]["best_speed"] = speed
-                speed_msg = f"\n⚡ Nuovo record personale di velocità per {nome}: {speed:.3f} slot/s"
-
-    msg = ""
-
-    # -------------------------------------------------------
-    #   WIN
-    # -------------------------------------------------------
-    if dice.value in WIN_VALUES:
-        scores[user_id]["last_was_win"] = True
-
-        scores[user_id]["sfiga"] = 0
-        scores[user_id]["streak"] += 1
-        streak = scores[user_id]["streak"]
-
-        if streak > scores[user_id]["best_streak"]:
-            scores[user_id]["best_streak"] = streak
-
-        scores[user_id]["total_wins"] += 1
-
-        if streak == 2:
-            scores[user_id]["double"] += 1
-        elif streak == 3:
-            scores[user_id]["triple"] += 1
-            # Triple notification - can activate domain
-            await message.reply_text(
-                f"🎲 *JACKPOT PROBABILITY RISING*\n"
-                f"{nome} ha ottenuto una *TRIPLA*.\n"
-                f"L'energia del dominio vibra attorno a lui…\n"
-                f"Può attivare l'ESPANSIONE entro i prossimi *10 messaggi*.",
-                parse_mode="Markdown"
-            )
 
-            scores[user_id]["last_triple_msg_id"] = message.message_id
+                u.last_triple_msg_id = message.message_id
 
-        elif streak == 4:
-            scores[user_id]["quad"] += 1
-        elif streak == 5:
-            scores[user_id]["quint"] += 1
+            if expansion:
+                msg += "🌌 *ESPANSIONE DEL DOMINIO ATTIVA*\n"
 
-        # Point calculation
-        if jackpot:
-            scores[user_id]["points"] += 2
-        else:
-            scores[user_id]["points"] += 1
+            msg += msg_vittoria(nome, result["jackpot"])
+            streak_msg = msg_streak(nome, streak)
+            if streak_msg:
+                msg += f"\n{streak_msg}"
 
-        if streak == 2:
-            scores[user_id]["points"] += 1
-        elif streak == 3:
-            scores[user_id]["points"] += 1
-        elif streak == 4:
-            scores[user_id]["points"] += 2
-        elif streak == 5:
-            scores[user_id]["points"] += 3
+            # handle duel turn with a win flag
+            duel_msg = handle_duel_turn(chat_id, user_id, nome, tx.scores, True)
 
-        if is_expansion_active(chat_id):
-            scores[user_id]["points"] += 1
-            msg += "🌌 *ESPANSIONE DEL DOMINIO ATTIVA*\n"
-
-        msg += msg_vittoria(nome, jackpot)
-        streak_msg = msg_streak(nome, streak)
-        if streak_msg:
-            msg += f"\n{streak_msg}"
-
-        # handle duel turn with a win flag
-        duel_msg = handle_duel_turn(chat_id, user_id, nome, scores, True)
-        if duel_msg:
-            msg += f"{duel_msg}"
-
-    # -------------------------------------------------------
-    #   LOSS
-    # -------------------------------------------------------
-    else:
-        scores[user_id]["last_was_win"] = False
-
-        scores[user_id]["streak"] = 0
-        scores[user_id]["sfiga"] += 1
-        sfiga = scores[user_id]["sfiga"]
-
-        if sfiga > scores[user_id]["best_sfiga"]:
-            scores[user_id]["best_sfiga"] = sfiga
-
-        msg = msg_sfiga(nome, sfiga)
-
-        # handle duel turn on a losing roll (turn still passes)
-        duel_msg = handle_duel_turn(chat_id, user_id, nome, scores, False)
-        if duel_msg:
-            msg += f"{duel_msg}"
-
-    if speed_msg:
-        if msg:
-            msg += speed_msg
+        # -------------------------------------------------------
+        #   LOSS
+        # -------------------------------------------------------
         else:
-            msg = speed_msg.lstrip()
-
-    if msg:
-        await message.reply_text(msg, parse_mode="Markdown")
-    # debug: log what we're about to save (especially during tests)
-    try:
-        print(f"[handle_dice] saving scores keys: {list(scores.keys())}")
-    except Exception:
-        pass
-    save_scores(scores)
+            msg = msg_sfiga(nome, result["sfiga"])
+
+            # handle duel turn on a losing roll (turn still passes)
+            duel_msg = handle_duel_turn(chat_id, user_id, nome, tx.scores, False)
+
+        # the result of a duel that ends on this roll goes out ahead of everything else
+        if duel_msg and in_duel and chat_id not in game_state.ACTIVE_DUELS:
+            if msg:
+                defer_reply(context.bot, chat_id, msg, reply_to=message.message_id)
+            defer_reply(
+                context.bot, chat_id, duel_msg.strip(),
+                reply_to=message.message_id, priority=PRIORITY_HIGH
+            )
+        elif msg:
+            defer_reply(context.bot, chat_id, msg + duel_msg, reply_to=message.message_id)
+
+        # speed records are the first thing to wait when the chat is busy
+        if result["speed_record"] is not None:
+            defer_reply(
+                context.bot, chat_id,
+                f"⚡ Nuovo record personale di velocità per {nome}: {result['speed_record']:.3f} slot/s",
+                reply_to=message.message_id, priority=PRIORITY_LOW
+            )
+
+    if tx.rolled_back:
+        return
+
+    # The roll is committed (a failed roll never gets here): only now does
+    # it reach this chat's shard, the event log, the rolling counters behind
+    # /top oggi|settimana|mese and the history for /storico.
+    async with get_score_store(chat_id).user(user_id, nome) as chat_tx:
+        apply_roll(chat_tx.user, dice.value, now_ts, expansion)
+    log_event(
+        "roll", user=user_id, name=nome, chat=chat_id, value=dice.value,
+        ts=now_ts, expansion=expansion, msg=message.message_id
+    )
+    # (the points are counted by the score stores when the roll commits)
+    get_windowed_stats().record_roll(
+        user_id, chat_id, now_ts, result["won"],
+        combo=result["won"] and 2 <= result["streak"] <= 5
+    )
+    # last rolls for /storico and the timing check
+    get_roll_history().record(user_id, dice.value, now_ts)
+    report_automated_timing(context.bot, user_id, nome, chat_id, now_ts)
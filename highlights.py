@@ -0,0 +1,159 @@
+"""
+Highlights - what changed on the points leaderboard since yesterday
+
+Shared by the admin's daily recap and /highlights. Today's points (the
+resident scores) are joined by user id with the last day recorded in the
+leaderboard series, over every player of the scope: everyone, or the
+players of one group ranked among themselves. The result is kept per
+(day, scope) until a score changes or a new day is recorded, so repeated
+/highlights calls only format it again.
+"""
+from collections.abc import Mapping
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from config import HIGHLIGHTS_TOP, HIGHLIGHTS_POINTS_THRESHOLD, HIGHLIGHTS_MOVERS
+from leaderboard_series import get_leaderboard_series
+from storage import ScoreStore, get_score_store
+
+
+def _ranks(points: Dict[str, int]) -> Dict[str, int]:
+    """Rank of each player (1 = most points, ties share the rank)"""
+    ranks: Dict[str, int] = {}
+    previous = None
+    for position, (user_id, value) in enumerate(sorted(points.items(), key=lambda p: -p[1]), start=1):
+        if value != previous:
+            rank, previous = position, value
+        ranks[user_id] = rank
+    return ranks
+
+
+class Highlights:
+    """Every player of a scope with today's and yesterday's points and rank"""
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        # user_id, name, points, change, rank, rank_before (None: new player)
+        self.rows = sorted(rows, key=lambda r: (r["rank"], r["name"]))
+
+    def top(self, limit: int = HIGHLIGHTS_TOP) -> List[Dict[str, Any]]:
+        return self.rows[:limit]
+
+    def gainers(self, limit: int = HIGHLIGHTS_MOVERS) -> List[Dict[str, Any]]:
+        """Biggest point gains of the day"""
+        rising = [r for r in self.rows if r["change"] > 0]
+        return sorted(rising, key=lambda r: -r["change"])[:limit]
+
+    def losers(self, limit: int = HIGHLIGHTS_MOVERS) -> List[Dict[str, Any]]:
+        """Biggest point losses of the day"""
+        falling = [r for r in self.rows if r["change"] < 0]
+        return sorted(falling, key=lambda r: r["change"])[:limit]
+
+
+class HighlightsEngine:
+    """Computes and caches Highlights per (day, scope)"""
+
+    def __init__(self, top: int = HIGHLIGHTS_TOP, points_threshold: int = HIGHLIGHTS_POINTS_THRESHOLD,
+                 movers: int = HIGHLIGHTS_MOVERS):
+        self.top = top
+        self.points_threshold = points_threshold
+        self.movers = movers
+        self._cache: Dict[Tuple[date, Optional[int]], Highlights] = {}
+        self._series_version = -1
+        self._store: Optional[ScoreStore] = None
+        self.computed = 0
+
+    def on_scores_changed(self, scores: Dict[str, Any], user_ids) -> None:
+        self._cache.clear()
+
+    def _subscribe(self) -> None:
+        store = get_score_store()
+        if store is not self._store:
+            self._store = store
+            store.subscribe(self.on_scores_changed)
+            self._cache.clear()
+
+    def compute(self, scope: Optional[int] = None, today: Optional[date] = None) -> Optional[Highlights]:
+        """Highlights of everyone (scope None) or of one group's players;
+        None until a day before ``today`` has been recorded"""
+        self._subscribe()
+        series = get_leaderboard_series()
+        today = today or datetime.now(timezone.utc).date()
+        if series.version != self._series_version:
+            self._series_version = series.version
+            self._cache.clear()
+        key = (today, scope)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        baseline = series.on(today - timedelta(days=1))
+        if baseline is None:
+            return None
+        scores = self._store.load()
+        members = scores if scope is None else get_score_store(scope).load()
+        points: Dict[str, int] = {}
+        before: Dict[str, int] = {}
+        for user_id, member in members.items():
+            entry = scores.get(user_id)
+            if not isinstance(member, Mapping) or not isinstance(entry, Mapping):
+                continue
+            points[user_id] = entry.get("points", 0) or 0
+            old = baseline.value(user_id)
+            if old is not None:
+                before[user_id] = old
+        ranks, ranks_before = _ranks(points), _ranks(before)
+        rows = [{
+            "user_id": user_id,
+            "name": scores[user_id].get("name", "Unknown"),
+            "points": value,
+            "change": value - before.get(user_id, 0),
+            "rank": ranks[user_id],
+            "rank_before": ranks_before.get(user_id),
+        } for user_id, value in points.items()]
+
+        if any(day != today for day, _ in self._cache):
+            self._cache.clear()  # a new day: yesterday's results are done
+        highlights = self._cache[key] = Highlights(rows)
+        self.computed += 1
+        return highlights
+
+    def format(self, highlights: Highlights, title: str) -> str:
+        """The Markdown message: top movers, gainers and losers, today's top"""
+        lines = [title, ""]
+        movers = []
+        for row in highlights.top(self.top):
+            name, rank, rank_before = row["name"], row["rank"], row["rank_before"]
+            if rank_before is None:
+                movers.append(f"⭐ {name} entra in top {self.top} a #{rank}!")
+            elif rank_before > self.top:
+                movers.append(f"⭐ {name} entra in top {self.top} a #{rank} (era #{rank_before})!")
+            elif rank_before > rank:
+                movers.append(f"📈 {name} sale a #{rank} (+{row['change']} pts)")
+            elif rank_before < rank:
+                movers.append(f"📉 {name} scende a #{rank}")
+            elif row["change"] > self.points_threshold:
+                movers.append(f"💎 {name} guadagna {row['change']} pts (rimane #{rank})")
+        if movers:
+            lines.append("*HIGHLIGHTS:*")
+            lines += movers
+        else:
+            lines.append("Nessun cambiamento significativo nel leaderboard.")
+
+        gainers, losers = highlights.gainers(self.movers), highlights.losers(self.movers)
+        if gainers:
+            lines += ["", "*IN SALITA:*"]
+            lines += [f"🚀 {r['name']}: +{r['change']} pts (#{r['rank']})" for r in gainers]
+        if losers:
+            lines += ["", "*IN DISCESA:*"]
+            lines += [f"🥶 {r['name']}: {r['change']} pts (#{r['rank']})" for r in losers]
+
+        lines += ["", f"*TOP {self.top} OGGI:*"]
+        lines += [f"#{r['rank']} - {r['name']}: {r['points']} pts" for r in highlights.top(self.top)]
+        return "\n".join(lines) + "\n"
+
+
+_engine = HighlightsEngine()
+
+
+def get_highlights_engine() -> HighlightsEngine:
+    """Return the process-wide highlights engine"""
+    return _engine
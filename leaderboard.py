@@ -0,0 +1,214 @@
+"""
+Leaderboard index - sorted per-metric views of the scores, kept up to date
+incrementally so /top* commands read the first K rows instead of sorting
+every player on each call
+"""
+from bisect import bisect_left, insort
+from collections.abc import Mapping
+from typing import Dict, Any, List, Optional, Set, Tuple, Callable, Iterator
+from storage import ScoreStore, get_score_store, get_global_view
+
+
+# Minimum slots before a player shows up in the winrate board
+WINRATE_MIN_SLOTS = 10
+
+
+def _combo_total(d: Dict[str, Any]) -> int:
+    return d.get("double", 0) + d.get("triple", 0) + d.get("quad", 0) + d.get("quint", 0)
+
+
+def _winrate(d: Dict[str, Any]) -> Optional[float]:
+    total_slots = d.get("total_slots", 0)
+    if total_slots < WINRATE_MIN_SLOTS:
+        return None
+    return d.get("total_wins", 0) / total_slots
+
+
+# metric -> function returning the value to rank by, or None when the player
+# does not belong in that board (same filters the /top* commands always used)
+METRICS: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    "points": lambda d: d.get("points"),
+    "best_streak": lambda d: d.get("best_streak"),
+    "best_sfiga": lambda d: d.get("best_sfiga"),
+    "combo": lambda d: _combo_total(d) or None,
+    "winrate": _winrate,
+    "best_speed": lambda d: d.get("best_speed", 0.0) or None,
+    "elo": lambda d: d.get("elo", 1000),
+    "duel_wins": lambda d: d.get("duel_wins", 0) if d.get("duel_wins", 0) + d.get("duel_losses", 0) > 0 else None,
+}
+
+
+class SortedKeyList:
+    """Sorted list split in buckets of ~LOAD items.
+
+    Insert/remove cost a bisect over the bucket maxima plus an insort into
+    one small bucket, so they stay O(log n) in practice even with a lot of
+    players; reading the first K keys only touches the first buckets.
+    """
+
+    LOAD = 500
+
+    def __init__(self):
+        self._buckets: List[List[tuple]] = []
+        self._maxes: List[tuple] = []
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def add(self, key: tuple) -> None:
+        self._len += 1
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            return
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+        bucket = self._buckets[i]
+        insort(bucket, key)
+        self._maxes[i] = bucket[-1]
+        if len(bucket) > 2 * self.LOAD:
+            half = len(bucket) // 2
+            self._buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self._maxes[i:i + 1] = [bucket[half - 1], bucket[-1]]
+
+    def remove(self, key: tuple) -> None:
+        i = bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        j = bisect_left(bucket, key)
+        del bucket[j]
+        self._len -= 1
+        if bucket:
+            self._maxes[i] = bucket[-1]
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+
+    def index(self, key: tuple) -> int:
+        i = bisect_left(self._maxes, key)
+        before = sum(len(b) for b in self._buckets[:i])
+        return before + bisect_left(self._buckets[i], key)
+
+    def head(self, k: int) -> Iterator[tuple]:
+        for bucket in self._buckets:
+            for key in bucket:
+                if k <= 0:
+                    return
+                yield key
+                k -= 1
+
+
+class Board:
+    """One metric: uid -> value plus the players sorted by value (desc)"""
+
+    def __init__(self, value_fn: Callable[[Dict[str, Any]], Any]):
+        self.value_fn = value_fn
+        self.values: Dict[str, Any] = {}
+        self._keys: Dict[str, tuple] = {}
+        self._sorted = SortedKeyList()
+
+    def __len__(self) -> int:
+        return len(self._sorted)
+
+    def update(self, user_id: str, entry: Optional[Dict[str, Any]]) -> None:
+        value = None
+        if isinstance(entry, Mapping):
+            try:
+                value = self.value_fn(entry)
+                sort_value = float(value) if value is not None else None
+            except (TypeError, ValueError):
+                value = sort_value = None  # corrupted field, keep it out of the board
+
+        old_key = self._keys.get(user_id)
+        new_key = (-sort_value, user_id) if value is not None else None
+        if old_key == new_key:
+            if value is not None:
+                self.values[user_id] = value
+            return
+        if old_key is not None:
+            self._sorted.remove(old_key)
+            del self._keys[user_id]
+            del self.values[user_id]
+        if new_key is not None:
+            self._sorted.add(new_key)
+            self._keys[user_id] = new_key
+            self.values[user_id] = value
+
+    def top(self, k: int) -> List[Tuple[str, Any]]:
+        return [(uid, self.values[uid]) for _, uid in self._sorted.head(k)]
+
+    def rank(self, user_id: str) -> Optional[int]:
+        key = self._keys.get(user_id)
+        if key is None:
+            return None
+        return self._sorted.index(key) + 1
+
+
+class LeaderboardIndex:
+    """All boards for one scores dict, fed by ScoreStore change notifications"""
+
+    def __init__(self, metrics: Optional[Dict[str, Callable]] = None,
+                 store: Optional[ScoreStore] = None):
+        self.metrics = metrics or METRICS
+        self.store = store or get_global_view()
+        self.boards: Dict[str, Board] = {}
+        self._stale = True
+
+    def rebuild(self, scores: Dict[str, Any]) -> None:
+        self.boards = {name: Board(fn) for name, fn in self.metrics.items()}
+        for user_id, entry in scores.items():
+            if not user_id.startswith("_"):
+                self.update(user_id, entry)
+        self._stale = False
+
+    def update(self, user_id: str, entry: Optional[Dict[str, Any]]) -> None:
+        for board in self.boards.values():
+            board.update(user_id, entry)
+
+    def on_scores_changed(self, scores: Optional[Dict[str, Any]], user_ids: Optional[Set[str]]) -> None:
+        if user_ids is None or scores is None:
+            self._stale = True
+            if scores is None:
+                self.boards = {}  # store unloaded/evicted: free the boards too
+            return
+        if self._stale:
+            return  # rebuilt on next read anyway
+        for user_id in user_ids:
+            if not user_id.startswith("_"):
+                self.update(user_id, scores.get(user_id))
+
+    def _ensure(self) -> None:
+        if self._stale:
+            self.rebuild(self.store.load())
+
+    def top(self, metric: str, k: int = 10) -> List[Tuple[str, Any]]:
+        """Top ``k`` (user_id, value) pairs of a board"""
+        self._ensure()
+        return self.boards[metric].top(k)
+
+    def rank(self, metric: str, user_id: str) -> Optional[Tuple[int, int]]:
+        """(position, board size) of a user, or None if not in that board"""
+        self._ensure()
+        board = self.boards[metric]
+        position = board.rank(user_id)
+        return (position, len(board)) if position is not None else None
+
+    def size(self, metric: str) -> int:
+        self._ensure()
+        return len(self.boards[metric])
+
+
+_indexes: Dict[Optional[int], LeaderboardIndex] = {}
+
+
+def get_leaderboard_index(chat_id: Optional[int] = None) -> LeaderboardIndex:
+    """Return the global index (or the one of a chat shard), subscribing it
+    to its ScoreStore on first use"""
+    store = get_score_store(chat_id) if chat_id is not None else get_global_view()
+    index = _indexes.get(chat_id)
+    if index is None or index.store is not store:
+        # first use, or the shard was evicted and reloaded since
+        index = _indexes[chat_id] = LeaderboardIndex(store=store)
+        store.subscribe(index.on_scores_changed)
+    return index
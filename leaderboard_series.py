@@ -0,0 +1,346 @@
+"""
+Leaderboard series - every player's key metrics, day by day
+
+Replaces the top-10 snapshots of leaderboard_snapshots/: once a day (and
+whenever a recap needs it) record() stores points, elo, total_slots,
+total_wins and best_streak of every player in the global scores.
+
+The series is columnar: player i is column i of one array per metric.
+Each recorded day is a frame holding only the players whose metrics
+changed since the previous frame, as deltas; every SERIES_KEYFRAME_DAYS a
+key frame holds the full values instead (deltas against zero, zeros left
+out). A day is rebuilt from the key frame before it plus at most a week of
+deltas, so reading any day costs one pass over the players, however long
+the history is.
+
+Frames are appended to SERIES_FILE (on the storage writer thread) and read
+once, at the first query:
+
+    b"SLTSERIES" + u8 version
+    frames: u32 length + zlib(payload)
+    payload: u8 key frame, i32 day (since 1970-01-01), u32 new ids,
+             u32 length + ids joined by NUL, u32 changed count,
+             changed * u32 column, then per metric changed * i64 delta
+"""
+import os
+import struct
+import zlib
+from array import array
+from bisect import bisect_right
+from collections.abc import Mapping
+from concurrent.futures import Future
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from config import SERIES_FILE, SERIES_KEYFRAME_DAYS
+from storage_writer import get_writer
+
+METRICS = ("points", "elo", "total_slots", "total_wins", "best_streak")
+
+MAGIC = b"SLTSERIES"
+VERSION = 1
+_HEADER = struct.Struct("<BiI")
+_U32 = struct.Struct("<I")
+
+# parsed days kept around (recaps compare the same two days over and over)
+_CACHED_DAYS = 8
+
+_EPOCH = date(1970, 1, 1)
+
+
+def _day(d: date) -> int:
+    return (d - _EPOCH).days
+
+
+def _metric_value(entry: Mapping, metric: str) -> int:
+    try:
+        return int(entry.get(metric) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class Columns:
+    """Every player's metrics on one day: ``values[m][i]`` is metric m of
+    player ``ids[i]``; players that joined later are past ``size``"""
+
+    def __init__(self, ids: List[str], index: Dict[str, int], values: List[array]):
+        self.ids = ids
+        self._index = index
+        self.values = values
+        self.size = len(values[0])
+        self._ranks: Dict[str, array] = {}
+
+    def _column(self, user_id: str) -> Optional[int]:
+        i = self._index.get(user_id)
+        return i if i is not None and i < self.size else None
+
+    def value(self, user_id: str, metric: str = "points") -> Optional[int]:
+        i = self._column(user_id)
+        return None if i is None else self.values[METRICS.index(metric)][i]
+
+    def ranks(self, metric: str = "points") -> array:
+        """Rank of every player (1 = best, ties share the rank)"""
+        ranks = self._ranks.get(metric)
+        if ranks is None:
+            column = self.values[METRICS.index(metric)]
+            order = sorted(range(self.size), key=column.__getitem__, reverse=True)
+            ranks = array("I", bytes(4 * self.size))
+            for position, i in enumerate(order):
+                if position and column[i] == column[order[position - 1]]:
+                    ranks[i] = ranks[order[position - 1]]
+                else:
+                    ranks[i] = position + 1
+            self._ranks[metric] = ranks
+        return ranks
+
+    def rank(self, user_id: str, metric: str = "points") -> Optional[int]:
+        i = self._column(user_id)
+        return None if i is None else self.ranks(metric)[i]
+
+    def top(self, metric: str = "points", limit: int = 10) -> List[Tuple[str, int]]:
+        column = self.values[METRICS.index(metric)]
+        best = sorted(range(self.size), key=lambda i: (-column[i], self.ids[i]))[:limit]
+        return [(self.ids[i], column[i]) for i in best]
+
+
+def movers(before: Columns, after: Columns, metric: str = "points",
+           limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Players whose value or rank changed between two days, biggest change
+    first: user_id, before, after, change, rank_before, rank_after (a player
+    missing on the first day counts as 0, unranked)"""
+    m = METRICS.index(metric)
+    old, new = before.values[m], after.values[m]
+    old_ranks, new_ranks = before.ranks(metric), after.ranks(metric)
+    rows = []
+    for i in range(after.size):
+        known = i < before.size
+        value = old[i] if known else 0
+        rank_before = old_ranks[i] if known else None
+        if new[i] == value and rank_before == new_ranks[i]:
+            continue
+        rows.append({
+            "user_id": after.ids[i],
+            "before": value,
+            "after": new[i],
+            "change": new[i] - value,
+            "rank_before": rank_before,
+            "rank_after": new_ranks[i],
+        })
+    rows.sort(key=lambda r: (-abs(r["change"]), r["rank_after"]))
+    return rows if limit is None else rows[:limit]
+
+
+class LeaderboardSeries:
+    """Delta-encoded daily columns of the global leaderboard"""
+
+    def __init__(self, path: str = SERIES_FILE, keyframe_days: int = SERIES_KEYFRAME_DAYS):
+        self.path = path
+        self.keyframe_days = keyframe_days
+        self._loaded = False
+        self.ids: List[str] = []
+        self._index: Dict[str, int] = {}
+        self._saved_ids = 0
+        # one entry per frame, in order (a day recorded twice has two frames)
+        self._frame_days: List[int] = []
+        self._frames: List[Tuple[bool, array, List[array]]] = []
+        self._sizes: List[int] = []
+        self._keyframes: List[int] = []
+        self._latest: List[array] = [array("q") for _ in METRICS]
+        self._cache: Dict[int, Columns] = {}
+
+    # ----- loading -----
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC:
+            print(f"⚠️ {self.path} non è una serie della classifica, ignorato", flush=True)
+            return
+        offset = good = len(MAGIC) + 1
+        while offset + 4 <= len(data):
+            (length,) = _U32.unpack_from(data, offset)
+            try:
+                self._apply(zlib.decompress(data[offset + 4:offset + 4 + length]))
+            except (zlib.error, struct.error, ValueError):
+                break
+            offset = good = offset + 4 + length
+        if good < len(data):
+            # a frame cut short by a crash: drop it so new frames line up
+            print(f"⚠️ {self.path}: ultimo giorno incompleto scartato", flush=True)
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+
+    def _apply(self, payload: bytes) -> None:
+        key, day, new_ids = _HEADER.unpack_from(payload, 0)
+        offset = _HEADER.size
+        (length,) = _U32.unpack_from(payload, offset)
+        offset += 4
+        names = payload[offset:offset + length].decode("utf-8").split("\0") if new_ids else []
+        if len(names) != new_ids:
+            raise ValueError("id count mismatch")
+        offset += length
+        (count,) = _U32.unpack_from(payload, offset)
+        offset += 4
+        changed = array("I", payload[offset:offset + 4 * count])
+        offset += 4 * count
+        deltas = []
+        for _ in METRICS:
+            deltas.append(array("q", payload[offset:offset + 8 * count]))
+            offset += 8 * count
+        if len(changed) != count or any(len(d) != count for d in deltas):
+            raise ValueError("short frame")
+        for name in names:
+            self._add_id(name)
+        self._saved_ids = len(self.ids)
+        self._push(day, bool(key), changed, deltas)
+
+    def _add_id(self, user_id: str) -> int:
+        i = self._index[user_id] = len(self.ids)
+        self.ids.append(user_id)
+        return i
+
+    def _push(self, day: int, key: bool, changed: array, deltas: List[array]) -> None:
+        """Add a frame in memory and move the latest columns forward"""
+        size = len(self.ids)
+        for column in self._latest:
+            column.extend([0] * (size - len(column)))
+            if key:
+                for i in range(len(column)):
+                    column[i] = 0
+        for m, column in enumerate(self._latest):
+            delta = deltas[m]
+            for j, i in enumerate(changed):
+                column[i] += delta[j]
+        if key:
+            self._keyframes.append(len(self._frames))
+        self._frame_days.append(day)
+        self._frames.append((key, changed, deltas))
+        self._sizes.append(size)
+
+    # ----- writing -----
+
+    def _columns_of(self, scores: Mapping) -> List[array]:
+        """The players' current values, aligned with ``ids`` (new players
+        get a column, removed ones drop to zero)"""
+        for user_id, entry in scores.items():
+            if isinstance(entry, Mapping) and user_id not in self._index:
+                self._add_id(user_id)
+        values = [array("q", bytes(8 * len(self.ids))) for _ in METRICS]
+        for user_id, entry in scores.items():
+            if isinstance(entry, Mapping):
+                i = self._index[user_id]
+                for m, metric in enumerate(METRICS):
+                    values[m][i] = _metric_value(entry, metric)
+        return values
+
+    def record(self, on: date, scores: Mapping) -> Future:
+        """Store every player's metrics for day ``on`` (recording the same day
+        again overrides it); the frame is appended on the writer thread"""
+        self._load()
+        day = _day(on)
+        if self._frame_days and day < self._frame_days[-1]:
+            raise ValueError(f"{on} is before the last recorded day")
+        values = self._columns_of(scores)
+        last_key = self._frame_days[self._keyframes[-1]] if self._keyframes else None
+        key = last_key is None or day - last_key >= self.keyframe_days
+        changed = array("I")
+        deltas = [array("q") for _ in METRICS]
+        for i in range(len(self.ids)):
+            if key:
+                base = [0] * len(METRICS)
+            else:
+                base = [column[i] if i < len(column) else 0 for column in self._latest]
+            row = [values[m][i] - base[m] for m in range(len(METRICS))]
+            if any(row):
+                changed.append(i)
+                for m, delta in enumerate(row):
+                    deltas[m].append(delta)
+
+        new_ids = self.ids[self._saved_ids:]
+        self._saved_ids = len(self.ids)
+        names = "\0".join(new_ids).encode("utf-8")
+        payload = b"".join([
+            _HEADER.pack(int(key), day, len(new_ids)),
+            _U32.pack(len(names)), names,
+            _U32.pack(len(changed)), changed.tobytes(),
+            *(d.tobytes() for d in deltas),
+        ])
+        self._push(day, key, changed, deltas)
+        return get_writer().submit(self._append, zlib.compress(payload, 6))
+
+    def _append(self, frame: bytes) -> None:
+        new = not os.path.exists(self.path)
+        with open(self.path, "ab") as f:
+            if new:
+                f.write(MAGIC + bytes([VERSION]))
+            f.write(_U32.pack(len(frame)) + frame)
+
+    # ----- reading -----
+
+    @property
+    def version(self) -> int:
+        """Grows with every recorded frame"""
+        self._load()
+        return len(self._frames)
+
+    def days(self) -> List[date]:
+        """Recorded days, oldest first"""
+        self._load()
+        return [_EPOCH + timedelta(days=d) for d in sorted(set(self._frame_days))]
+
+    def on(self, d: date) -> Optional[Columns]:
+        """Every player's metrics as recorded on day ``d`` (the latest day
+        recorded before it when ``d`` was skipped), None before the first"""
+        self._load()
+        frame = bisect_right(self._frame_days, _day(d)) - 1
+        if frame < 0:
+            return None
+        columns = self._cache.get(frame)
+        if columns is None:
+            size = self._sizes[frame]
+            start = self._keyframes[bisect_right(self._keyframes, frame) - 1]
+            values = [array("q", bytes(8 * size)) for _ in METRICS]
+            for key, changed, deltas in self._frames[start:frame + 1]:
+                for m, column in enumerate(values):
+                    delta = deltas[m]
+                    for j, i in enumerate(changed):
+                        column[i] += delta[j]
+            columns = Columns(self.ids, self._index, values)
+            if len(self._cache) >= _CACHED_DAYS:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[frame] = columns
+        return columns
+
+    def live(self, scores: Mapping) -> Columns:
+        """Columns of the current scores, to compare with a recorded day"""
+        self._load()
+        return Columns(self.ids, self._index, self._columns_of(scores))
+
+    def rank_on(self, user_id: str, d: date, metric: str = "points") -> Optional[Tuple[int, int]]:
+        """(rank, value) of a player on day ``d``, None if not recorded yet"""
+        columns = self.on(d)
+        if columns is None or columns.value(user_id, metric) is None:
+            return None
+        return columns.rank(user_id, metric), columns.value(user_id, metric)
+
+    def movers(self, since: date, until: date, metric: str = "points",
+               limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Biggest changes between two recorded days (see movers())"""
+        before, after = self.on(since), self.on(until)
+        if after is None:
+            return []
+        if before is None:
+            before = Columns(self.ids, self._index, [array("q") for _ in METRICS])
+        return movers(before, after, metric, limit)
+
+
+_series = LeaderboardSeries()
+
+
+def get_leaderboard_series() -> LeaderboardSeries:
+    """Return the process-wide leaderboard series"""
+    return _series
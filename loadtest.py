@@ -0,0 +1,251 @@
+"""
+Webhook load test - end-to-end throughput without the Telegram API
+
+Runs the real application in webhook mode (python-telegram-bot's embedded
+server) in a scratch directory, with FakeBotAPI answering every Bot API call
+locally, and posts synthetic dice updates to it over HTTP the way Telegram
+does. An update counts as done once every handler has run for it.
+
+    python loadtest.py --updates 5000 --connections 40
+    python loadtest.py --backend sqlite --users 2000 --chats 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+from telegram.request import BaseRequest, RequestData
+
+import game_state
+import storage
+from benchmark import UNTHROTTLED, summarize
+from config import STORAGE_BACKEND, WEBHOOK_PATH, WEBHOOK_MAX_CONNECTIONS
+from events import get_event_log, flush_events
+from outbox import flush_replies, reset_outbox
+from state_journal import get_state_journal
+from storage_backends import create_backend
+
+# Telegram sends the webhook's secret token in this header
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+FAKE_TOKEN = "123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11"
+FAKE_BOT_USER = {"id": 123456, "is_bot": True, "first_name": "SlotBot", "username": "slotbot_test_bot"}
+
+
+class FakeBotAPI(BaseRequest):
+    """Answers Bot API calls in-process: sends return a message, the rest ``True``"""
+
+    def __init__(self):
+        self.calls: Counter = Counter()
+        self._message_ids = iter(range(1, 1 << 62))
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _result(self, endpoint: str, params: Dict[str, Any]) -> Any:
+        if endpoint == "getMe":
+            return FAKE_BOT_USER
+        if not endpoint.startswith("send"):
+            return True
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": FAKE_BOT_USER,
+        }
+        if endpoint == "sendDice":
+            message["dice"] = {"emoji": params.get("emoji", "🎰"), "value": random.randint(1, 64)}
+        elif "text" in params:
+            message["text"] = params["text"]
+        return message
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout: Any = None, write_timeout: Any = None,
+                         connect_timeout: Any = None, pool_timeout: Any = None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data is not None else {}
+        body = {"ok": True, "result": self._result(endpoint, params)}
+        return 200, json.dumps(body).encode()
+
+
+def dice_update(update_id: int, user_id: int, chat_id: int, value: int,
+                name: Optional[str] = None) -> Dict[str, Any]:
+    """A slot roll as Telegram posts it to the webhook"""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": name or f"Utente{user_id}"},
+            "dice": {"emoji": "🎰", "value": value},
+        },
+    }
+
+
+class WebhookClient:
+    """Posts updates to a local webhook like Telegram would"""
+
+    def __init__(self, url: str, secret: Optional[str] = None,
+                 connections: int = WEBHOOK_MAX_CONNECTIONS):
+        headers = {SECRET_HEADER: secret} if secret else {}
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        self.url = url
+        self._client = httpx.AsyncClient(headers=headers, limits=limits, timeout=30)
+
+    async def post(self, update: Dict[str, Any]) -> float:
+        """Send one update, return the request's latency in seconds"""
+        started = time.perf_counter()
+        response = await self._client.post(self.url, json=update)
+        response.raise_for_status()
+        return time.perf_counter() - started
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def __aenter__(self) -> "WebhookClient":
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.close()
+
+
+def build_app(api: FakeBotAPI):
+    """The bot's handlers on an application that talks to ``api``"""
+    from bot import register_handlers
+
+    app = ApplicationBuilder().token(FAKE_TOKEN).request(api).concurrent_updates(True).build()
+    register_handlers(app)
+    return app
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_load(args: argparse.Namespace) -> Dict[str, Any]:
+    """Serve the webhook in a scratch directory and post ``args.updates`` rolls to it"""
+    rng = random.Random(args.seed)
+    home = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix="slotbot-load-")
+    os.chdir(scratch)
+    storage.set_backend(create_backend(args.backend))
+    reset_outbox(**UNTHROTTLED)
+    game_state.ACTIVE_DUELS.clear()
+    game_state.PENDING_DUELS.clear()
+    game_state.EXPANSION_UNTIL.clear()
+    game_state.DEBUG_MODE = False
+    game_state.SLOT_BLOCKED = False
+
+    api = FakeBotAPI()
+    app = build_app(api)
+    posted: Dict[int, float] = {}
+    done: Dict[int, float] = {}
+    finished = asyncio.Event()
+
+    async def mark_done(update: Update, context: Any) -> None:
+        done[update.update_id] = time.perf_counter()
+        if len(done) == args.updates:
+            finished.set()
+
+    # runs after the dice handler (group 0) for the same update
+    app.add_handler(TypeHandler(Update, mark_done), group=1)
+
+    port = args.port or _free_port()
+    url = f"http://127.0.0.1:{port}/{WEBHOOK_PATH}"
+    secret = "loadtest-secret"
+    latencies: List[float] = []
+    try:
+        async with app:
+            await app.updater.start_webhook(
+                listen="127.0.0.1", port=port, url_path=WEBHOOK_PATH,
+                secret_token=secret, max_connections=args.connections
+            )
+            await app.start()
+            gate = asyncio.Semaphore(args.connections)
+            users = [100000000 + i for i in range(args.users)]
+            chats = [-1000000000 - i for i in range(args.chats)]
+
+            async def post(client: WebhookClient, update_id: int) -> None:
+                update = dice_update(update_id, rng.choice(users), rng.choice(chats), rng.randint(1, 64))
+                async with gate:
+                    posted[update_id] = time.perf_counter()
+                    latencies.append(await client.post(update))
+
+            started = time.perf_counter()
+            async with WebhookClient(url, secret, args.connections) as client:
+                await asyncio.gather(*(post(client, i) for i in range(1, args.updates + 1)))
+            await asyncio.wait_for(finished.wait(), args.timeout)
+            elapsed = max(done.values()) - started
+
+            await app.updater.stop()
+            await app.stop()
+            await flush_replies()
+        flush_events()
+        await storage.flush_scores_async()
+    finally:
+        get_event_log().close()
+        get_state_journal().close()
+        os.chdir(home)
+        if args.keep:
+            print(f"  dati in {scratch}", flush=True)
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    return {
+        "updates": args.updates,
+        "connections": args.connections,
+        "backend": args.backend,
+        "updates_per_s": args.updates / elapsed if elapsed else 0.0,
+        "http": summarize(latencies),
+        "end_to_end": summarize([done[i] - posted[i] for i in done]),
+        "api_calls": dict(api.calls),
+    }
+
+
+async def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Test di carico del webhook senza l'API di Telegram")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--connections", type=int, default=WEBHOOK_MAX_CONNECTIONS)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--port", type=int, default=0, help="0: una porta libera")
+    parser.add_argument("--backend", default=STORAGE_BACKEND, choices=["json", "binary", "sqlite"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--out", help="scrivi il report JSON qui")
+    parser.add_argument("--keep", action="store_true", help="non cancellare la cartella temporanea")
+    args = parser.parse_args(argv)
+
+    print(f"🌐 Webhook: {args.updates} tiri su {args.connections} connessioni ({args.backend})", flush=True)
+    report = await run_load(args)
+    print(f"  {report['updates_per_s']:.0f} tiri/s, "
+          f"HTTP p50 {report['http']['p50_ms']:.2f}ms p99 {report['http']['p99_ms']:.2f}ms, "
+          f"completati p99 {report['end_to_end']['p99_ms']:.2f}ms", flush=True)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Report scritto in {args.out}", flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
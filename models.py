@@ -1,8 +1,9 @@
 """
 User data models and structure management
 """
-from typing import Dict, Any
-from config import ELO_K_FACTOR
+from collections.abc import Mapping, MutableMapping
+from typing import Dict, Any, Optional, Tuple, Callable, Iterator
+from config import ELO_K_FACTOR, WIN_VALUES, CURRENT_JSON_VERSION
 
 
 # Achievement definitions
@@ -23,105 +24,303 @@ ACHIEVEMENTS = {
 }
 
 
-def ensure_user_struct(scores: Dict[str, Any], user_id: str, nome: str) -> None:
-    """Ensure a user has all required fields in scores"""
-    if user_id not in scores:
-        scores[user_id] = {
-            "name": nome,
-            "points": 0,
-            "streak": 0,
-            "best_streak": 0,
-            "sfiga": 0,
-            "best_sfiga": 0,
-            "total_slots": 0,
-            "total_wins": 0,
-            "double": 0,
-            "triple": 0,
-            "quad": 0,
-            "quint": 0,
-            "duel_wins": 0,
-            "duel_losses": 0,
-            "elo": 1000,
-            "best_speed": 0.0,
-            "last_slot_ts": 0.0,
-            "last_was_win": False,
-            "last_triple_msg_id": None,
-            "domains_used": 0,
-            "last_slot_bot_ts": 0,
-            "last_duel_bot_ts": 0,
-            "last_tarocchi_ts": 0,
-            "last_lotteria_ts": 0,
-            "last_evento_ts": 0,
-            "last_bestemmia_sfiga": 0,
-            "achievements": []
-        }
-    else:
-        # Add missing fields for existing users
-        scores[user_id].setdefault("name", nome)
-        scores[user_id].setdefault("points", 0)
-        scores[user_id].setdefault("streak", 0)
-        scores[user_id].setdefault("best_streak", 0)
-        scores[user_id].setdefault("sfiga", 0)
-        scores[user_id].setdefault("best_sfiga", 0)
-        scores[user_id].setdefault("total_slots", 0)
-        scores[user_id].setdefault("total_wins", 0)
-        scores[user_id].setdefault("double", 0)
-        scores[user_id].setdefault("triple", 0)
-        scores[user_id].setdefault("quad", 0)
-        scores[user_id].setdefault("quint", 0)
-        scores[user_id].setdefault("duel_wins", 0)
-        scores[user_id].setdefault("duel_losses", 0)
-        scores[user_id].setdefault("elo", 1000)
-        scores[user_id].setdefault("best_speed", 0.0)
-        scores[user_id].setdefault("last_slot_ts", 0.0)
-        scores[user_id].setdefault("last_was_win", False)
-        scores[user_id].setdefault("last_triple_msg_id", None)
-        scores[user_id].setdefault("domains_used", 0)
-        scores[user_id].setdefault("last_slot_bot_ts", 0)
-        scores[user_id].setdefault("last_duel_bot_ts", 0)
-        scores[user_id].setdefault("last_tarocchi_ts", 0)
-        scores[user_id].setdefault("last_lotteria_ts", 0)
-        scores[user_id].setdefault("last_evento_ts", 0)
-        scores[user_id].setdefault("last_bestemmia_sfiga", 0)
-        scores[user_id].setdefault("achievements", [])
-
-        scores[user_id]["name"] = nome
+# Every user entry has exactly these fields, in storage order, with their
+# defaults ("achievements" starts as a fresh empty list)
+USER_FIELDS: Tuple[Tuple[str, Any], ...] = (
+    ("name", ""),
+    ("points", 0),
+    ("streak", 0),
+    ("best_streak", 0),
+    ("sfiga", 0),
+    ("best_sfiga", 0),
+    ("total_slots", 0),
+    ("total_wins", 0),
+    ("double", 0),
+    ("triple", 0),
+    ("quad", 0),
+    ("quint", 0),
+    ("duel_wins", 0),
+    ("duel_losses", 0),
+    ("elo", 1000),
+    ("best_speed", 0.0),
+    ("last_slot_ts", 0.0),
+    ("last_was_win", False),
+    ("last_triple_msg_id", None),
+    ("domains_used", 0),
+    ("last_slot_bot_ts", 0),
+    ("last_duel_bot_ts", 0),
+    ("last_tarocchi_ts", 0),
+    ("last_lotteria_ts", 0),
+    ("last_evento_ts", 0),
+    ("last_bestemmia_sfiga", 0),
+    ("achievements", None),
+)
+_FIELD_NAMES = tuple(field for field, _ in USER_FIELDS)
+_FIELD_SET = frozenset(_FIELD_NAMES)
+_DEFAULTS = dict(USER_FIELDS)
+
+
+class UserStats(MutableMapping):
+    """One user's stats, stored in slots instead of a 27-key dict.
+
+    Fields are plain attributes (``d.points += 1``). The mapping interface
+    (``d["points"]``, ``get``, ``items``) stays for generic code: admin edits,
+    leaderboards, serializers. Keys outside USER_FIELDS go to ``extra`` so
+    nothing read from disk is lost.
+    """
+    __slots__ = _FIELD_NAMES + ("extra",)
+
+    def __init__(self, name: str = "", **fields: Any):
+        for field, default in USER_FIELDS:
+            setattr(self, field, default)
+        self.achievements = []
+        self.extra: Optional[Dict[str, Any]] = None
+        self.name = name
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> "UserStats":
+        """Entry from its JSON form; missing fields get their default"""
+        self = cls.__new__(cls)
+        get = data.get
+        for field, default in USER_FIELDS:
+            setattr(self, field, get(field, default))
+        achievements = self.achievements
+        self.achievements = [] if achievements is None else list(achievements) if isinstance(achievements, list) else achievements
+        self.extra = None
+        if not _FIELD_SET.issuperset(data):
+            self.extra = {k: v for k, v in data.items() if k not in _FIELD_SET}
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON form of the entry (a new dict, safe to serialize elsewhere)"""
+        d = {field: getattr(self, field) for field in _FIELD_NAMES}
+        if isinstance(self.achievements, list):
+            d["achievements"] = list(self.achievements)
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    def copy(self) -> "UserStats":
+        return UserStats.from_dict(self.to_dict())
+
+    def __reduce__(self):
+        # pickle / copy.deepcopy
+        return UserStats.from_dict, (self.to_dict(),)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _FIELD_SET:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in _FIELD_SET:
+            return getattr(self, key)
+        return self.extra.get(key, default) if self.extra else default
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        # fixed fields always exist: deleting one restores its default
+        if key in _FIELD_SET:
+            setattr(self, key, [] if key == "achievements" else _DEFAULTS[key])
+        elif self.extra and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def clear(self) -> None:
+        UserStats.__init__(self, self.name)
+
+    def __contains__(self, key: object) -> bool:
+        return key in _FIELD_SET or bool(self.extra) and key in self.extra
+
+    def __iter__(self) -> Iterator[str]:
+        yield from _FIELD_NAMES
+        if self.extra:
+            yield from list(self.extra)
+
+    def __len__(self) -> int:
+        return len(_FIELD_NAMES) + len(self.extra or ())
+
+    def __repr__(self) -> str:
+        return f"UserStats({self.to_dict()!r})"
+
+
+def ensure_user_struct(scores: MutableMapping, user_id: str, nome: str) -> UserStats:
+    """Return the user's entry (created if missing) with its name set to ``nome``"""
+    d = scores.get(user_id)
+    if not isinstance(d, UserStats):
+        d = scores[user_id] = UserStats.from_dict(d) if isinstance(d, Mapping) else UserStats()
+    d.name = nome
+    return d
+
+
+def _migrate_v1(d: Dict[str, Any]) -> None:
+    d.setdefault("domains_used", 0)
+    d.setdefault("last_triple_msg_id", None)
+    d.setdefault("best_speed", 0.0)
+
+
+# _version -> upgrade of one raw entry dict from that version to the next
+MIGRATIONS: Dict[int, Callable[[Dict[str, Any]], None]] = {
+    1: _migrate_v1,
+}
+
+
+def migrate_scores(scores: MutableMapping) -> MutableMapping:
+    """Bring a scores mapping to CURRENT_JSON_VERSION, in place.
+
+    Each entry goes through the MIGRATIONS steps from the file's ``_version``
+    and becomes a UserStats; non-dict values under a user id are dropped as
+    corrupted, metadata keys (``_jackpot``, ``_version``) are kept.
+    """
+    version = scores.get("_version", 1)
+    steps = [MIGRATIONS[v] for v in range(version, CURRENT_JSON_VERSION)]
+    for user_id in list(scores):
+        if user_id.startswith("_"):
+            continue
+        d = scores[user_id]
+        if isinstance(d, UserStats) and not steps:
+            continue
+        if not isinstance(d, Mapping):
+            del scores[user_id]
+            continue
+        if steps:
+            d = dict(d.items())
+            for step in steps:
+                step(d)
+        scores[user_id] = UserStats.from_dict(d)
+    if version < CURRENT_JSON_VERSION:
+        scores["_version"] = CURRENT_JSON_VERSION
+    return scores
 
 
 def unlock_achievement(scores: Dict[str, Any], user_id: str, achievement_id: str) -> bool:
     """Unlock an achievement for a user. Returns True if newly unlocked, False if already owned"""
     if achievement_id not in ACHIEVEMENTS:
         return False
-    
-    if achievement_id in scores[user_id].get("achievements", []):
+
+    achievements = scores[user_id].achievements
+    if achievement_id in achievements:
         return False  # Already unlocked
-    
-    scores[user_id]["achievements"].append(achievement_id)
+
+    achievements.append(achievement_id)
     return True
 
 
 def get_achievements_display(scores: Dict[str, Any], user_id: str) -> str:
     """Get formatted achievement display for a user"""
-    user_achievements = scores[user_id].get("achievements", [])
-    
+    user_achievements = scores[user_id].achievements
+
     if not user_achievements:
         return ""
-    
+
     display = "\n🏆 *ACHIEVEMENTS:*\n"
     for ach_id in user_achievements:
         if ach_id in ACHIEVEMENTS:
             ach = ACHIEVEMENTS[ach_id]
             display += f"  {ach['emoji']} {ach['name']}\n"
-    
+
     return display
 
 
+def apply_roll(d: UserStats, value: int, now_ts: float, expansion: bool = False) -> Dict[str, Any]:
+    """Apply one slot roll to a user entry: the scoring rules of the game.
+
+    Shared by the dice handler and the event log replay. Returns what the
+    caller needs for messages: won, jackpot, streak, sfiga, speed_record.
+    """
+    last_ts = d.last_slot_ts
+    d.last_slot_ts = now_ts
+    d.total_slots += 1
+
+    speed_record: Optional[float] = None
+    if last_ts > 0:  # Only track speed if not first roll
+        delta = now_ts - last_ts
+        if delta > 0:  # we only care about positive intervals
+            speed = 1.0 / delta
+            best_speed = d.best_speed
+            if best_speed == 0.0 or speed > best_speed:  # First time or new record
+                d.best_speed = speed
+                speed_record = speed
+
+    jackpot = (value == 64)
+    won = value in WIN_VALUES
+
+    if won:
+        d.last_was_win = True
+
+        d.sfiga = 0
+        d.streak += 1
+        streak = d.streak
+
+        if streak > d.best_streak:
+            d.best_streak = streak
+
+        d.total_wins += 1
+
+        if streak == 2:
+            d.double += 1
+        elif streak == 3:
+            d.triple += 1
+        elif streak == 4:
+            d.quad += 1
+        elif streak == 5:
+            d.quint += 1
+
+        # Point calculation
+        if jackpot:
+            d.points += 2
+        else:
+            d.points += 1
+
+        if streak == 2:
+            d.points += 1
+        elif streak == 3:
+            d.points += 1
+        elif streak == 4:
+            d.points += 2
+        elif streak == 5:
+            d.points += 3
+
+        if expansion:
+            d.points += 1
+    else:
+        d.last_was_win = False
+
+        d.streak = 0
+        d.sfiga += 1
+
+        if d.sfiga > d.best_sfiga:
+            d.best_sfiga = d.sfiga
+
+    return {
+        "won": won,
+        "jackpot": jackpot,
+        "streak": d.streak,
+        "sfiga": d.sfiga,
+        "speed_record": speed_record,
+    }
+
+
 def update_elo(winner_id: str, loser_id: str, scores: Dict[str, Any]) -> tuple:
     """Calculate and update ELO ratings using standard formula
     Returns: (elo_gain_winner, elo_loss_loser)
     """
-    Ra = scores[winner_id]["elo"]
-    Rb = scores[loser_id]["elo"]
+    # item access: entries may be UserStats or plain dicts
+    winner, loser = scores[winner_id], scores[loser_id]
+    Ra = winner["elo"]
+    Rb = loser["elo"]
 
     Ea = 1 / (1 + 10 ** ((Rb - Ra) / 400))
     Eb = 1 / (1 + 10 ** ((Ra - Rb) / 400))
@@ -129,7 +328,7 @@ def update_elo(winner_id: str, loser_id: str, scores: Dict[str, Any]) -> tuple:
     new_Ra = int(Ra + ELO_K_FACTOR * (1 - Ea))
     new_Rb = int(Rb + ELO_K_FACTOR * (0 - Eb))
 
-    scores[winner_id]["elo"] = new_Ra
-    scores[loser_id]["elo"] = new_Rb
+    winner["elo"] = new_Ra
+    loser["elo"] = new_Rb
 
     return new_Ra - Ra, new_Rb - Rb
@@ -0,0 +1,336 @@
+"""
+Outbox - every message the bot sends goes through here
+
+Each chat has a queue drained by one sender task, under Telegram's flood
+limits (token buckets per chat, per group and global). A RetryAfter pauses
+the chat and the message is retried instead of being lost. Higher priority
+messages (duel results) go first, lower ones (speed records) last, and small
+texts waiting in the same queue are sent as one message.
+
+Replies to slot rolls are deferred: the roll is scored and committed as soon
+as it arrives, its replies are sent REPLY_DELAY seconds later so the result
+is not revealed while the slot is still spinning. Replies that come due
+within REPLY_MERGE_WINDOW of each other are merged.
+"""
+import asyncio
+import itertools
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from telegram import ReplyParameters
+from telegram.error import RetryAfter
+from config import (
+    REPLY_DELAY, REPLY_MERGE_WINDOW, SEND_RATE_PER_CHAT, SEND_BURST_PER_CHAT,
+    SEND_RATE_PER_GROUP, SEND_BURST_PER_GROUP, SEND_RATE_GLOBAL, SEND_MAX_RETRIES
+)
+
+# Telegram rejects longer messages (counted in UTF-16 code units)
+MAX_MESSAGE_LENGTH = 4096
+
+PRIORITY_HIGH = 0    # duel results
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2     # speed records and other extras
+
+
+def _length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _seconds(retry_after: Any) -> float:
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class TokenBucket:
+    """``rate`` sends per second, up to ``burst`` saved up"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated: Optional[float] = None
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a send is allowed"""
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, now: float, seconds: float) -> None:
+        """Telegram asked to wait (RetryAfter)"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class Outgoing:
+    """One queued send. Texts with the same ``merge_key`` can be joined;
+    ``send(text, reply_to)`` for texts, ``send()`` for other API calls."""
+    __slots__ = ("seq", "priority", "not_before", "wake", "text", "send",
+                 "reply_to", "merge_key", "future")
+
+    def __init__(self, seq: int, priority: int, not_before: float, wake: float,
+                 text: Optional[str], send: Callable[..., Awaitable[Any]],
+                 reply_to: Optional[int], merge_key: Optional[tuple],
+                 future: Optional[asyncio.Future]):
+        self.seq = seq
+        self.priority = priority
+        self.not_before = not_before
+        self.wake = wake
+        self.text = text
+        self.send = send
+        self.reply_to = reply_to
+        self.merge_key = merge_key
+        self.future = future
+
+
+class Outbox:
+    """Per-chat send queues, each drained by its own task"""
+
+    def __init__(self, delay: float = REPLY_DELAY, merge_window: float = REPLY_MERGE_WINDOW,
+                 chat_rate: float = SEND_RATE_PER_CHAT, chat_burst: float = SEND_BURST_PER_CHAT,
+                 group_rate: float = SEND_RATE_PER_GROUP, group_burst: float = SEND_BURST_PER_GROUP,
+                 global_rate: float = SEND_RATE_GLOBAL, max_retries: int = SEND_MAX_RETRIES):
+        self.delay = delay
+        self.merge_window = merge_window
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        # counters: API calls made, texts merged into another, RetryAfter hit, sends given up
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+        self.failed = 0
+        self._seq = itertools.count()
+        self._queues: Dict[Any, List[Outgoing]] = {}
+        self._senders: Dict[Any, asyncio.Task] = {}
+        self._wakeups: Dict[Any, asyncio.Event] = {}
+        self._buckets: Dict[Any, List[TokenBucket]] = {}
+        self._flushing = False
+
+    @property
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _chat_buckets(self, chat_id: Any) -> List[TokenBucket]:
+        buckets = self._buckets.get(chat_id)
+        if buckets is None:
+            buckets = [TokenBucket(self.chat_rate, self.chat_burst)]
+            if isinstance(chat_id, int) and chat_id < 0:  # groups and channels
+                buckets.append(TokenBucket(self.group_rate, self.group_burst))
+            self._buckets[chat_id] = buckets
+        return buckets
+
+    def enqueue(self, chat_id: Any, text: Optional[str], send: Callable[..., Awaitable[Any]],
+                reply_to: Optional[int] = None, merge_key: Optional[tuple] = None,
+                priority: int = PRIORITY_NORMAL, delay: float = 0.0,
+                wait: bool = True) -> Optional[asyncio.Future]:
+        """Queue one send; with ``wait`` the returned future gets its result"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        not_before = now + delay
+        future = loop.create_future() if wait else None
+        item = Outgoing(next(self._seq), priority, not_before,
+                        not_before + self.merge_window if delay else not_before,
+                        text, send, reply_to, merge_key, future)
+        self._queues.setdefault(chat_id, []).append(item)
+        self._wakeups.setdefault(chat_id, asyncio.Event()).set()
+        if chat_id not in self._senders:
+            self._senders[chat_id] = loop.create_task(self._run(chat_id))
+        return future
+
+    async def _run(self, chat_id: Any) -> None:
+        queue = self._queues[chat_id]
+        wakeup = self._wakeups[chat_id]
+        loop = asyncio.get_running_loop()
+        try:
+            while queue:
+                now = loop.time()
+                if not self._flushing:
+                    wake = min(item.wake for item in queue)
+                    if wake > now:
+                        # sleep until a deferred reply is due, or something new arrives
+                        wakeup.clear()
+                        try:
+                            await asyncio.wait_for(wakeup.wait(), wake - now)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                buckets = self._chat_buckets(chat_id)
+                wait = max([self.global_bucket.wait_time(now)] + [b.wait_time(now) for b in buckets])
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                batch = self._take_batch(queue, now)
+                for bucket in buckets + [self.global_bucket]:
+                    bucket.take(now)
+                await self._deliver(chat_id, batch)
+        finally:
+            del self._senders[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+                del self._wakeups[chat_id]
+
+    def _take_batch(self, queue: List[Outgoing], now: float) -> List[Outgoing]:
+        """Most urgent due send, plus the texts right behind it that merge with it"""
+        ready = sorted((item for item in queue if self._flushing or item.not_before <= now),
+                       key=lambda item: (item.priority, item.seq))
+        batch = [ready[0]]
+        head = ready[0]
+        if head.merge_key is not None:
+            length = _length(head.text)
+            for item in ready[1:]:
+                if item.merge_key != head.merge_key or length + 2 + _length(item.text) > MAX_MESSAGE_LENGTH:
+                    break
+                batch.append(item)
+                length += 2 + _length(item.text)
+        for item in batch:
+            queue.remove(item)
+        return batch
+
+    async def _deliver(self, chat_id: Any, batch: List[Outgoing]) -> None:
+        head = batch[0]
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            try:
+                if head.text is None:
+                    result = await head.send()
+                else:
+                    targets = {item.reply_to for item in batch}
+                    result = await head.send("\n\n".join(item.text for item in batch),
+                                             targets.pop() if len(targets) == 1 else None)
+                break
+            except RetryAfter as e:
+                seconds = _seconds(e.retry_after)
+                self.retried += 1
+                if attempt == self.max_retries:
+                    self._fail(chat_id, batch, e)
+                    return
+                print(f"⏳ Limite di Telegram nella chat {chat_id}: nuovo invio tra {seconds:.0f}s", flush=True)
+                for bucket in self._chat_buckets(chat_id):
+                    bucket.block(loop.time(), seconds)
+                await asyncio.sleep(seconds)
+            except Exception as e:
+                self._fail(chat_id, batch, e)
+                return
+        self.sent += 1
+        self.merged += len(batch) - 1
+        for item in batch:
+            if item.future is not None and not item.future.done():
+                item.future.set_result(result)
+
+    def _fail(self, chat_id: Any, batch: List[Outgoing], error: Exception) -> None:
+        self.failed += 1
+        awaited = False
+        for item in batch:
+            if item.future is not None and not item.future.done():
+                item.future.set_exception(error)
+                awaited = True
+        if not awaited:
+            print(f"⚠️ Messaggio non inviato nella chat {chat_id}: {error}", flush=True)
+
+    async def flush(self) -> None:
+        """Send everything queued now, deferred replies included (shutdown, tests)"""
+        self._flushing = True
+        try:
+            for wakeup in self._wakeups.values():
+                wakeup.set()
+            while self._senders:
+                await asyncio.gather(*list(self._senders.values()), return_exceptions=True)
+        finally:
+            self._flushing = False
+
+
+_outbox = Outbox()
+
+
+def get_outbox() -> Outbox:
+    """Return the process-wide outbox"""
+    return _outbox
+
+
+def reset_outbox(**kwargs: Any) -> Outbox:
+    """Replace the process-wide outbox (tests and benchmarks lift the limits)"""
+    global _outbox
+    _outbox = Outbox(**kwargs)
+    return _outbox
+
+
+def _text_merge_key(kind: Any, coalesce: bool, kwargs: Dict[str, Any]) -> Optional[tuple]:
+    # only plain texts merge: anything beyond a parse mode (keyboards, ...) goes alone
+    if not coalesce or set(kwargs) - {"parse_mode"}:
+        return None
+    return kind, kwargs.get("parse_mode")
+
+
+async def reply(message: Any, text: str, priority: int = PRIORITY_NORMAL,
+                coalesce: bool = True, **kwargs: Any) -> Any:
+    """``message.reply_text`` through the chat's queue; returns the sent Message.
+
+    Waits for delivery, throttling included: not to be awaited inside a
+    score transaction (use defer_reply there, or reply after it).
+    """
+    async def send(text: str, reply_to: Optional[int]) -> Any:
+        return await message.reply_text(text, **kwargs)
+
+    # replies only merge with other replies to the same message
+    return await _outbox.enqueue(message.chat_id, text, send, message.message_id,
+                                 _text_merge_key(("reply", message.message_id), coalesce, kwargs),
+                                 priority)
+
+
+async def send_text(bot: Any, chat_id: int, text: str, priority: int = PRIORITY_NORMAL,
+                    coalesce: bool = True, **kwargs: Any) -> Any:
+    """``bot.send_message`` through the chat's queue; returns the sent Message"""
+    async def send(text: str, reply_to: Optional[int]) -> Any:
+        return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+    return await _outbox.enqueue(chat_id, text, send, None,
+                                 _text_merge_key("send", coalesce, kwargs), priority)
+
+
+async def call(chat_id: int, method: Callable[..., Awaitable[Any]], /, *args: Any,
+               priority: int = PRIORITY_NORMAL, **kwargs: Any) -> Any:
+    """Any other send (documents, photos, dice) through the chat's queue"""
+    async def send() -> Any:
+        return await method(*args, **kwargs)
+
+    return await _outbox.enqueue(chat_id, None, send, priority=priority)
+
+
+def defer_reply(bot: Any, chat_id: int, text: str, reply_to: Optional[int] = None,
+                delete: Optional[int] = None, parse_mode: Optional[str] = "Markdown",
+                priority: int = PRIORITY_NORMAL) -> None:
+    """Send ``text`` after the animation delay (``delete``: a message to remove first)"""
+    if delete is not None:
+        async def remove() -> Any:
+            return await bot.delete_message(chat_id=chat_id, message_id=delete)
+
+        _outbox.enqueue(chat_id, None, remove, priority=priority, delay=_outbox.delay, wait=False)
+
+    async def send(text: str, reply_to: Optional[int]) -> Any:
+        return await bot.send_message(
+            chat_id=chat_id, text=text, parse_mode=parse_mode,
+            reply_parameters=ReplyParameters(reply_to, allow_sending_without_reply=True)
+            if reply_to is not None else None
+        )
+
+    _outbox.enqueue(chat_id, text, send, reply_to, ("defer", id(bot), parse_mode),
+                    priority, delay=_outbox.delay, wait=False)
+
+
+async def flush_replies() -> None:
+    """Send every queued message now"""
+    await _outbox.flush()
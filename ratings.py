@@ -0,0 +1,282 @@
+"""
+Ratings - Elo and Glicko-2 replayed from the duel history
+
+models.update_elo keeps the live ELO field up to date at the end of each
+duel. RatingEngine instead derives ratings from the stored history
+(storage.load_duels) in chronological order, so they can be rebuilt after
+/addduel, an import, or a change of K:
+
+- Elo with a configurable K, in floating point (no truncation per duel);
+- Glicko-2 (rating, deviation, volatility) with rating periods of
+  GLICKO2_PERIOD seconds: all duels of a period are scored against the
+  ratings at its start, then every player of the period is updated at once.
+
+Ratings live in flat arrays indexed by player, and only duels linked to
+user ids count (see storage.link_duel_ids). The engine follows the history
+like duel_history.DuelHistory does: duels appended since the last read are
+replayed on top of the current state, anything else (an import, a duel
+older than the last one seen) replays everything.
+"""
+import math
+from array import array
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from config import ELO_K_FACTOR, GLICKO2_TAU, GLICKO2_PERIOD
+from duel_history import winner_of
+from storage import load_duels
+
+ELO_START = 1000.0
+
+# Glicko-2 defaults (Glickman), and the factor between the Glicko and
+# Glicko-2 scales
+GLICKO_START = 1500.0
+GLICKO_START_RD = 350.0
+GLICKO_START_VOLATILITY = 0.06
+GLICKO_SCALE = 173.7178
+_CONVERGENCE = 1e-6
+
+
+def duel_time(duel: Dict[str, Any]) -> Optional[float]:
+    """Unix time of a duel record, if it has a readable timestamp"""
+    try:
+        return datetime.fromisoformat(duel["timestamp"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class EloRatings:
+    """Sequential Elo updates over a flat array of ratings"""
+
+    def __init__(self, k: float = ELO_K_FACTOR, start: float = ELO_START):
+        self.k = k
+        self.start = start
+        self.rating = array("d")
+
+    def grow(self, size: int) -> None:
+        self.rating.extend([self.start] * (size - len(self.rating)))
+
+    def add(self, winner: int, loser: int) -> None:
+        rating = self.rating
+        expected = 1.0 / (1.0 + 10.0 ** ((rating[loser] - rating[winner]) / 400.0))
+        change = self.k * (1.0 - expected)
+        rating[winner] += change
+        rating[loser] -= change
+
+
+class Glicko2Ratings:
+    """Glicko-2 over flat arrays (Glicko-2 scale), one rating period open at a time"""
+
+    def __init__(self, tau: float = GLICKO2_TAU, period: float = GLICKO2_PERIOD):
+        self.tau = tau
+        self.period_length = period
+        self.mu = array("d")
+        self.phi = array("d")
+        self.sigma = array("d")
+        # last period each player was rated in (-1: never)
+        self.last = array("q")
+        self.period: Optional[int] = None
+        self._games: List[Tuple[int, int]] = []
+        self._pending: Optional[Dict[int, Tuple[float, float, float]]] = None
+
+    def grow(self, size: int) -> None:
+        missing = size - len(self.mu)
+        self.mu.extend([0.0] * missing)
+        self.phi.extend([GLICKO_START_RD / GLICKO_SCALE] * missing)
+        self.sigma.extend([GLICKO_START_VOLATILITY] * missing)
+        self.last.extend([-1] * missing)
+
+    def period_of(self, ts: float) -> int:
+        return int(ts // self.period_length)
+
+    def add(self, period: int, winner: int, loser: int) -> None:
+        if self.period is not None and period > self.period:
+            self.close()
+        if self.period is None or period > self.period:
+            self.period = period
+        self._games.append((winner, loser))
+        self._pending = None
+
+    def close(self) -> None:
+        """Apply the open period to the arrays"""
+        for i, (mu, phi, sigma) in self._results().items():
+            self.mu[i], self.phi[i], self.sigma[i] = mu, phi, sigma
+            self.last[i] = self.period
+        self._games = []
+        self._pending = None
+
+    def _idle_phi(self, i: int, period: int) -> float:
+        """Deviation of player ``i`` at the start of ``period``: it grows
+        with each period they sat out, up to the starting deviation"""
+        phi = self.phi[i]
+        if self.last[i] >= 0:
+            idle = period - self.last[i] - 1
+            if idle > 0:
+                phi = min(math.sqrt(phi * phi + idle * self.sigma[i] ** 2), GLICKO_START_RD / GLICKO_SCALE)
+        return phi
+
+    def _results(self) -> Dict[int, Tuple[float, float, float]]:
+        """New (mu, phi, sigma) of everyone who played in the open period"""
+        if self._pending is not None:
+            return self._pending
+        period = self.period
+        start: Dict[int, Tuple[float, float, float]] = {}
+        for pair in self._games:
+            for i in pair:
+                if i not in start:
+                    phi = self._idle_phi(i, period)
+                    start[i] = (self.mu[i], phi, 1.0 / math.sqrt(1.0 + 3.0 * phi * phi / math.pi ** 2))
+        v_inv: Dict[int, float] = dict.fromkeys(start, 0.0)
+        score: Dict[int, float] = dict.fromkeys(start, 0.0)
+        for winner, loser in self._games:
+            mu_w, _, g_w = start[winner]
+            mu_l, _, g_l = start[loser]
+            e_w = 1.0 / (1.0 + math.exp(-g_l * (mu_w - mu_l)))
+            e_l = 1.0 / (1.0 + math.exp(-g_w * (mu_l - mu_w)))
+            v_inv[winner] += g_l * g_l * e_w * (1.0 - e_w)
+            v_inv[loser] += g_w * g_w * e_l * (1.0 - e_l)
+            score[winner] += g_l * (1.0 - e_w)
+            score[loser] -= g_w * e_l
+        results = {}
+        for i, (mu, phi, _) in start.items():
+            v = 1.0 / v_inv[i]
+            sigma = self._volatility(phi, self.sigma[i], v, v * score[i])
+            phi_star = math.sqrt(phi * phi + sigma * sigma)
+            new_phi = 1.0 / math.sqrt(1.0 / (phi_star * phi_star) + 1.0 / v)
+            results[i] = (mu + new_phi * new_phi * score[i], new_phi, sigma)
+        self._pending = results
+        return results
+
+    def _volatility(self, phi: float, sigma: float, v: float, delta: float) -> float:
+        """Step 5 of Glickman's algorithm (Illinois method)"""
+        tau2 = self.tau * self.tau
+        a = math.log(sigma * sigma)
+        phi2 = phi * phi
+
+        def f(x: float) -> float:
+            ex = math.exp(x)
+            return (ex * (delta * delta - phi2 - v - ex) / (2.0 * (phi2 + v + ex) ** 2)) - (x - a) / tau2
+
+        low = a
+        if delta * delta > phi2 + v:
+            high = math.log(delta * delta - phi2 - v)
+        else:
+            k = 1
+            while f(a - k * self.tau) < 0:
+                k += 1
+            high = a - k * self.tau
+        f_low, f_high = f(low), f(high)
+        while abs(high - low) > _CONVERGENCE:
+            mid = low + (low - high) * f_low / (f_high - f_low)
+            f_mid = f(mid)
+            if f_mid * f_high <= 0:
+                low, f_low = high, f_high
+            else:
+                f_low /= 2.0
+            high, f_high = mid, f_mid
+        return math.exp(low / 2.0)
+
+    def rating(self, i: int) -> Tuple[float, float]:
+        """(rating, deviation) on the Glicko scale, the open period included"""
+        mu, phi, _ = self._results().get(i) or (self.mu[i], self.phi[i], self.sigma[i])
+        return GLICKO_START + GLICKO_SCALE * mu, GLICKO_SCALE * phi
+
+
+class RatingEngine:
+    """Elo and Glicko-2 ratings of every player, following the duel history"""
+
+    def __init__(self, k: float = ELO_K_FACTOR, tau: float = GLICKO2_TAU,
+                 period: float = GLICKO2_PERIOD):
+        self.k = k
+        self.tau = tau
+        self.period = period
+        self._duels: Optional[List[Dict[str, Any]]] = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self.ids: List[str] = []
+        self._index: Dict[str, int] = {}
+        self.elo = EloRatings(self.k)
+        self.glicko = Glicko2Ratings(self.tau, self.period)
+        self._seen = 0
+        self._last_ts: Optional[float] = None
+        self.replayed = 0
+
+    def _player(self, user_id: str) -> int:
+        i = self._index.get(user_id)
+        if i is None:
+            i = self._index[user_id] = len(self.ids)
+            self.ids.append(user_id)
+            self.elo.grow(i + 1)
+            self.glicko.grow(i + 1)
+        return i
+
+    def _feed(self, duel: Dict[str, Any], ts: Optional[float]) -> None:
+        winner = winner_of(duel)
+        p1, p2 = duel.get("p1_id"), duel.get("p2_id")
+        if not winner or not p1 or not p2 or p1 == p2 or winner not in (p1, p2):
+            return
+        loser = p2 if winner == p1 else p1
+        w, l = self._player(winner), self._player(loser)
+        self.elo.add(w, l)
+        self.glicko.add(self.glicko.period_of(ts or 0.0), w, l)
+        self.replayed += 1
+
+    def rebuild(self) -> None:
+        """Replay the whole history, in timestamp order"""
+        self._reset()
+        duels = self._duels = load_duels()
+        times, last = [], None
+        for duel in duels:
+            # undated legacy records keep their place after the previous one
+            last = duel_time(duel) or last
+            times.append(last or 0.0)
+        for position in sorted(range(len(duels)), key=times.__getitem__):
+            self._feed(duels[position], times[position])
+        self._seen = len(duels)
+        self._last_ts = max(times, default=None)
+
+    def sync(self) -> None:
+        """Catch up with the history: replay only the appended duels when
+        they are newer than everything seen so far, else rebuild"""
+        duels = load_duels()
+        if duels is not self._duels or self._seen > len(duels):
+            return self.rebuild()
+        new = duels[self._seen:]
+        times = [duel_time(duel) or self._last_ts or 0.0 for duel in new]
+        if self._last_ts is not None and any(ts < self._last_ts for ts in times):
+            return self.rebuild()
+        for duel, ts in zip(new, times):
+            self._feed(duel, ts)
+            self._last_ts = ts
+        self._seen = len(duels)
+
+    def elo_of(self, user_id: str) -> Optional[float]:
+        self.sync()
+        i = self._index.get(user_id)
+        return None if i is None else self.elo.rating[i]
+
+    def glicko_of(self, user_id: str) -> Optional[Tuple[float, float]]:
+        """(rating, deviation) of a player, None without rated duels"""
+        self.sync()
+        i = self._index.get(user_id)
+        return None if i is None else self.glicko.rating(i)
+
+    def elo_ratings(self) -> Dict[str, float]:
+        self.sync()
+        return {user_id: self.elo.rating[i] for i, user_id in enumerate(self.ids)}
+
+    def glicko_top(self, limit: int = 10) -> List[Tuple[str, float, float]]:
+        """Best (user_id, rating, deviation), ranked by rating minus two
+        deviations so that a couple of lucky duels do not top the board"""
+        self.sync()
+        rated = [(user_id, *self.glicko.rating(i)) for i, user_id in enumerate(self.ids)]
+        rated.sort(key=lambda r: r[1] - 2 * r[2], reverse=True)
+        return rated[:limit]
+
+
+_engine = RatingEngine()
+
+
+def get_rating_engine() -> RatingEngine:
+    """Return the process-wide rating engine"""
+    return _engine
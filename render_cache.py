@@ -0,0 +1,53 @@
+"""
+Render cache - the final text of the /top* replies
+
+Groups ask for the same boards over and over, mostly between two rolls.
+Each reply is kept per (command, scope, window) with the version token it
+was rendered at: the version of the ScoreStore it reads (storage bumps it
+on every change it notifies), plus the rolling counters' version and the
+day for the time-window boards. While the token still matches, the reply
+is a dictionary lookup; the least recently used entries go first once
+RENDER_CACHE_SIZE are kept.
+"""
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Tuple
+from config import RENDER_CACHE_SIZE
+
+
+class RenderCache:
+    """Rendered replies by key, valid while their token matches"""
+
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[Hashable, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_or_render(self, key: Hashable, token: Hashable, render: Callable[[], Any]) -> Any:
+        """The cached value of ``key`` if rendered at ``token``, else ``render()``"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == token:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = render()
+        self._entries[key] = (token, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+_cache = RenderCache()
+
+
+def get_render_cache() -> RenderCache:
+    """Return the process-wide render cache"""
+    return _cache
@@ -0,0 +1,209 @@
+"""
+Startup restore - bring back the latest backup only where it is needed
+
+On a fresh disk (a redeploy without a volume) the data comes from the
+latest backup; on a disk that kept its data, the live files are usually
+as new as the backup or newer and must not be overwritten. For each data
+file the backup holds, startup_restore compares the live copy with the
+backup's checksum and time:
+
+- missing locally: restore it;
+- identical, or changed after the backup was taken: keep it;
+- older than the backup and different: restore it.
+
+Only the files to restore are read (their chunks from the backup store, or
+their entries from an old ZIP), and each is parsed before anything is
+written, so a damaged backup leaves the live data alone. Writes go through
+the backend like any import (temp file + rename for the JSON files).
+
+PhaseTimer logs how long each startup phase took.
+"""
+import hashlib
+import json
+import os
+import time
+import zipfile
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+from backup_store import BackupStore, get_backup_store
+from config import SCORES_FILE, SCORES_PACK_FILE, USERS_FILE, DUELS_FILE, CHAT_SCORES_DIR
+from scorepack import unpack_scores
+from storage_backends import StorageBackend, JsonBackend, BinaryBackend, SqliteBackend
+import storage
+
+
+class PhaseTimer:
+    """Wall time of named phases, printed as one line"""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.phases: List[Tuple[str, float]] = []
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def report(self) -> str:
+        total = time.perf_counter() - self._started
+        parts = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.phases)
+        return f"⏱️ {self.label}: {parts} (totale {total * 1000:.0f}ms)"
+
+
+def _is_data_file(name: str) -> bool:
+    return (name in (SCORES_FILE, SCORES_PACK_FILE, DUELS_FILE, USERS_FILE)
+            or (name.startswith(f"{CHAT_SCORES_DIR}/") and name.endswith(".json")))
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_crc32(path: str) -> int:
+    crc = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def live_path(backend: StorageBackend, name: str) -> Optional[str]:
+    """Where the live copy of a backup file is, for the file backends"""
+    if isinstance(backend, BinaryBackend) and name == SCORES_PACK_FILE:
+        return backend.pack_file
+    if not isinstance(backend, JsonBackend) or name == SCORES_PACK_FILE:
+        return None
+    if isinstance(backend, BinaryBackend) and name == SCORES_FILE:
+        return None  # its scores live in the pack
+    if name == SCORES_FILE:
+        return backend.scores_file
+    if name == USERS_FILE:
+        return backend.users_file
+    if name == DUELS_FILE:
+        return backend.duels_file
+    return os.path.join(backend.chat_dir, name[len(CHAT_SCORES_DIR) + 1:])
+
+
+def plan_restore(backend: StorageBackend, taken: float,
+                 checksums: Dict[str, Tuple[str, object]]) -> Dict[str, str]:
+    """Which backup files to restore, and why (name -> reason).
+
+    ``checksums`` maps each backup file to ("sha256" or "crc32", value);
+    ``taken`` is when the backup was taken (unix time).
+    """
+    if isinstance(backend, SqliteBackend):
+        # one database: all or nothing
+        if backend.is_empty():
+            return {name: "database vuoto" for name in checksums}
+        mtime = max(os.path.getmtime(p) for p in (backend.path, f"{backend.path}-wal") if os.path.exists(p))
+        if mtime < taken:
+            return {name: "database più vecchio del backup" for name in checksums}
+        return {}
+
+    plan = {}
+    for name, (kind, value) in checksums.items():
+        path = live_path(backend, name)
+        if path is None:
+            continue
+        if not os.path.exists(path):
+            plan[name] = "mancante"
+            continue
+        if os.path.getmtime(path) >= taken:
+            continue  # changed after the backup: keep it
+        live = _file_sha256(path) if kind == "sha256" else _file_crc32(path)
+        if live != value:
+            plan[name] = "più vecchio del backup"
+    # the pack is the faster way to load scores.json's content
+    if SCORES_FILE in plan and SCORES_PACK_FILE in checksums:
+        plan.setdefault(SCORES_PACK_FILE, plan.pop(SCORES_FILE))
+    return plan
+
+
+def validate(files: Dict[str, bytes]) -> None:
+    """Parse every payload; raises ValueError on the first bad one"""
+    for name, raw in files.items():
+        try:
+            if name == SCORES_PACK_FILE:
+                unpack_scores(raw)
+            else:
+                data = json.loads(raw.decode("utf-8"))
+                expected = list if name == DUELS_FILE else dict
+                if not isinstance(data, expected):
+                    raise ValueError(f"expected a JSON {expected.__name__}")
+        except Exception as e:
+            raise ValueError(f"{name}: {e}") from e
+
+
+def _from_store(store: BackupStore, backend: StorageBackend,
+                timer: PhaseTimer) -> Tuple[str, Dict[str, str], Dict[str, bytes]]:
+    backup_id = store.latest()
+    manifest = store.load_manifest(backup_id)
+    taken = datetime.fromisoformat(manifest["created"]).timestamp()
+    with timer.phase("confronto"):
+        checksums = {name: ("sha256", entry["sha256"])
+                     for name, entry in manifest["files"].items() if _is_data_file(name)}
+        plan = plan_restore(backend, taken, checksums)
+    with timer.phase("lettura"):
+        files = store.materialize(backup_id, set(plan)) if plan else {}
+    return backup_id, plan, files
+
+
+def _from_zip(path: str, backend: StorageBackend,
+              timer: PhaseTimer) -> Tuple[str, Dict[str, str], Dict[str, bytes]]:
+    with zipfile.ZipFile(path, "r") as z:
+        with timer.phase("confronto"):
+            checksums = {info.filename: ("crc32", info.CRC)
+                         for info in z.infolist() if _is_data_file(info.filename)}
+            plan = plan_restore(backend, os.path.getmtime(path), checksums)
+        with timer.phase("lettura"):
+            files = {}
+            for name in plan:
+                with z.open(name) as f:  # decompressed as it is read
+                    files[name] = f.read()
+    return os.path.basename(path), plan, files
+
+
+def startup_restore(store: Optional[BackupStore] = None,
+                    timer: Optional[PhaseTimer] = None) -> Dict[str, str]:
+    """Restore from the latest backup what the live data is missing or has
+    older; returns the restored files and why"""
+    store = store or get_backup_store()
+    timer = timer or PhaseTimer("Ripristino")
+    backend = storage.get_backend()
+    with timer.phase("ricerca backup"):
+        latest = store.latest()
+        legacy = storage.get_legacy_backups() if latest is None else []
+    if latest is None and not legacy:
+        return {}
+
+    try:
+        if latest is not None:
+            source, plan, files = _from_store(store, backend, timer)
+        else:
+            source, plan, files = _from_zip(legacy[-1], backend, timer)
+        if not plan:
+            print(f"✅ Dati locali aggiornati, backup {source} non necessario", flush=True)
+            return {}
+        with timer.phase("verifica"):
+            validate(files)
+        with timer.phase("scrittura"):
+            storage.import_json_files(files)
+            storage.get_writer().wait()
+    except Exception as e:
+        print(f"❌ Ripristino dal backup fallito, dati locali lasciati come sono: {e}", flush=True)
+        return {}
+
+    for name, reason in sorted(plan.items()):
+        print(f"  ♻️ {name}: {reason}", flush=True)
+    print(f"✅ Ripristinati {len(plan)} file dal backup {source}", flush=True)
+    return plan
@@ -0,0 +1,260 @@
+"""
+Roll history - each player's last rolls, in a fixed-size ring
+
+A roll is its dice value (1-64, one byte) and the milliseconds since the
+player's previous roll (one u32): a full ring of ROLL_HISTORY_SIZE rolls
+is ROLL_HISTORY_SIZE * 5 bytes, however much the player rolls. Absolute
+times are rebuilt backwards from the time of the last roll.
+
+The history powers /storico (the last rolls, per-symbol rates, luck
+against the odds) and the timing check of the anti-cheat: a long run of
+rolls at near-identical intervals is what a script does, not a thumb.
+
+The rings are saved to ROLL_HISTORY_FILE (on the storage writer thread)
+every few minutes and at shutdown, zlib-compressed, with the intervals as
+varints:
+
+    b"SLTROLLS" + u8 version, then zlib of, per player:
+    u8 id length + id, f64 time of the last roll, u16 count,
+    count * u8 value, count * varint interval (ms), oldest first
+"""
+import math
+import os
+import struct
+import zlib
+from array import array
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+from config import (
+    ROLL_HISTORY_FILE, ROLL_HISTORY_SIZE, ROLL_BOT_MIN_ROLLS, ROLL_BOT_MAX_CV,
+    ROLL_BOT_MAX_PAUSE, WIN_VALUES
+)
+from storage_writer import get_writer
+from storage_backends import write_bytes_atomic
+
+MAGIC = b"SLTROLLS"
+VERSION = 1
+_ENTRY = struct.Struct("<dH")
+_MAX_INTERVAL = 2 ** 32 - 1
+
+# Telegram's slot machine: value - 1 in base 4 gives the three reels
+SYMBOLS = ("bar", "uva", "limone", "sette")
+SYMBOL_EMOJI = {"bar": "🅱️", "uva": "🍇", "limone": "🍋", "sette": "7️⃣"}
+
+# chance of three equal reels (1, 22, 43, 64 out of 64 values)
+WIN_ODDS = len(WIN_VALUES) / 64
+
+
+def reels(value: int) -> Tuple[str, str, str]:
+    """The three symbols of a slot value, left to right"""
+    n = value - 1
+    return SYMBOLS[n & 3], SYMBOLS[(n >> 2) & 3], SYMBOLS[(n >> 4) & 3]
+
+
+def _varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class RollRing:
+    """One player's last rolls: values and intervals in parallel rings"""
+
+    __slots__ = ("capacity", "values", "intervals", "start", "last_ts")
+
+    def __init__(self, capacity: int = ROLL_HISTORY_SIZE):
+        self.capacity = capacity
+        self.values = bytearray()
+        self.intervals = array("I")
+        self.start = 0  # index of the oldest roll once the ring is full
+        self.last_ts = 0.0
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def add(self, value: int, ts: float) -> None:
+        interval = 0
+        if self.last_ts:
+            interval = min(max(int(round((ts - self.last_ts) * 1000)), 0), _MAX_INTERVAL)
+        self.last_ts = ts
+        if len(self.values) < self.capacity:
+            self.values.append(value)
+            self.intervals.append(interval)
+        else:
+            self.values[self.start] = value
+            self.intervals[self.start] = interval
+            self.start = (self.start + 1) % self.capacity
+
+    def _order(self) -> List[int]:
+        n = len(self.values)
+        return [(self.start + i) % n for i in range(n)] if n else []
+
+    def recent(self, limit: Optional[int] = None) -> List[Tuple[int, float]]:
+        """(value, unix time) of the last rolls, oldest first"""
+        order = self._order()
+        if limit is not None:
+            order = order[-limit:] if limit else []
+        rolls = []
+        ts = self.last_ts
+        for i in reversed(order):
+            rolls.append((self.values[i], ts))
+            ts -= self.intervals[i] / 1000
+        rolls.reverse()
+        return rolls
+
+    def gaps(self, limit: Optional[int] = None) -> List[float]:
+        """Seconds before each of the last rolls (0 for a player's first)"""
+        order = self._order()
+        if limit is not None:
+            order = order[-limit:] if limit else []
+        return [self.intervals[i] / 1000 for i in order]
+
+    def encode(self) -> bytes:
+        order = self._order()
+        out = bytearray(_ENTRY.pack(self.last_ts, len(order)))
+        out += bytes(self.values[i] for i in order)
+        for i in order:
+            _varint(self.intervals[i], out)
+        return bytes(out)
+
+    @classmethod
+    def decode(cls, data: bytes, offset: int, capacity: int = ROLL_HISTORY_SIZE) -> Tuple["RollRing", int]:
+        ring = cls(capacity)
+        ring.last_ts, count = _ENTRY.unpack_from(data, offset)
+        offset += _ENTRY.size
+        values = data[offset:offset + count]
+        offset += count
+        intervals = []
+        for _ in range(count):
+            interval, offset = _read_varint(data, offset)
+            intervals.append(interval)
+        keep = min(count, capacity)  # the size may have shrunk since
+        ring.values = bytearray(values[count - keep:])
+        ring.intervals = array("I", intervals[count - keep:])
+        return ring, offset
+
+
+def luck(rolls: List[int]) -> Dict[str, Any]:
+    """Wins against the odds and how often each symbol shows on the reels"""
+    wins = sum(1 for value in rolls if value in WIN_VALUES)
+    expected = len(rolls) * WIN_ODDS
+    spread = math.sqrt(len(rolls) * WIN_ODDS * (1 - WIN_ODDS)) if rolls else 0.0
+    symbols = dict.fromkeys(SYMBOLS, 0)
+    for value in rolls:
+        for symbol in reels(value):
+            symbols[symbol] += 1
+    reel_count = 3 * len(rolls) or 1
+    return {
+        "rolls": len(rolls),
+        "wins": wins,
+        "expected": expected,
+        # standard deviations above (lucky) or below (unlucky) the odds
+        "z": (wins - expected) / spread if spread else 0.0,
+        "symbols": {symbol: count / reel_count for symbol, count in symbols.items()},
+        "jackpots": sum(1 for value in rolls if value == 64),
+    }
+
+
+def timing(gaps: List[float], max_pause: float = ROLL_BOT_MAX_PAUSE) -> Optional[Dict[str, float]]:
+    """Mean gap and coefficient of variation of the rolls made in a row
+    (pauses longer than ``max_pause`` seconds are left out)"""
+    active = [gap for gap in gaps if 0 < gap <= max_pause]
+    if len(active) < 2:
+        return None
+    mean = sum(active) / len(active)
+    deviation = math.sqrt(sum((gap - mean) ** 2 for gap in active) / len(active))
+    return {"count": len(active), "mean": mean, "cv": deviation / mean}
+
+
+class RollHistory:
+    """Every player's RollRing, loaded lazily and saved as one compact file"""
+
+    def __init__(self, path: str = ROLL_HISTORY_FILE, capacity: int = ROLL_HISTORY_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self._rings: Optional[Dict[str, RollRing]] = None
+        # encoded rings, so a save only encodes the players who rolled since
+        self._encoded: Dict[str, bytes] = {}
+
+    def _load(self) -> Dict[str, RollRing]:
+        if self._rings is None:
+            self._rings = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "rb") as f:
+                        raw = f.read()
+                    if raw[:len(MAGIC)] != MAGIC:
+                        raise ValueError("not a roll history file")
+                    data = zlib.decompress(raw[len(MAGIC) + 1:])
+                    offset = 0
+                    while offset < len(data):
+                        length = data[offset]
+                        user_id = data[offset + 1:offset + 1 + length].decode("utf-8")
+                        ring, offset = RollRing.decode(data, offset + 1 + length, self.capacity)
+                        self._rings[user_id] = ring
+                except (OSError, ValueError, zlib.error, struct.error, IndexError) as e:
+                    print(f"⚠️ {self.path} illeggibile, storico dei tiri ripartito da zero: {e}", flush=True)
+                    self._rings = {}
+        return self._rings
+
+    def record(self, user_id: str, value: int, ts: float) -> RollRing:
+        rings = self._load()
+        ring = rings.get(user_id)
+        if ring is None:
+            ring = rings[user_id] = RollRing(self.capacity)
+        ring.add(value, ts)
+        self._encoded.pop(user_id, None)
+        return ring
+
+    def get(self, user_id: str) -> Optional[RollRing]:
+        return self._load().get(user_id)
+
+    def looks_automated(self, user_id: str, min_rolls: int = ROLL_BOT_MIN_ROLLS,
+                        max_cv: float = ROLL_BOT_MAX_CV) -> Optional[Dict[str, float]]:
+        """The timing of the player's last ``min_rolls`` rolls if they came
+        at near-identical intervals (what a script does), else None"""
+        ring = self.get(user_id)
+        if ring is None or len(ring) <= min_rolls:
+            return None
+        stats = timing(ring.gaps(min_rolls))
+        if stats is None or stats["count"] < min_rolls or stats["cv"] > max_cv:
+            return None
+        return stats
+
+    def save(self) -> Optional[Future]:
+        """Write every ring to disk on the writer thread"""
+        if self._rings is None:
+            return None
+        parts = [MAGIC, bytes([VERSION])]
+        body = []
+        for user_id, ring in self._rings.items():
+            encoded = self._encoded.get(user_id)
+            if encoded is None:
+                name = user_id.encode("utf-8")
+                encoded = self._encoded[user_id] = bytes([len(name)]) + name + ring.encode()
+            body.append(encoded)
+        return get_writer().submit(_write_compressed, self.path, parts, body)
+
+
+def _write_compressed(path: str, header: List[bytes], body: List[bytes]) -> None:
+    write_bytes_atomic(path, b"".join(header) + zlib.compress(b"".join(body), 6))
+
+
+_history = RollHistory()
+
+
+def get_roll_history() -> RollHistory:
+    """Return the process-wide roll history"""
+    return _history
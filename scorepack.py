@@ -0,0 +1,596 @@
+"""
+Score pack - compact binary format for the scores dict
+
+The per-user schema is derived from models.USER_FIELDS: every field
+becomes a fixed-size slot of one packed record, names and ids go through a
+string table and achievements become a bitmask. Anything that does not fit
+(unknown fields, odd types) is kept as JSON next to the records, so a
+pack -> JSON round trip is lossless.
+
+Layout, little endian, version 1:
+
+    b"SLTPACK" + u8 version
+    u16 field count, then per field: u8 type code, u8 name length, name
+    u32 length + JSON   loose keys stored as-is (_jackpot, _version, ...)
+    u32 length + JSON   per-user overrides {user_id: {field: value}}
+    u32 length + UTF-8  achievement ids joined by NUL (bit i = achievement i)
+    u32 length + UTF-8  string table joined by NUL
+    u32 user count
+    user count * u32    string index of each user id
+    user count * record struct("<" + field formats)
+
+Loading only decodes the tables; a user's record becomes a plain dict (or,
+for the score store, a UserStats) the first time it is accessed
+(PackedScores). Decoding every record at once goes straight from the record
+tuples into UserStats slots, so a full load is still several times faster
+than json.load ('bench' reports both figures).
+
+    python scorepack.py pack scores.json scores.pack
+    python scorepack.py unpack scores.pack scores.json
+    python scorepack.py bench [users]     # load time vs json.load
+"""
+import copy
+import gc
+import itertools
+import json
+import struct
+import sys
+from array import array
+from collections.abc import MutableMapping
+from typing import Dict, Any, List, Optional, Tuple, Iterator, Mapping, Callable
+from models import USER_FIELDS, ACHIEVEMENTS, UserStats
+
+MAGIC = b"SLTPACK"
+VERSION = 1
+
+# type code -> struct format
+FORMATS = {
+    "s": "I",  # string table index
+    "m": "Q",  # achievement bitmask
+    "b": "?",
+    "f": "d",
+    "i": "q",
+    "n": "q",  # int or None
+}
+NONE_INT = -(2 ** 63)
+INT_MIN, INT_MAX = NONE_INT + 1, 2 ** 63 - 1
+DEFAULTS = {"s": 0, "m": 0, "b": False, "f": 0.0, "i": 0, "n": NONE_INT}
+USER_FIELD_NAMES = frozenset(field for field, _ in USER_FIELDS)
+
+# override value of a schema field the original entry did not have
+ABSENT = {"__absent__": True}
+
+
+def default_schema() -> List[Tuple[str, str]]:
+    """(field, type code) for every field of models.UserStats"""
+    schema = []
+    for field, default in USER_FIELDS:
+        if field == "achievements":
+            code = "m"
+        elif isinstance(default, str):
+            code = "s"
+        elif isinstance(default, bool):
+            code = "b"
+        elif isinstance(default, float):
+            code = "f"
+        elif isinstance(default, int):
+            code = "i"
+        elif default is None:
+            code = "n"
+        else:
+            continue  # kept in the overrides
+        schema.append((field, code))
+    return schema
+
+
+SCHEMA = default_schema()
+
+
+def _record_struct(schema: List[Tuple[str, str]]) -> struct.Struct:
+    return struct.Struct("<" + "".join(FORMATS[code] for _, code in schema))
+
+
+def _apply_overrides(entry: MutableMapping, extra: Mapping[str, Any]) -> None:
+    for field, value in extra.items():
+        if value == ABSENT:
+            entry.pop(field, None)
+        else:
+            entry[field] = copy.deepcopy(value)
+
+
+class _MaskLists(dict):
+    """Achievement bitmask -> tuple of achievement ids, filled on demand"""
+
+    def __init__(self, achievements: List[str]):
+        super().__init__()
+        self.achievements = achievements
+
+    def __missing__(self, mask: int) -> Tuple[str, ...]:
+        value = self[mask] = tuple(a for i, a in enumerate(self.achievements) if mask >> i & 1)
+        return value
+
+
+def _stats_decoder(schema: List[Tuple[str, str]], strings: List[str],
+                   masks: _MaskLists) -> Callable[..., UserStats]:
+    """Function turning one record tuple into a UserStats.
+
+    Generated for the schema (like collections.namedtuple) so that each field
+    is one slot store, with no per-record dict in between. Only UserStats
+    fields can appear in the generated code.
+    """
+    if not USER_FIELD_NAMES.issuperset(field for field, _ in schema):
+        raise ValueError("schema has fields UserStats does not have")
+    args = [f"v{i}" for i in range(len(schema))]
+    lines = ["    o = new(UserStats)"]
+    for (field, code), arg in zip(schema, args):
+        if code == "s":
+            value = f"strings[{arg}]"
+        elif code == "m":
+            value = f"list(masks[{arg}])"
+        elif code == "n":
+            value = f"None if {arg} == NONE_INT else {arg}"
+        else:
+            value = arg
+        lines.append(f"    o.{field} = {value}")
+    present = {field for field, _ in schema}
+    for field, default in USER_FIELDS:
+        if field not in present:
+            # older pack: the field gets its default, as in UserStats.from_dict
+            lines.append(f"    o.{field} = {'[]' if field == 'achievements' else repr(default)}")
+    lines += ["    o.extra = None", "    return o"]
+    source = f"def decode({', '.join(args)}):\n" + "\n".join(lines) + "\n"
+    namespace = {"new": UserStats.__new__, "UserStats": UserStats, "strings": strings,
+                 "masks": masks, "NONE_INT": NONE_INT}
+    exec(source, namespace)
+    return namespace["decode"]
+
+
+class ScorePack:
+    """Decoded tables of a pack; records stay packed until asked for"""
+
+    def __init__(self, schema: List[Tuple[str, str]], loose: Dict[str, Any],
+                 overrides: Dict[str, Dict[str, Any]], achievements: List[str],
+                 strings: List[str], user_ids: List[str], records: bytes):
+        self.schema = schema
+        self.fields = [field for field, _ in schema]
+        self._string_fields = [field for field, code in schema if code == "s"]
+        self._mask_fields = [field for field, code in schema if code == "m"]
+        self._nullable_fields = [field for field, code in schema if code == "n"]
+        self.record = _record_struct(schema)
+        self.loose = loose
+        self.overrides = overrides
+        self.achievements = achievements
+        self.strings = strings
+        self.user_ids = user_ids
+        self.records = records
+        self._masks = _MaskLists(achievements)
+        self._decoder: Optional[Callable[..., UserStats]] = None
+
+    def raw(self, row: int) -> bytes:
+        size = self.record.size
+        return self.records[row * size:(row + 1) * size]
+
+    def _achievement_list(self, mask: int) -> List[str]:
+        return list(self._masks[mask])
+
+    def entry(self, user_id: str, row: int) -> Dict[str, Any]:
+        """Materialize one user's record as a plain dict"""
+        return self._build(user_id, self.record.unpack_from(self.records, row * self.record.size))
+
+    def entries(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Materialize every record, in file order"""
+        for user_id, values in zip(self.user_ids, self.record.iter_unpack(self.records)):
+            yield user_id, self._build(user_id, values)
+
+    def _build(self, user_id: str, values: tuple) -> Dict[str, Any]:
+        d = dict(zip(self.fields, values))
+        for field in self._string_fields:
+            d[field] = self.strings[d[field]]
+        for field in self._mask_fields:
+            d[field] = self._achievement_list(d[field])
+        for field in self._nullable_fields:
+            if d[field] == NONE_INT:
+                d[field] = None
+        extra = self.overrides.get(user_id)
+        if extra:
+            _apply_overrides(d, extra)
+        return d
+
+    def _stats_decoder(self) -> Optional[Callable[..., UserStats]]:
+        """Record tuple -> UserStats, or None if the schema has fields
+        UserStats does not (those records go through dicts)"""
+        if self._decoder is None and USER_FIELD_NAMES.issuperset(self.fields):
+            self._decoder = _stats_decoder(self.schema, self.strings, self._masks)
+        return self._decoder
+
+    def _with_overrides(self, user_id: str, stats: UserStats) -> UserStats:
+        _apply_overrides(stats, self.overrides[user_id])
+        if stats.achievements is None:
+            stats.achievements = []
+        return stats
+
+    def user_stats(self, user_id: str, row: int) -> UserStats:
+        """Materialize one user's record as a UserStats"""
+        decode = self._stats_decoder()
+        if decode is None:
+            return UserStats.from_dict(self.entry(user_id, row))
+        stats = decode(*self.record.unpack_from(self.records, row * self.record.size))
+        return self._with_overrides(user_id, stats) if user_id in self.overrides else stats
+
+    def all_user_stats(self, rows: Mapping[str, int]) -> List[UserStats]:
+        """Materialize the records of ``rows`` (user id -> row, in file
+        order) as UserStats, in the same order"""
+        decode = self._stats_decoder()
+        if decode is None:
+            return [UserStats.from_dict(self.entry(user_id, row)) for user_id, row in rows.items()]
+        records = self.record.iter_unpack(self.records)
+        if len(rows) < len(self.user_ids):
+            unpacked = list(records)
+            records = [unpacked[row] for row in rows.values()]
+        stats = list(itertools.starmap(decode, records))
+        if self.overrides:
+            for i, user_id in enumerate(rows):
+                if user_id in self.overrides:
+                    self._with_overrides(user_id, stats[i])
+        return stats
+
+
+class PackedScores(MutableMapping):
+    """Scores mapping over a ScorePack: entries become plain dicts (and stop
+    being tied to the pack) the first time they are read or replaced.
+
+    With ``as_stats`` set, records are decoded into UserStats instead (the
+    score store's entries).
+    """
+
+    def __init__(self, pack: Optional[ScorePack] = None, live: Optional[Dict[str, Any]] = None,
+                 rows: Optional[Dict[str, int]] = None):
+        self.pack = pack
+        self.as_stats = False
+        self._live: Dict[str, Any] = live if live is not None else dict(pack.loose if pack else {})
+        if rows is not None:
+            self._rows = rows
+        elif pack is not None:
+            self._rows = dict(zip(pack.user_ids, range(len(pack.user_ids))))
+            for key in self._live:
+                self._rows.pop(key, None)
+        else:
+            self._rows = {}
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self._live[key]
+        except KeyError:
+            pass
+        row = self._rows.pop(key)  # KeyError if unknown
+        entry = self.pack.user_stats(key, row) if self.as_stats else self.pack.entry(key, row)
+        self._live[key] = entry
+        return entry
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._rows.pop(key, None)
+        self._live[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key in self._live:
+            del self._live[key]
+        else:
+            del self._rows[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._live or key in self._rows
+
+    def __iter__(self) -> Iterator[str]:
+        # keys are copied: reading values while iterating moves them around
+        return iter(list(self._live) + list(self._rows))
+
+    def __len__(self) -> int:
+        return len(self._live) + len(self._rows)
+
+    @property
+    def packed_count(self) -> int:
+        """Users still only in packed form"""
+        return len(self._rows)
+
+    def materialized_items(self) -> List[Tuple[str, Any]]:
+        """Entries already materialized (plus loose keys), without decoding the rest"""
+        return list(self._live.items())
+
+    def materialize(self) -> None:
+        """Turn every remaining record into a dict in one pass"""
+        if not self._rows:
+            return
+        gc_enabled = gc.isenabled()
+        gc.disable()  # many small acyclic dicts: skip the collector passes
+        try:
+            rows = self._rows
+            if self.as_stats:
+                self._live.update(zip(rows, self.pack.all_user_stats(rows)))
+            else:
+                for user_id, entry in self.pack.entries():
+                    if user_id in rows:
+                        self._live[user_id] = entry
+            rows.clear()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def items(self):
+        self.materialize()
+        return self._live.items()
+
+    def values(self):
+        self.materialize()
+        return self._live.values()
+
+    def snapshot(self, copy_entry) -> "PackedScores":
+        """Independent copy sharing the (immutable) pack"""
+        live = {k: copy_entry(v) for k, v in self._live.items()}
+        return PackedScores(self.pack, live=live, rows=dict(self._rows))
+
+    def to_dict(self) -> Dict[str, Any]:
+        self.materialize()
+        return dict(self._live)
+
+
+# ----- encoding -----
+
+class _Encoder:
+    def __init__(self, schema: List[Tuple[str, str]], strings: Optional[List[str]] = None,
+                 achievements: Optional[List[str]] = None):
+        self.schema = schema
+        self.schema_fields = frozenset(field for field, _ in schema)
+        self.record = _record_struct(schema)
+        self.strings = list(strings or [])
+        self.string_index = {s: i for i, s in enumerate(self.strings)}
+        self.achievements = list(achievements or ACHIEVEMENTS)
+        self.achievement_bits = {a: i for i, a in enumerate(self.achievements)}
+        self.loose: Dict[str, Any] = {}
+        self.overrides: Dict[str, Dict[str, Any]] = {}
+        self.user_ids = array("I")
+        self.records: List[bytes] = []
+
+    def string(self, s: str) -> Optional[int]:
+        i = self.string_index.get(s)
+        if i is None:
+            if "\0" in s:
+                return None
+            i = self.string_index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def mask(self, achievements: Any) -> Optional[int]:
+        if not isinstance(achievements, list):
+            return None
+        mask = 0
+        for a in achievements:
+            bit = self.achievement_bits.get(a) if isinstance(a, str) else None
+            if bit is None:
+                if not isinstance(a, str) or "\0" in a or len(self.achievements) >= 64:
+                    return None
+                bit = self.achievement_bits[a] = len(self.achievements)
+                self.achievements.append(a)
+            mask |= 1 << bit
+        # the bitmask drops order and duplicates: only use it when lossless
+        if [a for i, a in enumerate(self.achievements) if mask >> i & 1] != achievements:
+            return None
+        return mask
+
+    def add(self, user_id: str, d: Any) -> None:
+        uid = self.string(user_id) if isinstance(d, Mapping) else None
+        if uid is None:
+            self.loose[user_id] = d
+            return
+        values = []
+        extra = {}
+        for field, code in self.schema:
+            if field not in d:
+                extra[field] = ABSENT
+                values.append(self.string("") if code == "s" else DEFAULTS[code])
+                continue
+            value = d[field]
+            if code == "s":
+                packed = self.string(value) if isinstance(value, str) else None
+            elif code == "m":
+                packed = self.mask(value)
+            elif code == "b":
+                packed = value if type(value) is bool else None
+            elif code == "f":
+                packed = value if type(value) is float else None
+            elif code == "n" and value is None:
+                packed = NONE_INT
+            else:
+                packed = value if type(value) is int and INT_MIN <= value <= INT_MAX else None
+            if packed is None:
+                # odd type for this field: the exact value goes in the overrides
+                extra[field] = value
+                packed = self.string("") if code == "s" else DEFAULTS[code]
+            values.append(packed)
+        for field, value in d.items():
+            if field not in self.schema_fields:
+                extra[field] = value
+        if extra:
+            self.overrides[user_id] = extra
+        self.user_ids.append(uid)
+        self.records.append(self.record.pack(*values))
+
+    def add_raw(self, user_id: str, raw: bytes, overrides: Optional[Dict[str, Any]]) -> None:
+        self.user_ids.append(self.string(user_id))
+        self.records.append(raw)
+        if overrides:
+            self.overrides[user_id] = overrides
+
+    def encode(self) -> bytes:
+        def blob(data: bytes) -> bytes:
+            return struct.pack("<I", len(data)) + data
+
+        header = [MAGIC, struct.pack("<BH", VERSION, len(self.schema))]
+        for field, code in self.schema:
+            name = field.encode("utf-8")
+            header.append(struct.pack("<cB", code.encode("ascii"), len(name)) + name)
+        header.append(blob(json.dumps(self.loose, ensure_ascii=False, separators=(",", ":")).encode("utf-8")))
+        header.append(blob(json.dumps(self.overrides, ensure_ascii=False, separators=(",", ":")).encode("utf-8")))
+        header.append(blob("\0".join(self.achievements).encode("utf-8")))
+        header.append(blob("\0".join(self.strings).encode("utf-8")))
+        header.append(struct.pack("<I", len(self.user_ids)))
+        user_ids = array("I", self.user_ids)
+        if sys.byteorder == "big":
+            user_ids.byteswap()
+        return b"".join(header) + user_ids.tobytes() + b"".join(self.records)
+
+
+def pack_scores(scores: Mapping[str, Any]) -> bytes:
+    """Encode a scores dict (or PackedScores) as a pack.
+
+    Users of a PackedScores that were never materialized are copied as raw
+    records, so re-saving a large, mostly idle table is cheap.
+    """
+    if isinstance(scores, PackedScores) and scores.pack is not None and scores.pack.schema == SCHEMA:
+        pack = scores.pack
+        encoder = _Encoder(SCHEMA, pack.strings, pack.achievements)
+        for user_id, row in scores._rows.items():
+            encoder.add_raw(user_id, pack.raw(row), pack.overrides.get(user_id))
+        for key, value in scores._live.items():
+            if key.startswith("_"):
+                encoder.loose[key] = value
+            else:
+                encoder.add(key, value)
+        return encoder.encode()
+
+    encoder = _Encoder(SCHEMA)
+    for key in scores:
+        value = scores[key]
+        if key.startswith("_"):
+            encoder.loose[key] = value
+        else:
+            encoder.add(key, value)
+    return encoder.encode()
+
+
+def unpack_scores(data: bytes) -> PackedScores:
+    """Decode a pack; user records are materialized on first access"""
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a score pack")
+    offset = len(MAGIC)
+    version, field_count = struct.unpack_from("<BH", data, offset)
+    if version > VERSION:
+        raise ValueError(f"score pack version {version} is newer than this bot ({VERSION})")
+    offset += 3
+
+    schema = []
+    for _ in range(field_count):
+        code, length = struct.unpack_from("<cB", data, offset)
+        offset += 2
+        schema.append((data[offset:offset + length].decode("utf-8"), code.decode("ascii")))
+        offset += length
+
+    def blob() -> bytes:
+        nonlocal offset
+        (length,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        chunk = data[offset:offset + length]
+        offset += length
+        return chunk
+
+    loose = json.loads(blob().decode("utf-8"))
+    overrides = json.loads(blob().decode("utf-8"))
+    raw = blob().decode("utf-8")
+    achievements = raw.split("\0") if raw else []
+    strings = blob().decode("utf-8").split("\0")
+    (count,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+
+    user_index = array("I")
+    user_index.frombytes(data[offset:offset + 4 * count])
+    if sys.byteorder == "big":
+        user_index.byteswap()
+    offset += 4 * count
+    user_ids = list(map(strings.__getitem__, user_index))
+
+    pack = ScorePack(schema, loose, overrides, achievements, strings, user_ids, data[offset:])
+    return PackedScores(pack)
+
+
+def json_to_pack(json_path: str, pack_path: str) -> int:
+    """Convert scores.json to a pack; returns the number of users"""
+    with open(json_path, "r", encoding="utf-8") as f:
+        scores = json.load(f)
+    with open(pack_path, "wb") as f:
+        f.write(pack_scores(scores))
+    return sum(1 for k in scores if not k.startswith("_"))
+
+
+def pack_to_json(pack_path: str, json_path: str) -> int:
+    """Convert a pack back to the human readable scores.json layout"""
+    with open(pack_path, "rb") as f:
+        scores = unpack_scores(f.read()).to_dict()
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(scores, f, ensure_ascii=False, indent=2)
+    return sum(1 for k in scores if not k.startswith("_"))
+
+
+def synthetic_scores(users: int, seed: int = 1) -> Dict[str, Any]:
+    """Plausible scores dict with ``users`` players (benchmarks, tests)"""
+    import random
+    rng = random.Random(seed)
+    achievement_ids = list(ACHIEVEMENTS)
+    scores: Dict[str, Any] = {"_version": 2, "_jackpot": 50}
+    for i in range(users):
+        user_id = str(100000000 + i)
+        d = scores[user_id] = UserStats(f"Giocatore {i}").to_dict()
+        d["points"] = rng.randint(-50, 5000)
+        d["total_slots"] = rng.randint(0, 10000)
+        d["total_wins"] = rng.randint(0, d["total_slots"])
+        d["best_streak"] = rng.randint(0, 12)
+        d["elo"] = rng.randint(800, 1400)
+        d["best_speed"] = rng.random() * 3
+        d["last_slot_ts"] = 1.7e9 + rng.random() * 1e7
+        d["achievements"] = sorted(rng.sample(achievement_ids, rng.randint(0, 4)), key=achievement_ids.index)
+    return scores
+
+
+def bench(users: int = 100000, repeat: int = 3) -> Dict[str, float]:
+    """Time json.loads of the usual indent=2 scores.json against unpack_scores,
+    lazily (only the tables) and in full (every record decoded into UserStats,
+    as the score store does on startup); best of ``repeat`` runs"""
+    import time
+    scores = synthetic_scores(users)
+    as_json = json.dumps(scores, ensure_ascii=False, indent=2).encode("utf-8")
+    as_pack = pack_scores(scores)
+
+    json_load = pack_load = materialize = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        json.loads(as_json)
+        json_load = min(json_load, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        packed = unpack_scores(as_pack)
+        pack_load = min(pack_load, time.perf_counter() - started)
+
+        packed.as_stats = True
+        started = time.perf_counter()
+        packed.materialize()
+        materialize = min(materialize, time.perf_counter() - started)
+
+    return {
+        "users": users,
+        "json_bytes": len(as_json),
+        "pack_bytes": len(as_pack),
+        "json_load_s": json_load,
+        "pack_load_s": pack_load,
+        "pack_materialize_all_s": materialize,
+        "lazy_speedup": json_load / pack_load,
+        "full_speedup": json_load / (pack_load + materialize),
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "pack":
+        print(f"{json_to_pack(sys.argv[2], sys.argv[3])} utenti impacchettati in {sys.argv[3]}")
+    elif len(sys.argv) == 4 and sys.argv[1] == "unpack":
+        print(f"{pack_to_json(sys.argv[2], sys.argv[3])} utenti scritti in {sys.argv[3]}")
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "bench":
+        print(json.dumps(bench(int(sys.argv[2]) if len(sys.argv) == 3 else 100000), indent=2))
+    else:
+        print("Uso: python scorepack.py pack scores.json scores.pack | unpack scores.pack scores.json | bench [utenti]")
@@ -0,0 +1,242 @@
+"""
+State journal - the live game state (active duels, pending /sfida
+challenges, domain expansions) survives restarts
+
+game_state.py keeps them in plain dicts. After every change the caller
+journals the changed key: one JSON line with its new value (null when it
+was removed), appended on the storage writer thread. Once the file passes
+STATE_JOURNAL_COMPACT_EVERY lines it is rewritten as a snapshot of the
+current state. At startup restore_game_state replays it and drops what went
+stale meanwhile; while the bot runs, deadlines.py (subscribed to the
+journal) expires entries on time.
+
+Lines are flushed to the OS, not fsync'ed: a redeploy or crash of the
+process loses nothing, a power cut may lose the last few changes.
+"""
+import json
+import os
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from config import (
+    STATE_JOURNAL_FILE, STATE_JOURNAL_COMPACT_EVERY, PENDING_DUEL_TTL, GAME_STATE_STALE_AFTER
+)
+from storage_writer import get_writer
+import game_state
+
+
+def _now() -> float:
+    return datetime.now(timezone.utc).timestamp()
+
+
+class StateJournal:
+    """Append-only journal of game_state changes, compacted as it grows"""
+
+    def __init__(self, path: str = STATE_JOURNAL_FILE,
+                 compact_every: int = STATE_JOURNAL_COMPACT_EVERY):
+        self.path = path
+        self.compact_every = compact_every
+        self._file = None
+        self._lines = 0
+        # last change of each entry: (kind, key) -> timestamp
+        self._touched: Dict[Tuple[str, Any], float] = {}
+        self._listeners: List[Callable[[str, Any], None]] = []
+
+    def subscribe(self, listener: Callable[[str, Any], None]) -> None:
+        """Call ``listener(kind, key)`` after every journaled change
+        (kind "duel", "pending", "expansion", or "clear" with key None)"""
+        self._listeners.append(listener)
+
+    def _notify(self, kind: str, key: Any) -> None:
+        for listener in self._listeners:
+            listener(kind, key)
+
+    # ----- recording -----
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        self._lines += 1
+        if self._lines > self.compact_every:
+            self.compact()
+            return
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        get_writer().submit(self._write, line)
+
+    def _touch(self, kind: str, key: Any, present: bool, ts: float) -> None:
+        if present:
+            self._touched[(kind, key)] = ts
+        else:
+            self._touched.pop((kind, key), None)
+
+    def record_duel(self, chat_id: int) -> None:
+        """Journal the duel of a chat as it is now (or its end)"""
+        ts = _now()
+        duel = game_state.ACTIVE_DUELS.get(chat_id)
+        self._touch("duel", chat_id, duel is not None, ts)
+        self._append({"k": "duel", "chat": chat_id, "v": duel, "ts": ts})
+        self._notify("duel", chat_id)
+
+    def record_pending(self, chat_id: int, challenger_id: str) -> None:
+        """Journal a /sfida challenge as it is now (or its removal)"""
+        ts = _now()
+        target = game_state.PENDING_DUELS.get((chat_id, challenger_id))
+        self._touch("pending", (chat_id, challenger_id), target is not None, ts)
+        self._append({"k": "pending", "chat": chat_id, "from": challenger_id, "v": target, "ts": ts})
+        self._notify("pending", (chat_id, challenger_id))
+
+    def record_expansion(self, chat_id: int) -> None:
+        """Journal the domain expansion timer of a chat"""
+        ts = _now()
+        until = game_state.EXPANSION_UNTIL.get(chat_id)
+        self._touch("expansion", chat_id, until is not None, ts)
+        self._append({"k": "expansion", "chat": chat_id, "v": until, "ts": ts})
+        self._notify("expansion", chat_id)
+
+    def record_clear(self) -> None:
+        """Journal that every duel, challenge and expansion was dropped"""
+        self._touched.clear()
+        self._append({"k": "clear", "ts": _now()})
+        self._notify("clear", None)
+
+    # ----- snapshot, replay, expiry -----
+
+    def _snapshot(self) -> List[Dict[str, Any]]:
+        now = _now()
+        records = []
+        for chat_id, duel in game_state.ACTIVE_DUELS.items():
+            ts = self._touched.get(("duel", chat_id), now)
+            records.append({"k": "duel", "chat": chat_id, "v": duel, "ts": ts})
+        for (chat_id, challenger_id), target in game_state.PENDING_DUELS.items():
+            ts = self._touched.get(("pending", (chat_id, challenger_id)), now)
+            records.append({"k": "pending", "chat": chat_id, "from": challenger_id, "v": target, "ts": ts})
+        for chat_id, until in game_state.EXPANSION_UNTIL.items():
+            ts = self._touched.get(("expansion", chat_id), now)
+            records.append({"k": "expansion", "chat": chat_id, "v": until, "ts": ts})
+        return records
+
+    def compact(self) -> Future:
+        """Rewrite the journal as a snapshot of the current state"""
+        records = self._snapshot()
+        self._lines = len(records)
+        text = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in records)
+        return get_writer().submit(self._rewrite, text)
+
+    def _apply(self, record: Dict[str, Any]) -> None:
+        kind, value, ts = record.get("k"), record.get("v"), record.get("ts", 0)
+        if kind == "clear":
+            game_state.ACTIVE_DUELS.clear()
+            game_state.PENDING_DUELS.clear()
+            game_state.EXPANSION_UNTIL.clear()
+            self._touched.clear()
+            return
+        if kind == "duel":
+            table, key = game_state.ACTIVE_DUELS, record["chat"]
+        elif kind == "pending":
+            table, key = game_state.PENDING_DUELS, (record["chat"], record["from"])
+        elif kind == "expansion":
+            table, key = game_state.EXPANSION_UNTIL, record["chat"]
+        else:
+            return
+        if value is None:
+            table.pop(key, None)
+        else:
+            table[key] = value
+        self._touch(kind, key, value is not None, ts)
+
+    def restore(self, now: Optional[float] = None) -> Dict[str, int]:
+        """Replay the journal into game_state, drop stale entries and
+        compact; returns how many duels/challenges/expansions are live"""
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line
+                    if isinstance(record, dict):
+                        try:
+                            self._apply(record)
+                        except (KeyError, TypeError):
+                            continue
+        self.expire(now)
+        self.compact()
+        return {
+            "duels": len(game_state.ACTIVE_DUELS),
+            "pending": len(game_state.PENDING_DUELS),
+            "expansions": len(game_state.EXPANSION_UNTIL),
+        }
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Drop the entries that went stale while the bot was down:
+        challenges older than PENDING_DUEL_TTL, duels idle and domains
+        dissolved (or ended) for GAME_STATE_STALE_AFTER"""
+        now = _now() if now is None else now
+        expired = 0
+        for chat_id in list(game_state.ACTIVE_DUELS):
+            if now - self._touched.get(("duel", chat_id), now) > GAME_STATE_STALE_AFTER:
+                del game_state.ACTIVE_DUELS[chat_id]
+                expired += 1
+        for key in list(game_state.PENDING_DUELS):
+            if now - self._touched.get(("pending", key), now) > PENDING_DUEL_TTL:
+                del game_state.PENDING_DUELS[key]
+                expired += 1
+        for chat_id, until in list(game_state.EXPANSION_UNTIL.items()):
+            if not until or now - until > GAME_STATE_STALE_AFTER:
+                del game_state.EXPANSION_UNTIL[chat_id]
+                expired += 1
+        return expired
+
+    # ----- file -----
+
+    def _write(self, line: str) -> None:
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(line)
+        self._file.flush()
+
+    def _rewrite(self, text: str) -> None:
+        self._close_file()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, self.path)
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self) -> None:
+        get_writer().submit(self._close_file).result()
+
+
+_journal = StateJournal()
+
+
+def get_state_journal() -> StateJournal:
+    """Return the process-wide state journal"""
+    return _journal
+
+
+def journal_duel(chat_id: int) -> None:
+    _journal.record_duel(chat_id)
+
+
+def journal_pending(chat_id: int, challenger_id: str) -> None:
+    _journal.record_pending(chat_id, challenger_id)
+
+
+def journal_expansion(chat_id: int) -> None:
+    _journal.record_expansion(chat_id)
+
+
+def journal_clear() -> None:
+    _journal.record_clear()
+
+
+def restore_game_state() -> Dict[str, int]:
+    """Bring back the duels, challenges and domains live before a restart"""
+    restored = _journal.restore()
+    if any(restored.values()):
+        print(f"♻️ Stato ripristinato: {restored['duels']} duelli, {restored['pending']} sfide, "
+              f"{restored['expansions']} domini", flush=True)
+    return restored
@@ -1,111 +1,568 @@
 """
-Storage layer - handles all JSON file operations
+Storage layer - resident scores, users and duels on top of a storage backend
+(JSON files or SQLite, see storage_backends.py)
+
+Reads are served from memory; writes are snapshotted on the event loop and
+serialized/written by the single writer thread (storage_writer.py), in order.
+Use flush_scores() (blocking) or await flush_scores_async() when the data
+must be on disk, e.g. before sending an export.
 """
+import asyncio
+import copy
 import json
 import os
 import zipfile
 import io
 import glob
+import itertools
+import time
 from datetime import datetime, timezone
-from typing import Dict, Any, List
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from collections.abc import Mapping
+from typing import Dict, Any, List, Optional, Set, AsyncIterator, Callable
 from config import (
-    SCORES_FILE, USERS_FILE, DUELS_FILE, 
-    CURRENT_JSON_VERSION, MAX_BACKUPS
+    SCORES_FILE, USERS_FILE, DUELS_FILE, SCORES_PACK_FILE,
+    CURRENT_JSON_VERSION, BACKUP_DIR,
+    SCORES_FLUSH_DELAY, SCORES_FLUSH_EVERY, CHAT_SCORES_DIR, CHAT_SHARD_IDLE
 )
+from storage_backends import StorageBackend, create_backend
+from storage_writer import get_writer
+from backup_store import get_backup_store
+from leaderboard_series import Columns, get_leaderboard_series
+from scorepack import PackedScores, pack_scores, unpack_scores
+from models import ensure_user_struct, migrate_scores, UserStats
+from windows import get_windowed_stats
+
+
+_backend: Optional[StorageBackend] = None
+
+
+def get_backend() -> StorageBackend:
+    """Return the configured storage backend, creating it on first use"""
+    global _backend
+    if _backend is None:
+        _backend = create_backend()
+    return _backend
+
+
+def set_backend(backend: StorageBackend) -> None:
+    """Swap the storage backend (tests, migrations); resident data is dropped"""
+    global _backend, _users, _duels
+    flush_scores()  # queued writes belong to the old backend
+    _backend = backend
+    _users = None
+    _duels = None
+    _score_store.invalidate()
+    for store in _chat_stores.values():
+        store.invalidate()
+    _chat_stores.clear()
+
+
+_MISSING = object()
+
+
+def _snapshot_entry(value: Any) -> Any:
+    if isinstance(value, UserStats):
+        return value.copy()
+    return copy.deepcopy(value)
+
+
+class UserTransaction:
+    """Handle yielded by ``ScoreStore.user``.
+
+    ``user`` is the live entry of the locked user, ``scores`` the shared dict
+    (for logic that also changes other keys, e.g. the lottery's _jackpot).
+    """
+
+    def __init__(self, scores: Dict[str, Any], user_id: str):
+        self.scores = scores
+        self.user_id = user_id
+        self.user = scores[user_id]
+        self.touched: Set[str] = set()
+        self.rolled_back = False
+        # every key of the transaction as it was before, restored on rollback
+        self.before: Dict[str, Any] = {user_id: _snapshot_entry(self.user)}
+
+    def touch(self, *keys: str) -> None:
+        """Add other keys to this transaction: they are saved with it, or
+        restored if it rolls back. Call it before changing them."""
+        for key in keys:
+            if key not in self.before:
+                self.before[key] = _snapshot_entry(self.scores[key]) if key in self.scores else _MISSING
+        self.touched.update(keys)
+
+    def rollback(self) -> None:
+        """Discard this user's changes when the block exits"""
+        self.rolled_back = True
+
+
+def _points_of(entry: Any) -> float:
+    points = entry.get("points") if isinstance(entry, Mapping) else None
+    return points if isinstance(points, (int, float)) and not isinstance(points, bool) else 0
+
+
+def _copy_entry(value: Any) -> Any:
+    if isinstance(value, UserStats):
+        value = value.to_dict()
+    if isinstance(value, dict):
+        return {k: (list(v) if isinstance(v, list) else dict(v) if isinstance(v, dict) else v)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+def load_entries(scores: Dict[str, Any]) -> Dict[str, Any]:
+    """migrate_scores for freshly read or imported scores; packed records
+    stay packed and become UserStats when first read"""
+    if not scores:
+        return scores  # nothing to migrate (new file or chat shard)
+    if isinstance(scores, PackedScores) and scores.get("_version", 1) >= CURRENT_JSON_VERSION:
+        scores.as_stats = True
+        # packed records are always dicts: only the loose keys can be corrupted
+        for k, v in scores.materialized_items():
+            if k.startswith("_"):
+                continue
+            if not isinstance(v, Mapping):
+                del scores[k]
+            elif not isinstance(v, UserStats):
+                scores[k] = UserStats.from_dict(v)
+        return scores
+    return migrate_scores(scores)
+
+
+def snapshot_scores(scores: Dict[str, Any], user_ids: Optional[Set[str]] = None) -> Dict[str, Any]:
+    """Copy of the entries to write (all, or ``user_ids``), safe to serialize
+    on the writer thread while the loop keeps mutating the live dict"""
+    if user_ids is None and isinstance(scores, PackedScores):
+        return scores.snapshot(_copy_entry)  # records never read are shared, not copied
+    keys = list(scores) if user_ids is None else [k for k in user_ids if k in scores]
+    return {k: _copy_entry(scores[k]) for k in keys}
+
+
+_versions = itertools.count(1)
+
+
+def new_version() -> int:
+    """A version number no score view has had yet: a reloaded shard never
+    repeats the version of the one it replaces"""
+    return next(_versions)
+
+
+class ScoreStore:
+    """Process-wide resident copy of the scores with write-behind flushing.
+
+    ``load`` hands out the same parsed dict on every call, ``save`` only marks
+    users dirty. The backend is written after ``flush_delay`` seconds or after
+    ``flush_every`` mutations, whichever comes first, and on ``flush()``;
+    the write itself runs on the writer thread, one at a time per store (the
+    changes made meanwhile are coalesced into the next write). With a
+    ``chat_id`` the store holds that chat's shard instead of the global
+    scores.
+    """
+
+    def __init__(self, flush_delay: float = SCORES_FLUSH_DELAY,
+                 flush_every: int = SCORES_FLUSH_EVERY, chat_id: Optional[int] = None):
+        self.chat_id = chat_id
+        self.last_used = time.monotonic()
+        self.flush_delay = flush_delay
+        self.flush_every = flush_every
+        self._scores: Optional[Dict[str, Any]] = None
+        self._dirty: Set[str] = set()
+        self._dirty_all = False
+        self._mutations = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._writing: Optional[Future] = None
+        self._flush_again = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_waiters: Dict[str, int] = {}
+        self._listeners: List[Callable[[Dict[str, Any], Optional[Set[str]]], None]] = []
+        # changes with every notified change (see render_cache.py)
+        self.version = new_version()
+
+    def subscribe(self, listener: Callable[[Dict[str, Any], Optional[Set[str]]], None]) -> None:
+        """Call ``listener(scores, user_ids)`` after every save.
+
+        ``user_ids`` is None when the whole dict changed (imports, reloads).
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, user_ids: Optional[Set[str]]) -> None:
+        self.version = new_version()
+        for listener in self._listeners:
+            listener(self._scores, user_ids)
+
+    @asynccontextmanager
+    async def user(self, user_id: str, nome: Optional[str] = None) -> AsyncIterator[UserTransaction]:
+        """Atomic read-modify-write of one user's entry.
+
+        Blocks on the same ``user_id`` are serialized, so a coroutine that
+        awaits in the middle never races another update of that user. The
+        entry is created/normalized with ``nome`` when given. On exception or
+        ``tx.rollback()`` the entry (and every key passed to ``tx.touch``) is
+        restored, otherwise they are marked dirty and the change of the user's
+        points goes to the time-window counters. Build replies inside the
+        block and send them after it: a send waits for the chat's queue,
+        and every other update of the user would wait with it.
+        """
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._lock_waiters[user_id] = self._lock_waiters.get(user_id, 0) + 1
+        try:
+            async with lock:
+                scores = self.load()
+                if nome is not None:
+                    ensure_user_struct(scores, user_id, nome)
+                tx = UserTransaction(scores, user_id)
+                try:
+                    yield tx
+                except BaseException:
+                    self._restore(scores, tx.before)
+                    raise
+                if tx.rolled_back:
+                    self._restore(scores, tx.before)
+                else:
+                    self.save(scores, user_id, *tx.touched)
+                    self._count_points(user_id, tx.before[user_id], scores.get(user_id))
+        finally:
+            self._lock_waiters[user_id] -= 1
+            if self._lock_waiters[user_id] == 0:
+                del self._lock_waiters[user_id]
+                del self._locks[user_id]
+
+    def _restore(self, scores: Dict[str, Any], before: Dict[str, Any]) -> None:
+        for key, value in before.items():
+            if value is _MISSING:
+                scores.pop(key, None)
+            else:
+                scores[key] = value
+        self._notify(set(before))
+
+    def _count_points(self, user_id: str, before: Any, after: Any) -> None:
+        old, new = _points_of(before), _points_of(after)
+        if new != old:
+            get_windowed_stats().record_points(user_id, self.chat_id, time.time(), new - old)
+
+    def load(self) -> Dict[str, Any]:
+        """Return the resident scores dict, reading the file on first use"""
+        self.last_used = time.monotonic()
+        if self._scores is None:
+            self._scores = self._read()
+        return self._scores
+
+    def _read(self) -> Dict[str, Any]:
+        if self.chat_id is None:
+            scores = get_backend().load_scores()
+        else:
+            scores = get_backend().load_chat_scores(self.chat_id)
+
+        # Old versions are migrated and corrupted entries (non-dict values)
+        # dropped; special metadata keys (e.g. _jackpot) are preserved
+        version = scores.get("_version", 1)
+        count = len(scores)
+        scores = load_entries(scores)
+        # persist the cleaned/migrated version
+        if len(scores) < count or (count and version < CURRENT_JSON_VERSION):
+            self._dirty_all = True
+        return scores
+
+    def save(self, scores: Dict[str, Any], *user_ids: str) -> None:
+        """Mark ``user_ids`` (or everything, if none given) as changed"""
+        if scores is not self._scores:
+            # A different dict replaces the resident copy (imports, migrations)
+            self._scores = load_entries(scores)
+            self._dirty_all = True
+            self._notify(None)
+        elif user_ids:
+            self._dirty.update(user_ids)
+            self._notify(set(user_ids))
+        else:
+            self._dirty_all = True
+            self._notify(None)
+
+        self._mutations += 1
+        if self._mutations >= self.flush_every:
+            self.flush()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._timer is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, migrations): write straight away
+            self.flush()
+            return
+        self._timer = loop.call_later(self.flush_delay, self.flush)
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty_all or bool(self._dirty)
+
+    @property
+    def busy(self) -> bool:
+        """True while a transaction holds or waits for a user lock"""
+        return bool(self._lock_waiters)
+
+    @property
+    def writing(self) -> bool:
+        """True while a write of this store is queued or running"""
+        return self._writing is not None and not self._writing.done()
+
+    def flush(self) -> Optional[Future]:
+        """Queue pending changes for the writer thread; returns the write's future"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._scores is None or not self.dirty:
+            return self._writing
+        if self.writing:
+            # one write at a time: whatever changed meanwhile goes in the next one
+            self._flush_again = True
+            return self._writing
+
+        backend = get_backend()
+        user_ids = None if self._dirty_all else set(self._dirty)
+        snapshot = snapshot_scores(self._scores, user_ids if backend.row_level else None)
+        if not backend.row_level:
+            user_ids = None
+        self._dirty.clear()
+        self._dirty_all = False
+        self._mutations = 0
+
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+        if self.chat_id is None:
+            self._writing = get_writer().submit(backend.save_scores, snapshot, user_ids)
+        else:
+            self._writing = get_writer().submit(backend.save_chat_scores, self.chat_id, snapshot, user_ids)
+        self._writing.add_done_callback(self._on_written)
+        return self._writing
+
+    def _on_written(self, future: Future) -> None:
+        # runs on the writer thread: hand the follow-up back to the loop
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._after_write, future)
+        else:
+            self._after_write(future)
+
+    def _after_write(self, future: Future) -> None:
+        failed = future.exception() is not None
+        if failed and self._scores is not None:
+            self._dirty_all = True  # retried with the next flush
+        if self._flush_again or failed:
+            self._flush_again = False
+            if self._loop is not None:
+                self._schedule_flush()
+
+    def sync(self) -> None:
+        """Flush and block until the changes are on disk"""
+        while True:
+            if self._writing is not None:
+                try:
+                    self._writing.result()
+                except Exception:
+                    return  # already reported by the writer, changes stay dirty
+            if not self.dirty or self._scores is None:
+                return
+            self.flush()
+
+    def invalidate(self) -> None:
+        """Forget the resident copy so the next load re-reads the backend"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._scores = None
+        self._dirty.clear()
+        self._dirty_all = False
+        self._mutations = 0
+        self._notify(None)
+
+
+_score_store = ScoreStore()
+_chat_stores: Dict[int, ScoreStore] = {}
+
+
+def get_score_store(chat_id: Optional[int] = None) -> ScoreStore:
+    """Return the global ScoreStore, or the shard of one chat (loaded lazily)"""
+    if chat_id is None:
+        return _score_store
+    store = _chat_stores.get(chat_id)
+    if store is None:
+        store = _chat_stores[chat_id] = ScoreStore(chat_id=chat_id)
+    return store
+
+
+def list_chats() -> List[int]:
+    """Chats with a shard, stored or resident"""
+    return sorted(set(get_backend().list_chats()) | set(_chat_stores))
+
+
+def evict_idle_chats(max_idle: float = CHAT_SHARD_IDLE) -> int:
+    """Flush and drop the chat shards unused for ``max_idle`` seconds"""
+    now = time.monotonic()
+    evicted = 0
+    for chat_id, store in list(_chat_stores.items()):
+        if store.busy or now - store.last_used < max_idle:
+            continue
+        store.flush()
+        if store.dirty:
+            continue  # an earlier write is still running, retry next round
+        store.invalidate()
+        del _chat_stores[chat_id]
+        evicted += 1
+    return evicted
+
+
+_global_view: Optional[Any] = None
+
+
+def set_global_view(view: Optional[Any]) -> None:
+    """Serve cross-chat reads (/score, global boards) from ``view``, an
+    object with ScoreStore's ``load``/``subscribe``/``version``. Cluster workers only
+    hold the part of the global scores made in their own chats."""
+    global _global_view
+    _global_view = view
+
+
+def get_global_view() -> Any:
+    """The store global reads go to: the global ScoreStore unless a view is set"""
+    return _global_view if _global_view is not None else _score_store
+
+
+def load_global_scores() -> Dict[str, Any]:
+    """Scores for read-only cross-chat views (same as load_scores outside a cluster)"""
+    return get_global_view().load()
 
 
 def load_scores() -> Dict[str, Any]:
-    """Load scores from JSON file, with automatic cleanup of corrupted entries"""
-    if not os.path.exists(SCORES_FILE):
-        return {}
-    try:
-        with open(SCORES_FILE, "r", encoding="utf-8") as f:
-            scores = json.load(f)
-        
-        # Filter out corrupted entries (non-dict values) but preserve
-        # special metadata keys that start with an underscore (e.g. _jackpot).
-        cleaned = {}
-        for k, v in scores.items():
-            if isinstance(v, dict) or k.startswith("_"):
-                cleaned[k] = v
-            # otherwise we drop the entry as corrupted
-        
-        # If we removed entries (excluding metadata), save the cleaned version
-        if len(cleaned) < len(scores):
-            save_scores(cleaned)
-        
-        return cleaned
-    except json.JSONDecodeError:
-        return {}
-
-
-def save_scores(scores: Dict[str, Any]) -> None:
-    """Save scores to JSON file"""
-    with open(SCORES_FILE, "w", encoding="utf-8") as f:
-        json.dump(scores, f, ensure_ascii=False, indent=2)
+    """Load scores (resident copy, corrupted entries are dropped on first read)"""
+    return _score_store.load()
 
 
-def load_users() -> Dict[str, Any]:
-    """Load users from JSON file"""
-    if not os.path.exists(USERS_FILE):
-        return {}
-    try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        return {}
+def save_scores(scores: Dict[str, Any], *user_ids: str) -> None:
+    """Save scores; pass the ids of the users that changed when known"""
+    _score_store.save(scores, *user_ids)
 
 
-def save_users(users: Dict[str, Any]) -> None:
-    """Save users to JSON file"""
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+def flush_scores() -> None:
+    """Write pending score changes (global and every chat shard) and wait
+    for them, and for every other queued write, to reach the disk"""
+    _score_store.sync()
+    for store in list(_chat_stores.values()):
+        store.sync()
+    get_writer().wait()
 
 
-def load_duels() -> List[Dict[str, Any]]:
-    """Load duels from JSON file"""
-    if not os.path.exists(DUELS_FILE):
-        return []
-    try:
-        with open(DUELS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        return []
+async def flush_scores_async() -> None:
+    """Like flush_scores, without blocking the event loop"""
+    _score_store.flush()
+    for store in list(_chat_stores.values()):
+        store.flush()
+    await get_writer().drain()
+    # changes made while the first writes ran were queued after them
+    if _score_store.dirty or any(store.dirty for store in _chat_stores.values()):
+        _score_store.flush()
+        for store in list(_chat_stores.values()):
+            store.flush()
+        await get_writer().drain()
 
 
-def save_duels(duels: List[Dict[str, Any]]) -> None:
-    """Save duels to JSON file"""
-    with open(DUELS_FILE, "w", encoding="utf-8") as f:
-        json.dump(duels, f, ensure_ascii=False, indent=2)
+_users: Optional[Dict[str, Any]] = None
 
 
-def migrate_scores(scores: Dict[str, Any]) -> Dict[str, Any]:
-    """Migrate scores to current version"""
-    version = scores.get("_version", 1)
+def load_users() -> Dict[str, Any]:
+    """Load users (id -> name), cached after the first read"""
+    global _users
+    if _users is None:
+        _users = get_backend().load_users()
+    return _users
 
-    # MIGRATION FROM VERSION 1 → 2
-    if version < 2:
-        for user_id, d in scores.items():
-            if user_id.startswith("_"):
-                continue
 
-            d.setdefault("domains_used", 0)
-            d.setdefault("last_triple_msg_id", None)
-            d.setdefault("best_speed", 0.0)
+def save_users(users: Dict[str, Any]) -> None:
+    """Save the whole users dict"""
+    global _users
+    _users = users
+    get_writer().submit(get_backend().save_users, dict(users))
 
-        scores["_version"] = 2
 
-    return scores
+def save_user_name(user_id: str, name: str) -> None:
+    """Record a user's display name, writing only when it changed"""
+    users = load_users()
+    if users.get(user_id) == name:
+        return
+    users[user_id] = name
+    get_writer().submit(get_backend().save_user_name, user_id, name)
 
 
-def migrate_duels(duels: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Migrate duels to current version"""
-    if isinstance(duels, list):
-        # If it's a list, wrap it or handle appropriately
-        pass
-    else:
-        duels = duels.copy() if isinstance(duels, dict) else {}
-    
+_duels: Optional[List[Dict[str, Any]]] = None
+
+
+def load_duels() -> List[Dict[str, Any]]:
+    """Load the duel history, cached after the first read. Legacy records
+    are linked to user ids (see link_duel_ids) and saved back once"""
+    global _duels
+    if _duels is None:
+        duels = get_backend().load_duels()
+        _duels = duels if isinstance(duels, list) else []
+        if link_duel_ids(_duels, load_users()):
+            save_duels(_duels)
+    return _duels
+
+
+def save_duels(duels: List[Dict[str, Any]]) -> None:
+    """Replace the whole duel history (imports)"""
+    global _duels
+    _duels = duels
+    get_writer().submit(get_backend().save_duels, list(duels))
+
+
+def append_duel(duel: Dict[str, Any]) -> None:
+    """Add one finished duel to the history"""
+    load_duels().append(duel)
+    get_writer().submit(get_backend().append_duel, dict(duel))
+
+
+def link_duel_ids(duels: List[Dict[str, Any]], users: Mapping[str, Any]) -> int:
+    """Give legacy duel records (display names only) their players' ids:
+    a name that exactly one user in ``users`` has maps to that user, other
+    names stay unlinked. Returns how many records changed"""
+    ids_by_name: Dict[str, Optional[str]] = {}
+    for user_id, name in users.items():
+        if user_id.startswith("_") or not isinstance(name, str):
+            continue
+        ids_by_name[name] = None if name in ids_by_name else user_id
+    changed = 0
+    for duel in duels:
+        if not isinstance(duel, dict) or (duel.get("p1_id") and duel.get("p2_id")):
+            continue
+        p1_id = duel.get("p1_id") or ids_by_name.get(duel.get("p1"))
+        p2_id = duel.get("p2_id") or ids_by_name.get(duel.get("p2"))
+        if not p1_id and not p2_id or p1_id == p2_id:
+            continue
+        if p1_id:
+            duel["p1_id"] = p1_id
+        if p2_id:
+            duel["p2_id"] = p2_id
+        if p1_id and duel.get("winner") == duel.get("p1"):
+            duel["winner_id"] = p1_id
+        elif p2_id and duel.get("winner") == duel.get("p2"):
+            duel["winner_id"] = p2_id
+        changed += 1
+    return changed
+
+
+def migrate_duels(duels: List[Dict[str, Any]], users: Optional[Mapping[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Migrate duels to current version (records linked to user ids)"""
+    if not isinstance(duels, list):
+        return []
+    link_duel_ids(duels, load_users() if users is None else users)
     return duels
 
 
@@ -115,125 +572,188 @@ def migrate_users(users: Dict[str, Any]) -> Dict[str, Any]:
     return users
 
 
-def create_backup_zip() -> str:
-    """Create a backup ZIP file with all JSON data"""
-    os.makedirs("backup", exist_ok=True)
+def export_data(filename: str) -> Any:
+    """Copy of what an export file contains, taken from the resident data"""
+    if filename == SCORES_FILE:
+        return snapshot_scores(load_scores())
+    if filename == USERS_FILE:
+        return dict(load_users())
+    if filename == DUELS_FILE:
+        return [dict(d) for d in load_duels()]
+    if filename.startswith(f"{CHAT_SCORES_DIR}/"):
+        chat_id = int(filename[len(CHAT_SCORES_DIR) + 1:-len(".json")])
+        return snapshot_scores(get_score_store(chat_id).load())
+    raise ValueError(f"Unknown export file: {filename}")
 
-    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d_%H-%M")
-    zip_path = f"backup/backup_{timestamp}.zip"
 
-    # CREATE ZIP FILE
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as z:
-        for filename in [SCORES_FILE, DUELS_FILE, USERS_FILE]:
-            if os.path.exists(filename):
-                z.write(filename)
+def _encode_json(data: Any) -> bytes:
+    if isinstance(data, PackedScores):
+        data = data.to_dict()
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
 
-    # KEEP ONLY LAST 10 BACKUPS
-    backups = sorted(glob.glob("backup/backup_*.zip"))
-    if len(backups) > MAX_BACKUPS:
-        for old in backups[:-MAX_BACKUPS]:
-            try:
-                os.remove(old)
-            except:
-                pass
 
-    return zip_path
+def export_json(filename: str) -> bytes:
+    """Serialize scores/users/duels as the JSON export format, whatever the backend"""
+    return _encode_json(export_data(filename))
+
+
+async def export_json_async(filename: str) -> bytes:
+    """export_json with the serialization done on the writer thread"""
+    return await get_writer().run(_encode_json, export_data(filename))
+
+
+def chat_export_names() -> List[str]:
+    """Archive names of the chat shards in backups/exports"""
+    return [f"{CHAT_SCORES_DIR}/{chat_id}.json" for chat_id in list_chats()]
+
+
+def _export_files() -> Dict[str, Any]:
+    files = {}
+    for filename in [SCORES_FILE, DUELS_FILE, USERS_FILE] + chat_export_names():
+        try:
+            files[filename] = export_data(filename)
+        except Exception as e:
+            print(f"⚠️ Export di {filename} saltato: {e}")
+    return files
+
+
+def _backup_payload(files: Dict[str, Any]) -> Dict[str, bytes]:
+    payload = {filename: _encode_json(data) for filename, data in files.items()}
+    # the compact copy is what a restart loads (see import_json_files)
+    if SCORES_FILE in files:
+        payload[SCORES_PACK_FILE] = pack_scores(files[SCORES_FILE])
+    return payload
+
+
+def _write_backup(files: Dict[str, Any]) -> str:
+    store = get_backup_store()
+    backup_id = store.create(_backup_payload(files))
+    store.prune()
+    return backup_id
+
+
+def create_backup() -> str:
+    """Add an incremental backup of all data to the backup store; returns its id"""
+    return get_writer().submit(_write_backup, _export_files()).result()
+
+
+async def create_backup_async() -> str:
+    """create_backup without blocking the event loop"""
+    return await get_writer().run(_write_backup, _export_files())
+
+
+def _build_backup_zip(backup_id: str) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as z:
+        for filename, raw in get_backup_store().materialize(backup_id).items():
+            z.writestr(filename, raw)
+    buffer.seek(0)
+    return buffer
+
+
+async def backup_zip_async(backup_id: str) -> io.BytesIO:
+    """A stored backup as an in-memory ZIP (the file sent to the admin)"""
+    return await get_writer().run(_build_backup_zip, backup_id)
 
 
 def get_backup_list() -> List[str]:
-    """Get list of available backups"""
-    return sorted(glob.glob("backup/backup_*.zip"))
+    """Ids of the stored backups, oldest first"""
+    return get_backup_store().list()
 
 
-def create_export_zip() -> io.BytesIO:
-    """Create an in-memory ZIP buffer with all JSON files and snapshots"""
+def get_legacy_backups() -> List[str]:
+    """Full ZIP backups written before the backup store"""
+    return sorted(glob.glob(f"{BACKUP_DIR}/backup_*.zip"))
+
+
+def _build_export_zip(files: Dict[str, Any]) -> io.BytesIO:
     buffer = io.BytesIO()
     
     with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as z:
-        for filename in [SCORES_FILE, DUELS_FILE, USERS_FILE]:
-            try:
-                z.write(filename)
-            except:
-                pass
+        for filename, data in files.items():
+            z.writestr(filename, _encode_json(data))
         # include leaderboard snapshots if any exist
-        snapshot_dir = "leaderboard_snapshots"
-        if os.path.isdir(snapshot_dir):
-            for path in glob.glob(f"{snapshot_dir}/*.json"):
-                try:
-                    z.write(path)
-                except:
-                    pass
+        for arcname, raw in get_backend().iter_snapshots():
+            z.writestr(arcname, raw)
     
     buffer.seek(0)
     return buffer
 
 
-def auto_import_latest_backup() -> bool:
-    """Auto-import the latest backup on bot startup. Returns True if successful."""
-    backups = get_backup_list()
-    if not backups:
-        return False
-    
-    latest_backup = backups[-1]  # Get the most recent backup
-    
-    try:
-        with zipfile.ZipFile(latest_backup, "r") as z:
-            # Extract all files
-            z.extractall(".")
-        print(f"✅ Auto-imported latest backup: {latest_backup}")
-        return True
-    except Exception as e:
-        print(f"❌ Failed to auto-import backup {latest_backup}: {str(e)}")
-        return False
-
-def save_leaderboard_snapshot() -> None:
-    """Save a snapshot of today's leaderboard for daily recap"""
-    scores = load_scores()
-    
-    # Create snapshot with timestamp
-    from datetime import datetime, timezone
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    
-    snapshot_dir = "leaderboard_snapshots"
-    if not os.path.exists(snapshot_dir):
-        os.makedirs(snapshot_dir)
-    
-    # Sort by points for top 10
-    top_10 = sorted(scores.items(), key=lambda x: x[1].get("points", 0), reverse=True)[:10]
-    
-    snapshot_data = {
-        "date": today,
-        "timestamp": datetime.now(timezone.utc).timestamp(),
-        "top_10": [
-            {
-                "user_id": uid,
-                "name": data.get("name", "Unknown"),
-                "points": data.get("points", 0),
-                "streak": data.get("streak", 0),
-                "elo": data.get("elo", 1000)
-            }
-            for uid, data in top_10
-        ]
-    }
-    
-    snapshot_file = f"{snapshot_dir}/{today}_snapshot.json"
-    with open(snapshot_file, 'w', encoding='utf-8') as f:
-        json.dump(snapshot_data, f, indent=2, ensure_ascii=False)
+def create_export_zip() -> io.BytesIO:
+    """Create an in-memory ZIP buffer with all JSON files and snapshots"""
+    return get_writer().submit(_build_export_zip, _export_files()).result()
+
+
+async def create_export_zip_async() -> io.BytesIO:
+    """create_export_zip without blocking the event loop"""
+    return await get_writer().run(_build_export_zip, _export_files())
+
+
+def _decode_import(files: Dict[str, bytes]) -> Dict[str, Any]:
+    """Parse (and migrate) the exported files of an import: filename ->
+    scores/users/duels, chat id -> shard. Touches nothing shared, so it can
+    run on the writer thread"""
+    decoded: Dict[Any, Any] = {}
+    if SCORES_PACK_FILE in files:
+        decoded[SCORES_FILE] = load_entries(unpack_scores(files[SCORES_PACK_FILE]))
+    elif SCORES_FILE in files:
+        decoded[SCORES_FILE] = load_entries(json.loads(files[SCORES_FILE].decode("utf-8")))
+    if USERS_FILE in files:
+        decoded[USERS_FILE] = migrate_users(json.loads(files[USERS_FILE].decode("utf-8")))
+    if DUELS_FILE in files:
+        decoded[DUELS_FILE] = json.loads(files[DUELS_FILE].decode("utf-8"))
+    for name, raw in files.items():
+        if name.startswith(f"{CHAT_SCORES_DIR}/") and name.endswith(".json"):
+            try:
+                chat_id = int(name[len(CHAT_SCORES_DIR) + 1:-len(".json")])
+            except ValueError:
+                continue
+            decoded[chat_id] = load_entries(json.loads(raw.decode("utf-8")))
+    return decoded
 
 
-def get_leaderboard_snapshots(days_back: int = 1) -> Dict[str, Any]:
-    """Get snapshots from N days ago for comparison"""
-    from datetime import datetime, timezone, timedelta
-    
-    snapshot_dir = "leaderboard_snapshots"
-    if not os.path.exists(snapshot_dir):
-        return None
-    
-    target_date = (datetime.now(timezone.utc) - timedelta(days=days_back)).strftime("%Y-%m-%d")
-    snapshot_file = f"{snapshot_dir}/{target_date}_snapshot.json"
-    
-    if not os.path.exists(snapshot_file):
-        return None
-    
-    with open(snapshot_file, 'r', encoding='utf-8') as f:
-        return json.load(f)
\ No newline at end of file
+def _apply_import(decoded: Dict[Any, Any]) -> None:
+    """Make decoded import data the resident data; the writes are queued"""
+    if SCORES_FILE in decoded:
+        save_scores(decoded[SCORES_FILE])
+    if USERS_FILE in decoded:
+        save_users(decoded[USERS_FILE])
+    if DUELS_FILE in decoded:
+        # after the users: legacy duels are linked to ids by name
+        save_duels(migrate_duels(decoded[DUELS_FILE]))
+    for key, shard in decoded.items():
+        if isinstance(key, int):
+            get_score_store(key).save(shard)
+
+
+def import_json_files(files: Dict[str, bytes]) -> None:
+    """Load exported JSON files (filename -> bytes) into the active backend.
+
+    A scores.pack (backups) is preferred over scores.json: it decodes several
+    times faster, even when every user is read back.
+    """
+    _apply_import(_decode_import(files))
+    flush_scores()
+
+
+async def import_json_files_async(files: Dict[str, bytes]) -> None:
+    """Like import_json_files, without blocking the event loop: the files are
+    decoded on the writer thread and the writes awaited"""
+    _apply_import(await get_writer().run(_decode_import, files))
+    await flush_scores_async()
+
+
+def save_leaderboard_snapshot() -> Future:
+    """Record today's metrics of every player in the leaderboard series
+    (written by the storage writer thread)"""
+    today = datetime.now(timezone.utc).date()
+    return get_leaderboard_series().record(today, load_scores())
+
+
+def get_leaderboard_snapshots(days_back: int = 1) -> Optional[Columns]:
+    """Every player's metrics as recorded N days ago, for comparison"""
+    from datetime import timedelta
+
+    target_date = (datetime.now(timezone.utc) - timedelta(days=days_back)).date()
+    return get_leaderboard_series().on(target_date)
@@ -0,0 +1,488 @@
+"""
+Storage backends - where scores, users, duels and snapshots actually live
+
+storage.py talks to exactly one backend, picked with STORAGE_BACKEND in
+config.py. JSON files stay the import/export format whatever the backend.
+"""
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, Any, List, Optional, Iterable, Iterator, Tuple
+from config import (
+    SCORES_FILE, USERS_FILE, DUELS_FILE, STORAGE_BACKEND, SQLITE_FILE,
+    SNAPSHOT_DIR, CHAT_SCORES_DIR, SCORES_PACK_FILE
+)
+from scorepack import pack_scores, unpack_scores
+
+
+def write_json_atomic(path: str, data: Any) -> None:
+    """Write JSON to a temp file and swap it in, so readers never see half a file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def write_bytes_atomic(path: str, data: bytes) -> None:
+    """Binary counterpart of write_json_atomic"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class StorageBackend:
+    """Interface shared by all backends.
+
+    ``save_scores`` receives the ids of the users that changed; ``None`` means
+    the whole dict must be written (imports, migrations, first save).
+    Backends with ``row_level`` only get the changed entries in that case;
+    the others always get the full dict.
+    """
+
+    name = "base"
+    row_level = False
+
+    def load_scores(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def save_scores(self, scores: Dict[str, Any], user_ids: Optional[Iterable[str]] = None) -> None:
+        raise NotImplementedError
+
+    def load_chat_scores(self, chat_id: int) -> Dict[str, Any]:
+        """Scores of one chat shard (same layout as the global scores)"""
+        raise NotImplementedError
+
+    def save_chat_scores(self, chat_id: int, scores: Dict[str, Any],
+                         user_ids: Optional[Iterable[str]] = None) -> None:
+        raise NotImplementedError
+
+    def list_chats(self) -> List[int]:
+        """Ids of the chats that have a stored shard"""
+        raise NotImplementedError
+
+    def is_empty(self) -> bool:
+        """True when no scores are stored yet"""
+        return not self.load_scores()
+
+    def load_users(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def save_users(self, users: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def save_user_name(self, user_id: str, name: str) -> None:
+        users = self.load_users()
+        users[user_id] = name
+        self.save_users(users)
+
+    def load_duels(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def save_duels(self, duels: List[Dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+    def append_duel(self, duel: Dict[str, Any]) -> None:
+        duels = self.load_duels()
+        duels.append(duel)
+        self.save_duels(duels)
+
+    def save_snapshot(self, date: str, data: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def load_snapshot(self, date: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def iter_snapshots(self) -> Iterator[Tuple[str, bytes]]:
+        """Yield (archive name, JSON bytes) for every stored snapshot"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class JsonBackend(StorageBackend):
+    """The original layout: scores.json, users.json, duels.json on disk"""
+
+    name = "json"
+
+    def __init__(self, scores_file: str = SCORES_FILE, users_file: str = USERS_FILE,
+                 duels_file: str = DUELS_FILE, snapshot_dir: str = SNAPSHOT_DIR,
+                 chat_dir: str = CHAT_SCORES_DIR):
+        self.scores_file = scores_file
+        self.users_file = users_file
+        self.duels_file = duels_file
+        self.snapshot_dir = snapshot_dir
+        self.chat_dir = chat_dir
+
+    def _read(self, path: str, default: Any) -> Any:
+        if not os.path.exists(path):
+            return default
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            return default
+
+    def load_scores(self) -> Dict[str, Any]:
+        return self._read(self.scores_file, {})
+
+    def save_scores(self, scores: Dict[str, Any], user_ids: Optional[Iterable[str]] = None) -> None:
+        # A JSON document can only be rewritten as a whole
+        if not isinstance(scores, dict):
+            scores = dict(scores.items())  # PackedScores loaded from a backup
+        write_json_atomic(self.scores_file, scores)
+
+    def _chat_path(self, chat_id: int) -> str:
+        return f"{self.chat_dir}/{chat_id}.json"
+
+    def load_chat_scores(self, chat_id: int) -> Dict[str, Any]:
+        return self._read(self._chat_path(chat_id), {})
+
+    def save_chat_scores(self, chat_id: int, scores: Dict[str, Any],
+                         user_ids: Optional[Iterable[str]] = None) -> None:
+        os.makedirs(self.chat_dir, exist_ok=True)
+        write_json_atomic(self._chat_path(chat_id), scores)
+
+    def list_chats(self) -> List[int]:
+        chats = []
+        for path in glob.glob(f"{self.chat_dir}/*.json"):
+            try:
+                chats.append(int(os.path.basename(path)[:-len(".json")]))
+            except ValueError:
+                pass
+        return sorted(chats)
+
+    def load_users(self) -> Dict[str, Any]:
+        return self._read(self.users_file, {})
+
+    def save_users(self, users: Dict[str, Any]) -> None:
+        write_json_atomic(self.users_file, users)
+
+    def load_duels(self) -> List[Dict[str, Any]]:
+        return self._read(self.duels_file, [])
+
+    def save_duels(self, duels: List[Dict[str, Any]]) -> None:
+        write_json_atomic(self.duels_file, duels)
+
+    def append_duel(self, duel: Dict[str, Any]) -> None:
+        # duels.json stays one JSON list: write the record over its closing
+        # bracket instead of rewriting the whole file
+        item = json.dumps(duel, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+        try:
+            with open(self.duels_file, "r+b") as f:
+                size = f.seek(0, os.SEEK_END)
+                start = f.seek(max(0, size - 256))
+                body = f.read().rstrip()
+                if not body.endswith(b"]"):
+                    raise ValueError("duels.json does not end with a list")
+                body = body[:-1].rstrip()
+                f.seek(start + len(body))
+                f.write((("\n  " if body.endswith(b"[") else ",\n  ") + item + "\n]").encode("utf-8"))
+                f.truncate()
+        except FileNotFoundError:
+            write_json_atomic(self.duels_file, [duel])
+        except ValueError:
+            self._append_duel_slow(duel)
+
+    def _append_duel_slow(self, duel: Dict[str, Any]) -> None:
+        # the tail is not a list's closing bracket: parse the whole file, and
+        # never replace a history that cannot be read with a new one
+        with open(self.duels_file, "r", encoding="utf-8") as f:
+            raw = f.read()
+        try:
+            duels = json.loads(raw) if raw.strip() else []
+        except json.JSONDecodeError:
+            duels = None
+        if not isinstance(duels, list):
+            kept = f"{self.duels_file}.corrupt-{int(time.time())}"
+            os.replace(self.duels_file, kept)
+            print(f"⚠️ {self.duels_file} illeggibile, spostato in {kept}: "
+                  f"lo storico dei duelli riparte da qui", flush=True)
+            duels = []
+        duels.append(duel)
+        write_json_atomic(self.duels_file, duels)
+
+    def _snapshot_path(self, date: str) -> str:
+        return f"{self.snapshot_dir}/{date}_snapshot.json"
+
+    def save_snapshot(self, date: str, data: Dict[str, Any]) -> None:
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        write_json_atomic(self._snapshot_path(date), data)
+
+    def load_snapshot(self, date: str) -> Optional[Dict[str, Any]]:
+        return self._read(self._snapshot_path(date), None)
+
+    def iter_snapshots(self) -> Iterator[Tuple[str, bytes]]:
+        if not os.path.isdir(self.snapshot_dir):
+            return
+        for path in sorted(glob.glob(f"{self.snapshot_dir}/*.json")):
+            try:
+                with open(path, "rb") as f:
+                    yield path, f.read()
+            except OSError:
+                pass
+
+
+class BinaryBackend(JsonBackend):
+    """JSON files, except the scores: those live in the compact scores.pack.
+
+    An existing scores.json is read once and replaced by the pack on the
+    first save.
+    """
+
+    name = "binary"
+
+    def __init__(self, pack_file: str = SCORES_PACK_FILE, **json_files: str):
+        super().__init__(**json_files)
+        self.pack_file = pack_file
+
+    def load_scores(self) -> Dict[str, Any]:
+        if os.path.exists(self.pack_file):
+            with open(self.pack_file, "rb") as f:
+                return unpack_scores(f.read())
+        return super().load_scores()
+
+    def save_scores(self, scores: Dict[str, Any], user_ids: Optional[Iterable[str]] = None) -> None:
+        write_bytes_atomic(self.pack_file, pack_scores(scores))
+
+
+class SqliteBackend(StorageBackend):
+    """SQLite (WAL) backend: one row per user, chat member, duel and snapshot.
+
+    Metadata keys of the scores dict (``_jackpot``, ``_version``) live in the
+    ``meta`` table, so scores round-trip unchanged through load/save.
+    """
+
+    name = "sqlite"
+    row_level = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS stats (
+            user_id TEXT PRIMARY KEY,
+            data    TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chat_stats (
+            chat_id INTEGER NOT NULL,
+            user_id TEXT NOT NULL,
+            data    TEXT NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            name    TEXT
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS duels (
+            id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            data      TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS leaderboard_snapshots (
+            date TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path: str = SQLITE_FILE):
+        self.path = path
+        # The connection is shared between the event loop and the writer
+        # thread, every access goes through self._lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+
+    def _transaction(self, statements: Iterable[Tuple[str, tuple]]) -> None:
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    cur.execute(sql, params)
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+            cur.execute("COMMIT")
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # ----- scores -----
+
+    def is_empty(self) -> bool:
+        return not self._query("SELECT 1 FROM stats LIMIT 1")
+
+    def load_scores(self) -> Dict[str, Any]:
+        scores: Dict[str, Any] = {}
+        for key, value in self._query("SELECT key, value FROM meta"):
+            scores[key] = json.loads(value)
+        for user_id, data in self._query("SELECT user_id, data FROM stats"):
+            scores[user_id] = json.loads(data)
+        return scores
+
+    def _score_row(self, scores: Dict[str, Any], key: str) -> Tuple[str, tuple]:
+        if key.startswith("_"):
+            if key in scores:
+                return ("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                        (key, json.dumps(scores[key], ensure_ascii=False)))
+            return ("DELETE FROM meta WHERE key = ?", (key,))
+        if key in scores:
+            return ("INSERT OR REPLACE INTO stats (user_id, data) VALUES (?, ?)",
+                    (key, json.dumps(scores[key], ensure_ascii=False)))
+        return ("DELETE FROM stats WHERE user_id = ?", (key,))
+
+    def save_scores(self, scores: Dict[str, Any], user_ids: Optional[Iterable[str]] = None) -> None:
+        if user_ids is None:
+            statements = [("DELETE FROM stats", ()), ("DELETE FROM meta", ())]
+            statements += [self._score_row(scores, key) for key in scores]
+        else:
+            statements = [self._score_row(scores, key) for key in user_ids]
+        self._transaction(statements)
+
+    # ----- chat shards -----
+
+    def load_chat_scores(self, chat_id: int) -> Dict[str, Any]:
+        rows = self._query("SELECT user_id, data FROM chat_stats WHERE chat_id = ?", (chat_id,))
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def _chat_row(self, chat_id: int, scores: Dict[str, Any], key: str) -> Tuple[str, tuple]:
+        if key in scores:
+            return ("INSERT OR REPLACE INTO chat_stats (chat_id, user_id, data) VALUES (?, ?, ?)",
+                    (chat_id, key, json.dumps(scores[key], ensure_ascii=False)))
+        return ("DELETE FROM chat_stats WHERE chat_id = ? AND user_id = ?", (chat_id, key))
+
+    def save_chat_scores(self, chat_id: int, scores: Dict[str, Any],
+                         user_ids: Optional[Iterable[str]] = None) -> None:
+        if user_ids is None:
+            statements = [("DELETE FROM chat_stats WHERE chat_id = ?", (chat_id,))]
+            statements += [self._chat_row(chat_id, scores, key) for key in scores]
+        else:
+            statements = [self._chat_row(chat_id, scores, key) for key in user_ids]
+        self._transaction(statements)
+
+    def list_chats(self) -> List[int]:
+        return [chat_id for (chat_id,) in self._query("SELECT DISTINCT chat_id FROM chat_stats ORDER BY chat_id")]
+
+    # ----- users -----
+
+    def load_users(self) -> Dict[str, Any]:
+        users: Dict[str, Any] = {}
+        for user_id, name in self._query("SELECT user_id, name FROM users"):
+            # metadata rows (_version) keep their JSON type
+            users[user_id] = json.loads(name) if user_id.startswith("_") else name
+        return users
+
+    def save_users(self, users: Dict[str, Any]) -> None:
+        statements = [("DELETE FROM users", ())]
+        for user_id, name in users.items():
+            if user_id.startswith("_"):
+                name = json.dumps(name)
+            statements.append(("INSERT INTO users (user_id, name) VALUES (?, ?)", (user_id, name)))
+        self._transaction(statements)
+
+    def save_user_name(self, user_id: str, name: str) -> None:
+        self._transaction([("INSERT OR REPLACE INTO users (user_id, name) VALUES (?, ?)", (user_id, name))])
+
+    # ----- duels -----
+
+    def load_duels(self) -> List[Dict[str, Any]]:
+        return [json.loads(data) for (data,) in self._query("SELECT data FROM duels ORDER BY id")]
+
+    def _duel_row(self, duel: Dict[str, Any]) -> Tuple[str, tuple]:
+        return ("INSERT INTO duels (timestamp, data) VALUES (?, ?)",
+                (duel.get("timestamp"), json.dumps(duel, ensure_ascii=False)))
+
+    def save_duels(self, duels: List[Dict[str, Any]]) -> None:
+        statements = [("DELETE FROM duels", ())]
+        statements += [self._duel_row(d) for d in duels]
+        self._transaction(statements)
+
+    def append_duel(self, duel: Dict[str, Any]) -> None:
+        self._transaction([self._duel_row(duel)])
+
+    # ----- snapshots -----
+
+    def save_snapshot(self, date: str, data: Dict[str, Any]) -> None:
+        self._transaction([("INSERT OR REPLACE INTO leaderboard_snapshots (date, data) VALUES (?, ?)",
+                            (date, json.dumps(data, ensure_ascii=False)))])
+
+    def load_snapshot(self, date: str) -> Optional[Dict[str, Any]]:
+        rows = self._query("SELECT data FROM leaderboard_snapshots WHERE date = ?", (date,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def iter_snapshots(self) -> Iterator[Tuple[str, bytes]]:
+        for date, data in self._query("SELECT date, data FROM leaderboard_snapshots ORDER BY date"):
+            yield f"{SNAPSHOT_DIR}/{date}_snapshot.json", data.encode("utf-8")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_json_to_sqlite(db_path: str = SQLITE_FILE, source: Optional[JsonBackend] = None) -> Dict[str, int]:
+    """One-shot copy of scores.json/users.json/duels.json (and snapshots) into SQLite"""
+    source = source or JsonBackend()
+    target = SqliteBackend(db_path)
+    try:
+        scores = source.load_scores()
+        users = source.load_users()
+        duels = source.load_duels()
+        target.save_scores(scores)
+        target.save_users(users)
+        target.save_duels(duels if isinstance(duels, list) else [])
+        chats = source.list_chats()
+        for chat_id in chats:
+            target.save_chat_scores(chat_id, source.load_chat_scores(chat_id))
+
+        snapshots = 0
+        for path, raw in source.iter_snapshots():
+            date = os.path.basename(path).split("_snapshot")[0]
+            try:
+                target.save_snapshot(date, json.loads(raw.decode("utf-8")))
+                snapshots += 1
+            except ValueError:
+                pass
+    finally:
+        target.close()
+
+    return {
+        "scores": sum(1 for k in scores if not k.startswith("_")),
+        "users": sum(1 for k in users if not k.startswith("_")),
+        "duels": len(duels),
+        "chats": len(chats),
+        "snapshots": snapshots,
+    }
+
+
+def create_backend(kind: str = STORAGE_BACKEND) -> StorageBackend:
+    """Build the configured backend (migrating the JSON files on first SQLite start)"""
+    if kind == "json":
+        return JsonBackend()
+    if kind == "binary":
+        return BinaryBackend()
+    if kind == "sqlite":
+        if not os.path.exists(SQLITE_FILE) and os.path.exists(SCORES_FILE):
+            counts = migrate_json_to_sqlite(SQLITE_FILE)
+            print(f"🔄 Migrati i JSON in {SQLITE_FILE}: {counts}", flush=True)
+        return SqliteBackend(SQLITE_FILE)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {kind}")
+
+
+if __name__ == "__main__":
+    # python storage_backends.py migrate [db_path]
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        db = sys.argv[2] if len(sys.argv) >= 3 else SQLITE_FILE
+        print(migrate_json_to_sqlite(db))
+    else:
+        print("Uso: python storage_backends.py migrate [db_path]")
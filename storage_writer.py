@@ -0,0 +1,61 @@
+"""
+Storage writer - one background thread that runs every disk write
+(serialization, file/SQLite writes, ZIP creation, event log fsync) in
+submission order, so the asyncio loop never blocks on I/O
+"""
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+class StorageWriter:
+    """Single-thread executor: jobs run one at a time, in the order submitted"""
+
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-writer")
+            return self._executor
+
+    @staticmethod
+    def _run(fn: Callable[..., Any], *args: Any) -> Any:
+        try:
+            return fn(*args)
+        except Exception as e:
+            print(f"❌ Scrittura su disco fallita ({getattr(fn, '__qualname__', fn)}): {e}", flush=True)
+            raise
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        """Queue ``fn(*args)`` after every job submitted before it"""
+        return self._get_executor().submit(self._run, fn, *args)
+
+    def wait(self) -> None:
+        """Block until every job queued so far has finished"""
+        self.submit(lambda: None).result()
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Queue ``fn(*args)`` and await its result without blocking the loop"""
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    async def drain(self) -> None:
+        """Await until every job queued so far has finished"""
+        await self.run(lambda: None)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+_writer = StorageWriter()
+
+
+def get_writer() -> StorageWriter:
+    """Return the process-wide writer thread"""
+    return _writer
@@ -6,16 +6,37 @@ Tests all commands, handlers, and game logic
 import os
 import sys
 import asyncio
+import io
+import json
+import shutil
+import tempfile
+import zipfile
+import glob
+import zlib
+from contextlib import contextmanager
 from unittest.mock import AsyncMock, MagicMock, patch
 
 # Setup environment
 os.environ['TOKEN'] = '123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11'
 os.environ['ADMIN_ID'] = '1234567890'
 
-# Clean test data files
-for f in ['scores.json', 'users.json', 'duels.json']:
-    if os.path.exists(f):
-        os.remove(f)
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+
+@contextmanager
+def scratch_dir():
+    """Run inside a fresh temporary directory: every data file the bot
+    writes (scores.json, chat_scores/, backup/, events.log, ...) is relative
+    to the working directory, so a test run never touches real data"""
+    work_dir = tempfile.mkdtemp(prefix="slotbot-tests-")
+    os.symlink(os.path.join(REPO_DIR, "immagini"), os.path.join(work_dir, "immagini"))
+    os.chdir(work_dir)
+    try:
+        yield work_dir
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
 
 class TestResults:
     def __init__(self):
@@ -147,6 +168,48 @@ async def test_game_logic():
         assert "test1" in loaded
         results.add_pass("Save/load scores")
 
+        # write-behind: inside the event loop a save only marks the user dirty
+        import json
+        from storage import get_score_store, flush_scores
+        store = get_score_store()
+        scores["test1"]["points"] = 77
+        save_scores(scores, "test1")
+        assert store.dirty
+        flush_scores()
+        assert not store.dirty
+        with open("scores.json", "r", encoding="utf-8") as f:
+            assert json.load(f)["test1"]["points"] == 77
+        assert load_scores() is scores
+        results.add_pass("Write-behind score store")
+
+        # per-user transactions: interleaved coroutines must not lose updates
+        async def bump(delay):
+            async with store.user("test1", "TestUser1") as tx:
+                points = tx.user["points"]
+                await asyncio.sleep(delay)
+                tx.user["points"] = points + 1
+
+        await asyncio.gather(bump(0.02), bump(0))
+        assert scores["test1"]["points"] == 79
+
+        async with store.user("test1") as tx:
+            tx.user["points"] = -1
+            tx.rollback()
+        assert load_scores()["test1"]["points"] == 79
+
+        # touched keys roll back with the user
+        jackpot = scores.get("_jackpot")
+        try:
+            async with store.user("test1") as tx:
+                tx.touch("_jackpot")
+                tx.scores["_jackpot"] = -50
+                tx.user.points = -1
+                raise RuntimeError("send failed")
+        except RuntimeError:
+            pass
+        assert scores.get("_jackpot") == jackpot and scores["test1"]["points"] == 79
+        results.add_pass("Per-user transactions")
+
         # test duel turn helper alternation and win detection
         from commands_gameplay import handle_duel_turn
         import game_state
@@ -174,6 +237,28 @@ async def test_game_logic():
         res = handle_duel_turn(chat, p2, "P2", scores, won=True)  # 3-0, duel should end
         assert "DUELLO FINITO" in res
         results.add_pass("Duel turn helper")
+
+        # the loser's result waits for (and survives) their own transaction
+        from commands_gameplay import flush_duel_results
+        await flush_duel_results()
+        losses = scores[p1].duel_losses
+        game_state.ACTIVE_DUELS[chat] = {
+            "p1_id": p1, "p2_id": p2, "p1_name": "P1", "p2_name": "P2",
+            "current_turn": p2, "score": {p1: 0, p2: 2},
+        }
+
+        async def loser_busy():
+            async with store.user(p1, "P1") as tx:
+                await asyncio.sleep(0.01)
+                tx.rollback()
+
+        busy = asyncio.ensure_future(loser_busy())
+        await asyncio.sleep(0)
+        assert "DUELLO FINITO" in handle_duel_turn(chat, p2, "P2", scores, won=True)
+        await busy
+        await flush_duel_results()
+        assert scores[p1].duel_losses == losses + 1
+        results.add_pass("Duel result recorded in the loser's own transaction")
     except Exception as e:
         results.add_fail("Game logic", e)
     
@@ -204,7 +289,8 @@ async def test_commands():
         from commands_stats import (
             score_command, top_command, topstreak_command, topsfiga_command,
             topcombo_command, topwinrate_command, topspeed_command,
-            topduelli_command, storicosfide_command, tope_command
+            topduelli_command, storicosfide_command, tope_command,
+            miesfide_command, h2h_command
         )
         from commands_gameplay import (
             sfida_command, espansione_command, benedici_command,
@@ -224,6 +310,8 @@ async def test_commands():
             ("tope", tope_command),
             ("topduelli", topduelli_command),
             ("storicosfide", storicosfide_command),
+            ("miesfide", miesfide_command),
+            ("h2h", h2h_command),
         ]
         
         gameplay_cmds = [
@@ -267,6 +355,9 @@ async def test_commands():
         mock_update.message.reply_text.reset_mock()
         await lotteria_command(mock_update, mock_context)
         # after second call file should contain _jackpot key
+        # (scores are written behind, so flush before reading the file)
+        from storage import flush_scores
+        flush_scores()
         import json
         with open('scores.json','r',encoding='utf-8') as f:
             data = json.load(f)
@@ -358,15 +449,13 @@ async def test_commands():
         from datetime import datetime, timezone, timedelta
         import json, os
 
-        # ensure yesterday snapshot exists with lower points
-        yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
-        if not os.path.exists("leaderboard_snapshots"):
-            os.makedirs("leaderboard_snapshots")
+        # ensure yesterday is recorded in the series with lower points
+        from leaderboard_series import get_leaderboard_series
+        yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).date()
         scores = load_scores()
         scores[uid]["points"] = 10
         save_scores(scores)
-        with open(f"leaderboard_snapshots/{yesterday}_snapshot.json", "w", encoding="utf-8") as f:
-            json.dump({"date": yesterday, "top_10": [{"user_id": uid, "name": "TestUser", "points": 10}]}, f)
+        get_leaderboard_series().record(yesterday, scores).result()
 
         # bump points to trigger a mover
         scores[uid]["points"] = 100
@@ -408,7 +497,7 @@ async def test_dice_handler():
         mock_update.message.via_bot = None
         
         mock_context = MagicMock()
-        mock_context.bot = MagicMock()
+        mock_context.bot = AsyncMock()
         
         # Test with winning roll
         dice_obj = MagicMock()
@@ -416,8 +505,7 @@ async def test_dice_handler():
         dice_obj.value = 22  # WIN
         mock_update.message.dice = dice_obj
         
-        with patch('asyncio.sleep', new_callable=AsyncMock):
-            await handle_dice(mock_update, mock_context)
+        await handle_dice(mock_update, mock_context)
         # debug: print stored score after win
         from storage import load_scores
         print("[dice test] post-win entry:", load_scores().get(str(mock_update.message.from_user.id)))
@@ -427,8 +515,7 @@ async def test_dice_handler():
         mock_update.message.dice.value = 5  # LOSE
         mock_update.message.reply_text.reset_mock()
 
-        with patch('asyncio.sleep', new_callable=AsyncMock):
-            await handle_dice(mock_update, mock_context)
+        await handle_dice(mock_update, mock_context)
 
         print("[dice test] post-lose entry:", load_scores().get(str(mock_update.message.from_user.id)))
         results.add_pass("Losing roll (5)")
@@ -437,8 +524,7 @@ async def test_dice_handler():
         mock_update.message.dice.value = 64  # JACKPOT
         mock_update.message.reply_text.reset_mock()
 
-        with patch('asyncio.sleep', new_callable=AsyncMock):
-            await handle_dice(mock_update, mock_context)
+        await handle_dice(mock_update, mock_context)
 
         print("[dice test] post-jackpot entry:", load_scores().get(str(mock_update.message.from_user.id)))
         results.add_pass("Jackpot roll (64)")
@@ -447,8 +533,7 @@ async def test_dice_handler():
         mock_update.message.from_user.is_bot = True
         mock_update.message.dice.value = 22
         mock_update.message.reply_text.reset_mock()
-        with patch('asyncio.sleep', new_callable=AsyncMock):
-            await handle_dice(mock_update, mock_context)
+        await handle_dice(mock_update, mock_context)
         print("[dice test] post-bot-ignore entry:", load_scores().get(str(mock_update.message.from_user.id)))
         results.add_pass("Bot dice ignored")
 
@@ -456,12 +541,45 @@ async def test_dice_handler():
         # first roll already done in previous tests, simulate another
         mock_update.message.from_user.is_bot = False
         mock_update.message.dice.value = 12
-        with patch('asyncio.sleep', new_callable=AsyncMock):
-            await handle_dice(mock_update, mock_context)
+        await handle_dice(mock_update, mock_context)
         scores = load_scores()
         uid = str(mock_update.message.from_user.id)
         assert scores[uid].get("best_speed", 0.0) > 0
         results.add_pass("Speed record updated")
+
+        # a roll that fails before committing leaves no event, shard or window trace
+        import handlers
+        from storage import get_score_store
+        from events import read_events, flush_events
+        from windows import get_windowed_stats
+        from roll_history import get_roll_history
+
+        def trace():
+            flush_events()
+            return (
+                sum(1 for e in read_events() if e.get("type") == "roll" and e.get("user") == uid),
+                get_score_store(888).load()[uid].get("total_slots"),
+                get_windowed_stats().totals(uid, "oggi", 888),
+                load_scores()[uid].get("total_slots"),
+                len(get_roll_history().get(uid) or ()),
+            )
+
+        before = trace()
+        original_duel_turn = handlers.handle_duel_turn
+        handlers.handle_duel_turn = MagicMock(side_effect=RuntimeError("duel"))
+        try:
+            await handle_dice(mock_update, mock_context)
+            assert False, "the roll should have failed"
+        except RuntimeError:
+            pass
+        finally:
+            handlers.handle_duel_turn = original_duel_turn
+        assert trace() == before
+        await handle_dice(mock_update, mock_context)
+        after = trace()
+        assert after[0] == before[0] + 1 and after[1] == before[1] + 1
+        assert after[2]["slots"] == before[2]["slots"] + 1 and after[4] == before[4] + 1
+        results.add_pass("Failed roll leaves no event, shard, window or history trace")
         
     except Exception as e:
         results.add_fail("Dice handler", e)
@@ -469,28 +587,1663 @@ async def test_dice_handler():
         traceback.print_exc()
     
     return results
+async def test_event_log():
+    """Test the event log and that a replay matches the live scores"""
+    results = TestResults()
+    print("\n📜 EVENT LOG TESTS")
+    print("="*50)
+
+    log_path = "test_events.log"
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    try:
+        from events import EventLog, read_events, replay, diff_scores, flush_events
+        from storage_writer import get_writer
+        from storage import load_scores
+
+        log = EventLog(log_path, fsync_every=3, fsync_delay=60)
+        log.append("roll", user="1", value=22)
+        log.append("roll", user="1", value=5)
+        assert not os.path.exists(log_path) or os.path.getsize(log_path) == 0
+        log.append("roll", user="1", value=64)
+        get_writer().wait()
+        assert len(list(read_events(log_path))) == 3
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write('{"type": "roll", "us')  # torn write from a crash
+        assert len(list(read_events(log_path))) == 3
+        log.close()
+        results.add_pass("Batched fsync and torn line skipped")
+
+        # the dice tests above logged every roll of user 12345
+        flush_events()
+        uid = "12345"
+        rebuilt = replay(e for e in read_events() if e.get("user") == uid)
+        live = load_scores()
+        assert rebuilt[uid]["total_slots"] == live[uid]["total_slots"] > 0
+        assert diff_scores(rebuilt, {uid: live[uid]}) == []
+        results.add_pass("Replay matches live scores")
+    except Exception as e:
+        results.add_fail("Event log", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        if os.path.exists(log_path):
+            os.remove(log_path)
+
+    return results
+
+async def test_scorepack():
+    """Test the compact binary scores format and the binary backend"""
+    results = TestResults()
+    print("\n📦 SCORE PACK TESTS")
+    print("="*50)
+
+    import storage
+    from storage_backends import JsonBackend, BinaryBackend
+    pack_path = "test_scores.pack"
+    try:
+        from models import UserStats
+        from scorepack import bench, pack_scores, unpack_scores, synthetic_scores, PackedScores
+
+        scores = synthetic_scores(500)
+        scores["100000001"]["achievements"] = ["quad", "first_blood"]  # not in table order
+        scores["100000002"]["extra_field"] = {"x": [1]}
+        scores["100000003"]["points"] = 1.5
+        del scores["100000004"]["elo"]
+        scores["100000005"]["last_triple_msg_id"] = 77
+        scores["100000006"]["name"] = "Nome \u0000 strano 🎰"
+        packed = unpack_scores(pack_scores(scores))
+        assert packed.packed_count == 500
+        assert packed["100000007"] == scores["100000007"] and packed.packed_count == 499
+        assert packed.to_dict() == scores
+        results.add_pass("Lossless JSON <-> pack round trip")
+
+        packed = unpack_scores(pack_scores(scores))
+        packed["100000009"]["points"] += 1
+        del packed["100000010"]
+        packed["nuovo"] = {"name": "Nuovo"}
+        expected = json.loads(json.dumps(scores))
+        expected["100000009"]["points"] += 1
+        del expected["100000010"]
+        expected["nuovo"] = {"name": "Nuovo"}
+        assert unpack_scores(pack_scores(packed)).to_dict() == expected
+        results.add_pass("Re-pack keeps untouched records as-is")
+
+        packed = unpack_scores(pack_scores(scores))
+        packed.as_stats = True
+        assert packed["100000002"].to_dict() == UserStats.from_dict(scores["100000002"]).to_dict()
+        packed.materialize()
+        assert packed.packed_count == 0
+        for user_id, entry in scores.items():
+            if not user_id.startswith("_"):
+                assert isinstance(packed[user_id], UserStats)
+                assert packed[user_id].to_dict() == UserStats.from_dict(entry).to_dict(), user_id
+        results.add_pass("Records decode straight into UserStats")
+
+        timing = bench(100000, repeat=2)
+        assert timing["full_speedup"] >= 5, timing
+        results.add_pass(f"Full load of 100k users {timing['full_speedup']:.1f}x faster than json.loads")
+
+        storage.flush_scores()
+        live = json.loads(storage.export_json("scores.json"))
+        backend = BinaryBackend(pack_file=pack_path)
+        storage.set_backend(backend)
+        loaded = storage.load_scores()  # no pack yet: read from scores.json
+        assert dict(loaded.items()) == live
+        uid = next(k for k in live if not k.startswith("_"))
+        loaded[uid]["points"] += 5
+        storage.save_scores(loaded, uid)
+        storage.flush_scores()
+        storage.set_backend(backend)
+        loaded = storage.load_scores()
+        assert isinstance(loaded, PackedScores)
+        assert loaded[uid]["points"] == live[uid]["points"] + 5
+        assert json.loads(storage.export_json("scores.json"))[uid]["points"] == live[uid]["points"] + 5
+        results.add_pass("Binary backend load/save and JSON export")
+
+        backup_id = storage.create_backup()
+        files = storage.get_backup_store().materialize(backup_id)
+        assert "scores.pack" in files and "scores.json" in files
+        storage.import_json_files({"scores.pack": files["scores.pack"]})
+        assert storage.load_scores()[uid]["points"] == live[uid]["points"] + 5
+        results.add_pass("Backups carry scores.pack and restore from it")
+
+        # /importall and /ripristina: decoding and writing leave the loop free
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0)
+
+        storage.load_scores()[uid]["points"] = 0
+        ticking = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0)
+        before = ticks
+        await storage.import_json_files_async({"scores.pack": files["scores.pack"]})
+        ticking.cancel()
+        assert ticks > before + 1
+        assert storage.load_scores()[uid]["points"] == live[uid]["points"] + 5
+        assert not storage.get_score_store().dirty
+        results.add_pass("Async import runs off the event loop")
+    except Exception as e:
+        results.add_fail("Score pack", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        storage.set_backend(JsonBackend())
+        if os.path.exists(pack_path):
+            os.remove(pack_path)
+
+    return results
+
+async def test_storage_writer():
+    """Test that disk writes run on the writer thread, in order"""
+    results = TestResults()
+    print("\n💾 STORAGE WRITER TESTS")
+    print("="*50)
+
+    try:
+        import threading
+        import storage
+        from storage_writer import get_writer
+
+        writer = get_writer()
+        seen = []
+        for i in range(5):
+            writer.submit(lambda i=i: seen.append((i, threading.current_thread().name)))
+        await writer.drain()
+        assert [i for i, _ in seen] == list(range(5))
+        assert all(name.startswith("storage-writer") for _, name in seen)
+        results.add_pass("Jobs run in order off the event loop")
+
+        store = storage.get_score_store()
+        scores = store.load()
+        uid = next(k for k in scores if not k.startswith("_"))
+        scores[uid]["points"] += 1
+        storage.save_scores(scores, uid)
+        first = store.flush()
+        scores[uid]["points"] += 1
+        storage.save_scores(scores, uid)
+        store.flush()  # coalesced behind the running write
+        await storage.flush_scores_async()
+        assert first.done() and not store.dirty
+        with open("scores.json", encoding="utf-8") as f:
+            assert json.load(f)[uid]["points"] == scores[uid]["points"]
+        results.add_pass("Coalesced writes reach the disk")
+
+        buf = await storage.create_export_zip_async()
+        assert "scores.json" in zipfile.ZipFile(buf).namelist()
+        assert json.loads(await storage.export_json_async("scores.json"))[uid]["points"] == scores[uid]["points"]
+        results.add_pass("Async export and ZIP")
+    except Exception as e:
+        results.add_fail("Storage writer", e)
+        import traceback
+        traceback.print_exc()
+
+    return results
+
+async def test_chat_shards():
+    """Test per-chat shards, their eviction and the /top scope"""
+    results = TestResults()
+    print("\n👥 CHAT SHARD TESTS")
+    print("="*50)
+
+    try:
+        import storage
+        from leaderboard import get_leaderboard_index
+        from commands_stats import top_command
+
+        # the dice tests rolled in chat 888 only
+        uid = "12345"
+        shard = storage.get_score_store(888).load()
+        assert shard[uid]["total_slots"] == storage.load_scores()[uid]["total_slots"]
+        assert get_leaderboard_index(888).top("points", 10)[0][0] == uid
+        assert storage.get_score_store(999).load() == {}
+        results.add_pass("Rolls recorded in the chat shard")
+
+        evicted = storage.evict_idle_chats(max_idle=0)
+        storage.get_writer().wait()
+        assert evicted >= 1 and 888 not in storage._chat_stores
+        assert os.path.exists("chat_scores/888.json")
+        assert 888 in storage.list_chats()
+        assert get_leaderboard_index(888).top("points", 10)[0][0] == uid
+        results.add_pass("Idle shard flushed, evicted and reloaded")
+
+        mock_update = MagicMock()
+        mock_update.message.chat_id = 888
+        mock_update.message.chat.type = "supergroup"
+        mock_update.message.reply_text = AsyncMock()
+        mock_context = MagicMock()
+        mock_context.args = []
+        await top_command(mock_update, mock_context)
+        assert "questo gruppo" in mock_update.message.reply_text.call_args[0][0]
+        mock_context.args = ["globale"]
+        await top_command(mock_update, mock_context)
+        assert "globale" in mock_update.message.reply_text.call_args[0][0]
+        results.add_pass("/top group and global scope")
+
+        export = storage.create_export_zip().getvalue()
+        names = zipfile.ZipFile(io.BytesIO(export)).namelist()
+        assert "chat_scores/888.json" in names
+        results.add_pass("Chat shards included in exports")
+
+        # ... and /importall brings them back
+        from commands_admin import importall_command
+        from outbox import flush_replies
+        points = storage.get_score_store(888).load()[uid].points
+        storage.get_score_store(888).load()[uid].points = -1
+        update = MagicMock()
+        update.message.from_user.id = 1234567890
+        update.message.reply_text = AsyncMock()
+        document = MagicMock()
+        document.download_as_bytearray = AsyncMock(return_value=bytearray(export))
+        update.message.reply_to_message.document.get_file = AsyncMock(return_value=document)
+        await importall_command(update, MagicMock())
+        await flush_replies()
+        assert "Import completo" in update.message.reply_text.call_args.args[0]
+        assert storage.get_score_store(888).load()[uid].points == points
+        results.add_pass("Export then /importall keeps the per-chat leaderboards")
+
+        # an admin edit waits for the roll in progress and survives its rollback
+        from commands_admin import setpoints_command
+        from events import flush_events, read_events, replay
+        storage.flush_scores()
+        flush_events()
+
+        async def roll_in_progress():
+            async with storage.get_score_store().user(uid) as tx:
+                tx.user.points += 1
+                await asyncio.sleep(0.01)
+                tx.rollback()
+
+        busy = asyncio.ensure_future(roll_in_progress())
+        await asyncio.sleep(0)
+        update.message.reply_text = AsyncMock()
+        context = MagicMock()
+        context.args = [uid, "4321"]
+        await setpoints_command(update, context)
+        await busy
+        await flush_replies()
+        assert "4321" in update.message.reply_text.call_args.args[0]
+        assert storage.load_scores()[uid].points == 4321
+        assert storage.get_score_store(888).load()[uid].points == 4321
+        flush_events()
+        rebuilt = replay(read_events(), chat_id=888)
+        assert rebuilt[uid].points == 4321
+        results.add_pass("Admin edits go through the user's transaction, shards included")
+    except Exception as e:
+        results.add_fail("Chat shards", e)
+        import traceback
+        traceback.print_exc()
+
+    return results
+
+async def test_leaderboard_index():
+    """Test the incremental leaderboard index against a full sort"""
+    results = TestResults()
+    print("\n🏆 LEADERBOARD INDEX TESTS")
+    print("="*50)
+
+    try:
+        import random
+        from leaderboard import LeaderboardIndex, SortedKeyList
+        from models import ensure_user_struct
+
+        SortedKeyList.LOAD = 4  # force many bucket splits/merges
+        rng = random.Random(7)
+        scores = {"_jackpot": 50}
+        for i in range(300):
+            ensure_user_struct(scores, f"u{i}", f"P{i}")
+            scores[f"u{i}"]["points"] = rng.randint(0, 100)
+            scores[f"u{i}"]["total_slots"] = rng.randint(0, 30)
+            scores[f"u{i}"]["total_wins"] = rng.randint(0, scores[f"u{i}"]["total_slots"])
+
+        index = LeaderboardIndex()
+        index.rebuild(scores)
+        for _ in range(500):
+            uid = f"u{rng.randint(0, 299)}"
+            scores[uid]["points"] += rng.randint(-5, 20)
+            scores[uid]["total_slots"] += 1
+            index.on_scores_changed(scores, {uid})
+
+        def expected(metric_fn):
+            rows = [(uid, metric_fn(d)) for uid, d in scores.items() if not uid.startswith("_")]
+            rows = [(uid, v) for uid, v in rows if v is not None]
+            return sorted(rows, key=lambda x: (-x[1], x[0]))
+
+        from leaderboard import METRICS
+        assert index.top("points", 10) == expected(METRICS["points"])[:10]
+        assert index.top("winrate", 10) == expected(METRICS["winrate"])[:10]
+        full = expected(METRICS["points"])
+        assert index.rank("points", full[42][0]) == (43, len(full))
+        results.add_pass("Incremental top-K matches full sort")
+
+        del scores["u0"]
+        index.on_scores_changed(scores, {"u0"})
+        assert index.rank("points", "u0") is None
+        results.add_pass("Removed user leaves every board")
+        SortedKeyList.LOAD = 500
+    except Exception as e:
+        results.add_fail("Leaderboard index", e)
+
+    return results
+
+async def test_storage_backends():
+    """Test the SQLite backend and the JSON -> SQLite migrator"""
+    results = TestResults()
+    print("\n🗄️  STORAGE BACKEND TESTS")
+    print("="*50)
+
+    import storage
+    from storage_backends import JsonBackend, SqliteBackend, migrate_json_to_sqlite
+    db_path = "test_slotbot.db"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+    backend = None
+    try:
+        storage.flush_scores()
+        counts = migrate_json_to_sqlite(db_path)
+        assert counts["scores"] == len([k for k in storage.load_scores() if not k.startswith("_")])
+        results.add_pass("JSON -> SQLite migration")
+
+        backend = SqliteBackend(db_path)
+        storage.set_backend(backend)
+        scores = storage.load_scores()
+        assert "_jackpot" in scores
+        uid = next(k for k in scores if not k.startswith("_"))
+        scores[uid]["points"] = 4242
+        storage.save_scores(scores, uid)
+        storage.flush_scores()
+        rows = backend._query("SELECT data FROM stats WHERE user_id = ?", (uid,))
+        assert json.loads(rows[0][0])["points"] == 4242
+        results.add_pass("SQLite per-user row update")
+
+        before = len(storage.load_duels())
+        storage.append_duel({"p1": "A", "p2": "B", "score1": 3, "score2": 1, "winner": "A", "timestamp": "x"})
+        assert len(storage.load_duels()) == before + 1
+        storage.save_user_name("999", "Nuovo")
+        storage.get_writer().wait()
+        assert backend.load_users()["999"] == "Nuovo"
+        storage.save_leaderboard_snapshot().result()
+        assert storage.get_leaderboard_snapshots(days_back=0) is not None
+        assert counts["chats"] == len(backend.list_chats()) >= 1
+        shard = storage.get_score_store(888)
+        shard.load()["12345"]["points"] = 77
+        shard.save(shard.load(), "12345")
+        shard.sync()
+        assert backend.load_chat_scores(888)["12345"]["points"] == 77
+        results.add_pass("SQLite duels, users, snapshots and chat shards")
+
+        buf = storage.create_export_zip()
+        names = zipfile.ZipFile(buf).namelist()
+        assert "scores.json" in names and "duels.json" in names
+        results.add_pass("SQLite export as JSON")
+    except Exception as e:
+        results.add_fail("Storage backends", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        storage.set_backend(JsonBackend())
+        if backend is not None:
+            backend.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    return results
+
+async def test_user_stats():
+    """Test the slotted user model and the versioned migration"""
+    results = TestResults()
+    print("\n👤 USER STATS TESTS")
+    print("="*50)
+
+    try:
+        import copy
+        import pickle
+        from models import UserStats, ensure_user_struct, migrate_scores, USER_FIELDS
+
+        d = UserStats("Mario", points=5, colore="blu")
+        assert d.points == 5 and d["points"] == 5 and d.elo == 1000
+        assert d.get("colore") == "blu" and "colore" in d and d.get("manca", 7) == 7
+        assert len(d) == len(USER_FIELDS) + 1
+        d["streak"] += 2
+        assert d.streak == 2
+        del d["streak"]
+        assert d.streak == 0
+        results.add_pass("Attribute and mapping access")
+
+        raw = d.to_dict()
+        assert json.loads(json.dumps(raw)) == raw
+        assert UserStats.from_dict(raw) == d and d == raw
+        twin = copy.deepcopy(d)
+        twin.achievements.append("first_blood")
+        assert d.achievements == [] and pickle.loads(pickle.dumps(twin)) == twin
+        results.add_pass("Dict round trip, copy and pickle")
+
+        scores = {"1": {"name": "Vecchio", "points": 3}, "2": "rotto", "_jackpot": 40}
+        migrate_scores(scores)
+        assert isinstance(scores["1"], UserStats) and scores["1"].domains_used == 0
+        assert scores["1"].points == 3 and "2" not in scores
+        assert scores["_version"] == 2 and scores["_jackpot"] == 40
+        assert ensure_user_struct(scores, "1", "Nuovo") is scores["1"] and scores["1"].name == "Nuovo"
+        results.add_pass("Versioned migration to UserStats")
+    except Exception as e:
+        results.add_fail("User stats", e)
+        import traceback
+        traceback.print_exc()
+
+    return results
+
+async def test_benchmark():
+    """Test the benchmark report helpers"""
+    results = TestResults()
+    print("\n⏱️ BENCHMARK TESTS")
+    print("="*50)
+
+    try:
+        import storage
+        from benchmark import summarize, compare_reports, make_update, make_context
+        from handlers import handle_dice
+
+        stats = summarize([i / 1000 for i in range(1, 101)])
+        assert stats["count"] == 100 and round(stats["p50_ms"]) == 51 and round(stats["p99_ms"]) == 100
+        results.add_pass("Latency percentiles")
+
+        old = {"runs": [{"users": 1000, "dice": {"p99_ms": 1.0, "bytes_written_per_roll": 100}}]}
+        new = {"runs": [{"users": 1000, "dice": {"p99_ms": 1.1, "bytes_written_per_roll": 200}}]}
+        regressions = compare_reports(old, new, 0.25)
+        assert len(regressions) == 1 and "bytes_written_per_roll" in regressions[0]
+        results.add_pass("Baseline comparison")
+
+        await handle_dice(make_update(4242, "Bench", 777, 1), make_context())
+        assert storage.load_scores()["4242"].total_slots == 1
+        results.add_pass("Synthetic update drives handle_dice")
+    except Exception as e:
+        results.add_fail("Benchmark", e)
+        import traceback
+        traceback.print_exc()
+
+    return results
+
+async def test_outbox():
+    """Test the per-chat send queues and the deferred roll replies"""
+    results = TestResults()
+    print("\n📨 OUTBOX TESTS")
+    print("="*50)
+
+    try:
+        import storage
+        from telegram.error import RetryAfter
+        from outbox import (
+            Outbox, TokenBucket, get_outbox, flush_replies, defer_reply,
+            PRIORITY_HIGH, PRIORITY_LOW
+        )
+        from handlers import handle_dice
+        from benchmark import make_update
+
+        async def send(text, reply_to):
+            sent.append((text, reply_to))
+
+        sent = []
+        box = Outbox(delay=0.05, merge_window=0.05)
+        box.enqueue(1, "primo", send, 10, ("t",), delay=box.delay, wait=False)
+        box.enqueue(1, "secondo", send, 11, ("t",), delay=box.delay, wait=False)
+        box.enqueue(2, "altra chat", send, 12, ("t",), delay=box.delay, wait=False)
+        assert not sent and box.pending == 3
+        await asyncio.sleep(0.2)
+        assert sorted(sent) == [("altra chat", 12), ("primo\n\nsecondo", None)]
+        assert box.sent == 2 and box.merged == 1 and box.pending == 0
+        results.add_pass("Deferred replies wait for the animation and merge per chat")
+
+        sent = []
+        box = Outbox(chat_rate=1000, chat_burst=1)
+        first = box.enqueue(3, "x" * 3000, send, 1, ("t",))
+        box.enqueue(3, "y" * 3000, send, 1, ("t",))
+        box.enqueue(3, "record", send, 1, ("low",), priority=PRIORITY_LOW)
+        box.enqueue(3, "duello", send, 1, ("high",), priority=PRIORITY_HIGH)
+        await first
+        await box.flush()
+        assert [t[:6] for t, _ in sent] == ["duello", "xxxxxx", "yyyyyy", "record"]
+        results.add_pass("Priorities and the message size limit are respected")
+
+        bucket = TokenBucket(rate=2, burst=1)
+        assert bucket.wait_time(0.0) == 0
+        bucket.take(0.0)
+        assert abs(bucket.wait_time(0.0) - 0.5) < 1e-9 and bucket.wait_time(0.5) == 0
+        bucket.block(0.5, 3)
+        assert bucket.wait_time(1.0) == 2.5
+        results.add_pass("Token bucket paces sends and honours RetryAfter")
+
+        calls = []
+
+        async def flaky():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RetryAfter(0)
+            return "ok"
+
+        box = Outbox()
+        assert await box.enqueue(4, None, flaky) == "ok"
+        assert len(calls) == 2 and box.retried == 1 and box.failed == 0
+        results.add_pass("RetryAfter is retried instead of dropping the message")
+
+        await flush_replies()  # the dice tests' replies
+        bot = AsyncMock()
+        context = MagicMock()
+        context.bot = bot
+        before = storage.load_scores().get("5151")
+        await handle_dice(make_update(5151, "Veloce", 515, 1, message_id=99), context)
+        assert storage.load_scores()["5151"].total_slots == (before.total_slots if before else 0) + 1
+        assert bot.send_message.call_count == 0 and get_outbox().pending >= 1
+        await flush_replies()
+        reply = bot.send_message.call_args_list[0].kwargs
+        assert reply["chat_id"] == 515 and reply["reply_parameters"].message_id == 99
+        results.add_pass("handle_dice commits at once and replies later")
+
+        bot = AsyncMock()
+        defer_reply(bot, 516, "tiro", reply_to=1)
+        defer_reply(bot, 516, "fine duello", reply_to=1, priority=PRIORITY_HIGH)
+        await flush_replies()
+        assert bot.send_message.call_args.kwargs["text"] == "fine duello\n\ntiro"
+        results.add_pass("Duel results lead the merged reply")
+
+        # a reply stuck in the chat's queue must not hold the user's lock
+        from commands_minigames import tarocchi_command
+        update = make_update(5252, "Lento", 517, message_id=98)
+        released = asyncio.Event()
+
+        async def slow_reply(*args, **kwargs):
+            await released.wait()
+
+        update.message.reply_text = slow_reply
+        pending = asyncio.ensure_future(tarocchi_command(update, MagicMock()))
+        await asyncio.sleep(0.01)
+        assert not pending.done()
+        async with asyncio.timeout(1):
+            async with storage.get_score_store().user("5252", "Lento") as tx:
+                assert tx.user.last_tarocchi_ts > 0
+        released.set()
+        await pending
+        results.add_pass("Replies wait in the queue without holding the user's lock")
+    except Exception as e:
+        results.add_fail("Outbox", e)
+        import traceback
+        traceback.print_exc()
+
+    return results
+
+async def test_webhook():
+    """Test the webhook runtime against the fake Bot API"""
+    results = TestResults()
+    print("\n🌐 WEBHOOK TESTS")
+    print("="*50)
+
+    try:
+        import storage
+        from telegram import Update
+        from outbox import flush_replies
+        from loadtest import FakeBotAPI, build_app, dice_update
+
+        api = FakeBotAPI()
+        app = build_app(api)
+        async with app:
+            await app.process_update(Update.de_json(dice_update(1, 6161, -616, 64, "Web"), app.bot))
+            await app.process_update(Update.de_json(
+                {"update_id": 2, "message": {
+                    "message_id": 2, "date": 0, "chat": {"id": -616, "type": "supergroup"},
+                    "from": {"id": 6161, "is_bot": False, "first_name": "Web"},
+                    "text": "/score", "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}},
+                app.bot))
+            await flush_replies()
+        assert storage.load_scores()["6161"].total_slots == 1
+        assert api.calls["getMe"] == 1 and api.calls["sendMessage"] >= 2
+        results.add_pass("Synthetic updates run through the real handlers")
+
+        try:
+            import tornado  # noqa: F401  (python-telegram-bot[webhooks])
+        except ImportError:
+            results.add_warning("Webhook server", "tornado non installato, server HTTP non testato")
+        else:
+            import argparse
+            from loadtest import run_load
+            report = await run_load(argparse.Namespace(
+                updates=50, connections=8, users=10, chats=3, port=0, backend="json",
+                seed=1, timeout=30, keep=False))
+            assert report["end_to_end"]["count"] == 50 and report["api_calls"]["setWebhook"] == 1
+            results.add_pass("Updates posted over HTTP are all handled")
+    except Exception as e:
+        results.add_fail("Webhook", e)
+        import traceback
+        traceback.print_exc()
+
+    return results
+
+async def test_cluster():
+    """Test chat routing across worker processes and the merged global view"""
+    results = TestResults()
+    print("\n🧩 CLUSTER TESTS")
+    print("="*50)
+
+    try:
+        import glob
+        import tempfile
+        from cluster import ClusterFront, ClusterNode, merge_partials, route, update_chat_id
+        from config import ROLL_HISTORY_FILE, WINDOWS_FILE
+        from leaderboard import LeaderboardIndex
+        from loadtest import dice_update
+
+        a = {"1": {"name": "A", "points": 10, "total_slots": 5, "best_streak": 3, "elo": 1016,
+                   "last_slot_ts": 100.0, "streak": 2, "achievements": ["triple"]}}
+        b = {"1": {"name": "A2", "points": -2, "total_slots": 4, "best_streak": 5, "elo": 990,
+                   "last_slot_ts": 200.0, "streak": 0, "achievements": ["triple", "quad"]},
+             "_version": 2}
+        merged = merge_partials([a, b])
+        m = merged["1"]
+        assert (m.points, m.total_slots, m.best_streak, m.elo) == (8, 9, 5, 1006)
+        assert m.name == "A2" and m.streak == 0 and m.achievements == ["triple", "quad"]
+        results.add_pass("Partial entries merge field by field")
+
+        assert update_chat_id(dice_update(1, 7, -42, 5)) == -42
+        assert update_chat_id({"update_id": 1, "inline_query": {"id": "q", "from": {"id": 9}}}) == 9
+        assert route(-42, 4) == route(-42, 4) < 4
+        results.add_pass("Updates are routed by chat")
+
+        # workers are spawned in this cwd: keep them away from the suite's files
+        home = os.getcwd()
+        scratch = tempfile.mkdtemp(prefix="slotbot-cluster-")
+        os.chdir(scratch)
+        try:
+            front = ClusterFront(workers=2, root=scratch, backend="json", fake_api=True, sync_interval=0.2)
+            front.start()
+            chats = [-101, -102, -103, -104]
+            for i in range(40):
+                front.dispatch(dice_update(i + 1, 7000 + i % 3, chats[i % 4], 1 + i % 64))
+            stats = await asyncio.to_thread(front.stop)
+        finally:
+            os.chdir(home)
+        assert [s["updates"] for s in stats] == front.routed and sum(front.routed) == 40
+        for chat in chats:
+            owner = os.path.join(scratch, f"worker-{route(chat, 2)}", "chat_scores", f"{chat}.json")
+            assert os.path.exists(owner)
+        parts = []
+        for path in glob.glob(os.path.join(scratch, "shared", "*.json")):
+            with open(path, encoding="utf-8") as f:
+                parts.append(json.load(f)["scores"])
+        assert len(parts) == 2
+        merged = merge_partials(parts)
+        assert sum(merged[str(7000 + u)].total_slots for u in range(3)) == 40
+        results.add_pass("Worker processes own their chats, shared store adds up")
+
+        for index in range(2):
+            workdir = os.path.join(scratch, f"worker-{index}")
+            assert os.path.exists(os.path.join(workdir, WINDOWS_FILE))
+            assert os.path.exists(os.path.join(workdir, ROLL_HISTORY_FILE))
+        results.add_pass("Workers save their counters and roll history on shutdown")
+
+        jobs = {s["worker"]: set(s["jobs"]) for s in stats}
+        assert {"scheduled_backup", "daily_recap"} <= jobs[0]
+        assert not {"scheduled_backup", "daily_recap"} & jobs[1]
+        for worker_jobs in jobs.values():
+            assert {"scheduled_eviction", "scheduled_windows_save", "scheduled_roll_history_save",
+                    "sync"} <= worker_jobs
+        results.add_pass("Workers run the bot's jobs, admin backup and daily recap in one")
+
+        node = ClusterNode(2, scratch)  # a third worker reading the other two
+        board = LeaderboardIndex(store=node)
+        top_ids = {user_id for user_id, _ in board.top("points", 1000)}
+        assert {"7000", "7001", "7002"} <= top_ids
+        assert node.load()["7001"].total_slots == merged["7001"].total_slots
+        results.add_pass("Merged view feeds the global boards")
+    except Exception as e:
+        results.add_fail("Cluster", e)
+        import traceback
+        traceback.print_exc()
+
+    return results
+
+async def test_state_journal():
+    """Test that duels, challenges and domains survive a restart"""
+    results = TestResults()
+    print("\n♻️ STATE JOURNAL TESTS")
+    print("="*50)
+
+    import game_state
+    saved = (dict(game_state.ACTIVE_DUELS), dict(game_state.PENDING_DUELS), dict(game_state.EXPANSION_UNTIL))
+    path = "test_game_state.log"
+    try:
+        from state_journal import StateJournal
+        from storage_writer import get_writer
+        from commands_gameplay import handle_duel_turn
+
+        def reset():
+            game_state.ACTIVE_DUELS.clear()
+            game_state.PENDING_DUELS.clear()
+            game_state.EXPANSION_UNTIL.clear()
+
+        reset()
+        if os.path.exists(path):
+            os.remove(path)
+        journal = StateJournal(path, compact_every=1000)
+        duel = {"p1_id": "1", "p2_id": "2", "p1_name": "A", "p2_name": "B",
+                "current_turn": "1", "score": {"1": 0, "2": 0}}
+        game_state.ACTIVE_DUELS[-5] = duel
+        journal.record_duel(-5)
+        game_state.PENDING_DUELS[(-5, "3")] = 4
+        journal.record_pending(-5, "3")
+        game_state.EXPANSION_UNTIL[-6] = 9999999999.0
+        journal.record_expansion(-6)
+        duel["score"]["1"] = 2
+        duel["current_turn"] = "2"
+        journal.record_duel(-5)
+        journal.close()
+        expected = (dict(game_state.ACTIVE_DUELS), dict(game_state.PENDING_DUELS), dict(game_state.EXPANSION_UNTIL))
+
+        reset()  # the restart
+        restored = StateJournal(path).restore()
+        get_writer().wait()
+        assert restored == {"duels": 1, "pending": 1, "expansions": 1}
+        assert (game_state.ACTIVE_DUELS, game_state.PENDING_DUELS, game_state.EXPANSION_UNTIL) == expected
+        assert game_state.ACTIVE_DUELS[-5]["score"]["1"] == 2
+        results.add_pass("Live state replayed after a restart")
+
+        reset()
+        journal = StateJournal(path)
+        journal.restore(now=expected[2][-6] + 2 * 24 * 3600)
+        get_writer().wait()
+        assert not game_state.PENDING_DUELS and not game_state.EXPANSION_UNTIL and not game_state.ACTIVE_DUELS
+        results.add_pass("Stale challenges, duels and domains expire")
+
+        reset()
+        journal = StateJournal(path, compact_every=5)
+        game_state.ACTIVE_DUELS[-7] = {"p1_id": "1", "p2_id": "2", "p1_name": "A", "p2_name": "B",
+                                       "current_turn": "1", "score": {"1": 0, "2": 0}}
+        journal.record_duel(-7)
+        for _ in range(12):
+            turn = game_state.ACTIVE_DUELS[-7]["current_turn"]
+            handle_duel_turn(-7, turn, "X", {}, False)  # journals through the process-wide journal
+            journal.record_duel(-7)
+        journal.close()
+        with open(path, encoding="utf-8") as f:
+            assert len(f.readlines()) <= 5
+        live = dict(game_state.ACTIVE_DUELS)
+        reset()
+        StateJournal(path).restore()
+        get_writer().wait()
+        assert game_state.ACTIVE_DUELS == live
+        results.add_pass("Journal compacts and still restores")
+    except Exception as e:
+        results.add_fail("State journal", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        game_state.ACTIVE_DUELS.clear()
+        game_state.PENDING_DUELS.clear()
+        game_state.EXPANSION_UNTIL.clear()
+        game_state.ACTIVE_DUELS.update(saved[0])
+        game_state.PENDING_DUELS.update(saved[1])
+        game_state.EXPANSION_UNTIL.update(saved[2])
+        for leftover in (path, path + ".tmp"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    return results
+
+async def test_deadlines():
+    """Test that domains, challenges and idle duels expire on time"""
+    results = TestResults()
+    print("\n⌛ DEADLINE TESTS")
+    print("="*50)
+
+    import game_state
+    saved = (dict(game_state.ACTIVE_DUELS), dict(game_state.PENDING_DUELS), dict(game_state.EXPANSION_UNTIL))
+    try:
+        import storage
+        from deadlines import DeadlineScheduler, _now
+        from outbox import flush_replies
+        from state_journal import get_state_journal, journal_duel, journal_pending, journal_expansion
+
+        scheduler = DeadlineScheduler(duel_timeout=60, pending_ttl=30, forfeit=True)
+        get_state_journal().subscribe(scheduler.on_state_changed)
+        now = _now()
+
+        for deadline, key in ((now + 5, "c"), (now + 1, "a"), (now + 3, "b")):
+            scheduler.set("pending", key, deadline)
+        scheduler.set("pending", "a", now + 4)  # moved: the old entry is stale
+        scheduler.cancel("pending", "b")
+        assert scheduler.next_deadline() == now + 4
+        assert scheduler.pop_due(now + 10) == [("pending", "a"), ("pending", "c")]
+        assert len(scheduler) == 0 and scheduler.next_deadline() is None
+        results.add_pass("Heap moves and cancels deadlines lazily")
+
+        bot = AsyncMock()
+        game_state.PENDING_DUELS[(-8, "1")] = "2"
+        journal_pending(-8, "1")
+        game_state.EXPANSION_UNTIL[-8] = now + 100
+        journal_expansion(-8)
+        assert await scheduler.run_due(bot, now=now + 31) == 1
+        assert (-8, "1") not in game_state.PENDING_DUELS and -8 in game_state.EXPANSION_UNTIL
+        assert await scheduler.run_due(bot, now=now + 101) == 1
+        await flush_replies()
+        assert -8 not in game_state.EXPANSION_UNTIL
+        assert "dominio si dissolve" in bot.send_message.call_args.kwargs["text"]
+        results.add_pass("Challenges lapse and domains dissolve with their message")
+
+        scores = storage.load_scores()
+        before = {uid: (scores[uid].duel_wins, scores[uid].duel_losses) if uid in scores else (0, 0)
+                  for uid in ("7101", "7102")}
+        game_state.ACTIVE_DUELS[-9] = {"p1_id": "7101", "p2_id": "7102", "p1_name": "Primo",
+                                       "p2_name": "Secondo", "current_turn": "7102",
+                                       "score": {"7101": 1, "7102": 0}}
+        journal_duel(-9)
+        game_state.ACTIVE_DUELS[-10] = {"p1_id": "7101", "p2_id": "7102", "p1_name": "Primo",
+                                        "p2_name": "Secondo", "current_turn": "7101",
+                                        "score": {"7101": 0, "7102": 0}}
+        journal_duel(-10)
+        game_state.ACTIVE_DUELS[-10]["current_turn"] = "7102"
+        scheduler.set("duel", -10, now + 500)  # a roll re-armed it
+        bot = AsyncMock()
+        assert await scheduler.run_due(bot, now=now + 61) == 1
+        await flush_replies()
+        assert -9 not in game_state.ACTIVE_DUELS and -10 in game_state.ACTIVE_DUELS
+        scores = storage.load_scores()
+        assert scores["7101"].duel_wins == before["7101"][0] + 1
+        assert scores["7102"].duel_losses == before["7102"][1] + 1
+        assert "Secondo" in bot.send_message.call_args.kwargs["text"]
+        results.add_pass("Idle duel is lost by the player on turn, active one kept")
+    except Exception as e:
+        results.add_fail("Deadlines", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        get_state_journal()._listeners.remove(scheduler.on_state_changed)
+        game_state.ACTIVE_DUELS.clear()
+        game_state.PENDING_DUELS.clear()
+        game_state.EXPANSION_UNTIL.clear()
+        game_state.ACTIVE_DUELS.update(saved[0])
+        game_state.PENDING_DUELS.update(saved[1])
+        game_state.EXPANSION_UNTIL.update(saved[2])
+
+    return results
+
+async def test_duel_history():
+    """Test the indexed duel history and its migration"""
+    results = TestResults()
+    print("\n🤺 DUEL HISTORY TESTS")
+    print("="*50)
+
+    try:
+        import tempfile
+        import storage
+        from storage_backends import JsonBackend
+        from duel_history import DuelHistory
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "duels.json")
+            backend = JsonBackend(duels_file=path)
+            backend.append_duel({"p1": "A", "p2": "B", "winner": "A"})
+            backend.save_duels(backend.load_duels() + [{"p1": "C", "p2": "D", "winner": "D"}])
+            backend.append_duel({"p1": "È", "p2": "F", "winner": "F"})
+            with open(path, encoding="utf-8") as f:
+                assert [d["p1"] for d in json.load(f)] == ["A", "C", "È"]
+
+            # a damaged history is moved aside, never overwritten
+            with open(path, "a", encoding="utf-8") as f:
+                f.write('{"p1": "G"')
+            backend.append_duel({"p1": "H", "p2": "I", "winner": "H"})
+            kept = glob.glob(path + ".corrupt-*")
+            assert len(kept) == 1 and '"È"' in open(kept[0], encoding="utf-8").read()
+            assert [d["p1"] for d in backend.load_duels()] == ["H"]
+        results.add_pass("duels.json appended in place, a damaged one kept aside")
+
+        duels = [
+            {"p1": "Anna", "p2": "Bruno", "winner": "Anna"},
+            {"p1": "Anna", "p2": "Gemello", "winner": "Gemello"},
+            {"p1": "Bruno", "p2": "Ignoto", "winner": "Ignoto"},
+        ]
+        users = {"1": "Anna", "2": "Bruno", "3": "Gemello", "4": "Gemello", "_version": 2}
+        assert storage.link_duel_ids(duels, users) == 3
+        assert duels[0] == {"p1": "Anna", "p2": "Bruno", "winner": "Anna",
+                            "p1_id": "1", "p2_id": "2", "winner_id": "1"}
+        assert duels[1]["p1_id"] == "1" and "p2_id" not in duels[1] and "winner_id" not in duels[1]
+        assert duels[2]["p1_id"] == "2" and "winner_id" not in duels[2]
+        results.add_pass("Legacy duels linked to ids by unambiguous name")
+
+        # /importall loads the users first, so the imported duels get their ids
+        from commands_admin import importall_command
+        from outbox import flush_replies
+        saved_users, saved_duels = dict(storage.load_users()), list(storage.load_duels())
+        try:
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, "w") as z:
+                z.writestr("duels.json", json.dumps([{"p1": "Importo", "p2": "Esporto", "winner": "Esporto"}]))
+                z.writestr("users.json", json.dumps({"7251": "Importo", "7252": "Esporto"}))
+            update = MagicMock()
+            update.message.from_user.id = 1234567890
+            update.message.reply_text = AsyncMock()
+            document = MagicMock()
+            document.download_as_bytearray = AsyncMock(return_value=bytearray(buf.getvalue()))
+            update.message.reply_to_message.document.get_file = AsyncMock(return_value=document)
+            await importall_command(update, MagicMock())
+            await flush_replies()
+            assert "Import completo" in update.message.reply_text.call_args.args[0]
+            assert storage.load_duels() == [{"p1": "Importo", "p2": "Esporto", "winner": "Esporto",
+                                             "p1_id": "7251", "p2_id": "7252", "winner_id": "7252"}]
+        finally:
+            storage.save_users(saved_users)
+            storage.save_duels(saved_duels)
+        results.add_pass("/importall links imported duels to the imported users")
+
+        saved = storage._duels
+        try:
+            storage._duels = []
+            history = DuelHistory()
+            for i, winner in enumerate(["7201", "7201", "7202", "7201", "7201", "7201"]):
+                storage.append_duel({"p1": "X", "p2": "Y", "p1_id": "7201", "p2_id": "7202",
+                                     "winner_id": winner, "score1": i, "score2": 0})
+            storage.append_duel({"p1": "X", "p2": "Z", "p1_id": "7201", "p2_id": "7203",
+                                 "winner_id": "7203", "score1": 9, "score2": 9})
+            assert history.record("7201", "7202") == {"wins": 5, "losses": 1, "streak": 3, "best_streak": 3}
+            assert history.record("7201") == {"wins": 5, "losses": 2, "streak": -1, "best_streak": 3}
+            assert [d["score1"] for d in history.head_to_head("7202", "7201", limit=2)] == [5, 4]
+            assert len(history.for_player("7203")) == 1 and history.for_player("9999") == []
+            storage.append_duel({"p1": "Y", "p2": "Z", "p1_id": "7202", "p2_id": "7203", "winner_id": "7202"})
+            assert len(history.for_player("7203")) == 2  # indexed on the next read
+            storage._duels = []  # an import replaced the list
+            assert history.for_player("7201") == []
+            results.add_pass("Per-player and head-to-head queries")
+        finally:
+            storage._duels = saved
+    except Exception as e:
+        results.add_fail("Duel history", e)
+        import traceback
+        traceback.print_exc()
+
+    return results
+
+async def test_ratings():
+    """Test the Elo/Glicko-2 replay of the duel history"""
+    results = TestResults()
+    print("\n📈 RATING TESTS")
+    print("="*50)
+
+    import storage
+    saved = storage._duels
+    try:
+        from ratings import Glicko2Ratings, RatingEngine, GLICKO_SCALE
+
+        # Glickman's worked example: 1500/200 beats 1400/30, loses to 1550/100 and 1700/300
+        glicko = Glicko2Ratings(tau=0.5)
+        glicko.grow(4)
+        for i, (rating, rd) in enumerate([(1500, 200), (1400, 30), (1550, 100), (1700, 300)]):
+            glicko.mu[i], glicko.phi[i], glicko.last[i] = (rating - 1500) / GLICKO_SCALE, rd / GLICKO_SCALE, 0
+        for winner, loser in ((0, 1), (2, 0), (3, 0)):
+            glicko.add(1, winner, loser)
+        rating, rd = glicko.rating(0)
+        assert abs(rating - 1464.06) < 0.05 and abs(rd - 151.52) < 0.05
+        results.add_pass("Glicko-2 matches the reference example")
+
+        def duel(a, b, winner, day):
+            return {"p1": a, "p2": b, "p1_id": a, "p2_id": b, "winner_id": winner,
+                    "timestamp": f"2026-01-{day:02d}T12:00:00+00:00"}
+
+        storage._duels = [duel("a", "b", "a", 1), duel("b", "c", "c", 1), duel("a", "c", "a", 2)]
+        engine = RatingEngine(k=32)
+        elo = engine.elo_ratings()
+        assert abs(sum(elo.values()) - 3000) < 1e-9 and elo["a"] > elo["c"] > elo["b"]
+
+        for day in (3, 4, 5):
+            storage.append_duel(duel("b", "a", "b", day))
+        storage.get_writer().wait()
+        incremental = (engine.elo_ratings(), engine.glicko_of("a"), engine.glicko_of("b"))
+        fresh = RatingEngine(k=32)
+        assert incremental == (fresh.elo_ratings(), fresh.glicko_of("a"), fresh.glicko_of("b"))
+        assert engine.replayed == 6
+        results.add_pass("Appended duels replay incrementally, same as a rebuild")
+
+        storage._duels.append(duel("c", "a", "c", 1))  # backdated, e.g. /addduel of an old duel
+        engine.sync()
+        assert engine.replayed == 7
+        assert engine.elo_ratings() == RatingEngine(k=32).elo_ratings()
+        assert engine.glicko_top(1)[0][0] in ("a", "b", "c")
+        assert RatingEngine(k=64).elo_ratings() != engine.elo_ratings()
+        results.add_pass("Out-of-order history is replayed in time order")
+    except Exception as e:
+        results.add_fail("Ratings", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        storage._duels = saved
+
+    return results
+
+async def test_backup_store():
+    """Test incremental backups, retention and point-in-time restore"""
+    results = TestResults()
+    print("\n📦 BACKUP STORE TESTS")
+    print("="*50)
+
+    try:
+        import tempfile
+        from datetime import datetime, timedelta, timezone
+        from backup_store import BackupStore, split_chunks, CHUNK_MAX
+
+        users = {str(i): {"name": f"Giocatore {i}", "points": i, "streak": 0} for i in range(20000)}
+        data = json.dumps(users, indent=2).encode()
+        chunks = split_chunks(data)
+        assert b"".join(chunks) == data and len(chunks) > 10
+        assert all(len(c) <= CHUNK_MAX for c in split_chunks(b"x" * (3 * CHUNK_MAX)))
+        users["10"]["points"] = 123456789  # longer: everything after it shifts
+        changed = split_chunks(json.dumps(users, indent=2).encode())
+        assert len(set(changed) - set(chunks)) == 1
+        results.add_pass("Content-defined chunks survive a shifting edit")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store = BackupStore(tmp)
+            t0 = datetime(2026, 1, 5, 10, 0, tzinfo=timezone.utc)
+            first = store.create({"scores.json": data, "users.json": b"{}"}, now=t0)
+            full = store.usage()
+            second = store.create({"scores.json": json.dumps(users, indent=2).encode(), "users.json": b"{}"},
+                                  now=t0 + timedelta(hours=1))
+            written = store.load_manifest(second)["written"]
+            assert 0 < written < full / 5
+            assert store.load_manifest(second)["files"]["users.json"] == store.load_manifest(first)["files"]["users.json"]
+            assert store.materialize(first)["scores.json"] == data
+            assert store.at(t0 + timedelta(minutes=30)) == first and store.at(t0 - timedelta(1)) is None
+            results.add_pass("Backups store only changed chunks and restore any point")
+
+            store = BackupStore(os.path.join(tmp, "tiers"))
+            start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+            for hour in range(0, 24 * 70, 3):  # every 3 hours for 10 weeks
+                store.create({"f": str(hour).encode()}, now=start + timedelta(hours=hour))
+            removed, swept = store.prune()
+            kept = store.list()
+            times = [datetime.strptime(b, "%Y-%m-%d_%H-%M-%S") for b in kept]
+            assert removed > 0 and swept == removed and len(kept) <= 24 + 7 + 8 + 1
+            assert len({t.date() for t in times}) >= 7 and len({t.isocalendar()[:2] for t in times}) >= 8
+            assert store.materialize(kept[-1])["f"] == str(24 * 70 - 3).encode()
+            results.add_pass("Tiered retention keeps hourly, daily and weekly backups")
+    except Exception as e:
+        results.add_fail("Backup store", e)
+        import traceback
+        traceback.print_exc()
+
+    return results
+
+async def test_startup_restore():
+    """Test that startup restores only missing or outdated data"""
+    results = TestResults()
+    print("\n♻️ STARTUP RESTORE TESTS")
+    print("="*50)
+
+    import tempfile
+    import storage
+    from storage_backends import JsonBackend
+    tmp = tempfile.mkdtemp(prefix="slotbot-restore-")
+    try:
+        import shutil
+        from datetime import datetime, timedelta, timezone
+        from backup_store import BackupStore
+        from restore import startup_restore, PhaseTimer
+
+        def backend():
+            return JsonBackend(scores_file=os.path.join(tmp, "scores.json"),
+                               users_file=os.path.join(tmp, "users.json"),
+                               duels_file=os.path.join(tmp, "duels.json"),
+                               chat_dir=os.path.join(tmp, "chat_scores"))
+
+        store = BackupStore(os.path.join(tmp, "backup"))
+        taken = datetime.now(timezone.utc) - timedelta(hours=1)
+        backed_up = {"9001": {"name": "Salvato", "points": 50}}
+        store.create({
+            "scores.json": json.dumps(backed_up).encode(),
+            "users.json": json.dumps({"9001": "Salvato"}).encode(),
+            "duels.json": b"[]",
+            "chat_scores/-77.json": json.dumps(backed_up).encode(),
+        }, now=taken)
+
+        storage.set_backend(backend())
+        timer = PhaseTimer("Test")
+        plan = startup_restore(store, timer)
+        assert set(plan) == {"scores.json", "users.json", "duels.json", "chat_scores/-77.json"}
+        storage.set_backend(backend())
+        assert storage.load_scores()["9001"]["points"] == 50
+        assert storage.get_score_store(-77).load()["9001"]["points"] == 50
+        assert "lettura" in timer.report() and "verifica" in timer.report()
+        results.add_pass("Fresh disk restored from the latest backup")
+
+        scores = storage.load_scores()
+        scores["9001"]["points"] = 75  # played after the backup
+        storage.save_scores(scores, "9001")
+        storage.flush_scores()
+        assert startup_restore(store) == {}
+        storage.set_backend(backend())
+        assert storage.load_scores()["9001"]["points"] == 75
+        results.add_pass("Newer local data is left alone")
+
+        old = (taken - timedelta(hours=1)).timestamp()
+        os.utime(os.path.join(tmp, "scores.json"), (old, old))
+        os.remove(os.path.join(tmp, "users.json"))
+        assert startup_restore(store) == {"scores.json": "più vecchio del backup", "users.json": "mancante"}
+        storage.set_backend(backend())
+        assert storage.load_scores()["9001"]["points"] == 50
+        results.add_pass("Older or missing files restored, the rest skipped")
+
+        with open(os.path.join(tmp, "scores.json"), "w", encoding="utf-8") as f:
+            json.dump({"9001": {"name": "Vivo", "points": 1}}, f)
+        os.utime(os.path.join(tmp, "scores.json"), (old, old))
+        for path in glob.glob(os.path.join(tmp, "backup", "objects", "*", "*")):
+            with open(path, "wb") as f:
+                f.write(zlib.compress(b"{rotto"))
+        assert startup_restore(store) == {}
+        storage.set_backend(backend())
+        assert storage.load_scores()["9001"]["name"] == "Vivo"
+        results.add_pass("Damaged backup leaves live data untouched")
+
+        shutil.rmtree(os.path.join(tmp, "backup"))
+        os.makedirs(os.path.join(tmp, "legacy"))
+        zip_path = os.path.join(tmp, "legacy", "backup_2026-01-01_00-00.zip")
+        with zipfile.ZipFile(zip_path, "w") as z:
+            z.writestr("scores.json", json.dumps(backed_up))
+            z.writestr("duels.json", "[]")
+        old = os.path.getmtime(zip_path) - 3600
+        os.utime(os.path.join(tmp, "scores.json"), (old, old))
+        with patch("storage.get_legacy_backups", return_value=[zip_path]):
+            assert set(startup_restore(BackupStore(os.path.join(tmp, "empty")))) == {"scores.json"}
+        storage.set_backend(backend())
+        assert storage.load_scores()["9001"]["name"] == "Salvato"
+        results.add_pass("Old ZIP backups: only the needed entries are read")
+    except Exception as e:
+        results.add_fail("Startup restore", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        storage.set_backend(JsonBackend())
+        import shutil
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return results
+
+async def test_windows():
+    """Test the daily/weekly/monthly boards and their rolling counters"""
+    results = TestResults()
+    print("\n📅 TIME WINDOW TESTS")
+    print("="*50)
+
+    import tempfile
+    tmp = tempfile.mkdtemp(prefix="slotbot-windows-")
+    try:
+        from datetime import datetime, timezone
+        import storage
+        from windows import WindowedStats, RollingCounters, day_number, get_windowed_stats
+
+        counters = RollingCounters()
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+        for day in range(730):  # two years of daily play
+            counters.add(day_number(start) + day, [1, 1, 10, 0, 0, 0])
+        buckets = len(counters.days) + len(counters.weeks) + len(counters.months)
+        assert buckets <= 60, buckets
+        today = day_number(start) + 729
+        assert counters.total(today, 1)[2] == 10 and counters.total(today, 7)[2] == 70
+        assert counters.total(today, 30)[2] == 300
+        assert counters.total(today, 100000)[0] + counters.older[0] == 730
+        results.add_pass("Compaction keeps two years of play in a few dozen buckets")
+
+        stats = WindowedStats(os.path.join(tmp, "windows.json"))
+        now = datetime(2026, 3, 10, 12, tzinfo=timezone.utc).timestamp()
+
+        def roll(user_id, chat_id, ts, won, points, combo):
+            # what handle_dice and the global and chat score stores record
+            stats.record_roll(user_id, chat_id, ts, won=won, combo=combo)
+            stats.record_points(user_id, None, ts, points)
+            stats.record_points(user_id, chat_id, ts, points)
+
+        for _ in range(12):
+            roll("a", -5, now, True, 5, True)
+            roll("b", -5, now - 3 * 86400, False, -1, False)
+        roll("b", -6, now, True, 100, False)
+        stats.record_duel("a", "b", -5, now)
+        assert [r[0] for r in stats.top("points", "oggi", now=now)] == ["b", "a"]
+        assert [r[0] for r in stats.top("points", "oggi", -5, now=now)] == ["a"]
+        assert stats.top("points", "settimana", now=now)[0][1] == 88
+        assert [r[0] for r in stats.top("winrate", "settimana", -5, now=now)] == ["a", "b"]
+        assert stats.totals("b", "settimana", -5, now=now)["duel_losses"] == 1
+        stats.save().result()
+        reloaded = WindowedStats(stats.path)
+        assert reloaded.totals("a", "mese", None, now=now) == stats.totals("a", "mese", None, now=now)
+        results.add_pass("Window totals, boards per chat and persistence")
+
+        from handlers import handle_dice
+        from commands_stats import top_command
+        import game_state
+        game_state.DEBUG_MODE = False
+        update = MagicMock()
+        update.message.from_user.id = 7301
+        update.message.from_user.first_name = "Finestra"
+        update.message.from_user.is_bot = False
+        update.message.chat_id = -7300
+        update.message.chat.type = "group"
+        update.message.message_id = 300
+        update.message.edit_date = None
+        update.message.forward_from = None
+        update.message.forward_from_chat = None
+        update.message.via_bot = None
+        update.message.reply_text = AsyncMock()
+        update.message.dice.emoji = "🎰"
+        update.message.dice.value = 64
+        context = MagicMock()
+        context.bot = AsyncMock()
+        await handle_dice(update, context)
+        totals = get_windowed_stats().totals("7301", "oggi", -7300)
+        assert totals["slots"] == 1 and totals["wins"] == 1 and totals["points"] > 0
+        points = get_windowed_stats().totals("7301", "oggi")["points"]
+        assert points == storage.load_scores()["7301"].points
+
+        # points moved outside the dice handler count too
+        from commands_admin import addpoints_command
+        admin = MagicMock()
+        admin.message.from_user.id = 1234567890
+        admin.message.reply_text = AsyncMock()
+        admin_context = MagicMock()
+        admin_context.args = ["7301", "-40"]
+        await addpoints_command(admin, admin_context)
+        assert get_windowed_stats().totals("7301", "oggi")["points"] == storage.load_scores()["7301"].points
+        assert get_windowed_stats().totals("7301", "oggi", -7300)["points"] == \
+            storage.get_score_store(-7300).load()["7301"].points
+        async with storage.get_score_store().user("7301") as tx:
+            tx.user.points += 1000
+            tx.rollback()
+        assert get_windowed_stats().totals("7301", "oggi")["points"] == storage.load_scores()["7301"].points
+
+        update.message.reply_text = AsyncMock()
+        context.args = ["oggi"]
+        await top_command(update, context)
+        from outbox import flush_replies
+        await flush_replies()
+        text = update.message.reply_text.call_args.args[0]
+        assert "oggi" in text and "Finestra" in text and "questo gruppo" in text
+        results.add_pass("Rolls and every other points change feed the counters, /top oggi reads them")
+    except Exception as e:
+        results.add_fail("Time windows", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        import shutil
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return results
+
+async def test_leaderboard_series():
+    """Test the delta-encoded daily series of the whole leaderboard"""
+    results = TestResults()
+    print("\n📉 LEADERBOARD SERIES TESTS")
+    print("="*50)
+
+    import tempfile
+    import random
+    tmp = tempfile.mkdtemp(prefix="slotbot-series-")
+    try:
+        from datetime import date, timedelta
+        from leaderboard_series import LeaderboardSeries, METRICS
+
+        rng = random.Random(7)
+        path = os.path.join(tmp, "series.bin")
+        series = LeaderboardSeries(path, keyframe_days=7)
+        scores = {str(i): {"name": f"P{i}", "points": rng.randint(0, 5000), "elo": 1000,
+                           "total_slots": 0, "total_wins": 0, "best_streak": 0} for i in range(3000)}
+        scores["_jackpot"] = 5
+        start = date(2026, 1, 1)
+        truth = {}
+        for day in range(20):
+            for uid in rng.sample(range(3000 + day), 40):
+                entry = scores.setdefault(str(uid), {"name": f"P{uid}"})
+                entry["points"] = entry.get("points", 0) + rng.randint(-50, 300)
+                entry["total_slots"] = entry.get("total_slots", 0) + 1
+            series.record(start + timedelta(days=day), scores)
+            truth[day] = {uid: e["points"] for uid, e in scores.items() if isinstance(e, dict)}
+        series.record(start + timedelta(days=19), scores).result()  # same day again
+        full_frame = 3000 * (4 + 8 * len(METRICS))
+        assert os.path.getsize(path) < 3 * full_frame + 20 * 40 * (4 + 8 * len(METRICS)) * 2
+        results.add_pass("Only changed players are stored between key frames")
+
+        reloaded = LeaderboardSeries(path, keyframe_days=7)
+        for day in (0, 6, 7, 13, 19):
+            columns = reloaded.on(start + timedelta(days=day))
+            for uid in ("0", "17", "2999", "3005"):
+                assert columns.value(uid) == truth[day].get(uid), (day, uid)
+        ranked = sorted(truth[10].values(), reverse=True)
+        rank, value = reloaded.rank_on("17", start + timedelta(days=10))
+        assert value == truth[10]["17"] and rank == ranked.index(value) + 1
+        assert reloaded.on(start - timedelta(days=1)) is None
+        assert reloaded.on(start + timedelta(days=30)).value("0") == truth[19]["0"]
+        results.add_pass("Any day's values and ranks, also after reloading")
+
+        moved = reloaded.movers(start + timedelta(days=3), start + timedelta(days=12), limit=5)
+        changes = sorted((abs(truth[12][u] - truth[3].get(u, 0)) for u in truth[12]), reverse=True)
+        assert [abs(r["change"]) for r in moved] == changes[:5]
+        assert all(r["after"] == truth[12][r["user_id"]] for r in moved)
+        results.add_pass("Biggest movers between two days")
+
+        with open(path, "ab") as f:
+            f.write(b"\x40\x00\x00\x00tronco")  # a frame cut short by a crash
+        size = os.path.getsize(path)
+        recovered = LeaderboardSeries(path)
+        assert recovered.on(start + timedelta(days=19)).value("0") == truth[19]["0"]
+        assert os.path.getsize(path) == size - 10
+        try:
+            recovered.record(start, scores)
+            assert False, "a day before the last one must be refused"
+        except ValueError:
+            pass
+        results.add_pass("A truncated last frame is dropped on load")
+    except Exception as e:
+        results.add_fail("Leaderboard series", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        import shutil
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return results
+
+async def test_highlights():
+    """Test the shared, cached highlights of the recap and /highlights"""
+    results = TestResults()
+    print("\n✨ HIGHLIGHTS TESTS")
+    print("="*50)
+
+    import tempfile
+    import storage
+    tmp = tempfile.mkdtemp(prefix="slotbot-highlights-")
+    ids = ("7401", "7402", "7403")
+    try:
+        from datetime import datetime, timedelta, timezone
+        from leaderboard_series import LeaderboardSeries
+        from highlights import HighlightsEngine
+        from models import ensure_user_struct
+
+        series = LeaderboardSeries(os.path.join(tmp, "series.bin"))
+        today = datetime.now(timezone.utc).date()
+        scores = storage.load_scores()
+        for uid, name, points in zip(ids, ("Razzo", "Crollo", "Fermo"), (1, 10**6, 10**6 - 1)):
+            ensure_user_struct(scores, uid, name)
+            scores[uid]["points"] = points
+        storage.save_scores(scores, *ids)
+        series.record(today - timedelta(days=1), scores).result()
+        scores["7401"]["points"] = 2 * 10**6
+        scores["7402"]["points"] = 5
+        storage.save_scores(scores, "7401", "7402")
+
+        with patch("highlights.get_leaderboard_series", return_value=series):
+            engine = HighlightsEngine(top=2, points_threshold=50, movers=2)
+            highlights = engine.compute(today=today)
+            text = engine.format(highlights, "TITOLO")
+            assert highlights.top(1)[0]["user_id"] == "7401" and highlights.top(1)[0]["rank_before"] > 2
+            assert "Razzo entra in top 2 a #1 (era #" in text
+            assert highlights.gainers(1)[0]["user_id"] == "7401" and highlights.losers(1)[0]["user_id"] == "7402"
+            assert "IN SALITA" in text and "IN DISCESA" in text and "TOP 2 OGGI" in text
+            results.add_pass("Ranks joined over the whole population, gainers and losers")
+
+            assert engine.compute(today=today) is highlights and engine.computed == 1
+            scores["7403"]["points"] += 1
+            storage.save_scores(scores, "7403")
+            assert engine.compute(today=today) is not highlights and engine.computed == 2
+            series.record(today, scores).result()
+            engine.compute(today=today)
+            assert engine.computed == 3
+            results.add_pass("Cached per day until a score changes or a day is recorded")
+
+            shard = storage.get_score_store(-7400)
+            shard.save({"7401": {"name": "Razzo", "points": 3}, "7403": {"name": "Fermo", "points": 3}})
+            group = engine.compute(-7400, today=today)
+            assert [r["user_id"] for r in group.top()] == ["7401", "7403"]
+            assert group.top()[1]["rank_before"] == 1
+            assert "Fermo scende a #2" in engine.format(group, "T")
+            quiet = HighlightsEngine(top=1, movers=0)
+            assert "IN SALITA" not in quiet.format(group, "T") and "TOP 1 OGGI" in quiet.format(group, "T")
+            results.add_pass("Group scope ranks the group's players; thresholds configurable")
+    except Exception as e:
+        results.add_fail("Highlights", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        scores = storage.load_scores()
+        for uid in ids:
+            scores.pop(uid, None)
+        storage.save_scores(scores)
+        import shutil
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return results
+
+async def test_render_cache():
+    """Test that /top* replies are reused until their scores change"""
+    results = TestResults()
+    print("\n🗂️ RENDER CACHE TESTS")
+    print("="*50)
+
+    import time
+    import storage
+    try:
+        from render_cache import RenderCache, get_render_cache
+        from commands_stats import top_command, topcombo_command
+        from windows import get_windowed_stats
+        from outbox import flush_replies
+
+        cache = get_render_cache()
+        cache.clear()
+        update = MagicMock()
+        update.message.chat_id = -7500
+        update.message.chat.type = "group"
+        update.message.reply_text = AsyncMock()
+        context = MagicMock()
+        context.args = []
+        shard = storage.get_score_store(-7500)
+        async with shard.user("7501", "Cache") as tx:
+            tx.scores["7501"]["points"] = 40
+
+        async def sent(command, args=()):
+            context.args = list(args)
+            update.message.reply_text.reset_mock()
+            await command(update, context)
+            await flush_replies()
+            return update.message.reply_text.call_args.args[0]
+
+        hits = cache.hits
+        first = await sent(top_command)
+        assert await sent(top_command) == first and cache.hits == hits + 1
+        assert "Cache — 40 punti" in first
+        await sent(topcombo_command)
+        assert cache.hits == hits + 1  # another command, another entry
+        results.add_pass("Repeated /top between rolls is served from the cache")
+
+        async with shard.user("7501") as tx:
+            tx.scores["7501"]["points"] = 55
+        assert "Cache — 55 punti" in await sent(top_command)
+        old = shard.version
+        storage.evict_idle_chats(max_idle=-1)
+        assert storage.get_score_store(-7500).version != old
+        results.add_pass("A score change or a reloaded shard renders again")
+
+        stats = get_windowed_stats()
+        stats.record_points("7501", -7500, time.time(), 9)
+        storage.save_user_name("7501", "Cache")
+        day_text = await sent(top_command, ["oggi"])
+        hits = cache.hits
+        assert await sent(top_command, ["oggi"]) == day_text and cache.hits == hits + 1
+        stats.record_points("7501", -7500, time.time(), 1)
+        assert await sent(top_command, ["oggi"]) != day_text
+        results.add_pass("Time-window boards follow the rolling counters")
+
+        small = RenderCache(max_entries=2)
+        for key in "abc":
+            small.get_or_render(key, 1, lambda: key)
+        assert len(small) == 2 and small.get_or_render("a", 1, lambda: "again") == "again"
+        assert small.get_or_render("a", 2, lambda: "new") == "new"
+        results.add_pass("Least recently used entries are dropped")
+    except Exception as e:
+        results.add_fail("Render cache", e)
+        import traceback
+        traceback.print_exc()
+
+    return results
+
+async def test_roll_history():
+    """Test the per-player roll rings, /storico and the timing check"""
+    results = TestResults()
+    print("\n🎞️ ROLL HISTORY TESTS")
+    print("="*50)
+
+    import tempfile
+    tmp = tempfile.mkdtemp(prefix="slotbot-rolls-")
+    try:
+        from roll_history import RollHistory, RollRing, reels, luck
+        ring = RollRing(256)
+        for i in range(1000):
+            ring.add(i % 64 + 1, 1000.0 + i * 1.5)
+        assert len(ring) == 256
+        assert len(ring.values) + ring.intervals.itemsize * len(ring.intervals) == 256 * 5
+        recent = ring.recent()
+        assert recent[-1] == (1000 % 64, 1000.0 + 999 * 1.5)
+        assert recent[0][0] == (1000 - 256) % 64 + 1
+        assert abs(recent[0][1] - (1000.0 + 744 * 1.5)) < 1e-6
+        assert ring.gaps(3) == [1.5, 1.5, 1.5]
+        results.add_pass("Rings stay at 5 bytes per roll and rebuild the timestamps")
+
+        history = RollHistory(os.path.join(tmp, "roll_history.bin"), capacity=64)
+        for i in range(100):
+            history.record("1", i % 64 + 1, 5000.0 + i * 0.25)
+        history.record("2", 64, 6000.0)
+        history.save().result()
+        reloaded = RollHistory(history.path, capacity=64)
+        assert reloaded.get("1").recent() == history.get("1").recent()
+        assert reloaded.get("2").recent() == [(64, 6000.0)]
+        assert reloaded.get("3") is None
+        results.add_pass("Roll history survives a save and reload")
+
+        assert reels(64) == ("sette", "sette", "sette") and reels(1) == ("bar", "bar", "bar")
+        stats = luck([1, 22, 43, 64, 2, 3, 64])
+        assert stats["wins"] == 5 and stats["jackpots"] == 2
+        assert abs(sum(stats["symbols"].values()) - 1) < 1e-9 and stats["z"] > 2
+        results.add_pass("Reels, wins against the odds and symbol rates")
+
+        import random
+        bot = RollHistory(os.path.join(tmp, "bot.bin"))
+        thumb = RollHistory(os.path.join(tmp, "thumb.bin"))
+        rng = random.Random(3)
+        ts = jittered = 10000.0
+        for _ in range(40):
+            ts += 2.0
+            jittered += rng.uniform(1.0, 6.0)
+            bot.record("9", 5, ts)
+            thumb.record("9", 5, jittered)
+        assert bot.looks_automated("9")["mean"] == 2.0
+        assert thumb.looks_automated("9") is None
+        results.add_pass("Machine-regular roll timing is spotted, human timing is not")
+
+        from handlers import handle_dice
+        from commands_stats import storico_command
+        from roll_history import get_roll_history
+        import game_state
+        game_state.DEBUG_MODE = False
+        update = MagicMock()
+        update.message.from_user.id = 7401
+        update.message.from_user.first_name = "Storico"
+        update.message.from_user.is_bot = False
+        update.message.chat_id = -7400
+        update.message.chat.type = "group"
+        update.message.message_id = 400
+        update.message.edit_date = None
+        update.message.forward_from = None
+        update.message.forward_from_chat = None
+        update.message.via_bot = None
+        update.message.reply_text = AsyncMock()
+        update.message.dice.emoji = "🎰"
+        update.message.dice.value = 64
+        context = MagicMock()
+        context.bot = AsyncMock()
+        await handle_dice(update, context)
+        assert [v for v, _ in get_roll_history().get("7401").recent()] == [64]
+
+        update.message.reply_text = AsyncMock()
+        context.args = []
+        await storico_command(update, context)
+        from outbox import flush_replies
+        await flush_replies()
+        text = update.message.reply_text.call_args.args[0]
+        assert "Storico" in text and "7️⃣7️⃣7️⃣" in text and "Jackpot 777: 1" in text
+
+        update.message.from_user.id = 7402
+        update.message.reply_text = AsyncMock()
+        await storico_command(update, context)
+        await flush_replies()
+        assert "nessun tiro" in update.message.reply_text.call_args.args[0]
+        results.add_pass("Rolls feed the history and /storico shows them")
+    except Exception as e:
+        results.add_fail("Roll history", e)
+        import traceback
+        traceback.print_exc()
+    finally:
+        import shutil
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return results
+
 async def main():
     print("\n" + "="*50)
     print("🧪 SLOTBOT COMPREHENSIVE TEST SUITE")
     print("="*50)
     
     all_results = TestResults()
+
+    # mocked bots answer at once: don't wait on Telegram's flood limits
+    from outbox import reset_outbox
+    from benchmark import UNTHROTTLED
+    reset_outbox(**UNTHROTTLED)
     
     # Run test groups
     import_results = await test_imports()
     logic_results = await test_game_logic()
+    user_stats_results = await test_user_stats()
     command_results = await test_commands()
     dice_results = await test_dice_handler()
+    outbox_results = await test_outbox()
+    event_results = await test_event_log()
+    shard_results = await test_chat_shards()
+    writer_results = await test_storage_writer()
+    pack_results = await test_scorepack()
+    backend_results = await test_storage_backends()
+    leaderboard_results = await test_leaderboard_index()
+    benchmark_results = await test_benchmark()
+    webhook_results = await test_webhook()
+    cluster_results = await test_cluster()
+    journal_results = await test_state_journal()
+    deadline_results = await test_deadlines()
+    duel_history_results = await test_duel_history()
+    rating_results = await test_ratings()
+    backup_results = await test_backup_store()
+    restore_results = await test_startup_restore()
+    window_results = await test_windows()
+    series_results = await test_leaderboard_series()
+    highlights_results = await test_highlights()
+    render_results = await test_render_cache()
+    roll_history_results = await test_roll_history()
     
     # Combine results
-    all_results.passed = (import_results.passed + logic_results.passed + 
-                          command_results.passed + dice_results.passed)
-    all_results.failed = (import_results.failed + logic_results.failed + 
-                          command_results.failed + dice_results.failed)
-    all_results.warnings = (import_results.warnings + logic_results.warnings + 
-                            command_results.warnings + dice_results.warnings)
-    all_results.errors = (import_results.errors + logic_results.errors + 
-                          command_results.errors + dice_results.errors)
+    groups = [import_results, logic_results, user_stats_results, command_results, dice_results,
+              outbox_results, event_results, shard_results, writer_results, pack_results,
+              backend_results, leaderboard_results, benchmark_results, webhook_results,
+              cluster_results, journal_results, deadline_results, duel_history_results,
+              rating_results, backup_results, restore_results, window_results,
+              series_results, highlights_results, render_results, roll_history_results]
+    all_results.passed = sum(r.passed for r in groups)
+    all_results.failed = sum(r.failed for r in groups)
+    all_results.warnings = sum(r.warnings for r in groups)
+    all_results.errors = [e for r in groups for e in r.errors]
     
     # Print summary
     success = all_results.summary()
@@ -503,5 +2256,6 @@ async def main():
         return 1
 
 if __name__ == "__main__":
-    exit_code = asyncio.run(main())
+    with scratch_dir():
+        exit_code = asyncio.run(main())
     sys.exit(exit_code)
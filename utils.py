@@ -21,6 +21,11 @@ def is_expansion_active(chat_id: int) -> bool:
     return game_state.EXPANSION_UNTIL.get(chat_id, 0) > now_ts
 
 
+def msg_dominio_dissolto() -> str:
+    """Domain expansion end message"""
+    return "🌌 *Il dominio si dissolve.*\nLa realtà torna stabile."
+
+
 def msg_vittoria(nome: str, jackpot: bool) -> str:
     """Victory message"""
     if jackpot:
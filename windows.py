@@ -0,0 +1,236 @@
+"""
+Windowed stats - per-user rolling counters for the daily, weekly and
+monthly leaderboards
+
+Every roll and duel result adds to the player's bucket of the current UTC
+day, globally and in the chat's scope: slots, wins, combos, duel wins and
+losses. Points come from the score stores instead: every committed change
+of an entry's points (rolls, lottery, events, admin edits) is added to the
+scope of the store it happened in, so /top oggi|settimana|mese add up to
+the same points as /top. A window (oggi, settimana, mese, anno) is the sum of
+the buckets it covers, so /top oggi never reads the event log or the
+snapshots.
+
+Day buckets older than WINDOW_KEEP_DAYS are folded into weekly buckets,
+weeks older than WINDOW_KEEP_WEEKS into monthly ones, months older than
+WINDOW_KEEP_MONTHS into a single all-time remainder: a player costs at most
+about sixty buckets per scope, however long they have been playing.
+
+The counters are kept in memory and saved to WINDOWS_FILE (on the storage
+writer thread) every few minutes and at shutdown.
+"""
+import json
+import os
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from config import WINDOWS_FILE, WINDOW_KEEP_DAYS, WINDOW_KEEP_WEEKS, WINDOW_KEEP_MONTHS
+from storage_writer import get_writer
+from storage_backends import write_json_atomic
+
+FIELDS = ("slots", "wins", "points", "combos", "duel_wins", "duel_losses")
+SLOTS, WINS, POINTS, COMBOS, DUEL_WINS, DUEL_LOSSES = range(len(FIELDS))
+
+# window argument -> days it covers, today included
+WINDOWS = {"oggi": 1, "settimana": 7, "mese": 30, "anno": 365}
+
+# Minimum slots in the window before a player shows up in the winrate board
+WINDOW_WINRATE_MIN_SLOTS = 10
+
+_EPOCH = date(1970, 1, 1)
+
+
+def day_number(ts: float) -> int:
+    """UTC day of a timestamp, counted from 1970-01-01"""
+    return int(ts // 86400)
+
+
+def _week_of(day: int) -> int:
+    return day // 7
+
+
+def _month_of(day: int) -> int:
+    d = _EPOCH + timedelta(days=day)
+    return d.year * 12 + d.month - 1
+
+
+def _month_start(month: int) -> int:
+    return (date(month // 12, month % 12 + 1, 1) - _EPOCH).days
+
+
+def _add(target: List[int], values: List[int]) -> None:
+    for i, value in enumerate(values):
+        target[i] += value
+
+
+class RollingCounters:
+    """One player's counters in one scope: day, week and month buckets"""
+
+    __slots__ = ("days", "weeks", "months", "older", "compacted")
+
+    def __init__(self):
+        self.days: Dict[int, List[int]] = {}
+        self.weeks: Dict[int, List[int]] = {}
+        self.months: Dict[int, List[int]] = {}
+        self.older = [0] * len(FIELDS)
+        # day of the last compaction (it only has work to do once a day)
+        self.compacted = -1
+
+    def add(self, day: int, values: List[int]) -> None:
+        bucket = self.days.get(day)
+        if bucket is None:
+            bucket = self.days[day] = [0] * len(FIELDS)
+            if day > self.compacted:
+                self.compact(day)
+        _add(bucket, values)
+
+    def compact(self, today: int) -> None:
+        """Fold buckets that fell out of their tier into the next coarser one"""
+        self.compacted = today
+        for day in [d for d in self.days if d <= today - WINDOW_KEEP_DAYS]:
+            _add(self.weeks.setdefault(_week_of(day), [0] * len(FIELDS)), self.days.pop(day))
+        this_week = _week_of(today)
+        for week in [w for w in self.weeks if w <= this_week - WINDOW_KEEP_WEEKS]:
+            _add(self.months.setdefault(_month_of(week * 7), [0] * len(FIELDS)), self.weeks.pop(week))
+        this_month = _month_of(today)
+        for month in [m for m in self.months if m <= this_month - WINDOW_KEEP_MONTHS]:
+            _add(self.older, self.months.pop(month))
+
+    def total(self, today: int, days: int) -> List[int]:
+        """Sum of the buckets inside the last ``days`` days (coarse buckets
+        count when they start inside the window)"""
+        first = today - days + 1
+        totals = [0] * len(FIELDS)
+        for day, bucket in self.days.items():
+            if first <= day <= today:
+                _add(totals, bucket)
+        if first <= today - WINDOW_KEEP_DAYS:
+            for week, bucket in self.weeks.items():
+                if week * 7 >= first:
+                    _add(totals, bucket)
+            for month, bucket in self.months.items():
+                if _month_start(month) >= first:
+                    _add(totals, bucket)
+        return totals
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Copy for saving (the writer thread serializes it while rolls go on)"""
+        return {
+            "d": {k: list(v) for k, v in self.days.items()},
+            "w": {k: list(v) for k, v in self.weeks.items()},
+            "m": {k: list(v) for k, v in self.months.items()},
+            "o": list(self.older),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RollingCounters":
+        counters = cls()
+        counters.days = {int(k): list(v) for k, v in data.get("d", {}).items()}
+        counters.weeks = {int(k): list(v) for k, v in data.get("w", {}).items()}
+        counters.months = {int(k): list(v) for k, v in data.get("m", {}).items()}
+        counters.older = list(data.get("o", counters.older))
+        return counters
+
+
+def window_value(metric: str, totals: List[int]) -> Optional[float]:
+    """What a board ranks by, or None when the player is not on it"""
+    if metric == "points":
+        return totals[POINTS] or None
+    if metric == "combo":
+        return totals[COMBOS] or None
+    if metric == "winrate":
+        if totals[SLOTS] < WINDOW_WINRATE_MIN_SLOTS:
+            return None
+        return totals[WINS] / totals[SLOTS]
+    raise ValueError(f"Unknown window metric: {metric}")
+
+
+class WindowedStats:
+    """Rolling counters of every player, globally (scope None) and per chat"""
+
+    def __init__(self, path: str = WINDOWS_FILE):
+        self.path = path
+        self._scopes: Optional[Dict[Optional[int], Dict[str, RollingCounters]]] = None
+        # bumped on every recorded roll or duel (see render_cache.py)
+        self.version = 0
+
+    def _load(self) -> Dict[Optional[int], Dict[str, RollingCounters]]:
+        if self._scopes is None:
+            self._scopes = {None: {}}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    for scope, users in data.items():
+                        key = None if scope == "global" else int(scope)
+                        self._scopes[key] = {uid: RollingCounters.from_dict(c) for uid, c in users.items()}
+                except (OSError, ValueError) as e:
+                    print(f"⚠️ {self.path} illeggibile, contatori ripartono da zero: {e}", flush=True)
+        return self._scopes
+
+    def _record(self, user_id: str, scopes: Tuple[Optional[int], ...], ts: float, values: List[int]) -> None:
+        loaded = self._load()
+        self.version += 1
+        day = day_number(ts)
+        for scope in scopes:
+            users = loaded.setdefault(scope, {})
+            counters = users.get(user_id)
+            if counters is None:
+                counters = users[user_id] = RollingCounters()
+            counters.add(day, values)
+
+    def _scopes_of(self, chat_id: Optional[int]) -> Tuple[Optional[int], ...]:
+        return (None, chat_id) if chat_id is not None else (None,)
+
+    def record_roll(self, user_id: str, chat_id: Optional[int], ts: float,
+                    won: bool, combo: bool) -> None:
+        self._record(user_id, self._scopes_of(chat_id), ts, [1, int(won), 0, int(combo), 0, 0])
+
+    def record_points(self, user_id: str, scope: Optional[int], ts: float, points: int) -> None:
+        """Points won or lost in one scope only (global for None): the score
+        store of that scope reports each committed change"""
+        self._record(user_id, (scope,), ts, [0, 0, points, 0, 0, 0])
+
+    def record_duel(self, winner_id: str, loser_id: str, chat_id: Optional[int], ts: float) -> None:
+        self._record(winner_id, self._scopes_of(chat_id), ts, [0, 0, 0, 0, 1, 0])
+        self._record(loser_id, self._scopes_of(chat_id), ts, [0, 0, 0, 0, 0, 1])
+
+    def totals(self, user_id: str, window: str, chat_id: Optional[int] = None,
+               now: Optional[float] = None) -> Dict[str, int]:
+        """One player's counters over a window"""
+        today = day_number(now if now is not None else datetime.now(timezone.utc).timestamp())
+        counters = self._load().get(chat_id, {}).get(user_id)
+        totals = counters.total(today, WINDOWS[window]) if counters else [0] * len(FIELDS)
+        return dict(zip(FIELDS, totals))
+
+    def top(self, metric: str, window: str, chat_id: Optional[int] = None, limit: int = 10,
+            now: Optional[float] = None) -> List[Tuple[str, float, Dict[str, int]]]:
+        """Best (user_id, value, totals) of a board over a window"""
+        today = day_number(now if now is not None else datetime.now(timezone.utc).timestamp())
+        days = WINDOWS[window]
+        rows = []
+        for user_id, counters in self._load().get(chat_id, {}).items():
+            totals = counters.total(today, days)
+            value = window_value(metric, totals)
+            if value is not None:
+                rows.append((user_id, value, dict(zip(FIELDS, totals))))
+        rows.sort(key=lambda r: (-r[1], r[0]))
+        return rows[:limit]
+
+    def save(self) -> Optional[Future]:
+        """Write the counters to disk on the writer thread"""
+        if self._scopes is None:
+            return None
+        data = {
+            "global" if scope is None else str(scope): {uid: c.to_dict() for uid, c in users.items()}
+            for scope, users in self._scopes.items()
+        }
+        return get_writer().submit(write_json_atomic, self.path, data)
+
+
+_windowed = WindowedStats()
+
+
+def get_windowed_stats() -> WindowedStats:
+    """Return the process-wide rolling counters"""
+    return _windowed